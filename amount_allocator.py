@@ -0,0 +1,179 @@
+"""
+Уникальные суммы для платежей на общий кошелек
+
+Все покупатели получают один активный кошелек, поэтому два платежа на
+одинаковую цену различаются только суммой: к базовой сумме добавляется
+суффикс в микро-USDT (base + suffix * AMOUNT_SUFFIX_STEP). Занятые
+суффиксы хранятся битовой картой на (кошелек, базовая сумма), поиск
+свободного - младший нулевой бит. Резерв действует AMOUNT_RESERVATION_TTL
+секунд и освобождается при истечении.
+
+Резервы записываются в amount_reservations: уникальный индекс по
+(кошелек, сумма) не дает двум процессам выдать одну сумму, а проверка
+платежа - один поиск точной суммы без запросов по отправителю.
+"""
+
+import heapq
+import logging
+import secrets
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+USDT_UNITS = 1000000  # USDT имеет 6 знаков
+
+
+def to_units(amount: float) -> int:
+    """Сумма USDT -> микро-USDT"""
+    return round(amount * USDT_UNITS)
+
+
+class AmountAllocationError(Exception):
+    """Свободных уникальных сумм для базовой суммы не осталось"""
+
+
+class AmountAllocator:
+    """Выдача и освобождение уникальных сумм по кошельку"""
+
+    def __init__(self, db: Database, slots: int = None, step_units: int = None, ttl: float = None):
+        self.db = db
+        self.slots = slots if slots is not None else config.AMOUNT_SUFFIX_SLOTS
+        self.step_units = step_units if step_units is not None else config.AMOUNT_SUFFIX_STEP
+        self.ttl = ttl if ttl is not None else config.AMOUNT_RESERVATION_TTL
+        self._lock = threading.Lock()
+        # (кошелек, базовая сумма) -> битовая карта суффиксов (бит i - суффикс i + 1)
+        self._bitmaps: Dict[Tuple[str, int], int] = {}
+        # (кошелек, точная сумма) -> резерв
+        self._reserved: Dict[Tuple[str, int], Dict] = {}
+        # (expires_at, id, кошелек, сумма) - очередь истечения
+        self._expiry: List[Tuple] = []
+        self.allocated_total = 0
+        self.released_total = 0
+
+    def _track(self, reservation: Dict):
+        wallet, units = reservation['wallet_address'], reservation['amount_units']
+        suffix = (units - reservation['base_units']) // self.step_units
+        if 1 <= suffix <= self.slots:
+            key = (wallet, reservation['base_units'])
+            self._bitmaps[key] = self._bitmaps.get(key, 0) | (1 << (suffix - 1))
+        self._reserved[(wallet, units)] = reservation
+        heapq.heappush(self._expiry, (reservation['expires_at'], reservation['id'], wallet, units))
+
+    def _untrack(self, wallet: str, units: int) -> Optional[Dict]:
+        reservation = self._reserved.pop((wallet, units), None)
+        if reservation is None:
+            return None
+        key = (wallet, reservation['base_units'])
+        suffix = (units - reservation['base_units']) // self.step_units
+        if key in self._bitmaps and 1 <= suffix <= self.slots:
+            self._bitmaps[key] &= ~(1 << (suffix - 1))
+            if not self._bitmaps[key]:
+                del self._bitmaps[key]
+        return reservation
+
+    def load(self) -> int:
+        """Загрузить неистекшие резервы из базы (истекшие сразу освобождаются)"""
+        with self._lock:
+            self._bitmaps.clear()
+            self._reserved.clear()
+            self._expiry = []
+            for reservation in self.db.get_live_amount_reservations():
+                self._track(reservation)
+        self.release_expired()
+        return len(self._reserved)
+
+    def allocate(self, wallet_address: str, base_amount: float, reference: str = None,
+                 user_wallet: str = None) -> Dict:
+        """
+        Зарезервировать уникальную сумму для платежа
+
+        Возвращает резерв: amount (сумма к оплате), amount_units, reference,
+        expires_at. Поднимает AmountAllocationError, если суффиксы кончились.
+        """
+        self.release_expired()
+        base_units = to_units(base_amount)
+        reference = reference or secrets.token_urlsafe(12)
+        key = (wallet_address, base_units)
+
+        with self._lock:
+            # Биты, занятые суммами других базовых сумм или другим процессом
+            skipped = 0
+            while True:
+                mask = self._bitmaps.get(key, 0) | skipped
+                free = ~mask & (mask + 1)
+                suffix = free.bit_length()
+                if suffix > self.slots:
+                    raise AmountAllocationError(
+                        f"Нет свободных сумм для {base_amount} на кошельке {wallet_address}")
+                units = base_units + suffix * self.step_units
+                if (wallet_address, units) in self._reserved:
+                    skipped |= free
+                    continue
+
+                now = time.time()
+                reservation = {
+                    'wallet_address': wallet_address,
+                    'amount_units': units,
+                    'base_units': base_units,
+                    'reference': reference,
+                    'user_wallet': user_wallet,
+                    'created_at': now,
+                    'expires_at': now + self.ttl,
+                    'status': 'reserved',
+                }
+                reservation_id = self.db.add_amount_reservation(
+                    wallet_address, units, base_units, reference, user_wallet, now, now + self.ttl)
+                if reservation_id is None:
+                    skipped |= free
+                    continue
+
+                reservation['id'] = reservation_id
+                self._track(reservation)
+                self.allocated_total += 1
+                break
+
+        return dict(reservation, amount=units / USDT_UNITS)
+
+    def lookup(self, wallet_address: str, amount: float) -> Optional[Dict]:
+        """Резерв точной суммы на кошельке"""
+        with self._lock:
+            return self._reserved.get((wallet_address, to_units(amount)))
+
+    def release(self, wallet_address: str, amount: float) -> Optional[Dict]:
+        """Освободить сумму (платеж отменен); резерв помечается 'expired'"""
+        with self._lock:
+            reservation = self._untrack(wallet_address, to_units(amount))
+        if reservation:
+            self.db.set_amount_reservations_status([reservation['id']], 'expired')
+            self.released_total += 1
+        return reservation
+
+    def release_expired(self, now: float = None) -> List[Dict]:
+        """Освободить резервы с истекшим сроком одной пачкой"""
+        now = time.time() if now is None else now
+        released = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, reservation_id, wallet, units = heapq.heappop(self._expiry)
+                current = self._reserved.get((wallet, units))
+                if current is not None and current['id'] == reservation_id:
+                    released.append(self._untrack(wallet, units))
+        if released:
+            self.db.set_amount_reservations_status([r['id'] for r in released], 'expired')
+            self.released_total += len(released)
+            logger.info(f"Освобождено {len(released)} истекших сумм")
+        return released
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'reserved': len(self._reserved),
+                'bases': len(self._bitmaps),
+                'allocated_total': self.allocated_total,
+                'released_total': self.released_total,
+            }
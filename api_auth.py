@@ -0,0 +1,160 @@
+"""
+Проверка API ключей для всех сервисов
+
+В базе хранится только хеш ключа (hash_api_key). Результат проверки
+кешируется в процессе: действующий ключ на API_KEY_CACHE_TTL секунд,
+неизвестный - на API_KEY_NEGATIVE_TTL (перебор ключей не нагружает
+базу). Кеш ограничен API_KEY_CACHE_SIZE записями и вытесняет давно не
+использованные. Отзыв ключа поднимает версию 'api_keys' в базе; процессы
+сверяют ее не чаще раза в API_KEY_VERSION_CHECK_INTERVAL и при смене
+сбрасывают кеш, так что отзыв доходит до всех воркеров за это время.
+Счетчики использования копятся в памяти и записываются пачкой раз в
+API_KEY_USAGE_FLUSH_INTERVAL, а не на каждый запрос.
+"""
+
+import asyncio
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import config
+from database import API_KEY_SCOPE_USER, Database, hash_api_key
+
+logger = logging.getLogger(__name__)
+
+
+class ApiKeyAuth:
+    """Хранилище хешей API ключей с кешем, отзывом по версии и счетчиками использования"""
+
+    def __init__(self, db: Database, cache_size: int = None, ttl: float = None, negative_ttl: float = None,
+                 version_check_interval: float = None, flush_interval: float = None):
+        """
+        Args:
+            cache_size: Максимум ключей (и неверных, и действующих) в кеше
+            ttl: Сколько секунд действующий ключ не перепроверяется в базе
+            negative_ttl: Сколько секунд помнится неверный ключ
+            version_check_interval: Как часто сверять версию ключей в базе, секунды
+            flush_interval: Как часто записывать счетчики использования, секунды
+        """
+        self.db = db
+        self.cache_size = cache_size or config.API_KEY_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else config.API_KEY_CACHE_TTL
+        self.negative_ttl = negative_ttl if negative_ttl is not None else config.API_KEY_NEGATIVE_TTL
+        self.version_check_interval = (version_check_interval if version_check_interval is not None
+                                       else config.API_KEY_VERSION_CHECK_INTERVAL)
+        self.flush_interval = flush_interval if flush_interval is not None else config.API_KEY_USAGE_FLUSH_INTERVAL
+
+        self._lock = threading.Lock()
+        # хеш ключа -> (данные ключа или None для неверного, истекает)
+        self._cache: OrderedDict = OrderedDict()
+        self._version: Optional[int] = None
+        self._version_checked = 0.0
+        # хеш ключа -> (запросов, время последнего) до записи в базу
+        self._usage: Dict[str, Tuple[int, float]] = {}
+        self.counters = {'hits': 0, 'negative_hits': 0, 'lookups': 0, 'rejected': 0,
+                         'invalidations': 0, 'flushes': 0}
+
+    def _check_version(self, now: float):
+        """Сбросить кеш, если версия ключей в базе сменилась (не чаще version_check_interval)"""
+        if now - self._version_checked < self.version_check_interval:
+            return
+        version = self.db.get_version('api_keys')
+        with self._lock:
+            self._version_checked = now
+            if self._version is not None and version != self._version:
+                self._cache.clear()
+                self.counters['invalidations'] += 1
+            self._version = version
+
+    def authenticate(self, api_key: str) -> Optional[Dict]:
+        """Данные ключа {'key_id': хеш, 'user_id', 'scope'} или None для неверного/отозванного"""
+        key_id = hash_api_key(api_key)
+        now = time.time()
+        self._check_version(now)
+
+        with self._lock:
+            cached = self._cache.get(key_id)
+            if cached and cached[1] > now:
+                self._cache.move_to_end(key_id)
+                principal = cached[0]
+                if principal is None:
+                    self.counters['negative_hits'] += 1
+                    self.counters['rejected'] += 1
+                    return None
+                self.counters['hits'] += 1
+                self._record_usage(key_id, now)
+                return principal
+
+        record = self.db.get_api_key_principal(key_id)
+        principal = dict(record, key_id=key_id) if record is not None else None
+        with self._lock:
+            self.counters['lookups'] += 1
+            self._cache[key_id] = (principal, now + (self.ttl if principal else self.negative_ttl))
+            self._cache.move_to_end(key_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            if principal is None:
+                self.counters['rejected'] += 1
+                return None
+            self._record_usage(key_id, now)
+        return principal
+
+    def _record_usage(self, key_id: str, now: float):
+        """Учесть запрос по ключу в памяти (под self._lock)"""
+        count, _ = self._usage.get(key_id, (0, now))
+        self._usage[key_id] = (count + 1, now)
+
+    def create_key(self, user_id: int = 0, scope: str = API_KEY_SCOPE_USER) -> str:
+        """Выпустить новый ключ; в базе остается только хеш, сам ключ возвращается один раз"""
+        api_key = secrets.token_urlsafe(32)
+        key_id = self.db.add_api_key(api_key, user_id, scope)
+        with self._lock:
+            self._cache.pop(key_id, None)
+        return api_key
+
+    def revoke(self, key_id: str) -> bool:
+        """Отозвать ключ по хешу: сразу в этом процессе, в остальных - при сверке версии"""
+        revoked = self.db.revoke_api_key(key_id)
+        with self._lock:
+            self._cache.pop(key_id, None)
+        return revoked
+
+    def flush_usage(self) -> int:
+        """Записать накопленные счетчики использования одной транзакцией; возвращает число ключей"""
+        with self._lock:
+            usage, self._usage = self._usage, {}
+        if not usage:
+            return 0
+        try:
+            self.db.add_api_key_usage(usage)
+        except Exception:
+            # Вернуть счетчики, чтобы не потерять их при следующей записи
+            with self._lock:
+                for key_id, (count, last_used) in usage.items():
+                    pending, pending_last = self._usage.get(key_id, (0, 0))
+                    self._usage[key_id] = (pending + count, max(last_used, pending_last))
+            raise
+        with self._lock:
+            self.counters['flushes'] += 1
+        return len(usage)
+
+    async def run(self):
+        """Фоновая запись счетчиков использования (при остановке сервиса - flush_usage())"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await loop.run_in_executor(None, self.flush_usage)
+            except Exception as e:
+                logger.error(f"Ошибка записи использования API ключей: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats['cached'] = len(self._cache)
+            stats['version'] = self._version
+            stats['pending_usage'] = len(self._usage)
+        return stats
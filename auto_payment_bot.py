@@ -10,6 +10,8 @@ from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
 from database import Database
 from tron_tracker import TronTracker
+from chain_ledger import ChainLedger
+from confirmation_pipeline import ConfirmationPipeline
 import config
 
 # Настройка логирования
@@ -23,6 +25,10 @@ class AutoPaymentBot:
     def __init__(self):
         self.db = Database()
         self.tron_tracker = TronTracker()
+        # Зачисление только после CONFIRMATION_BLOCKS блоков
+        self.confirmations = ConfirmationPipeline(self.db, self.tron_tracker)
+        # Журнал зачислений с хешем блока, откат при реорганизации
+        self.ledger = ChainLedger(self.db, self.tron_tracker)
         self.application = None
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -216,48 +222,68 @@ class AutoPaymentBot:
             users = cursor.fetchall()
             conn.close()
             
+            # Новый цикл опроса - бюджет повторов Tron API восстанавливается
+            self.tron_tracker.start_cycle()
+
             for user_id, wallet_address in users:
                 try:
-                    # Получаем новые транзакции
+                    # Новые транзакции ждут подтверждений в состоянии 'seen'
                     new_transfers = self.tron_tracker.get_new_transfers(wallet_address)
-                    
-                    for transfer in new_transfers:
-                        # Проверяем, не обработан ли уже этот платеж
-                        conn = self.db.get_connection()
-                        cursor = conn.cursor()
-                        cursor.execute('''
-                            SELECT COUNT(*) FROM confirmed_payments 
-                            WHERE transaction_hash = ?
-                        ''', (transfer['tx_hash'],))
-                        already_processed = cursor.fetchone()[0] > 0
-                        conn.close()
-                        
-                        if not already_processed:
-                            # Автоматически зачисляем платеж
-                            self.db.confirm_payment(
-                                user_id,
-                                transfer['amount'],
-                                'USDT',
-                                transfer['tx_hash'],
-                                wallet_address
-                            )
-                            
-                            # Отправляем уведомление пользователю
-                            try:
-                                await context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=f"🎉 Получен автоматический платеж!\n\n"
-                                         f"💰 Сумма: {transfer['amount']:.2f} USDT\n"
-                                         f"🔗 Транзакция: `{transfer['tx_hash']}`\n"
-                                         f"📱 Кошелек: `{wallet_address}`\n\n"
-                                         f"✅ Платеж автоматически зачислен!",
-                                    parse_mode='Markdown'
-                                )
-                            except Exception as e:
-                                logger.error(f"Ошибка отправки уведомления: {e}")
+                    self.confirmations.observe(user_id, wallet_address, new_transfers)
                 
                 except Exception as e:
                     logger.error(f"Ошибка обработки платежей для пользователя {user_id}: {e}")
+            
+            # Один запрос текущего блока на цикл, подтвержденные зачисляются пачкой
+            credited = []
+            for transfer in self.confirmations.promote():
+                user_id = transfer['user_id']
+                wallet_address = transfer['wallet_address']
+                try:
+                    # Проверяем, не обработан ли уже этот платеж
+                    if self.db.is_transaction_confirmed(transfer['tx_hash']):
+                        continue
+                    
+                    # Автоматически зачисляем платеж
+                    if not self.db.confirm_payment(
+                        user_id,
+                        transfer['amount'],
+                        'USDT',
+                        transfer['tx_hash'],
+                        wallet_address
+                    ):
+                        # Кошелек не привязан к пользователю: перевод отклонен, не зачислен
+                        continue
+                    credited.append(transfer)
+                    
+                    # Отправляем уведомление пользователю
+                    try:
+                        await context.bot.send_message(
+                            chat_id=user_id,
+                            text=f"🎉 Получен автоматический платеж!\n\n"
+                                 f"💰 Сумма: {transfer['amount']:.2f} USDT\n"
+                                 f"🔗 Транзакция: `{transfer['tx_hash']}`\n"
+                                 f"📱 Кошелек: `{wallet_address}`\n\n"
+                                 f"✅ Платеж автоматически зачислен!",
+                            parse_mode='Markdown'
+                        )
+                    except Exception as e:
+                        logger.error(f"Ошибка отправки уведомления: {e}")
+                
+                except Exception as e:
+                    logger.error(f"Ошибка зачисления платежа {transfer['tx_hash']}: {e}")
+            
+            # Запись зачислений в журнал и откат зачислений из сиротских блоков
+            for credit in self.ledger.sync(credited):
+                try:
+                    await context.bot.send_message(
+                        chat_id=credit['user_id'],
+                        text=f"⚠️ Платеж {credit['amount']:.2f} USDT отменен: блок с транзакцией "
+                             f"`{credit['tx_hash']}` не вошел в основную цепочку сети",
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка отправки уведомления об откате: {e}")
                     
         except Exception as e:
             logger.error(f"Ошибка в задаче проверки платежей: {e}")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк пакетного декодера TRC20 на большом синтетическом корпусе
+
+Сравнивает построчный разбор hex строк (как в parse_trc20_transfer до
+появления trc20_decoder) с пакетным декодированием.
+
+Запуск: python bench_trc20_decoder.py [количество_вызовов]
+"""
+
+import random
+import sys
+import time
+
+from trc20_decoder import (
+    decode_calls, decode_event_logs, np,
+    SELECTOR_TRANSFER, SELECTOR_TRANSFER_FROM, TRANSFER_EVENT_TOPIC
+)
+
+
+def build_corpus(size: int, seed: int = 42):
+    """Синтетический корпус: 70% transfer, 20% transferFrom, 10% прочие вызовы"""
+    rng = random.Random(seed)
+    # Ограниченный набор адресов, как в реальном потоке платежей
+    addresses = [rng.randbytes(20) for _ in range(5000)]
+
+    def word_address():
+        return bytes(12) + rng.choice(addresses)
+
+    def word_amount():
+        return rng.randint(1, 10 ** 12).to_bytes(32, 'big')
+
+    calls = []
+    for _ in range(size):
+        roll = rng.random()
+        if roll < 0.7:
+            data = SELECTOR_TRANSFER + word_address() + word_amount()
+        elif roll < 0.9:
+            data = SELECTOR_TRANSFER_FROM + word_address() + word_address() + word_amount()
+        else:
+            data = bytes.fromhex('095ea7b3') + word_address() + word_amount()  # approve
+        calls.append(data.hex())
+
+    logs = []
+    for _ in range(size // 2):
+        logs.append({
+            'topics': [TRANSFER_EVENT_TOPIC.hex(), word_address().hex(), word_address().hex()],
+            'data': word_amount().hex(),
+        })
+    return calls, logs
+
+
+def naive_decode(calls):
+    """Построчный разбор строк, как раньше в TronTracker.parse_trc20_transfer"""
+    result = {}
+    for position, data in enumerate(calls):
+        method = data[:8]
+        if method == 'a9059cbb':
+            result[position] = ('41' + data[32:72], int(data[72:136], 16))
+        elif method == '23b872dd':
+            result[position] = ('41' + data[96:136], int(data[136:200], 16))
+    return result
+
+
+def measure(name: str, func, rows: int):
+    """Замер одного варианта"""
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    print(f"   {name:<38} {elapsed * 1000:8.1f} мс   {rows / elapsed:12,.0f} вызовов/с")
+    return result
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    print("📊 БЕНЧМАРК ДЕКОДЕРА TRC20")
+    print("=" * 70)
+    print(f"   Вызовов: {size:,}, логов событий: {size // 2:,}, numpy: {'да' if np is not None else 'нет'}")
+    calls, logs = build_corpus(size)
+    call_bytes = [bytes.fromhex(call) for call in calls]
+    print()
+
+    naive = measure("построчно (hex строки)", lambda: naive_decode(calls), size)
+    batch = measure("пакетно (hex строки)", lambda: decode_calls(calls), size)
+    measure("пакетно (bytes)", lambda: decode_calls(call_bytes), size)
+    measure("пакетно + base58 адреса", lambda: list(decode_calls(calls).rows()), size)
+    events = measure("события Transfer пакетно", lambda: decode_event_logs(logs), size // 2)
+
+    assert {i: amount for i, (_, amount) in naive.items()} == dict(zip(batch.index, batch.amount))
+    assert len(events) == len(logs)
+    print()
+    print(f"✅ Результаты совпадают: {len(batch):,} переводов, пропущено {batch.skipped:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк цикла проверки платежей на локальном фейковом Tron API
+
+Поднимает FakeTronServer с синтетической цепочкой, направляет на него
+TronTracker и в течение заданного времени опрашивает кошельки так же,
+как check_payments_task ботов (get_new_transfers по каждому кошельку).
+Во время опроса в цепочку добавляются контрольные переводы, для них
+измеряется задержка обнаружения: от отправки до появления в результате
+опроса.
+
+Запуск: python bench_tron_pipeline.py --wallets 50 --duration 20 --rate-429 0.02
+"""
+
+import argparse
+import random
+import statistics
+import threading
+import time
+
+from fake_tron_server import FakeTronServer, SyntheticChain, random_address
+from request_coalescer import RequestCoalescer
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID, KIND_TRONSCAN
+from tron_tracker import TronTracker
+
+
+def percentile(values, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def build_tracker(url: str, coalesce_ttl: float, hedge_delay: float) -> TronTracker:
+    """TronTracker, у которого оба провайдера смотрят на фейковый сервер"""
+    router = ProviderRouter(
+        [TronProvider('trongrid', url, KIND_TRONGRID, timeout=5),
+         TronProvider('tronscan', url, KIND_TRONSCAN, timeout=5)],
+        hedge_delay=hedge_delay
+    )
+    return TronTracker(router=router, coalescer=RequestCoalescer(ttl=coalesce_ttl))
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    wallets = [random_address(rng) for _ in range(args.wallets)]
+    chain = SyntheticChain(wallets=wallets, rate=args.rate,
+                           block_interval=args.block_interval, seed=args.seed)
+    server = FakeTronServer(chain, latency=args.latency, latency_jitter=args.latency_jitter,
+                            rate_429=args.rate_429, error_rate=args.error_rate).start()
+    tracker = build_tracker(server.url, args.coalesce_ttl, args.hedge_delay)
+
+    probes = {}          # tx_hash -> время отправки
+    detected = {}        # tx_hash -> задержка обнаружения
+    stop = threading.Event()
+
+    def inject_probes():
+        """Контрольные переводы с фиксированным интервалом"""
+        while not stop.wait(args.probe_interval):
+            wallet = rng.choice(wallets)
+            tx_hash = chain.inject_transfer(wallet, rng.randint(1, 100))
+            probes[tx_hash] = chain.injected_at[tx_hash]
+
+    injector = threading.Thread(target=inject_probes, daemon=True)
+    injector.start()
+
+    cycle_times = []
+    started = time.monotonic()
+    try:
+        while time.monotonic() - started < args.duration:
+            cycle_started = time.monotonic()
+            for wallet in wallets:
+                for transfer in tracker.get_new_transfers(wallet):
+                    tx_hash = transfer['tx_hash']
+                    if tx_hash in probes and tx_hash not in detected:
+                        detected[tx_hash] = time.time() - probes[tx_hash]
+            cycle_times.append(time.monotonic() - cycle_started)
+
+            # Пауза между циклами, как CHECK_INTERVAL в ботах
+            remaining = args.interval - cycle_times[-1]
+            if remaining > 0:
+                time.sleep(remaining)
+    finally:
+        stop.set()
+        injector.join()
+        server.stop()
+
+    return {
+        'cycles': cycle_times,
+        'probes': len(probes),
+        'detected': list(detected.values()),
+        'server': dict(server.stats),
+        'coalescing': tracker.coalescing_stats(),
+        'providers': tracker.router.health_report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк цикла опроса на фейковом Tron API")
+    parser.add_argument('--wallets', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=15.0, help="секунд")
+    parser.add_argument('--interval', type=float, default=1.0, help="пауза между циклами опроса")
+    parser.add_argument('--rate', type=float, default=5.0, help="фоновых переводов в секунду")
+    parser.add_argument('--block-interval', type=float, default=1.0)
+    parser.add_argument('--probe-interval', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--latency-jitter', type=float, default=0.01)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--coalesce-ttl', type=float, default=0.0)
+    parser.add_argument('--hedge-delay', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print("📊 БЕНЧМАРК ЦИКЛА ОПРОСА (фейковый Tron API)")
+    print("=" * 70)
+    print(f"   Кошельков: {args.wallets}, длительность: {args.duration} с, "
+          f"429: {args.rate_429:.0%}, 5xx: {args.error_rate:.0%}, задержка: {args.latency * 1000:.0f} мс")
+    result = run(args)
+
+    cycles = result['cycles']
+    print()
+    print(f"🔄 Циклов: {len(cycles)}")
+    print(f"   время цикла p50: {percentile(cycles, 0.5) * 1000:8.1f} мс   "
+          f"p95: {percentile(cycles, 0.95) * 1000:8.1f} мс   max: {max(cycles) * 1000:8.1f} мс")
+
+    latencies = result['detected']
+    print(f"🎯 Контрольных переводов: {result['probes']}, обнаружено: {len(latencies)}")
+    if latencies:
+        print(f"   задержка обнаружения p50: {percentile(latencies, 0.5) * 1000:8.0f} мс   "
+              f"p95: {percentile(latencies, 0.95) * 1000:8.0f} мс   "
+              f"среднее: {statistics.mean(latencies) * 1000:8.0f} мс")
+
+    print(f"🌐 Сервер: {result['server']}")
+    print(f"♻️ Объединение запросов: {result['coalescing']}")
+    for name, health in result['providers'].items():
+        print(f"   {name}: {health}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""
+Доставка callback'ов мерчантам из outbox в базе
+
+Callback пишется в таблицу callback_outbox в той же транзакции, что и
+смена статуса платежа, поэтому не теряется ни при падении процесса, ни
+при недоступности мерчанта. CallbackDispatcher забирает созревшие записи
+пачками и отправляет их параллельно (до CALLBACK_WORKERS одновременно,
+не больше CALLBACK_PER_HOST на один хост) через общий пул соединений.
+Неудачная попытка откладывается с экспоненциальной паузой и разбросом,
+после CALLBACK_MAX_ATTEMPTS попыток или постоянной ошибки (4xx) запись
+уходит в dead-letter (status 'dead'). Доставка at-least-once: получатель
+должен быть готов к повтору одного и того же callback'а.
+
+Каждое событие получает номер seq, возрастающий по адресу получателя.
+При WEBHOOK_SECRET тело подписывается HMAC-SHA256 (заголовок
+X-Webhook-Signature: t=<время>,v1=<hex>, подписывается "<время>.<тело>").
+В пакетном режиме (WEBHOOK_BATCH_ENABLED) события одного адреса копятся
+до WEBHOOK_BATCH_WINDOW секунд или WEBHOOK_BATCH_SIZE штук и уходят одним
+POST {"events": [...]}; из нескольких событий одного платежа в пачке
+остается последнее. Получатель отбрасывает события с seq не больше уже
+обработанного для того же платежа - повтор пачки идемпотентен.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+import config
+import metrics
+from confirmation_pipeline import _percentile
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Ответы 4xx, после которых повтор имеет смысл
+RETRYABLE_STATUSES = (408, 425, 429)
+
+# Как часто удалять доставленные записи старше CALLBACK_RETENTION
+PURGE_INTERVAL = 3600
+
+
+def sign_payload(secret: str, body: bytes, timestamp: int = None) -> str:
+    """Значение X-Webhook-Signature для тела запроса"""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify_signature(secret: str, body: bytes, header: str, tolerance: float = 300) -> bool:
+    """Проверка X-Webhook-Signature на стороне получателя (tolerance - допустимый возраст, секунды)"""
+    try:
+        fields = dict(part.split('=', 1) for part in header.split(','))
+        timestamp = int(fields['t'])
+    except (KeyError, ValueError):
+        return False
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    return hmac.compare_digest(sign_payload(secret, body, timestamp), header)
+
+
+def coalesce(callbacks: List[Dict]) -> List[Dict]:
+    """Из событий одного платежа (event_key) оставить последнее по seq; порядок - по seq"""
+    latest: Dict[str, Dict] = {}
+    single = []
+    for callback in callbacks:
+        key = callback.get('event_key')
+        if key is None:
+            single.append(callback)
+        elif key not in latest or latest[key]['seq'] < callback['seq']:
+            latest[key] = callback
+    return sorted(single + list(latest.values()), key=lambda callback: callback['seq'] or 0)
+
+
+class CallbackDispatcher:
+    """Пул доставки callback'ов из outbox с повторами и dead-letter"""
+
+    def __init__(self, db: Database, workers: int = None, per_host: int = None, timeout: float = None,
+                 max_attempts: int = None, retry_base: float = None, retry_max: float = None,
+                 poll_interval: float = None, batch: bool = None, batch_window: float = None,
+                 batch_size: int = None, secret: str = None, latency_window: int = 1000):
+        """
+        Args:
+            workers: Одновременных доставок (и размер пула соединений)
+            per_host: Одновременных запросов на один хост
+            timeout: Таймаут одной попытки, секунды
+            max_attempts: Попыток до dead-letter
+            retry_base: Пауза после первой неудачи, секунды (дальше удваивается)
+            retry_max: Максимальная пауза между попытками, секунды
+            poll_interval: Проверка outbox без явного notify(), секунды
+            batch: Пакетный режим - события адреса одним POST
+            batch_window: Сколько ждать событий в пачку, секунды
+            batch_size: Максимум событий в пачке
+            secret: Ключ HMAC подписи (пусто - без подписи)
+        """
+        self.db = db
+        self.workers = workers or config.CALLBACK_WORKERS
+        self.per_host = per_host or config.CALLBACK_PER_HOST
+        self.timeout = timeout if timeout is not None else config.CALLBACK_TIMEOUT
+        self.max_attempts = max_attempts or config.CALLBACK_MAX_ATTEMPTS
+        self.retry_base = retry_base if retry_base is not None else config.CALLBACK_RETRY_BASE
+        self.retry_max = retry_max if retry_max is not None else config.CALLBACK_RETRY_MAX
+        self.poll_interval = poll_interval if poll_interval is not None else config.CALLBACK_POLL_INTERVAL
+        self.batch = batch if batch is not None else config.WEBHOOK_BATCH_ENABLED
+        self.batch_window = batch_window if batch_window is not None else config.WEBHOOK_BATCH_WINDOW
+        self.batch_size = batch_size or config.WEBHOOK_BATCH_SIZE
+        self.secret = secret if secret is not None else config.WEBHOOK_SECRET
+        # Запись, взятая в работу, недоступна другим до истечения аренды
+        self.lease = self.timeout * 3 + 30
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_purge = 0.0
+        # Задержка от записи в outbox до доставки, секунды
+        self._latencies: deque = deque(maxlen=latency_window)
+        self.counters = {'delivered': 0, 'retried': 0, 'dead': 0, 'attempts': 0,
+                         'requests': 0, 'coalesced': 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.workers, limit_per_host=self.per_host)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def retry_delay(self, attempts: int) -> float:
+        """Пауза после attempts неудачных попыток: половина экспоненты плюс случайный разброс"""
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _request(self, callbacks: List[Dict]) -> Tuple[bytes, Dict[str, str]]:
+        """Тело и заголовки POST: одно событие как есть или пачка {"events": [...]}"""
+        if self.batch:
+            events = coalesce(callbacks)
+            self.counters['coalesced'] += len(callbacks) - len(events)
+            body = json.dumps({
+                'events': [{'id': callback['id'], 'seq': callback['seq'], 'created_at': callback['created_at'],
+                            'data': json.loads(callback['payload'])} for callback in events]
+            }, ensure_ascii=False).encode()
+        else:
+            events = callbacks
+            body = callbacks[0]['payload'].encode()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Webhook-Id': ','.join(str(callback['id']) for callback in events),
+            'X-Webhook-Seq': str(max(callback['seq'] or 0 for callback in events)),
+        }
+        if self.secret:
+            headers['X-Webhook-Signature'] = sign_payload(self.secret, body)
+        return body, headers
+
+    async def _deliver(self, callbacks: List[Dict]) -> Tuple[bool, Optional[str]]:
+        """Одна попытка: (доставлен, ошибка); ошибка без повтора начинается с 'permanent'"""
+        body, headers = self._request(callbacks)
+        try:
+            async with self._get_session().post(callbacks[0]['url'], data=body, headers=headers) as response:
+                if 200 <= response.status < 300:
+                    return True, None
+                if 400 <= response.status < 500 and response.status not in RETRYABLE_STATUSES:
+                    return False, f"permanent: HTTP {response.status}"
+                return False, f"HTTP {response.status}"
+        except asyncio.TimeoutError:
+            return False, "timeout"
+        except aiohttp.ClientError as e:
+            return False, f"{type(e).__name__}: {e}"
+
+    async def run_once(self) -> int:
+        """Доставить все созревшие callback'и; возвращает число обработанных записей"""
+        loop = asyncio.get_running_loop()
+        processed = 0
+        while True:
+            now = time.time()
+            if self.batch:
+                batches = await loop.run_in_executor(None, self.db.claim_callback_batches, now,
+                                                     self.batch_window, self.batch_size, self.lease,
+                                                     self.workers * 4)
+            else:
+                callbacks = await loop.run_in_executor(None, self.db.claim_callbacks, self.workers * 4,
+                                                       now, self.lease)
+                batches = [[callback] for callback in callbacks]
+            if not batches:
+                break
+            results = await asyncio.gather(*[self._deliver(batch) for batch in batches])
+            self.counters['requests'] += len(batches)
+
+            delivered, failed = [], []
+            finished = time.time()
+            # Результат запроса относится ко всем событиям пачки
+            callbacks = [callback for batch in batches for callback in batch]
+            results = [result for batch, result in zip(batches, results) for _ in batch]
+            for callback, (ok, error) in zip(callbacks, results):
+                attempts = callback['attempts'] + 1
+                if ok:
+                    delivered.append((callback['id'], finished))
+                    self._latencies.append(finished - callback['created_at'])
+                elif attempts >= self.max_attempts or error.startswith('permanent'):
+                    failed.append((callback['id'], error, attempts, None))
+                    logger.error(f"Callback {callback['id']} на {callback['url']} в dead-letter "
+                                 f"после {attempts} попыток: {error}")
+                else:
+                    failed.append((callback['id'], error, attempts, finished + self.retry_delay(attempts)))
+                    logger.warning(f"Callback {callback['id']} на {callback['url']} не доставлен "
+                                   f"(попытка {attempts}): {error}")
+            await loop.run_in_executor(None, self.db.finish_callbacks, delivered, failed)
+
+            dead = sum(1 for item in failed if item[3] is None)
+            self.counters['attempts'] += len(callbacks)
+            self.counters['delivered'] += len(delivered)
+            self.counters['dead'] += dead
+            self.counters['retried'] += len(failed) - dead
+            metrics.CALLBACK_DELIVERIES.labels('delivered').inc(len(delivered))
+            metrics.CALLBACK_DELIVERIES.labels('dead').inc(dead)
+            metrics.CALLBACK_DELIVERIES.labels('retried').inc(len(failed) - dead)
+            processed += len(callbacks)
+
+        if time.time() - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = time.time()
+            purged = await loop.run_in_executor(None, self.db.purge_delivered_callbacks,
+                                                self._last_purge - config.CALLBACK_RETENTION)
+            if purged:
+                logger.info(f"Удалено доставленных callback'ов: {purged}")
+        return processed
+
+    async def run(self):
+        """Фоновая доставка: по notify() или раз в poll_interval"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    await self.run_once()
+                except Exception as e:
+                    logger.error(f"Ошибка доставки callback'ов: {e}")
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.close()
+
+    def notify(self):
+        """В outbox появились записи - разбудить доставку (из любого потока)"""
+        if self._loop is None or self._wakeup is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            logger.debug("Цикл доставки callback'ов уже закрыт")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> Dict:
+        stats = dict(self.counters)
+        stats['batch'] = self.batch
+        latencies = list(self._latencies)
+        stats['latency_avg_ms'] = round(sum(latencies) / len(latencies) * 1000) if latencies else None
+        p95 = _percentile(latencies, 0.95)
+        stats['latency_p95_ms'] = round(p95 * 1000) if p95 is not None else None
+        stats['backlog'] = self.db.get_callback_backlog(time.time())
+        return stats
+
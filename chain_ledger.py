@@ -0,0 +1,129 @@
+"""
+Журнал зачислений с защитой от реорганизаций сети
+
+Каждое зачисление записывается в chain_transfers вместе с номером и хешем
+блока. Раз в цикл одним запросом берутся последние REORG_CHECK_BLOCKS
+блоков: если хеш блока зачисления на том же номере изменился, блок стал
+сиротским и зачисление откатывается. Число запросов не зависит от числа
+кошельков и зачислений.
+
+Блок зачисления определяется только по ID транзакции в полученных блоках.
+Если транзакции там нет, а блок с ее номером или временем (список TRC20
+транзакций TronGrid номер блока не отдает) в окне есть, транзакция была
+в сиротском блоке - зачисление сразу откатывается. Если такого блока в
+окне нет, зачисление записывается без блока и ищется снова в следующих
+циклах.
+"""
+
+import logging
+import time
+from typing import Dict, List, Optional
+
+import config
+from database import Database
+from tron_tracker import TronTracker
+
+logger = logging.getLogger(__name__)
+
+
+class ChainLedger:
+    """Запись зачислений с хешем блока и откат зачислений из сиротских блоков"""
+
+    def __init__(self, db: Database, tracker: TronTracker, window: int = None, block_time: float = None):
+        self.db = db
+        self.tracker = tracker
+        self.window = window if window is not None else config.REORG_CHECK_BLOCKS
+        self.block_time_ms = int((block_time if block_time is not None else config.TRON_BLOCK_TIME) * 1000)
+        self.block_requests = 0
+        self.recorded_total = 0
+        self.reversed_total = 0
+
+    def _horizon(self) -> int:
+        """Время (мс), старше которого зачисления уже вне окна проверки (с запасом x2)"""
+        return int(time.time() * 1000) - self.window * self.block_time_ms * 2
+
+    @staticmethod
+    def _canonical(credit: Dict, by_number: Dict, by_time: Dict) -> Optional[Dict]:
+        """Блок основной цепочки на номере или времени зачисления (None - вне окна)"""
+        return by_number.get(credit.get('block_number')) or by_time.get(credit.get('block_timestamp'))
+
+    def _reverse(self, orphaned: List[Dict], now: float):
+        self.db.reverse_chain_credits(orphaned, now)
+        self.reversed_total += len(orphaned)
+        for credit in orphaned:
+            logger.warning(f"Зачисление {credit['tx_hash']} ({credit['amount']} {credit['currency']}) "
+                           f"откачено: блок {credit['block_number']} стал сиротским")
+
+    def sync(self, credited: List[Dict]) -> List[Dict]:
+        """
+        Записать новые зачисления и проверить последние блоки
+
+        credited - переводы, зачисленные в этом цикле (результат
+        ConfirmationPipeline.promote). Запрос блоков делается только если
+        есть что записывать или проверять. Возвращает откаченные зачисления.
+        """
+        horizon = self._horizon()
+        recent = self.db.get_chain_credits(horizon)
+        unlocated = self.db.get_unlocated_chain_credits(horizon)
+        if not credited and not recent and not unlocated:
+            return []
+
+        blocks = self.tracker.get_recent_blocks(self.window)
+        self.block_requests += 1
+        by_number = {block['number']: block for block in blocks}
+        by_time = {block['timestamp']: block for block in blocks}
+        by_tx = {tx_hash: block for block in blocks for tx_hash in block['transactions']}
+        lowest = blocks[0]['number'] if blocks else None
+
+        orphaned = []
+        for credit in recent:
+            block = by_number.get(credit['block_number'])
+            if block is None:
+                # Блок ниже окна проверки - он уже достаточно глубоко
+                if lowest is None or credit['block_number'] > lowest:
+                    logger.warning(f"Блок {credit['block_number']} зачисления {credit['tx_hash']} не найден")
+                continue
+            if block['hash'] != credit['block_hash']:
+                orphaned.append(credit)
+
+        now = time.time()
+        if orphaned:
+            self._reverse(orphaned, now)
+
+        entries = []
+        for transfer in credited:
+            entry = dict(transfer, block_hash=None)
+            block = by_tx.get(transfer['tx_hash'])
+            if block:
+                entry.update(block_number=block['number'], block_hash=block['hash'],
+                             block_timestamp=block['timestamp'])
+            entries.append(entry)
+        self.recorded_total += self.db.add_chain_credits(entries, now)
+        if any(not entry['block_hash'] for entry in entries):
+            unlocated = self.db.get_unlocated_chain_credits(horizon)
+
+        # Зачисления без блока: найденные в блоках записываются с хешем,
+        # а если блок на их месте в окне есть, но транзакции в нем нет - откат
+        located, missing = [], []
+        for credit in unlocated:
+            block = by_tx.get(credit['tx_hash'])
+            if block:
+                located.append(dict(credit, block_number=block['number'], block_hash=block['hash'],
+                                    block_timestamp=block['timestamp']))
+            elif self._canonical(credit, by_number, by_time):
+                missing.append(credit)
+            else:
+                logger.warning(f"Транзакция {credit['tx_hash']} не найдена в последних блоках, "
+                               f"проверка повторится")
+        self.db.add_chain_credits(located, now)
+        if missing:
+            self._reverse(missing, now)
+        return orphaned + missing
+
+    def stats(self) -> Dict:
+        return {
+            'window_blocks': self.window,
+            'block_requests': self.block_requests,
+            'recorded_total': self.recorded_total,
+            'reversed_total': self.reversed_total,
+        }
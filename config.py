@@ -9,6 +9,123 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 # Tron Configuration
 TRON_API_URL = os.getenv('TRON_API_URL', 'https://api.trongrid.io')
 TRON_API_KEY = os.getenv('TRON_API_KEY')
+TRON_API_TIMEOUT = float(os.getenv('TRON_API_TIMEOUT', 10))  # seconds
+# Суточная квота Tron API (TronGrid free tier) для метрики tron_api_quota_remaining
+TRON_API_DAILY_QUOTA = int(os.getenv('TRON_API_DAILY_QUOTA', 100000))
+
+# Upstream providers (TronScan и собственная нода с TronGrid-совместимым /v1 API)
+TRONSCAN_API_URL = os.getenv('TRONSCAN_API_URL', 'https://apilist.tronscanapi.com')
+TRONSCAN_API_KEY = os.getenv('TRONSCAN_API_KEY')
+TRON_NODE_URL = os.getenv('TRON_NODE_URL')
+TRON_NODE_API_KEY = os.getenv('TRON_NODE_API_KEY')
+# Переопределение маршрутов: "balance=tronscan,trongrid;account=node,trongrid"
+TRON_PROVIDER_ROUTES = os.getenv('TRON_PROVIDER_ROUTES', '')
+# Вызовы, для которых разрешены hedged-запросы ко второму провайдеру
+TRON_HEDGED_CALLS = [c.strip() for c in os.getenv('TRON_HEDGED_CALLS', 'trc20_transactions,balance').split(',') if c.strip()]
+TRON_HEDGE_DELAY = float(os.getenv('TRON_HEDGE_DELAY', 0.5))  # seconds
+PROVIDER_EWMA_ALPHA = float(os.getenv('PROVIDER_EWMA_ALPHA', 0.3))
+PROVIDER_ERROR_THRESHOLD = float(os.getenv('PROVIDER_ERROR_THRESHOLD', 0.5))
+PROVIDER_CONSECUTIVE_FAILURES = int(os.getenv('PROVIDER_CONSECUTIVE_FAILURES', 3))
+PROVIDER_OPEN_SECONDS = float(os.getenv('PROVIDER_OPEN_SECONDS', 30))
+
+# Объединение одинаковых запросов к upstream и micro-cache ответов
+COALESCE_TTL = float(os.getenv('COALESCE_TTL', 2))  # seconds, 0 - без кэша
+COALESCE_MAX_ENTRIES = int(os.getenv('COALESCE_MAX_ENTRIES', 5000))
+
+# Повторы временных ошибок Tron API (таймаут, 429, 5xx)
+TRON_RETRY_MAX_ATTEMPTS = int(os.getenv('TRON_RETRY_MAX_ATTEMPTS', 3))
+TRON_RETRY_BASE_DELAY = float(os.getenv('TRON_RETRY_BASE_DELAY', 0.2))  # seconds
+TRON_RETRY_MAX_DELAY = float(os.getenv('TRON_RETRY_MAX_DELAY', 2))  # seconds
+TRON_RETRY_AFTER_MAX = float(os.getenv('TRON_RETRY_AFTER_MAX', 5))  # больший Retry-After - отказ без ожидания
+TRON_RETRY_BUDGET = int(os.getenv('TRON_RETRY_BUDGET', 20))  # повторов на цикл опроса
+
+# Кэш проверки существования адресов в сети
+ADDRESS_EXISTENCE_TTL = int(os.getenv('ADDRESS_EXISTENCE_TTL', 3600))  # seconds
+ADDRESS_EXISTENCE_CACHE_SIZE = int(os.getenv('ADDRESS_EXISTENCE_CACHE_SIZE', 10000))
+
+# Push-прием событий Transfer (TronGrid event server / event plugin ноды)
+EVENT_PUSH_TOKEN = os.getenv('EVENT_PUSH_TOKEN')  # значение заголовка X-Event-Token; без него прием выключен
+EVENT_STREAM_QUIET_SECONDS = float(os.getenv('EVENT_STREAM_QUIET_SECONDS', 30))  # тишина -> опрос
+EVENT_DEDUPE_SIZE = int(os.getenv('EVENT_DEDUPE_SIZE', 100000))
+EVENT_POLL_OVERLAP = float(os.getenv('EVENT_POLL_OVERLAP', 60))  # seconds, запас курсора при опросе
+EVENT_VERIFY_ATTEMPTS = int(os.getenv('EVENT_VERIFY_ATTEMPTS', 5))  # сверок события с сетью до отказа
+
+# Уникальные суммы на общем кошельке: base + suffix * step (микро-USDT)
+AMOUNT_SUFFIX_SLOTS = int(os.getenv('AMOUNT_SUFFIX_SLOTS', 999))  # сумм на одну базовую сумму
+AMOUNT_SUFFIX_STEP = int(os.getenv('AMOUNT_SUFFIX_STEP', 1))  # 1 = 0.000001 USDT
+AMOUNT_RESERVATION_TTL = int(os.getenv('AMOUNT_RESERVATION_TTL', 3600))  # seconds
+
+# Срок жизни ожидающих платежей и фоновая очистка истекших
+PENDING_PAYMENT_TTL = int(os.getenv('PENDING_PAYMENT_TTL', 3600))  # seconds
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', 60))  # seconds
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', 500))
+
+# Окно последних входящих переводов для /verify-payment (фоновый опрос кошелька)
+TRANSFER_WINDOW_SECONDS = int(os.getenv('TRANSFER_WINDOW_SECONDS', 86400))  # возраст перевода в окне
+TRANSFER_WINDOW_SIZE = int(os.getenv('TRANSFER_WINDOW_SIZE', 100000))  # переводов в окне
+TRANSFER_WINDOW_POLL_INTERVAL = float(os.getenv('TRANSFER_WINDOW_POLL_INTERVAL', 5))  # seconds
+TRANSFER_WINDOW_POLL_LIMIT = int(os.getenv('TRANSFER_WINDOW_POLL_LIMIT', 200))  # переводов за запрос
+TRANSFER_WINDOW_MAX_PAGES = int(os.getenv('TRANSFER_WINDOW_MAX_PAGES', 10))  # запросов за один опрос
+TRANSFER_WINDOW_OVERLAP = float(os.getenv('TRANSFER_WINDOW_OVERLAP', 60))  # seconds, запас курсора
+
+# Ожидание статуса платежа на сервере (long-poll и SSE)
+PAYMENT_POLL_INTERVAL = float(os.getenv('PAYMENT_POLL_INTERVAL', 5))  # seconds, фоновый опрос платежей
+LONG_POLL_MAX_TIMEOUT = float(os.getenv('LONG_POLL_MAX_TIMEOUT', 60))  # seconds
+SSE_HEARTBEAT_INTERVAL = float(os.getenv('SSE_HEARTBEAT_INTERVAL', 15))  # seconds
+
+# WebSocket подписки мерчантов на события платежей
+WS_REPLAY_SIZE = int(os.getenv('WS_REPLAY_SIZE', 10000))  # событий для продолжения по seq
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 1000))  # больше - медленный клиент отключается
+
+# Доставка callback'ов из outbox (callback_outbox)
+CALLBACK_WORKERS = int(os.getenv('CALLBACK_WORKERS', 8))  # одновременных доставок, размер пула соединений
+CALLBACK_PER_HOST = int(os.getenv('CALLBACK_PER_HOST', 4))  # одновременных запросов на один хост
+CALLBACK_TIMEOUT = float(os.getenv('CALLBACK_TIMEOUT', 10))  # seconds
+CALLBACK_MAX_ATTEMPTS = int(os.getenv('CALLBACK_MAX_ATTEMPTS', 8))  # потом dead-letter
+CALLBACK_RETRY_BASE = float(os.getenv('CALLBACK_RETRY_BASE', 5))  # seconds, удваивается с попыткой
+CALLBACK_RETRY_MAX = float(os.getenv('CALLBACK_RETRY_MAX', 3600))  # seconds
+CALLBACK_POLL_INTERVAL = float(os.getenv('CALLBACK_POLL_INTERVAL', 1))  # seconds
+CALLBACK_RETENTION = int(os.getenv('CALLBACK_RETENTION', 604800))  # seconds, хранение доставленных
+
+# Пакетные подписанные webhook'и: события одного адреса за окно - одним POST
+WEBHOOK_BATCH_ENABLED = os.getenv('WEBHOOK_BATCH_ENABLED', 'false').lower() == 'true'
+WEBHOOK_BATCH_WINDOW = float(os.getenv('WEBHOOK_BATCH_WINDOW', 2))  # seconds, ожидание пачки
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 100))  # событий в одном POST
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # ключ HMAC-SHA256 подписи; пусто - без подписи
+
+# Проверка API ключей сервисов (кеш в процессе, отзыв через версию в базе)
+API_KEY_CACHE_SIZE = int(os.getenv('API_KEY_CACHE_SIZE', 10000))  # ключей в кеше
+API_KEY_CACHE_TTL = float(os.getenv('API_KEY_CACHE_TTL', 300))  # seconds, действующий ключ
+API_KEY_NEGATIVE_TTL = float(os.getenv('API_KEY_NEGATIVE_TTL', 60))  # seconds, неверный ключ
+API_KEY_VERSION_CHECK_INTERVAL = float(os.getenv('API_KEY_VERSION_CHECK_INTERVAL', 1))  # seconds
+API_KEY_USAGE_FLUSH_INTERVAL = float(os.getenv('API_KEY_USAGE_FLUSH_INTERVAL', 30))  # seconds
+
+# Ограничение частоты запросов ("N/S" - N запросов за S секунд, всплеск до N) и квоты
+RATE_LIMIT_DEFAULT = os.getenv('RATE_LIMIT_DEFAULT', '120/60')
+RATE_LIMIT_VERIFY = os.getenv('RATE_LIMIT_VERIFY', '30/60')  # /verify-payment
+RATE_LIMIT_CHECK = os.getenv('RATE_LIMIT_CHECK', '120/60')  # /check-payment, /payments/{id}/...
+RATE_LIMIT_CREATE = os.getenv('RATE_LIMIT_CREATE', '60/60')  # /create-payment
+RATE_LIMIT_GET_API_KEY = os.getenv('RATE_LIMIT_GET_API_KEY', '5/3600')  # /get-api-key, на IP клиента
+API_KEY_DAILY_QUOTA = int(os.getenv('API_KEY_DAILY_QUOTA', 10000))  # запросов на ключ в сутки, 0 - без квоты
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv('RATE_LIMIT_SYNC_INTERVAL', 1))  # seconds, сверка лимитов воркеров с базой
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')  # X-Admin-Token для /admin/usage; пусто - отключено
+
+# Пакетные проверки (/verify-payments, /payments/status): элементов в одном запросе
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100))
+
+# Idempotency-Key создания платежей
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 86400))  # seconds, хранение ответа для повторов
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))  # seconds, ключ занят запросом
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv('IDEMPOTENCY_PURGE_INTERVAL', 3600))  # seconds
+
+# ETag и кеш ответов на чтение (статусы платежей, информация о кошельке)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))  # ответов в кеше процесса
+WALLET_INFO_MAX_AGE = int(os.getenv('WALLET_INFO_MAX_AGE', 30))  # seconds, /wallet-info (баланс)
+
+# Несколько воркеров uvicorn: канал событий через базу и лидер фоновых опросов
+SHARED_BUS_POLL_INTERVAL = float(os.getenv('SHARED_BUS_POLL_INTERVAL', 0.2))  # seconds, задержка событий
+SHARED_BUS_RETENTION = float(os.getenv('SHARED_BUS_RETENTION', 300))  # seconds, хранение событий канала
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', 15))  # seconds, смена лидера после падения воркера
 
 # Database Configuration
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///payments.db')
@@ -16,7 +133,9 @@ DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///payments.db')
 # Bot Settings
 CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', 60))  # seconds
 CONFIRMATION_BLOCKS = int(os.getenv('CONFIRMATION_BLOCKS', 3))
+TRON_BLOCK_TIME = float(os.getenv('TRON_BLOCK_TIME', 3))  # seconds, для оценки глубины по времени блока
+# Сколько последних блоков сверяется с журналом зачислений (один запрос, не больше 100)
+REORG_CHECK_BLOCKS = int(os.getenv('REORG_CHECK_BLOCKS', 30))
 
 # TRC20 Token Configuration (USDT example)
 USDT_CONTRACT_ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"  # USDT TRC20
-
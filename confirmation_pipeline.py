@@ -0,0 +1,133 @@
+"""
+Стадия подтверждений перед зачислением платежей
+
+Новые переводы сначала записываются в состоянии 'seen'. Раз в цикл
+запрашивается текущий блок сети (один запрос на цикл, а не на каждую
+транзакцию), и все переводы, набравшие CONFIRMATION_BLOCKS блоков сверху,
+возвращаются для зачисления одной пачкой. В 'confirmed' перевод переходит
+в той же транзакции, что и зачисление (Database.confirm_payment): если
+зачисление не удалось из-за ошибки, перевод остается в 'seen' и вернется
+в следующем цикле; перевод на кошелек, не привязанный к пользователю,
+переходит в 'rejected' и больше не продвигается.
+
+Если номер блока перевода неизвестен (список TRC20 транзакций TronGrid
+его не отдает), глубина оценивается по времени блока и TRON_BLOCK_TIME.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import config
+from database import Database
+from tron_tracker import TronTracker
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class ConfirmationPipeline:
+    """seen -> confirmed с пакетным продвижением и замером задержки"""
+
+    def __init__(self, db: Database, tracker: TronTracker, confirmations: int = None,
+                 block_time: float = None, latency_window: int = 1000):
+        self.db = db
+        self.tracker = tracker
+        self.confirmations = confirmations if confirmations is not None else config.CONFIRMATION_BLOCKS
+        self.block_time_ms = int((block_time if block_time is not None else config.TRON_BLOCK_TIME) * 1000)
+        self._lock = threading.Lock()
+        # Задержки seen -> confirmed (секунды) последних продвинутых переводов
+        self._latencies = deque(maxlen=latency_window)
+        # Уже учтенные в счетчиках переводы, еще не закрытые зачислением
+        self._promoted = set()
+        self.seen_total = 0
+        self.confirmed_total = 0
+        self.head_requests = 0
+        self.last_head: Optional[Dict] = None
+
+    def observe(self, user_id: int, wallet_address: str, transfers: List[Dict]) -> int:
+        """Записать найденные переводы кошелька; возвращает число новых"""
+        added = self.db.add_seen_transfers(user_id, wallet_address, transfers, time.time())
+        if added:
+            with self._lock:
+                self.seen_total += added
+        return added
+
+    def depth(self, transfer: Dict, head: Dict) -> int:
+        """Число блоков поверх блока перевода"""
+        block_number = transfer.get('block_number')
+        if block_number:
+            return head['number'] - block_number
+        timestamp = transfer.get('block_timestamp')
+        if not timestamp:
+            return 0
+        return int((head['timestamp'] - timestamp) // self.block_time_ms)
+
+    def promote(self) -> List[Dict]:
+        """
+        Продвинуть переводы, набравшие нужную глубину
+
+        Текущий блок запрашивается только если есть ожидающие переводы.
+        Ошибка Tron API поднимается: переводы остаются в 'seen' до
+        следующего цикла. Уже зачисленные переводы закрываются здесь же
+        и не возвращаются.
+        """
+        pending = self.db.get_seen_transfers()
+        credited = self.db.get_confirmed_hashes([transfer['tx_hash'] for transfer in pending])
+        if credited:
+            self.db.mark_transfers_confirmed(list(credited), time.time())
+            pending = [transfer for transfer in pending if transfer['tx_hash'] not in credited]
+        if not pending:
+            return []
+
+        if self.confirmations <= 0:
+            ready = pending
+        else:
+            head = self.tracker.get_now_block()
+            with self._lock:
+                self.head_requests += 1
+                self.last_head = head
+            ready = [transfer for transfer in pending if self.depth(transfer, head) >= self.confirmations]
+
+        if not ready:
+            return []
+
+        now = time.time()
+        with self._lock:
+            # Повторно возвращенные после неудачного зачисления не учитываются дважды
+            self._promoted &= {transfer['tx_hash'] for transfer in pending}
+            for transfer in ready:
+                transfer['confirmed_at'] = now
+                if transfer['tx_hash'] not in self._promoted:
+                    self._promoted.add(transfer['tx_hash'])
+                    self.confirmed_total += 1
+                    self._latencies.append(now - transfer['seen_at'])
+
+        logger.info(f"Подтверждено {len(ready)} переводов из {len(pending)} ожидающих")
+        return ready
+
+    def stats(self) -> Dict:
+        """Счетчики и задержка seen -> confirmed (мс)"""
+        with self._lock:
+            latencies = list(self._latencies)
+            head = self.last_head
+            stats = {
+                'confirmations': self.confirmations,
+                'seen_total': self.seen_total,
+                'confirmed_total': self.confirmed_total,
+                'head_requests': self.head_requests,
+                'head_block': head['number'] if head else None,
+            }
+
+        for name, share in (('latency_p50_ms', 0.5), ('latency_p95_ms', 0.95)):
+            value = _percentile(latencies, share)
+            stats[name] = round(value * 1000) if value is not None else None
+        return stats
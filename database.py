@@ -1,12 +1,28 @@
 import sqlite3
+import hashlib
 import json
 import logging
+import time
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Tuple
 import config
+import metrics
 
 logger = logging.getLogger(__name__)
 
+# Префикс хеша API ключа: в базе хранится только хеш, сам ключ - у клиента
+API_KEY_HASH_PREFIX = 'sha256:'
+
+# Область API ключа: 'user' - события и платежи только своего user_id,
+# 'merchant' - все пользователи (выпускается только через админ-эндпоинт)
+API_KEY_SCOPE_USER = 'user'
+API_KEY_SCOPE_MERCHANT = 'merchant'
+
+def hash_api_key(api_key: str) -> str:
+    """Хеш API ключа для хранения и поиска (ключи случайные, соль не нужна)"""
+    return API_KEY_HASH_PREFIX + hashlib.sha256(api_key.encode()).hexdigest()
+
+@metrics.timed_methods(metrics.DB_QUERY_SECONDS, exclude=('get_connection',))
 class Database:
     def __init__(self, db_path: str = "payments.db"):
         self.db_path = db_path
@@ -38,10 +54,176 @@ class Database:
                 wallet_address TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 status TEXT DEFAULT 'pending',
+                expires_at TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
         
+        # Платежи Simple Payment API (simple_payment_api.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS simple_payments (
+                payment_id TEXT PRIMARY KEY,
+                amount REAL,
+                currency TEXT,
+                wallet_address TEXT,
+                status TEXT DEFAULT 'pending',
+                transaction_hash TEXT,
+                callback_url TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                api_key TEXT,
+                expires_at TIMESTAMP
+            )
+        ''')
+        
+        # API ключи интеграций (scope 'merchant' - доступ ко всем пользователям);
+        # api_key - хеш ключа (hash_api_key), usage_count/last_used_at пишутся пачками
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS api_keys (
+                api_key TEXT PRIMARY KEY,
+                user_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT 1,
+                usage_count INTEGER DEFAULT 0,
+                last_used_at REAL
+            )
+        ''')
+        
+        # Ограничение частоты запросов: token bucket на (ключ или IP, группа эндпоинтов)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                bucket TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        
+        # Суточное потребление ключей (квота API_KEY_DAILY_QUOTA или api_keys.daily_quota)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS api_key_daily_usage (
+                api_key TEXT NOT NULL,
+                day TEXT NOT NULL,
+                requests INTEGER DEFAULT 0,
+                rejected INTEGER DEFAULT 0,
+                PRIMARY KEY (api_key, day)
+            )
+        ''')
+        
+        # Idempotency-Key создания платежей: повтор запроса отдает сохраненный ответ
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                scope TEXT NOT NULL,
+                idempotency_key TEXT NOT NULL,
+                request_hash TEXT NOT NULL,
+                response TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (scope, idempotency_key)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires
+            ON idempotency_keys (expires_at)
+        ''')
+        
+        # Счетчики версий: смена версии сбрасывает кеши процессов (отзыв ключей и т.п.)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # Канал событий между воркерами: каждый процесс читает строки после своего курсора
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bus_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                origin TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_bus_events_created
+            ON bus_events (created_at)
+        ''')
+        
+        # Аренды лидерства: фоновый опрос выполняет один воркер, пока продлевает аренду
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        
+        # Исходящие callback'и: пишутся в одной транзакции со сменой статуса,
+        # доставляются CallbackDispatcher; status pending / delivered / dead
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS callback_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                event_key TEXT,
+                seq INTEGER,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                created_at REAL,
+                delivered_at REAL,
+                last_error TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_callback_outbox_due
+            ON callback_outbox (status, next_attempt_at)
+        ''')
+        # Последний номер события по адресу получателя (seq в webhook)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS callback_sequences (
+                url TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL
+            )
+        ''')
+        
+        # Callback URL пользователей Payment Bot API (payment_api /payment/callback)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS callback_urls (
+                user_id INTEGER PRIMARY KEY,
+                callback_url TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Базы с API ключами в открытом виде: ключи заменяются хешами
+        self._ensure_column(cursor, 'api_keys', 'usage_count', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'api_keys', 'last_used_at', 'REAL')
+        self._ensure_column(cursor, 'api_keys', 'daily_quota', 'INTEGER')
+        self._ensure_column(cursor, 'api_keys', 'scope', f"TEXT DEFAULT '{API_KEY_SCOPE_USER}'")
+        conn.create_function('hash_api_key', 1, hash_api_key)
+        cursor.execute('''
+            UPDATE api_keys SET api_key = hash_api_key(api_key) WHERE api_key NOT LIKE ?
+        ''', (API_KEY_HASH_PREFIX + '%',))
+        cursor.execute('''
+            UPDATE simple_payments SET api_key = hash_api_key(api_key)
+            WHERE api_key IS NOT NULL AND api_key != '' AND api_key NOT LIKE ?
+        ''', (API_KEY_HASH_PREFIX + '%',))
+        
+        # Базы, созданные до появления срока жизни платежей
+        self._ensure_column(cursor, 'pending_payments', 'expires_at', 'TIMESTAMP')
+        self._ensure_column(cursor, 'simple_payments', 'transaction_hash', 'TEXT')
+        self._ensure_column(cursor, 'simple_payments', 'expires_at', 'TIMESTAMP')
+        for table in ('pending_payments', 'simple_payments'):
+            cursor.execute(f'''
+                UPDATE {table} SET expires_at = datetime(created_at, ?)
+                WHERE expires_at IS NULL
+            ''', (f'{config.PENDING_PAYMENT_TTL:+d} seconds',))
+            # Очистка выбирает истекшие по индексу, не просматривая таблицу
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_{table}_status_expires
+                ON {table} (status, expires_at)
+            ''')
+        
         # Таблица подтвержденных платежей
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS confirmed_payments (
@@ -120,6 +302,75 @@ class Database:
             )
         ''')
         
+        # Переводы, найденные в сети и ожидающие нужной глубины подтверждений
+        # (seen -> confirmed при зачислении, rejected - кошелек не привязан к пользователю)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS seen_transfers (
+                tx_hash TEXT PRIMARY KEY,
+                user_id INTEGER,
+                wallet_address TEXT NOT NULL,
+                amount REAL NOT NULL,
+                currency TEXT DEFAULT 'USDT',
+                from_address TEXT,
+                block_number INTEGER,
+                block_timestamp INTEGER,
+                seen_at REAL NOT NULL,
+                status TEXT DEFAULT 'seen',
+                confirmed_at REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_seen_transfers_status ON seen_transfers (status)')
+        
+        # Журнал зачислений с привязкой к блоку (только добавление записей):
+        # entry = 'credit' - зачисление, 'reversal' - откат после реорганизации
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chain_transfers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entry TEXT NOT NULL,
+                tx_hash TEXT NOT NULL,
+                user_id INTEGER,
+                wallet_address TEXT,
+                amount REAL,
+                currency TEXT DEFAULT 'USDT',
+                block_number INTEGER,
+                block_hash TEXT,
+                block_timestamp INTEGER,
+                recorded_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chain_transfers_tx ON chain_transfers (tx_hash)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chain_transfers_block_time ON chain_transfers (block_timestamp)')
+        for action in ('UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS chain_transfers_no_{action.lower()}
+                BEFORE {action} ON chain_transfers
+                BEGIN
+                    SELECT RAISE(ABORT, 'chain_transfers is append-only');
+                END
+            ''')
+        
+        # Зарезервированные уникальные суммы на общих кошельках:
+        # status = 'reserved' / 'paid' / 'expired', transaction_hash - перевод, оплативший резерв
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS amount_reservations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wallet_address TEXT NOT NULL,
+                amount_units INTEGER NOT NULL,
+                base_units INTEGER NOT NULL,
+                reference TEXT,
+                user_wallet TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                status TEXT DEFAULT 'reserved',
+                transaction_hash TEXT
+            )
+        ''')
+        self._ensure_column(cursor, 'amount_reservations', 'transaction_hash', 'TEXT')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_amount_reservations_live
+            ON amount_reservations (wallet_address, amount_units) WHERE status != 'expired'
+        ''')
+        
         conn.commit()
         conn.close()
     
@@ -132,6 +383,7 @@ class Database:
             INSERT OR REPLACE INTO users (user_id, username, wallet_address, auto_mode)
             VALUES (?, ?, ?, 0)
         ''', (user_id, username, wallet_address))
+        self._bump_version(cursor, f"user:{user_id}")
         
         conn.commit()
         conn.close()
@@ -156,17 +408,27 @@ class Database:
             }
         return None
     
-    def add_pending_payment(self, user_id: int, amount: float, currency: str, wallet_address: str):
-        """Добавить ожидающий платеж"""
+    @staticmethod
+    def _ensure_column(cursor, table: str, column: str, declaration: str):
+        """Добавить колонку в таблицу, созданную старой версией"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+    
+    def add_pending_payment(self, user_id: int, amount: float, currency: str, wallet_address: str,
+                            ttl: int = None):
+        """Добавить ожидающий платеж (истекает через ttl секунд, по умолчанию PENDING_PAYMENT_TTL)"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
+        ttl = ttl if ttl is not None else config.PENDING_PAYMENT_TTL
         cursor.execute('''
-            INSERT INTO pending_payments (user_id, amount, currency, wallet_address)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, amount, currency, wallet_address))
+            INSERT INTO pending_payments (user_id, amount, currency, wallet_address, expires_at)
+            VALUES (?, ?, ?, ?, datetime('now', ?))
+        ''', (user_id, amount, currency, wallet_address, f'{ttl:+d} seconds'))
         
         payment_id = cursor.lastrowid
+        self._bump_version(cursor, f"user:{user_id}")
         conn.commit()
         conn.close()
         
@@ -179,7 +441,7 @@ class Database:
         
         cursor.execute('''
             SELECT * FROM pending_payments 
-            WHERE wallet_address = ? AND status = 'pending'
+            WHERE wallet_address = ? AND status = 'pending' AND expires_at > datetime('now')
         ''', (wallet_address,))
         
         results = cursor.fetchall()
@@ -199,9 +461,47 @@ class Database:
         
         return payments
     
+    def get_all_pending_payments(self) -> List[Dict]:
+        """Все ожидающие платежи одним запросом (загрузка индекса PaymentMatcher)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM pending_payments
+            WHERE status = 'pending' AND expires_at > datetime('now') ORDER BY id
+        ''')
+        payments = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return payments
+    
+    def get_confirmed_hashes(self, tx_hashes: List[str]) -> set:
+        """Какие из транзакций уже зачислены (один запрос на пачку)"""
+        if not tx_hashes:
+            return set()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        placeholders = ','.join('?' * len(tx_hashes))
+        cursor.execute(f'''
+            SELECT transaction_hash FROM confirmed_payments
+            WHERE transaction_hash IN ({placeholders})
+        ''', list(tx_hashes))
+        confirmed = {row[0] for row in cursor.fetchall()}
+        
+        conn.close()
+        return confirmed
+    
     def confirm_payment(self, user_id: int, amount: float, currency: str, 
-                       transaction_hash: str, wallet_address: str):
-        """Подтвердить платеж"""
+                       transaction_hash: str, wallet_address: str, callback_payload: Dict = None):
+        """
+        Подтвердить платеж (callback_payload - callback на URL пользователя в той же транзакции)
+        
+        Возвращает True, если платеж зачислен. Если кошелек не привязан к
+        пользователю, возвращает False, а перевод стадии подтверждений
+        переходит в 'rejected' и больше не продвигается.
+        """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -214,6 +514,11 @@ class Database:
         wallet_exists = cursor.fetchone()[0] > 0
         if not wallet_exists:
             logger.warning(f"⚠️ Попытка подтвердить платеж на кошелек {wallet_address}, который не принадлежит пользователю {user_id}")
+            cursor.execute('''
+                UPDATE seen_transfers SET status = 'rejected', confirmed_at = ?
+                WHERE tx_hash = ? AND status = 'seen'
+            ''', (time.time(), transaction_hash))
+            conn.commit()
             conn.close()
             return False
         
@@ -230,8 +535,19 @@ class Database:
             WHERE user_id = ? AND amount = ? AND wallet_address = ? AND status = 'pending'
         ''', (user_id, amount, wallet_address))
         
+        # Перевод стадии подтверждений закрывается вместе с зачислением
+        cursor.execute('''
+            UPDATE seen_transfers SET status = 'confirmed', confirmed_at = ?
+            WHERE tx_hash = ? AND status = 'seen'
+        ''', (time.time(), transaction_hash))
+        
+        if callback_payload is not None:
+            self._enqueue_callback(cursor, callback_payload, user_id=user_id)
+        self._bump_version(cursor, f"user:{user_id}")
+        
         conn.commit()
         conn.close()
+        return True
     
     def is_transaction_confirmed(self, transaction_hash: str) -> bool:
         """Проверить, была ли транзакция уже подтверждена"""
@@ -401,6 +717,7 @@ class Database:
             SET wallet_address = ? 
             WHERE user_id = ?
         ''', (wallet_address, user_id))
+        self._bump_version(cursor, f"user:{user_id}")
         
         conn.commit()
         conn.close()
@@ -544,6 +861,23 @@ class Database:
             }
         return None
     
+    def get_receiving_wallet(self) -> Optional[str]:
+        """Кошелек приема платежей: самый новый активный кошелек всех пользователей"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT wallet_address FROM user_wallets 
+            WHERE is_active = 1 
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''')
+        
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result[0] if result else None
+    
     def create_payment_link(self, user_wallet: str, active_wallet: str):
         """Создать связь между кошельком пользователя и активным кошельком"""
         conn = sqlite3.connect(self.db_path)
@@ -625,4 +959,1008 @@ class Database:
         conn.commit()
         conn.close()
         logger.info(f"Платеж {tx_hash} отмечен как подтвержденный")
-
+    
+    # Методы для стадии подтверждений (seen -> confirmed)
+    def add_seen_transfers(self, user_id: int, wallet_address: str, transfers: List[Dict],
+                           seen_at: float) -> int:
+        """
+        Записать новые переводы в состоянии 'seen'
+        
+        Уже известные и уже зачисленные транзакции пропускаются.
+        Возвращает число добавленных переводов.
+        """
+        if not transfers:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        hashes = [transfer['tx_hash'] for transfer in transfers]
+        placeholders = ','.join('?' * len(hashes))
+        cursor.execute(f'''
+            SELECT transaction_hash FROM confirmed_payments
+            WHERE transaction_hash IN ({placeholders})
+        ''', hashes)
+        credited = {row[0] for row in cursor.fetchall()}
+        
+        before = conn.total_changes
+        cursor.executemany('''
+            INSERT OR IGNORE INTO seen_transfers
+            (tx_hash, user_id, wallet_address, amount, currency, from_address,
+             block_number, block_timestamp, seen_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (transfer['tx_hash'], user_id, wallet_address, transfer['amount'],
+             transfer.get('currency', 'USDT'), transfer.get('from'),
+             transfer.get('block_number') or None, transfer.get('timestamp') or None, seen_at)
+            for transfer in transfers if transfer['tx_hash'] not in credited
+        ])
+        added = conn.total_changes - before
+        
+        conn.commit()
+        conn.close()
+        return added
+    
+    def get_seen_transfers(self) -> List[Dict]:
+        """Переводы, ожидающие подтверждений"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM seen_transfers WHERE status = 'seen' ORDER BY seen_at
+        ''')
+        transfers = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return transfers
+    
+    def mark_transfers_confirmed(self, tx_hashes: List[str], confirmed_at: float):
+        """Перевести пачку уже зачисленных переводов в состояние 'confirmed' одной транзакцией"""
+        if not tx_hashes:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.executemany('''
+            UPDATE seen_transfers SET status = 'confirmed', confirmed_at = ?
+            WHERE tx_hash = ? AND status = 'seen'
+        ''', [(confirmed_at, tx_hash) for tx_hash in tx_hashes])
+        
+        conn.commit()
+        conn.close()
+    
+    # Журнал зачислений chain_transfers (защита от реорганизаций)
+    def add_chain_credits(self, transfers: List[Dict], recorded_at: float) -> int:
+        """
+        Записать зачисления в журнал с номером и хешем блока
+        
+        Записываются только транзакции, которые есть в confirmed_payments.
+        Возвращает число записей.
+        """
+        if not transfers:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        before = conn.total_changes
+        cursor.executemany('''
+            INSERT INTO chain_transfers
+            (entry, tx_hash, user_id, wallet_address, amount, currency,
+             block_number, block_hash, block_timestamp, recorded_at)
+            SELECT 'credit', ?, ?, ?, ?, ?, ?, ?, ?, ?
+            WHERE EXISTS (SELECT 1 FROM confirmed_payments WHERE transaction_hash = ?)
+        ''', [
+            (transfer['tx_hash'], transfer.get('user_id'), transfer.get('wallet_address'),
+             transfer['amount'], transfer.get('currency', 'USDT'), transfer.get('block_number') or None,
+             transfer.get('block_hash'), transfer.get('block_timestamp') or None, recorded_at,
+             transfer['tx_hash'])
+            for transfer in transfers
+        ])
+        added = conn.total_changes - before
+        
+        conn.commit()
+        conn.close()
+        return added
+    
+    def get_chain_credits(self, since_timestamp: int) -> List[Dict]:
+        """Неоткаченные зачисления в блоках не старше since_timestamp (мс)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT c.* FROM chain_transfers c
+            WHERE c.entry = 'credit' AND c.block_hash IS NOT NULL AND c.block_timestamp >= ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM chain_transfers r
+                  WHERE r.entry = 'reversal' AND r.tx_hash = c.tx_hash AND r.block_hash = c.block_hash
+              )
+            ORDER BY c.block_number
+        ''', (since_timestamp,))
+        credits = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return credits
+    
+    def get_unlocated_chain_credits(self, since_timestamp: int) -> List[Dict]:
+        """
+        Зачисления, записанные без блока (транзакции не было в полученных блоках)
+        
+        Берется последняя запись по транзакции: если после нее блок найден
+        или зачисление откачено, транзакция не возвращается.
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT c.* FROM chain_transfers c
+            WHERE c.entry = 'credit' AND c.block_hash IS NULL
+              AND COALESCE(c.block_timestamp, CAST(c.recorded_at * 1000 AS INTEGER)) >= ?
+              AND EXISTS (SELECT 1 FROM confirmed_payments p WHERE p.transaction_hash = c.tx_hash)
+              AND NOT EXISTS (SELECT 1 FROM chain_transfers l WHERE l.tx_hash = c.tx_hash AND l.id > c.id)
+            ORDER BY c.id
+        ''', (since_timestamp,))
+        credits = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return credits
+    
+    def reverse_chain_credits(self, credits: List[Dict], recorded_at: float) -> int:
+        """
+        Откатить зачисления из сиротских блоков одной транзакцией
+        
+        В журнал добавляется запись 'reversal', платеж удаляется из
+        confirmed_payments, последний подтвержденный ожидающий платеж на ту
+        же сумму снова становится 'pending', а перевод убирается из
+        seen_transfers - если транзакция попадет в новую ветку, она будет
+        найдена и зачислена заново.
+        """
+        if not credits:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        for credit in credits:
+            cursor.execute('''
+                INSERT INTO chain_transfers
+                (entry, tx_hash, user_id, wallet_address, amount, currency,
+                 block_number, block_hash, block_timestamp, recorded_at)
+                VALUES ('reversal', ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (credit['tx_hash'], credit['user_id'], credit['wallet_address'], credit['amount'],
+                  credit['currency'], credit['block_number'], credit['block_hash'],
+                  credit['block_timestamp'], recorded_at))
+            cursor.execute('DELETE FROM confirmed_payments WHERE transaction_hash = ?', (credit['tx_hash'],))
+            cursor.execute('''
+                UPDATE pending_payments SET status = 'pending'
+                WHERE id = (
+                    SELECT id FROM pending_payments
+                    WHERE user_id = ? AND amount = ? AND wallet_address = ? AND status = 'confirmed'
+                    ORDER BY id DESC LIMIT 1
+                )
+            ''', (credit['user_id'], credit['amount'], credit['wallet_address']))
+            cursor.execute('DELETE FROM seen_transfers WHERE tx_hash = ?', (credit['tx_hash'],))
+            self._bump_version(cursor, f"user:{credit['user_id']}")
+        
+        conn.commit()
+        conn.close()
+        logger.warning(f"Откачено {len(credits)} зачислений из сиротских блоков")
+        return len(credits)
+    
+    # Уникальные суммы на общих кошельках (amount_reservations)
+    def add_amount_reservation(self, wallet_address: str, amount_units: int, base_units: int,
+                               reference: str, user_wallet: Optional[str], created_at: float,
+                               expires_at: float) -> Optional[int]:
+        """Зарезервировать сумму; None - она уже занята (в том числе другим процессом)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO amount_reservations
+                (wallet_address, amount_units, base_units, reference, user_wallet, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (wallet_address, amount_units, base_units, reference, user_wallet, created_at, expires_at))
+            reservation_id = cursor.lastrowid
+            conn.commit()
+        except sqlite3.IntegrityError:
+            reservation_id = None
+        finally:
+            conn.close()
+        return reservation_id
+    
+    def get_live_amount_reservations(self) -> List[Dict]:
+        """Неистекшие резервы (загрузка AmountAllocator)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM amount_reservations WHERE status != 'expired' ORDER BY id
+        ''')
+        reservations = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return reservations
+    
+    def find_amount_reservation(self, wallet_address: str, amount_units: int) -> Optional[Dict]:
+        """Резерв точной суммы на кошельке (один запрос по уникальному индексу)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM amount_reservations
+            WHERE wallet_address = ? AND amount_units = ? AND status != 'expired'
+        ''', (wallet_address, amount_units))
+        row = cursor.fetchone()
+        
+        conn.close()
+        return dict(row) if row else None
+    
+    def find_amount_reservations(self, wallet_address: str, amounts_units: List[int]) -> Dict[int, Dict]:
+        """Резервы нескольких сумм на кошельке одним запросом по уникальному индексу: сумма -> резерв"""
+        amounts_units = list(set(amounts_units))
+        if not amounts_units:
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT * FROM amount_reservations
+            WHERE wallet_address = ? AND amount_units IN ({','.join('?' * len(amounts_units))})
+              AND status != 'expired'
+        ''', (wallet_address, *amounts_units))
+        reservations = {row['amount_units']: dict(row) for row in cursor.fetchall()}
+        
+        conn.close()
+        return reservations
+    
+    def set_amount_reservations_status(self, reservation_ids: List[int], status: str):
+        """Сменить статус пачки резервов ('expired'; оплата - mark_amount_reservations_paid)"""
+        if not reservation_ids:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.executemany('''
+            UPDATE amount_reservations SET status = ? WHERE id = ?
+        ''', [(status, reservation_id) for reservation_id in reservation_ids])
+        
+        conn.commit()
+        conn.close()
+    
+    def mark_amount_reservations_paid(self, payments: Dict[int, str]) -> List[int]:
+        """
+        Отметить резервы оплаченными: id резерва -> хеш оплатившего перевода
+        
+        Меняются только резервы в статусе 'reserved'. Возвращает id резервов,
+        которые отметил этот вызов; остальные уже оплачены (в том числе
+        параллельным запросом другого процесса).
+        """
+        if not payments:
+            return []
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        marked = []
+        for reservation_id, tx_hash in payments.items():
+            cursor.execute('''
+                UPDATE amount_reservations SET status = 'paid', transaction_hash = ?
+                WHERE id = ? AND status = 'reserved'
+            ''', (tx_hash, reservation_id))
+            if cursor.rowcount:
+                marked.append(reservation_id)
+        
+        conn.commit()
+        conn.close()
+        return marked
+    
+    # Истечение ожидающих платежей
+    def expire_payments(self, table: str, limit: int,
+                        callback_payload: Callable[[Dict], Optional[Dict]] = None) -> List[Dict]:
+        """
+        Перевести пачку истекших платежей в 'expired' одной транзакцией
+        
+        table - pending_payments или simple_payments. Возвращает
+        истекшие строки (не больше limit). callback_payload(строка) -
+        тело callback'а об истечении, ставится в outbox в той же транзакции.
+        """
+        key = {'pending_payments': 'id', 'simple_payments': 'payment_id'}[table]
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        # IMMEDIATE: подтверждение платежа не проскочит между выборкой и обновлением
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(f'''
+            SELECT * FROM {table}
+            WHERE status = 'pending' AND expires_at <= datetime('now')
+            ORDER BY expires_at LIMIT ?
+        ''', (limit,))
+        rows = [dict(row) for row in cursor.fetchall()]
+        cursor.executemany(f'''
+            UPDATE {table} SET status = 'expired' WHERE {key} = ?
+        ''', [(row[key],) for row in rows])
+        if callback_payload:
+            for row in rows:
+                payload = callback_payload(row)
+                if payload is not None:
+                    self._enqueue_callback(cursor, payload, url=row.get('callback_url'), user_id=row.get('user_id'))
+        # Версии для ETag: платеж Simple API или статус платежей пользователя
+        for row in rows:
+            self._bump_version(cursor, f"payment:{row['payment_id']}" if table == 'simple_payments'
+                               else f"user:{row['user_id']}")
+        
+        conn.commit()
+        conn.close()
+        for row in rows:
+            row['status'] = 'expired'
+        return rows
+    
+    # API ключи
+    def add_api_key(self, api_key: str, user_id: int = 0, scope: str = API_KEY_SCOPE_USER) -> str:
+        """Сохранить хеш API ключа с областью scope; возвращает хеш"""
+        key_hash = hash_api_key(api_key)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO api_keys (api_key, user_id, scope) VALUES (?, ?, ?)
+        ''', (key_hash, user_id, scope))
+        
+        conn.commit()
+        conn.close()
+        return key_hash
+    
+    def get_api_key_user(self, api_key: str) -> Optional[int]:
+        """user_id активного API ключа (None - ключ неизвестен или отключен)"""
+        return self.get_api_key_owner(hash_api_key(api_key))
+    
+    def get_api_key_owner(self, key_hash: str) -> Optional[int]:
+        """user_id активного ключа по его хешу (None - ключ неизвестен или отключен)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT user_id FROM api_keys WHERE api_key = ? AND is_active = 1
+        ''', (key_hash,))
+        row = cursor.fetchone()
+        
+        conn.close()
+        return row[0] if row else None
+    
+    def get_api_key_principal(self, key_hash: str) -> Optional[Dict]:
+        """{'user_id', 'scope'} активного ключа по его хешу (None - ключ неизвестен или отключен)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT user_id, scope FROM api_keys WHERE api_key = ? AND is_active = 1
+        ''', (key_hash,))
+        row = cursor.fetchone()
+        
+        conn.close()
+        if not row:
+            return None
+        return {'user_id': row[0], 'scope': row[1] or API_KEY_SCOPE_USER}
+    
+    def revoke_api_key(self, key_hash: str) -> bool:
+        """Отключить ключ и поднять версию 'api_keys' (кеши всех процессов сбрасываются)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE api_keys SET is_active = 0 WHERE api_key = ? AND is_active = 1
+        ''', (key_hash,))
+        revoked = cursor.rowcount > 0
+        if revoked:
+            self._bump_version(cursor, 'api_keys')
+        
+        conn.commit()
+        conn.close()
+        return revoked
+    
+    def add_api_key_usage(self, usage: Dict[str, Tuple[int, float]]):
+        """Прибавить накопленное использование ключей: {хеш: (запросов, время последнего)}"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.executemany('''
+            UPDATE api_keys
+            SET usage_count = COALESCE(usage_count, 0) + ?, last_used_at = MAX(COALESCE(last_used_at, 0), ?)
+            WHERE api_key = ?
+        ''', [(count, last_used, key_hash) for key_hash, (count, last_used) in usage.items()])
+        
+        conn.commit()
+        conn.close()
+    
+    def get_api_key_usage(self, key_hash: str) -> Optional[Dict]:
+        """Использование ключа: usage_count, last_used_at"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT usage_count, last_used_at FROM api_keys WHERE api_key = ?
+        ''', (key_hash,))
+        row = cursor.fetchone()
+        
+        conn.close()
+        return dict(row) if row else None
+    
+    # Ограничение частоты и суточные квоты
+    def get_rate_limit_state(self, bucket: str, quota_key: str = None, day: str = None,
+                             default_quota: int = 0) -> Dict:
+        """
+        Общее состояние бакета и квоты ключа за сутки day
+        
+        Возвращает {'tokens', 'updated_at'} (None - бакета в базе нет) и
+        {'quota', 'used'} ключа (quota - api_keys.daily_quota или default_quota).
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT tokens, updated_at FROM rate_limit_buckets WHERE bucket = ?', (bucket,))
+        row = cursor.fetchone()
+        state = {'tokens': row[0] if row else None, 'updated_at': row[1] if row else None,
+                 'quota': default_quota, 'used': 0}
+        if quota_key:
+            state['quota'], state['used'] = self._api_key_quota(cursor, quota_key, day, default_quota)
+        
+        conn.close()
+        return state
+    
+    @staticmethod
+    def _api_key_quota(cursor, key_hash: str, day: str, default_quota: int) -> Tuple[int, int]:
+        """(квота, запросов за сутки day) ключа"""
+        cursor.execute('''
+            SELECT COALESCE(daily_quota, ?) FROM api_keys WHERE api_key = ?
+        ''', (default_quota, key_hash))
+        row = cursor.fetchone()
+        quota = row[0] if row else default_quota
+        cursor.execute('''
+            SELECT requests FROM api_key_daily_usage WHERE api_key = ? AND day = ?
+        ''', (key_hash, day))
+        row = cursor.fetchone()
+        return quota, row[0] if row else 0
+    
+    def sync_rate_limits(self, buckets: Dict[str, Tuple[int, float, float]],
+                         usage: Dict[Tuple[str, str], Tuple[int, int]],
+                         quota_keys: List[Tuple[str, str]], now: float, default_quota: int = 0) -> Dict:
+        """
+        Записать списания воркера и прочитать общее состояние одной транзакцией
+        
+        buckets - {бакет: (списано токенов, емкость, пополнение в секунду)},
+        usage - {(хеш ключа, сутки): (запросов, отказов)}, quota_keys -
+        [(хеш ключа, сутки)] для чтения квот. BEGIN IMMEDIATE сериализует
+        сверку воркеров. Возвращает {'tokens': {бакет: токены},
+        'quotas': {(ключ, сутки): (квота, запросов)}}.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        shared = {'tokens': {}, 'quotas': {}}
+        try:
+            for bucket, (spent, capacity, rate) in buckets.items():
+                cursor.execute('SELECT tokens, updated_at FROM rate_limit_buckets WHERE bucket = ?', (bucket,))
+                row = cursor.fetchone()
+                tokens = min(capacity, row[0] + max(0, now - row[1]) * rate) if row else capacity
+                if spent:
+                    tokens = max(0.0, tokens - spent)
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO rate_limit_buckets (bucket, tokens, updated_at) VALUES (?, ?, ?)
+                    ''', (bucket, tokens, now))
+                shared['tokens'][bucket] = tokens
+            
+            cursor.executemany('''
+                INSERT INTO api_key_daily_usage (api_key, day, requests, rejected) VALUES (?, ?, ?, ?)
+                ON CONFLICT(api_key, day) DO UPDATE SET
+                    requests = requests + excluded.requests, rejected = rejected + excluded.rejected
+            ''', [(key_hash, day, requests, rejected) for (key_hash, day), (requests, rejected) in usage.items()])
+            for key_hash, day in quota_keys:
+                shared['quotas'][(key_hash, day)] = self._api_key_quota(cursor, key_hash, day, default_quota)
+            conn.commit()
+        finally:
+            conn.close()
+        return shared
+    
+    def purge_rate_limit_buckets(self, before: float) -> int:
+        """Удалить бакеты, не менявшиеся с before (к этому времени они полные)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?', (before,))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    def set_api_key_quota(self, key_hash: str, daily_quota: Optional[int]) -> bool:
+        """Суточная квота ключа (None - по умолчанию API_KEY_DAILY_QUOTA, 0 - без квоты)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('UPDATE api_keys SET daily_quota = ? WHERE api_key = ?', (daily_quota, key_hash))
+        updated = cursor.rowcount > 0
+        
+        conn.commit()
+        conn.close()
+        return updated
+    
+    def get_api_key_usage_report(self, day: str, default_quota: int = 0) -> List[Dict]:
+        """Потребление ключей за сутки day: запросы, отказы, квота, всего запросов"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT k.api_key AS key_id, k.user_id, k.is_active,
+                   COALESCE(k.daily_quota, ?) AS daily_quota,
+                   COALESCE(d.requests, 0) AS requests_today,
+                   COALESCE(d.rejected, 0) AS rejected_today,
+                   k.usage_count, k.last_used_at
+            FROM api_keys k
+            LEFT JOIN api_key_daily_usage d ON d.api_key = k.api_key AND d.day = ?
+            ORDER BY requests_today DESC, k.created_at
+        ''', (default_quota, day))
+        report = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return report
+    
+    # Ключи идемпотентности
+    def claim_idempotency_key(self, scope: str, key: str, request_hash: str, now: float,
+                              lock_timeout: float) -> Optional[Dict]:
+        """
+        Занять ключ идемпотентности или вернуть запись о нем
+        
+        Поиск по первичному ключу (scope, key) в BEGIN IMMEDIATE: из двух
+        одновременных повторов ключ занимает один. Свободный или истекший
+        ключ занимается на lock_timeout секунд, возвращается None. Иначе -
+        {'request_hash', 'response'} (response None - запрос еще выполняется).
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT request_hash, response FROM idempotency_keys
+            WHERE scope = ? AND idempotency_key = ? AND expires_at > ?
+        ''', (scope, key, now))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('''
+                INSERT OR REPLACE INTO idempotency_keys
+                (scope, idempotency_key, request_hash, response, created_at, expires_at)
+                VALUES (?, ?, ?, NULL, ?, ?)
+            ''', (scope, key, request_hash, now, now + lock_timeout))
+        
+        conn.commit()
+        conn.close()
+        if row is None:
+            return None
+        return {'request_hash': row[0], 'response': json.loads(row[1]) if row[1] is not None else None}
+    
+    def save_idempotent_response(self, scope: str, key: str, response: Dict, expires_at: float):
+        """Сохранить ответ занятого ключа до expires_at"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE idempotency_keys SET response = ?, expires_at = ?
+            WHERE scope = ? AND idempotency_key = ?
+        ''', (json.dumps(response, ensure_ascii=False), expires_at, scope, key))
+        
+        conn.commit()
+        conn.close()
+    
+    def release_idempotency_key(self, scope: str, key: str):
+        """Освободить ключ без сохраненного ответа (запрос не выполнен - повтор допустим)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            DELETE FROM idempotency_keys
+            WHERE scope = ? AND idempotency_key = ? AND response IS NULL
+        ''', (scope, key))
+        
+        conn.commit()
+        conn.close()
+    
+    def purge_idempotency_keys(self, now: float) -> int:
+        """Удалить истекшие ключи идемпотентности"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    # Счетчики версий
+    @staticmethod
+    def _bump_version(cursor, name: str):
+        cursor.execute('''
+            INSERT INTO versions (name, version) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1
+        ''', (name,))
+    
+    def bump_version(self, name: str):
+        """Поднять версию name"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        self._bump_version(cursor, name)
+        
+        conn.commit()
+        conn.close()
+    
+    def get_version(self, name: str) -> int:
+        """Текущая версия name (0 - еще не менялась)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT version FROM versions WHERE name = ?', (name,))
+        row = cursor.fetchone()
+        
+        conn.close()
+        return row[0] if row else 0
+    
+    # Канал событий между воркерами
+    def add_bus_event(self, channel: str, payload: Dict, origin: str, now: float) -> int:
+        """Записать событие канала; возвращает его номер (растет во всех процессах)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO bus_events (channel, payload, origin, created_at) VALUES (?, ?, ?, ?)
+        ''', (channel, json.dumps(payload, ensure_ascii=False, default=str), origin, now))
+        event_id = cursor.lastrowid
+        
+        conn.commit()
+        conn.close()
+        return event_id
+    
+    def get_bus_events(self, after_id: int, limit: int) -> List[Dict]:
+        """События с номером больше after_id по возрастанию номера"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, channel, payload, origin FROM bus_events
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, limit))
+        events = [{'id': row[0], 'channel': row[1], 'payload': json.loads(row[2]), 'origin': row[3]}
+                  for row in cursor.fetchall()]
+        
+        conn.close()
+        return events
+    
+    def get_last_bus_event_id(self) -> int:
+        """Номер последнего события (0 - событий не было)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'bus_events'")
+        row = cursor.fetchone()
+        
+        conn.close()
+        return row[0] if row else 0
+    
+    def purge_bus_events(self, before: float) -> int:
+        """Удалить события старше before (все воркеры их уже прочитали)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM bus_events WHERE created_at < ?', (before,))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    # Аренды лидерства
+    def acquire_lease(self, name: str, holder: str, now: float, ttl: float) -> bool:
+        """
+        Занять или продлить аренду name до now + ttl
+        
+        Аренда переходит к holder, если она свободна, истекла или уже его;
+        проверка и запись - одна инструкция UPSERT. Возвращает True, если
+        аренда у holder.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at <= ?
+        ''', (name, holder, now + ttl, now))
+        acquired = cursor.rowcount > 0
+        
+        conn.commit()
+        conn.close()
+        return acquired
+    
+    def release_lease(self, name: str, holder: str):
+        """Освободить аренду, если она у holder (другой воркер займет ее сразу)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+        
+        conn.commit()
+        conn.close()
+    
+    def get_lease(self, name: str) -> Optional[Dict]:
+        """Текущая аренда {'holder', 'expires_at'} или None"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT holder, expires_at FROM leases WHERE name = ?', (name,))
+        row = cursor.fetchone()
+        
+        conn.close()
+        return {'holder': row[0], 'expires_at': row[1]} if row else None
+    
+    # Исходящие callback'и (outbox)
+    @staticmethod
+    def _enqueue_callback(cursor, payload: Dict, url: str = None, user_id: int = None):
+        """
+        Поставить callback в outbox внутри текущей транзакции: на url или на URL пользователя
+        
+        Событие получает следующий номер (seq) своего адреса и ключ платежа
+        (event_key), по которому пакетная доставка схлопывает повторы.
+        """
+        if not url and user_id is not None:
+            cursor.execute('SELECT callback_url FROM callback_urls WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            url = row[0] if row else None
+        if not url:
+            return
+        
+        cursor.execute('''
+            INSERT INTO callback_sequences (url, seq) VALUES (?, 1)
+            ON CONFLICT(url) DO UPDATE SET seq = seq + 1
+        ''', (url,))
+        cursor.execute('SELECT seq FROM callback_sequences WHERE url = ?', (url,))
+        seq = cursor.fetchone()[0]
+        
+        key = payload.get('payment_id') or payload.get('transaction_hash')
+        now = time.time()
+        cursor.execute('''
+            INSERT INTO callback_outbox (url, payload, event_key, seq, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (url, json.dumps(payload, ensure_ascii=False), str(key) if key is not None else None,
+              seq, now, now))
+    
+    def get_simple_payments(self, payment_ids: List[str], key_id: str) -> Dict[str, Dict]:
+        """Статусы платежей ключа одним запросом по первичному ключу: payment_id -> платеж"""
+        payment_ids = list(set(payment_ids))
+        if not payment_ids:
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT payment_id, status, amount, currency, transaction_hash
+            FROM simple_payments
+            WHERE payment_id IN ({','.join('?' * len(payment_ids))}) AND api_key = ?
+        ''', (*payment_ids, key_id))
+        payments = {row['payment_id']: dict(row) for row in cursor.fetchall()}
+        
+        conn.close()
+        return payments
+    
+    def complete_simple_payments(self, completions: List[Dict]) -> List[Dict]:
+        """
+        Отметить платежи Simple Payment API оплаченными одной транзакцией
+        
+        completions - [{payment_id, transaction_hash, callback_url, payload}].
+        Callback ставится в outbox вместе со сменой статуса. Возвращает
+        реально закрытые платежи (еще бывшие 'pending').
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        completed = []
+        for item in completions:
+            cursor.execute('''
+                UPDATE simple_payments
+                SET status = 'completed', transaction_hash = ?
+                WHERE payment_id = ? AND status = 'pending'
+            ''', (item['transaction_hash'], item['payment_id']))
+            if cursor.rowcount:
+                completed.append(item)
+                self._bump_version(cursor, f"payment:{item['payment_id']}")
+                if item.get('callback_url'):
+                    self._enqueue_callback(cursor, item['payload'], url=item['callback_url'])
+        
+        conn.commit()
+        conn.close()
+        return completed
+    
+    def claim_callbacks(self, limit: int, now: float, lease: float) -> List[Dict]:
+        """
+        Забрать пачку callback'ов, которым пора отправляться
+        
+        next_attempt_at сдвигается на lease: если процесс упадет во время
+        доставки, callback снова станет доступен (доставка at-least-once).
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT * FROM callback_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+        ''', (now, limit))
+        callbacks = [dict(row) for row in cursor.fetchall()]
+        cursor.executemany('''
+            UPDATE callback_outbox SET next_attempt_at = ? WHERE id = ?
+        ''', [(now + lease, callback['id']) for callback in callbacks])
+        
+        conn.commit()
+        conn.close()
+        return callbacks
+    
+    def claim_callback_batches(self, now: float, window: float, size: int, lease: float,
+                               limit: int) -> List[List[Dict]]:
+        """
+        Забрать пачки callback'ов по адресам получателей (пакетный режим)
+        
+        Адрес готов к отправке, когда его старейшее событие ждет не меньше
+        window секунд или набралось size событий. Возвращает до limit пачек
+        по size событий в порядке seq; аренда - как в claim_callbacks.
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT url FROM callback_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            GROUP BY url
+            HAVING COUNT(*) >= ? OR MIN(created_at) <= ?
+            LIMIT ?
+        ''', (now, size, now - window, limit))
+        urls = [row['url'] for row in cursor.fetchall()]
+        
+        batches = []
+        for url in urls:
+            cursor.execute('''
+                SELECT * FROM callback_outbox
+                WHERE url = ? AND status = 'pending' AND next_attempt_at <= ?
+                ORDER BY seq LIMIT ?
+            ''', (url, now, size))
+            batch = [dict(row) for row in cursor.fetchall()]
+            cursor.executemany('''
+                UPDATE callback_outbox SET next_attempt_at = ? WHERE id = ?
+            ''', [(now + lease, callback['id']) for callback in batch])
+            batches.append(batch)
+        
+        conn.commit()
+        conn.close()
+        return batches
+    
+    def finish_callbacks(self, delivered: List[Tuple[int, float]], failed: List[Tuple[int, str, int, Optional[float]]]):
+        """
+        Записать результаты доставки одной транзакцией
+        
+        delivered - [(id, delivered_at)]; failed - [(id, ошибка, попыток,
+        время следующей попытки или None - в dead-letter)].
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.executemany('''
+            UPDATE callback_outbox SET status = 'delivered', delivered_at = ?, attempts = attempts + 1
+            WHERE id = ?
+        ''', [(delivered_at, callback_id) for callback_id, delivered_at in delivered])
+        cursor.executemany('''
+            UPDATE callback_outbox
+            SET status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END,
+                next_attempt_at = ?, attempts = ?, last_error = ?
+            WHERE id = ?
+        ''', [(next_at, next_at, attempts, error, callback_id)
+              for callback_id, error, attempts, next_at in failed])
+        
+        conn.commit()
+        conn.close()
+    
+    def get_callback_backlog(self, now: float) -> Dict:
+        """Очередь callback'ов: ожидают, пора отправлять, dead-letter, возраст старейшего"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT
+                SUM(status = 'pending'),
+                SUM(status = 'pending' AND next_attempt_at <= ?),
+                SUM(status = 'dead'),
+                MIN(CASE WHEN status = 'pending' THEN created_at END)
+            FROM callback_outbox WHERE status IN ('pending', 'dead')
+        ''', (now,))
+        pending, due, dead, oldest = cursor.fetchone()
+        
+        conn.close()
+        return {
+            'pending': pending or 0,
+            'due': due or 0,
+            'dead': dead or 0,
+            'oldest_pending_age': round(now - oldest, 1) if oldest else None,
+        }
+    
+    def get_dead_callbacks(self, limit: int = 100) -> List[Dict]:
+        """Callback'и в dead-letter (исчерпаны попытки доставки)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM callback_outbox WHERE status = 'dead' ORDER BY id DESC LIMIT ?
+        ''', (limit,))
+        callbacks = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return callbacks
+    
+    def purge_delivered_callbacks(self, before: float) -> int:
+        """Удалить доставленные callback'и старше before"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            DELETE FROM callback_outbox WHERE status = 'delivered' AND delivered_at < ?
+        ''', (before,))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    # Callback URL пользователей
+    def set_callback_url(self, user_id: int, callback_url: str):
+        """Зарегистрировать (заменить) callback URL пользователя"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO callback_urls (user_id, callback_url) VALUES (?, ?)
+        ''', (user_id, callback_url))
+        
+        conn.commit()
+        conn.close()
+    
+    def delete_callback_url(self, user_id: int) -> bool:
+        """Отменить callback пользователя; False - его не было"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM callback_urls WHERE user_id = ?', (user_id,))
+        deleted = cursor.rowcount > 0
+        
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    def get_callback_urls(self) -> Dict[int, str]:
+        """Зарегистрированные callback URL: {user_id: url}"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT user_id, callback_url FROM callback_urls')
+        urls = dict(cursor.fetchall())
+        
+        conn.close()
+        return urls
@@ -0,0 +1,291 @@
+"""
+Прием событий Transfer от TronGrid event server или event plugin ноды
+
+События нормализуются, дедуплицируются и передаются в тот же путь
+зачисления, что и результаты опроса (ConfirmationPipeline.observe).
+Перевод на отслеживаемый кошелек принимается только после сверки с
+транзакцией в сети (get_transaction_details): контракт USDT, получатель
+и сумма должны совпасть. Если транзакция еще не видна или Tron API
+недоступен, сверка повторяется при следующих пачках (до
+EVENT_VERIFY_ATTEMPTS раз).
+
+Любое входящее событие (в том числе чужой перевод или пустой heartbeat)
+считается признаком живого потока - endpoint передает сюда только
+запросы с верным X-Event-Token. Если поток молчит дольше
+EVENT_STREAM_QUIET_SECONDS, цикл обработки возвращается к опросу кошельков
+с курсора - времени последнего принятого события.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+import config
+from confirmation_pipeline import ConfirmationPipeline
+from trc20_decoder import decode_call
+from tron_address import to_base58
+from tron_tracker import TronAPIError
+
+logger = logging.getLogger(__name__)
+
+
+def _address(value) -> Optional[str]:
+    """Адрес из события: base58, hex с 41 или 0x-hex (20 байт)"""
+    if not value:
+        return None
+    try:
+        return to_base58(value[2:] if value.startswith('0x') else value)
+    except ValueError:
+        return None
+
+
+def normalize_event(event: Dict) -> Optional[Dict]:
+    """
+    Событие Transfer USDT -> перевод в формате get_new_transfers
+
+    Поддерживаются формат TronGrid event API (transaction_id, result) и
+    формат event plugin ноды (transactionId, topicMap / dataMap).
+    Возвращает None для других контрактов и событий.
+    """
+    name = event.get('event_name') or event.get('eventName') or ''
+    if name != 'Transfer' and not name.startswith('Transfer('):
+        return None
+    if _address(event.get('contract_address') or event.get('contractAddress')) != config.USDT_CONTRACT_ADDRESS:
+        return None
+
+    result = event.get('result') or {}
+    topics = event.get('topicMap') or {}
+    data = event.get('dataMap') or {}
+    from_address = _address(result.get('from') or topics.get('from'))
+    to_address = _address(result.get('to') or topics.get('to'))
+    value = result.get('value', data.get('value'))
+    tx_hash = event.get('transaction_id') or event.get('transactionId')
+    if not (tx_hash and to_address and value is not None):
+        return None
+
+    return {
+        'tx_hash': tx_hash,
+        'event_index': event.get('event_index', event.get('eventIndex', 0)),
+        'amount': int(value) / 1000000,  # USDT имеет 6 знаков
+        'currency': 'USDT',
+        'from': from_address or '',
+        'to': to_address,
+        'timestamp': event.get('block_timestamp') or event.get('timeStamp') or 0,
+        'block_number': event.get('block_number') or event.get('blockNumber') or 0,
+    }
+
+
+def matches_transaction(transfer: Dict, transaction: Dict) -> bool:
+    """Транзакция успешна и содержит transfer USDT на тот же адрес и ту же сумму"""
+    if any(ret.get('contractRet', 'SUCCESS') != 'SUCCESS' for ret in transaction.get('ret') or []):
+        return False
+    for contract in transaction.get('raw_data', {}).get('contract', []):
+        value = contract.get('parameter', {}).get('value', {})
+        if contract.get('type') != 'TriggerSmartContract' or not value.get('contract_address'):
+            continue
+        if _address(value['contract_address']) != config.USDT_CONTRACT_ADDRESS:
+            continue
+        decoded = decode_call(value.get('data') or '')
+        if decoded and decoded['to'] == transfer['to'] and abs(decoded['amount'] - transfer['amount']) < 1e-6:
+            return True
+    return False
+
+
+class EventIngestor:
+    """Push-прием событий с дедупликацией и переключением на опрос"""
+
+    def __init__(self, pipeline: ConfirmationPipeline, watched_wallets: Callable[[], Dict[str, int]],
+                 quiet_seconds: float = None, dedupe_size: int = None, poll_overlap: float = None,
+                 verify_attempts: int = None):
+        """
+        Args:
+            pipeline: Стадия подтверждений, куда попадают переводы
+            watched_wallets: Функция -> {кошелек: user_id} отслеживаемых кошельков
+            verify_attempts: Сколько раз сверять событие, транзакция которого не найдена
+        """
+        self.pipeline = pipeline
+        self.watched_wallets = watched_wallets
+        self.verify_attempts = verify_attempts if verify_attempts is not None else config.EVENT_VERIFY_ATTEMPTS
+        self.quiet_seconds = quiet_seconds if quiet_seconds is not None else config.EVENT_STREAM_QUIET_SECONDS
+        self.dedupe_size = dedupe_size if dedupe_size is not None else config.EVENT_DEDUPE_SIZE
+        self.poll_overlap_ms = int((poll_overlap if poll_overlap is not None else config.EVENT_POLL_OVERLAP) * 1000)
+
+        self._lock = threading.Lock()
+        self._seen: OrderedDict = OrderedDict()
+        # Ключ события -> [перевод, число попыток] для несверенных переводов
+        self._unverified: OrderedDict = OrderedDict()
+        self.last_event_at: Optional[float] = None
+        # Курсор: время блока последнего принятого события или опроса (мс)
+        self.cursor_ms: Optional[int] = None
+        self.counters = {'received': 0, 'accepted': 0, 'duplicates': 0, 'ignored': 0,
+                         'rejected': 0, 'unverified': 0}
+        # Канал между воркерами (share): push может прийти в любой воркер, а опрашивает лидер
+        self.bus = None
+        self._shared_at = 0.0
+
+    def share(self, bus):
+        """
+        Делиться состоянием push-потока через SharedBus
+
+        Время последнего события, курсор и ключи принятых событий уходят
+        в канал 'events.push': лидер опроса видит поток живым, даже если
+        события принимают другие воркеры.
+        """
+        self.bus = bus
+        bus.subscribe('events.push', lambda payload, event_id: self.apply_shared(payload))
+
+    def apply_shared(self, payload: Dict):
+        """Учесть push-события, принятые другим воркером"""
+        with self._lock:
+            self.last_event_at = max(self.last_event_at or 0, payload['at'])
+            if payload.get('cursor_ms'):
+                self.cursor_ms = max(self.cursor_ms or 0, payload['cursor_ms'])
+            for key in payload.get('keys', ()):
+                self._seen[key] = True
+                self._seen.move_to_end(key)
+            while len(self._seen) > self.dedupe_size:
+                self._seen.popitem(last=False)
+
+    def _share_push(self, keys: List[str]):
+        """Опубликовать пачку в канал; heartbeat - не чаще трети quiet_seconds"""
+        if self.bus is None:
+            return
+        with self._lock:
+            at = self.last_event_at
+            if not keys and at - self._shared_at < self.quiet_seconds / 3:
+                return
+            self._shared_at = at
+            payload = {'at': at, 'cursor_ms': self.cursor_ms, 'keys': keys}
+        self.bus.publish('events.push', payload)
+
+    def _known(self, key: str) -> bool:
+        """Событие уже принято или ждет повторной сверки"""
+        with self._lock:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                return True
+            return key in self._unverified
+
+    def _remember(self, key: str):
+        with self._lock:
+            self._seen[key] = True
+            if len(self._seen) > self.dedupe_size:
+                self._seen.popitem(last=False)
+
+    def _verify(self, transfer: Dict) -> Optional[bool]:
+        """Сверка с сетью: True/False, None - транзакция не найдена или Tron API недоступен"""
+        try:
+            transaction = self.pipeline.tracker.get_transaction_details(transfer['tx_hash'])
+        except TronAPIError as e:
+            logger.warning(f"Не удалось сверить событие {transfer['tx_hash']}: {e}")
+            return None
+        if transaction is None:
+            return None
+        return matches_transaction(transfer, transaction)
+
+    def _retry_later(self, key: str, transfer: Dict) -> bool:
+        """Отложить сверку; False - попытки исчерпаны"""
+        with self._lock:
+            entry = self._unverified.pop(key, [transfer, 0])
+            entry[1] += 1
+            if entry[1] >= self.verify_attempts:
+                return False
+            self._unverified[key] = entry
+            if len(self._unverified) > self.dedupe_size:
+                self._unverified.popitem(last=False)
+            return True
+
+    def ingest(self, events: Iterable[Dict]) -> Dict[str, int]:
+        """
+        Принять пачку событий (пустая пачка - heartbeat)
+
+        Возвращает счетчики по пачке: accepted, duplicates, ignored,
+        rejected (не совпало с сетью), unverified (сверка отложена).
+        Отложенные переводы прошлых пачек сверяются повторно.
+        """
+        events = list(events)
+        result = {'accepted': 0, 'duplicates': 0, 'ignored': 0, 'rejected': 0, 'unverified': 0}
+        with self._lock:
+            self.last_event_at = time.time()
+            self.counters['received'] += len(events)
+            retries = [(key, entry[0]) for key, entry in self._unverified.items()]
+
+        wallets = self.watched_wallets() if events or retries else {}
+        candidates = []
+        for event in events:
+            transfer = normalize_event(event)
+            if transfer is None or transfer['to'] not in wallets:
+                result['ignored'] += 1
+                continue
+            key = f"{transfer['tx_hash']}:{transfer['event_index']}"
+            if self._known(key):
+                result['duplicates'] += 1
+                continue
+            candidates.append((key, transfer))
+        candidates = retries + candidates
+
+        by_wallet: Dict[str, List[Dict]] = {}
+        accepted = []
+        for key, transfer in candidates:
+            if transfer['to'] not in wallets:
+                # Кошелек перестал отслеживаться, пока сверка была отложена
+                with self._lock:
+                    self._unverified.pop(key, None)
+                result['ignored'] += 1
+                continue
+            verified = self._verify(transfer)
+            if verified is None and self._retry_later(key, transfer):
+                result['unverified'] += 1
+                continue
+            with self._lock:
+                self._unverified.pop(key, None)
+            if not verified:
+                logger.warning(f"Событие {transfer['tx_hash']} не подтверждено сетью, перевод отклонен")
+                result['rejected'] += 1
+                continue
+            self._remember(key)
+            accepted.append(key)
+            by_wallet.setdefault(transfer['to'], []).append(transfer)
+            result['accepted'] += 1
+            self._advance_cursor(transfer['timestamp'])
+
+        for wallet_address, transfers in by_wallet.items():
+            self.pipeline.observe(wallets[wallet_address], wallet_address, transfers)
+
+        with self._lock:
+            for key, value in result.items():
+                self.counters[key] += value
+        self._share_push(accepted)
+        return result
+
+    def _advance_cursor(self, timestamp_ms: int):
+        if timestamp_ms:
+            with self._lock:
+                self.cursor_ms = max(self.cursor_ms or 0, timestamp_ms)
+
+    def push_active(self) -> bool:
+        """Поток событий жив (было событие за quiet_seconds)"""
+        with self._lock:
+            return self.last_event_at is not None and time.time() - self.last_event_at < self.quiet_seconds
+
+    def poll_cursor(self) -> Optional[int]:
+        """min_timestamp для опроса после тишины потока (с запасом на поздние события)"""
+        with self._lock:
+            if self.cursor_ms is None:
+                return None
+            return max(0, self.cursor_ms - self.poll_overlap_ms)
+
+    def record_poll(self, transfers: List[Dict]):
+        """Сдвинуть курсор по результатам опроса"""
+        for transfer in transfers:
+            self._advance_cursor(transfer.get('timestamp'))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats['cursor_ms'] = self.cursor_ms
+            stats['last_event_age'] = round(time.time() - self.last_event_at, 1) if self.last_event_at else None
+        stats['mode'] = 'push' if self.push_active() else 'polling'
+        return stats
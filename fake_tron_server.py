@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""
+Локальная замена TronGrid / TronScan для офлайн нагрузочного тестирования
+
+Реализует пути, которые использует TronTracker:
+- GET /v1/accounts/{address}                    (TronGrid, баланс в trc20)
+- GET /v1/accounts/{address}/transactions/trc20 (TronGrid, переводы)
+- GET /v1/transactions/{hash}                   (детали транзакции)
+- GET /api/account?address=...                  (TronScan, баланс)
+- GET /wallet/getnowblock                       (текущий блок)
+- GET /wallet/getblockbylatestnum?num=N         (последние N блоков)
+
+EventEmitter - замена TronGrid event server: отправляет события Transfer
+новых блоков на push-прием (POST /events/tron в payment_api).
+
+Данные берутся из синтетической цепочки SyntheticChain: блоки создаются
+каждые block_interval секунд по реальному времени, в каждом блоке переводы
+USDT с заданной средней частотой. Сервер умеет добавлять задержку, 429 и
+5xx ответы с заданной вероятностью. SyntheticChain.reorg() заменяет
+последние блоки другой веткой для проверки отката зачислений.
+
+Запуск: python fake_tron_server.py --port 8090 --rate 5 --wallet T...
+Затем TRON_API_URL=http://127.0.0.1:8090 TRONSCAN_API_URL=http://127.0.0.1:8090
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+import config
+from tron_address import ADDRESS_PREFIX, b58check_encode, base58_to_hex
+from trc20_decoder import SELECTOR_TRANSFER
+
+USDT_DECIMALS = 6
+TRON_BLOCK_INTERVAL = 3.0  # секунды
+
+
+def random_address(rng: random.Random) -> str:
+    """Случайный корректный base58 адрес"""
+    return b58check_encode(bytes([ADDRESS_PREFIX]) + rng.randbytes(20))
+
+
+class SyntheticChain:
+    """
+    Синтетическая цепочка блоков с USDT переводами
+
+    Блоки создаются лениво: при каждом обращении достраиваются все блоки,
+    которые должны были появиться к текущему моменту. Доля watched_share
+    переводов уходит на кошельки из wallets, остальные - шум на случайные
+    адреса. История по каждому адресу ограничена history_size записями.
+    """
+
+    def __init__(self, wallets: List[str] = None, rate: float = 1.0,
+                 block_interval: float = TRON_BLOCK_INTERVAL, watched_share: float = 0.5,
+                 history_size: int = 10000, seed: int = None, start_block: int = 60000000):
+        self.wallets = list(wallets or [])
+        self.rate = rate
+        self.block_interval = block_interval
+        self.watched_share = watched_share
+        self.history_size = history_size
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._senders = [random_address(self._rng) for _ in range(1000)]
+
+        self.blocks: deque = deque(maxlen=history_size)
+        self.head_number = start_block
+        self.head_hash = self._block_hash(start_block, b'genesis')
+        self.head_time = time.time()
+
+        self._transfers: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.history_size))
+        self._transactions: Dict[str, Dict] = {}
+        self._tx_order: deque = deque()
+        self.balances: Dict[str, int] = defaultdict(int)
+        self._pending: List[Dict] = []
+        # Время добавления переводов через inject_transfer: tx_hash -> time.time()
+        self.injected_at: Dict[str, float] = {}
+        self.transfer_count = 0
+
+    @staticmethod
+    def _block_hash(number: int, parent: bytes) -> str:
+        """ID блока как в Tron: номер в первых 8 байтах, дальше хеш"""
+        digest = hashlib.sha256(number.to_bytes(8, 'big') + parent).digest()
+        return (number.to_bytes(8, 'big') + digest[8:]).hex()
+
+    def _poisson(self, lam: float) -> int:
+        """Число переводов в блоке"""
+        if lam <= 0:
+            return 0
+        if lam > 30:
+            return max(0, int(round(self._rng.gauss(lam, math.sqrt(lam)))))
+        limit, k, p = math.exp(-lam), 0, 1.0
+        while True:
+            p *= self._rng.random()
+            if p <= limit:
+                return k
+            k += 1
+
+    def _new_transfer(self, to_address: str, amount: int, from_address: str = None) -> Dict:
+        tx_hash = hashlib.sha256(f"{self.transfer_count}:{self._rng.random()}".encode()).hexdigest()
+        self.transfer_count += 1
+        return {
+            'tx_hash': tx_hash,
+            'from': from_address or self._rng.choice(self._senders),
+            'to': to_address,
+            'value': amount,
+        }
+
+    def _random_transfer(self) -> Dict:
+        if self.wallets and self._rng.random() < self.watched_share:
+            to_address = self._rng.choice(self.wallets)
+        else:
+            to_address = self._rng.choice(self._senders)
+        amount = self._rng.randint(1, 500) * 10 ** USDT_DECIMALS + self._rng.randint(0, 999999)
+        return self._new_transfer(to_address, amount)
+
+    def _produce_block(self, timestamp: float):
+        """Создать следующий блок с ожидающими и случайными переводами"""
+        number = self.head_number + 1
+        block_hash = self._block_hash(number, bytes.fromhex(self.head_hash))
+        block_ms = int(timestamp * 1000)
+
+        transfers = self._pending + [self._random_transfer()
+                                     for _ in range(self._poisson(self.rate * self.block_interval))]
+        self._pending = []
+        events = []
+
+        for index, transfer in enumerate(transfers):
+            record = {
+                'transaction_id': transfer['tx_hash'],
+                'token_info': {
+                    'symbol': 'USDT',
+                    'address': config.USDT_CONTRACT_ADDRESS,
+                    'decimals': USDT_DECIMALS,
+                    'name': 'Tether USD',
+                },
+                'block_timestamp': block_ms,
+                'from': transfer['from'],
+                'to': transfer['to'],
+                'type': 'Transfer',
+                'value': str(transfer['value']),
+            }
+            self._transfers[transfer['to']].appendleft(record)
+            self._transfers[transfer['from']].appendleft(record)
+            self.balances[transfer['to']] += transfer['value']
+            self._transactions[transfer['tx_hash']] = self._raw_transaction(transfer, number, block_ms)
+            self._tx_order.append(transfer['tx_hash'])
+            # Событие в формате TronGrid event API (адреса - 0x + 20 байт)
+            events.append({
+                'transaction_id': transfer['tx_hash'],
+                'block_number': number,
+                'block_timestamp': block_ms,
+                'contract_address': config.USDT_CONTRACT_ADDRESS,
+                'event_name': 'Transfer',
+                'event_index': index,
+                'result': {
+                    'from': '0x' + base58_to_hex(transfer['from'])[2:],
+                    'to': '0x' + base58_to_hex(transfer['to'])[2:],
+                    'value': str(transfer['value']),
+                },
+            })
+
+        # Детали транзакций храним в том же объеме, что и историю
+        while len(self._tx_order) > self.history_size * 10:
+            self._transactions.pop(self._tx_order.popleft(), None)
+
+        self.blocks.append({
+            'number': number,
+            'hash': block_hash,
+            'parent_hash': self.head_hash,
+            'timestamp': block_ms,
+            'transactions': [transfer['tx_hash'] for transfer in transfers],
+            'transfers': transfers,
+            'events': events,
+        })
+        self.head_number, self.head_hash, self.head_time = number, block_hash, timestamp
+
+    @staticmethod
+    def _raw_transaction(transfer: Dict, block_number: int, block_ms: int) -> Dict:
+        """Транзакция в формате ноды: TriggerSmartContract с ABI данными transfer"""
+        data = (SELECTOR_TRANSFER.hex()
+                + base58_to_hex(transfer['to'])[2:].rjust(64, '0')
+                + format(transfer['value'], '064x'))
+        return {
+            'txID': transfer['tx_hash'],
+            'blockNumber': block_number,
+            'ret': [{'contractRet': 'SUCCESS'}],
+            'raw_data': {
+                'contract': [{
+                    'type': 'TriggerSmartContract',
+                    'parameter': {
+                        'value': {
+                            'data': data,
+                            'owner_address': base58_to_hex(transfer['from']),
+                            'contract_address': base58_to_hex(config.USDT_CONTRACT_ADDRESS),
+                        },
+                    },
+                }],
+                'timestamp': block_ms,
+            },
+        }
+
+    def advance(self, now: float = None):
+        """Достроить блоки до текущего момента"""
+        now = time.time() if now is None else now
+        with self._lock:
+            while self.head_time + self.block_interval <= now:
+                self._produce_block(self.head_time + self.block_interval)
+
+    def inject_transfer(self, to_address: str, amount: float, from_address: str = None) -> str:
+        """Добавить перевод в следующий блок, возвращает хеш транзакции"""
+        with self._lock:
+            transfer = self._new_transfer(to_address, int(round(amount * 10 ** USDT_DECIMALS)), from_address)
+            self._pending.append(transfer)
+            self.injected_at[transfer['tx_hash']] = time.time()
+        return transfer['tx_hash']
+
+    def trc20_transactions(self, address: str, limit: int = 20, min_timestamp: int = None,
+                           only_to: bool = False, max_timestamp: int = None) -> List[Dict]:
+        """Переводы адреса, новые первыми"""
+        self.advance()
+        result = []
+        with self._lock:
+            for record in self._transfers.get(address, ()):
+                if min_timestamp and record['block_timestamp'] < min_timestamp:
+                    break
+                if max_timestamp and record['block_timestamp'] > max_timestamp:
+                    continue
+                if only_to and record['to'] != address:
+                    continue
+                result.append(record)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def transaction(self, tx_hash: str) -> Optional[Dict]:
+        self.advance()
+        with self._lock:
+            return self._transactions.get(tx_hash)
+
+    def balance(self, address: str) -> int:
+        self.advance()
+        with self._lock:
+            return self.balances.get(address, 0)
+
+    def events_since(self, block_number: int) -> tuple:
+        """События блоков новее block_number: (события, номер последнего блока)"""
+        self.advance()
+        with self._lock:
+            events = [event for block in self.blocks if block['number'] > block_number
+                      for event in block['events']]
+            return events, self.head_number
+
+    def head(self) -> Dict:
+        """Текущий блок"""
+        self.advance()
+        with self._lock:
+            return {'number': self.head_number, 'hash': self.head_hash,
+                    'timestamp': int(self.head_time * 1000)}
+
+    def account_exists(self, address: str) -> bool:
+        self.advance()
+        with self._lock:
+            return address in self.wallets or address in self._transfers
+
+    def recent_blocks(self, count: int) -> List[Dict]:
+        """Последние count блоков, новые первыми"""
+        self.advance()
+        with self._lock:
+            return list(self.blocks)[-count:][::-1] if count > 0 else []
+
+    def reorg(self, depth: int) -> List[str]:
+        """
+        Заменить последние depth блоков блоками другой ветки
+
+        Блоки новой ветки имеют те же номера и время, но другие хеши и не
+        содержат переводов: переводы сиротских блоков исчезают из истории
+        и балансов. Возвращает хеши выброшенных транзакций.
+        """
+        self.advance()
+        with self._lock:
+            orphaned = [block for block in self.blocks if block['number'] > self.head_number - depth]
+            if not orphaned:
+                return []
+            dropped = set()
+            parent = orphaned[0]['parent_hash']
+            for block in orphaned:
+                for transfer in block['transfers']:
+                    dropped.add(transfer['tx_hash'])
+                    self.balances[transfer['to']] -= transfer['value']
+                    self._transactions.pop(transfer['tx_hash'], None)
+                block_hash = self._block_hash(block['number'], bytes.fromhex(parent) + b'fork')
+                block.update(hash=block_hash, parent_hash=parent, transactions=[], transfers=[], events=[])
+                parent = block_hash
+            self.head_hash = parent
+
+            for address in list(self._transfers):
+                records = self._transfers[address]
+                if any(record['transaction_id'] in dropped for record in records):
+                    self._transfers[address] = deque(
+                        (record for record in records if record['transaction_id'] not in dropped),
+                        maxlen=self.history_size)
+        return sorted(dropped)
+
+
+class FakeTronServer:
+    """
+    HTTP сервер поверх SyntheticChain с внедрением задержек и ошибок
+
+    latency / latency_jitter - задержка ответа (секунды), rate_429 и
+    error_rate - вероятность ответа 429 / 503. Параметры можно менять на
+    лету, счетчики запросов - в stats.
+    """
+
+    def __init__(self, chain: SyntheticChain, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, latency_jitter: float = 0.0,
+                 rate_429: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.chain = chain
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self._rng = random.Random()
+        self._stats_lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+        self.routes = [
+            (re.compile(r'^/v1/accounts/(?P<address>\w+)/transactions/trc20$'), self._trc20_transactions),
+            (re.compile(r'^/v1/accounts/(?P<address>\w+)$'), self._account),
+            (re.compile(r'^/v1/transactions/(?P<tx_hash>\w+)$'), self._transaction),
+            (re.compile(r'^/api/account$'), self._tronscan_account),
+            (re.compile(r'^/wallet/getnowblock$'), self._now_block),
+            (re.compile(r'^/wallet/getblockbylatestnum$'), self._latest_blocks),
+        ]
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = None
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, body, headers = fake.handle('GET', self.path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, method: str, raw_path: str):
+        """Обработать запрос: (статус, тело, заголовки)"""
+        self._count('requests')
+        delay = self.latency + (self._rng.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = self._rng.random()
+        if roll < self.rate_429:
+            self._count('injected_429')
+            return 429, {'Error': 'request rate exceeded'}, {'Retry-After': str(self.retry_after)}
+        if roll < self.rate_429 + self.error_rate:
+            self._count('injected_errors')
+            return 503, {'Error': 'service unavailable'}, {}
+
+        parsed = urlparse(raw_path)
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        for pattern, handler in self.routes:
+            match = pattern.match(parsed.path)
+            if match:
+                self._count(handler.__name__.lstrip('_'))
+                return handler(query, **match.groupdict())
+        self._count('not_found')
+        return 404, {'Error': f'unknown path {parsed.path}'}, {}
+
+    def _account(self, query: Dict, address: str):
+        if not self.chain.account_exists(address):
+            return 200, {'data': [], 'success': True, 'meta': {'at': int(time.time() * 1000)}}, {}
+        balance = self.chain.balance(address)
+        account = {
+            'address': base58_to_hex(address),
+            'balance': 0,
+            'trc20': [{config.USDT_CONTRACT_ADDRESS: str(balance)}],
+        }
+        return 200, {'data': [account], 'success': True, 'meta': {'at': int(time.time() * 1000)}}, {}
+
+    def _trc20_transactions(self, query: Dict, address: str):
+        contract = query.get('contract_address')
+        if contract and contract != config.USDT_CONTRACT_ADDRESS:
+            data = []
+        else:
+            data = self.chain.trc20_transactions(
+                address,
+                limit=min(int(query.get('limit', 20)), 200),
+                min_timestamp=int(query['min_timestamp']) if 'min_timestamp' in query else None,
+                only_to=query.get('only_to') == 'true',
+                max_timestamp=int(query['max_timestamp']) if 'max_timestamp' in query else None,
+            )
+        return 200, {'data': data, 'success': True,
+                     'meta': {'at': int(time.time() * 1000), 'page_size': len(data)}}, {}
+
+    def _transaction(self, query: Dict, tx_hash: str):
+        transaction = self.chain.transaction(tx_hash)
+        if transaction is None:
+            return 404, {'Error': 'transaction not found'}, {}
+        return 200, transaction, {}
+
+    def _tronscan_account(self, query: Dict):
+        address = query.get('address', '')
+        return 200, {
+            'address': address,
+            'trc20token_balances': [{
+                'tokenId': config.USDT_CONTRACT_ADDRESS,
+                'balance': str(self.chain.balance(address)),
+                'tokenDecimal': USDT_DECIMALS,
+                'tokenAbbr': 'USDT',
+            }],
+        }, {}
+
+    def _now_block(self, query: Dict):
+        head = self.chain.head()
+        return 200, {
+            'blockID': head['hash'],
+            'block_header': {'raw_data': {'number': head['number'], 'timestamp': head['timestamp']}},
+        }, {}
+
+    def _latest_blocks(self, query: Dict):
+        num = int(query.get('num', 1))
+        if not 0 < num <= 100:
+            return 400, {'Error': 'num must be in (0, 100]'}, {}
+        return 200, {'block': [{
+            'blockID': block['hash'],
+            'block_header': {'raw_data': {'number': block['number'], 'timestamp': block['timestamp'],
+                                          'parentHash': block['parent_hash']}},
+            'transactions': [{'txID': tx_hash} for tx_hash in block['transactions']],
+        } for block in self.chain.recent_blocks(num)]}, {}
+
+    def start(self) -> 'FakeTronServer':
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class EventEmitter:
+    """
+    Локальная замена event server: отправляет события Transfer новых блоков
+
+    send - функция, принимающая список событий (по умолчанию POST на
+    target_url). Пока paused=True, события не отправляются - так
+    имитируется замолчавший поток. Пустая пачка отправляется как heartbeat.
+    """
+
+    def __init__(self, chain: SyntheticChain, target_url: str = None, send=None,
+                 interval: float = None, token: str = None, heartbeat: bool = True):
+        self.chain = chain
+        self.interval = interval if interval is not None else chain.block_interval
+        self.heartbeat = heartbeat
+        self.paused = False
+        self.sent_events = 0
+        self._last_block = chain.head_number
+        self._stop = threading.Event()
+        self._thread = None
+        self.target_url = target_url
+        self._headers = {'X-Event-Token': token} if token else {}
+        self._send = send or self._post
+
+    def _post(self, events: List[Dict]):
+        requests.post(self.target_url, json=events, headers=self._headers, timeout=5)
+
+    def emit_once(self) -> int:
+        """Отправить события, накопившиеся с прошлой отправки"""
+        events, head = self.chain.events_since(self._last_block)
+        if self.paused:
+            return 0
+        self._last_block = head
+        if events or self.heartbeat:
+            self._send(events)
+            self.sent_events += len(events)
+        return len(events)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.emit_once()
+            except Exception as e:
+                print(f"⚠️ Ошибка отправки событий: {e}")
+
+    def start(self) -> 'EventEmitter':
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный фейковый TronGrid / TronScan")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--rate', type=float, default=1.0, help="переводов в секунду")
+    parser.add_argument('--block-interval', type=float, default=TRON_BLOCK_INTERVAL)
+    parser.add_argument('--wallet', action='append', default=[], help="отслеживаемый кошелек (можно несколько)")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--emit-events', help="URL push-приема событий, например http://127.0.0.1:8000/events/tron")
+    parser.add_argument('--event-token', default=config.EVENT_PUSH_TOKEN)
+    args = parser.parse_args()
+
+    chain = SyntheticChain(wallets=args.wallet, rate=args.rate,
+                           block_interval=args.block_interval, seed=args.seed)
+    server = FakeTronServer(chain, args.host, args.port, latency=args.latency,
+                            latency_jitter=args.latency_jitter, rate_429=args.rate_429,
+                            error_rate=args.error_rate)
+    print(f"🚀 Фейковый Tron API: {server.url}")
+    print(f"   TRON_API_URL={server.url} TRONSCAN_API_URL={server.url}")
+    if args.emit_events:
+        EventEmitter(chain, args.emit_events, token=args.event_token).start()
+        print(f"📡 События Transfer -> {args.emit_events}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️ Остановлен")
+        print(f"📊 {dict(server.stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Идемпотентное создание платежей по заголовку Idempotency-Key
+
+Клиент, повторяющий запрос после таймаута, передает тот же
+Idempotency-Key: первый запрос занимает ключ в таблице idempotency_keys
+(поиск по первичному ключу), ответ сохраняется на IDEMPOTENCY_TTL
+секунд, повтор получает сохраненный ответ без новой строки платежа.
+Повтор, пока первый запрос еще выполняется, получает 409; тот же ключ
+с другими параметрами - 422. Ключ занимается на
+IDEMPOTENCY_LOCK_TIMEOUT: если процесс упал посреди запроса, ключ
+освобождается сам. Неуспешный ответ не сохраняется - повтор выполняется
+заново. Истекшие ключи удаляет фоновая задача.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина Idempotency-Key
+MAX_KEY_LENGTH = 255
+
+
+def request_hash(payload: Dict) -> str:
+    """Отпечаток параметров запроса: тот же ключ с другими параметрами - ошибка клиента"""
+    body = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """Ключи идемпотентности в базе (общие для всех воркеров) с TTL и фоновой очисткой"""
+
+    def __init__(self, db: Database, ttl: float = None, lock_timeout: float = None,
+                 purge_interval: float = None):
+        """
+        Args:
+            ttl: Сколько секунд хранится ответ для повторов
+            lock_timeout: Сколько секунд ключ занят выполняющимся запросом
+            purge_interval: Как часто удалять истекшие ключи, секунды
+        """
+        self.db = db
+        self.ttl = ttl if ttl is not None else config.IDEMPOTENCY_TTL
+        self.lock_timeout = lock_timeout if lock_timeout is not None else config.IDEMPOTENCY_LOCK_TIMEOUT
+        self.purge_interval = purge_interval if purge_interval is not None else config.IDEMPOTENCY_PURGE_INTERVAL
+        self._lock = threading.Lock()
+        self.counters = {'claimed': 0, 'replayed': 0, 'in_progress': 0, 'mismatched': 0, 'purged': 0}
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def begin(self, scope: str, key: str, payload: Dict) -> Optional[Dict]:
+        """
+        Занять ключ перед выполнением запроса
+
+        Возвращает сохраненный ответ для повтора или None - ключ занят этим
+        запросом (после выполнения - complete() или release()). Поднимает
+        HTTPException 400/409/422.
+        """
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400,
+                                detail=f"Idempotency-Key должен быть от 1 до {MAX_KEY_LENGTH} символов")
+        fingerprint = request_hash(payload)
+        existing = self.db.claim_idempotency_key(scope, key, fingerprint, time.time(), self.lock_timeout)
+        if existing is None:
+            self._count('claimed')
+            return None
+        if existing['request_hash'] != fingerprint:
+            self._count('mismatched')
+            raise HTTPException(status_code=422,
+                                detail="Idempotency-Key уже использован с другими параметрами запроса")
+        if existing['response'] is None:
+            self._count('in_progress')
+            raise HTTPException(status_code=409, detail="Запрос с этим Idempotency-Key еще выполняется",
+                                headers={'Retry-After': '1'})
+        self._count('replayed')
+        return existing['response']
+
+    def complete(self, scope: str, key: str, response: Dict):
+        """Сохранить ответ для повторов на ttl секунд"""
+        try:
+            self.db.save_idempotent_response(scope, key, response, time.time() + self.ttl)
+        except Exception as e:
+            # Платеж уже создан - ответ клиенту важнее; ключ освободится через lock_timeout
+            logger.error(f"Ошибка сохранения ответа Idempotency-Key: {e}")
+
+    def release(self, scope: str, key: str):
+        """Освободить ключ без ответа (запрос не выполнен, повтор выполнится заново)"""
+        try:
+            self.db.release_idempotency_key(scope, key)
+        except Exception as e:
+            # Ключ освободится сам через lock_timeout
+            logger.error(f"Ошибка освобождения Idempotency-Key: {e}")
+
+    async def run(self):
+        """Фоновое удаление истекших ключей"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                purged = await loop.run_in_executor(None, self.db.purge_idempotency_keys, time.time())
+                self._count('purged', purged)
+            except Exception as e:
+                logger.error(f"Ошибка очистки ключей идемпотентности: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self.counters)
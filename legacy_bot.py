@@ -9,6 +9,7 @@ from telegram import Update
 from telegram.ext import Updater, CommandHandler, CallbackContext
 from database import Database
 from tron_tracker import TronTracker
+from request_executor import TronAPIError
 import config
 
 # Настройка логирования
@@ -222,10 +223,15 @@ class LegacyPaymentBot:
         wallet_address = user_data['wallet_address']
         
         # Получаем информацию об аккаунте
-        account_info = self.tron_tracker.get_account_info(wallet_address)
+        try:
+            account_info = self.tron_tracker.get_account_info(wallet_address)
+            balance = self.tron_tracker.get_balance(wallet_address) if account_info else None
+        except TronAPIError as e:
+            logger.warning(f"Tron API недоступен: {e}")
+            update.message.reply_text("⏳ Tron API временно недоступен. Попробуйте позже.")
+            return
         
         if account_info:
-            balance = self.tron_tracker.get_balance(wallet_address)
             
             update.message.reply_text(
                 f"💰 Баланс кошелька:\n\n"
@@ -37,6 +37,8 @@ class WhitelistManager:
             cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
             cursor.execute('DELETE FROM pending_payments WHERE user_id = ?', (user_id,))
             cursor.execute('DELETE FROM confirmed_payments WHERE user_id = ?', (user_id,))
+            # Сброс кешей статуса платежей пользователя (ETag)
+            self.db._bump_version(cursor, f"user:{user_id}")
             
             conn.commit()
             conn.close()
@@ -123,6 +125,7 @@ class WhitelistManager:
             cursor.execute('DELETE FROM users')
             cursor.execute('DELETE FROM pending_payments')
             cursor.execute('DELETE FROM confirmed_payments')
+            cursor.execute("UPDATE versions SET version = version + 1 WHERE name LIKE 'user:%'")
             
             conn.commit()
             conn.close()
@@ -0,0 +1,399 @@
+"""
+Метрики сервисов в текстовом формате Prometheus (exposition format 0.0.4)
+
+Счетчики (Counter), значения (Gauge) и гистограммы (Histogram) с
+метками хранятся в памяти процесса и отдаются эндпоинтом /metrics
+каждого сервиса (install). Внешняя библиотека не нужна: формат
+совместим с Prometheus, VictoriaMetrics и т.п. Метрики общие для всех
+модулей процесса: TronTracker пишет запросы к upstream, Database -
+задержку каждого метода (один метод - один запрос или транзакция),
+фоновые опросы - длительность цикла, зачисления - задержку обнаружения
+платежа (время блока -> зачисление). Значения, которые дешевле считать
+в момент опроса (очередь callback'ов), задаются функцией
+(Gauge.set_function).
+
+Под uvicorn --workers N у каждого воркера свои метрики: Prometheus
+складывает их по меткам instance/pod при опросе каждого воркера.
+"""
+
+import bisect
+import functools
+import inspect
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм задержки по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple = ()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, '_Metric'] = {}
+
+    def register(self, metric: '_Metric'):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values, **labels):
+        """Значение метрики для набора меток (создается при первом обращении)"""
+        if labels:
+            values = tuple(str(labels[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def _unlabeled(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"]
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется при каждом опросе /metrics"""
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception as e:
+                logger.warning(f"Ошибка вычисления метрики: {e}")
+                return math.nan
+        with self._lock:
+            return self._value
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._unlabeled().inc(amount)
+
+
+class Gauge(_Metric):
+    """Текущее значение"""
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._unlabeled().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._unlabeled().set_function(function)
+
+
+class _Observations:
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Контекстный менеджер: наблюдение - длительность блока"""
+        return _Timer(self.observe)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class _Timer:
+    def __init__(self, observe: Callable[[float], None]):
+        self.observe = observe
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(time.perf_counter() - self.started)
+
+
+class Histogram(_Metric):
+    """Распределение значений по накопительным корзинам (_bucket, _sum, _count)"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional[Registry] = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _Observations(self.buckets)
+
+    def observe(self, value: float):
+        self._unlabeled().observe(value)
+
+    def time(self):
+        return self._unlabeled().time()
+
+    def _render_child(self, values, child) -> List[str]:
+        counts, total, count = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, values, (('le', _format_value(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values, (('le', '+Inf'),))
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        plain = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{plain} {_format_value(total)}")
+        lines.append(f"{self.name}_count{plain} {count}")
+        return lines
+
+
+# Upstream (Tron API)
+TRON_API_REQUESTS = Counter('tron_api_requests_total', 'Запросы к Tron API по провайдеру, вызову и статусу',
+                            ('provider', 'endpoint', 'status'))
+TRON_API_REQUEST_SECONDS = Histogram('tron_api_request_seconds', 'Задержка запросов к Tron API',
+                                     ('provider', 'endpoint'))
+TRON_API_QUOTA_REMAINING = Gauge('tron_api_quota_remaining',
+                                 'Остаток суточной квоты Tron API (TRON_API_DAILY_QUOTA) по запросам процесса')
+
+# База данных
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Задержка методов Database (запрос или транзакция SQLite)',
+                             ('query',), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
+# Фоновые опросы и зачисление
+POLL_CYCLE_SECONDS = Histogram('poll_cycle_seconds', 'Длительность цикла фонового опроса', ('poller',))
+PAYMENT_DETECTION_SECONDS = Histogram('payment_detection_seconds',
+                                      'Задержка обнаружения платежа: время блока -> зачисление', ('service',),
+                                      buckets=(1, 3, 5, 10, 15, 30, 60, 120, 300, 600, 1800))
+
+# Callback'и
+CALLBACK_BACKLOG = Gauge('callback_backlog', 'Очередь callback\'ов outbox (pending, due, dead)', ('state',))
+CALLBACK_DELIVERIES = Counter('callback_deliveries_total', 'Результаты попыток доставки callback\'ов',
+                              ('result',))
+
+# API ключи
+# Остаток квоты каждого ключа - только в /admin/usage: метка на ключ растет без предела
+API_KEYS_QUOTA_EXHAUSTED = Gauge('api_keys_quota_exhausted',
+                                 'API ключи с исчерпанной суточной квотой (по последней сверке воркера)')
+RATE_LIMIT_REJECTIONS = Counter('rate_limit_rejections_total', 'Отказы 429 по группе эндпоинтов и причине',
+                                ('scope', 'reason'))
+
+# HTTP сервисов
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP запросы к сервису', ('service', 'method', 'route', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('http_request_seconds', 'Длительность обработки HTTP запроса',
+                                 ('service', 'route'))
+
+
+class UpstreamQuota:
+    """Остаток суточной (UTC) квоты Tron API по запросам этого процесса"""
+
+    def __init__(self, daily_quota: int = None):
+        self.daily_quota = daily_quota if daily_quota is not None else config.TRON_API_DAILY_QUOTA
+        self._lock = threading.Lock()
+        self._day = None
+        self._used = 0
+        TRON_API_QUOTA_REMAINING.set(self.daily_quota)
+
+    def record(self, now: float = None):
+        day = datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc).date()
+        with self._lock:
+            if day != self._day:
+                self._day, self._used = day, 0
+            self._used += 1
+            remaining = max(0, self.daily_quota - self._used)
+        TRON_API_QUOTA_REMAINING.set(remaining)
+
+
+upstream_quota = UpstreamQuota()
+
+
+def observe_upstream(provider: str, endpoint: str, status, seconds: float):
+    """Учесть один HTTP запрос к провайдеру Tron API"""
+    TRON_API_REQUESTS.labels(provider, endpoint, status).inc()
+    TRON_API_REQUEST_SECONDS.labels(provider, endpoint).observe(seconds)
+    upstream_quota.record()
+
+
+def observe_detection(service: str, block_timestamp_ms: Optional[int], now: float = None):
+    """Задержка от времени блока перевода до зачисления"""
+    if not block_timestamp_ms:
+        return
+    now = now if now is not None else time.time()
+    PAYMENT_DETECTION_SECONDS.labels(service).observe(max(0.0, now - block_timestamp_ms / 1000))
+
+
+def track_callback_backlog(get_db: Callable):
+    """Очередь callback'ов outbox считается запросом к базе get_db() при каждом опросе /metrics"""
+    def state(name):
+        return lambda: get_db().get_callback_backlog(time.time())[name]
+    for name in ('pending', 'due', 'dead'):
+        CALLBACK_BACKLOG.labels(name).set_function(state(name))
+
+
+def timed_methods(histogram: Histogram, exclude: Iterable[str] = ()):
+    """Декоратор класса: задержка каждого публичного метода - в histogram с меткой-именем метода"""
+    exclude = set(exclude)
+
+    def decorate(cls):
+        for name, member in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not inspect.isfunction(member):
+                continue
+            setattr(cls, name, _timed(member, histogram, name))
+        return cls
+    return decorate
+
+
+def _timed(function: Callable, histogram: Histogram, label: str) -> Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.labels(label).observe(time.perf_counter() - started)
+    return wrapper
+
+
+class HTTPMetricsMiddleware:
+    """ASGI middleware: число и длительность HTTP запросов по шаблону пути (не по конкретному id)"""
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            path = getattr(route, 'path', 'unmatched')
+            HTTP_REQUESTS.labels(self.service, scope['method'], path, status[0]).inc()
+            HTTP_REQUEST_SECONDS.labels(self.service, path).observe(time.perf_counter() - started)
+
+
+def install(app, service: str):
+    """Подключить к FastAPI приложению учет HTTP запросов и эндпоинт GET /metrics"""
+    from fastapi.responses import Response
+
+    app.add_middleware(HTTPMetricsMiddleware, service=service)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_endpoint():
+        """Метрики процесса в формате Prometheus"""
+        return Response(content=REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
@@ -6,12 +6,20 @@ API сервер для платежной системы
 
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import secrets
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Header, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List, Dict
 import uvicorn
 from payment_integration import PaymentIntegration
+from api_auth import ApiKeyAuth
+from database import API_KEY_SCOPE_MERCHANT, API_KEY_SCOPE_USER
+from rate_limiter import require_admin
+from idempotency import IdempotencyStore
+from response_cache import ResponseCache
+from shared_state import SharedBus, LeaderLease
+import metrics
 import config
 
 # Настройка логирования
@@ -34,8 +42,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Метрики Prometheus: GET /metrics
+metrics.install(app, 'payment_api')
+
 # Инициализация платежной системы
 payment_system = PaymentIntegration()
+metrics.track_callback_backlog(lambda: payment_system.db)
+
+# API ключи подписок: хеши в базе, кеш проверки в процессе
+api_auth = ApiKeyAuth(payment_system.db)
+
+# Idempotency-Key создания платежей
+idempotency = IdempotencyStore(payment_system.db)
+
+# Готовые ответы на чтение по версии платежей пользователя (ETag, 304)
+response_cache = ResponseCache()
+
+# Несколько воркеров: события WebSocket из любого воркера доходят до всех,
+# Tron API опрашивает только лидер (остальные воркеры обслуживают запросы)
+shared_bus = SharedBus(payment_system.db)
+payment_system.share_events(shared_bus)
+poller_leader = LeaderLease(payment_system.db, 'payment_api.poller')
 
 # Модели данных
 class PaymentRequest(BaseModel):
@@ -61,6 +88,10 @@ class BalanceResponse(BaseModel):
     currency: Optional[str] = None
     error: Optional[str] = None
 
+class ApiKeyRequest(BaseModel):
+    user_id: int = 0
+    scope: str = API_KEY_SCOPE_USER
+
 class PaymentCallback(BaseModel):
     user_id: int
     amount: float
@@ -68,9 +99,6 @@ class PaymentCallback(BaseModel):
     transaction_hash: str
     wallet_address: str
 
-# Глобальный словарь для хранения callback функций
-payment_callbacks: Dict[int, callable] = {}
-
 @app.get("/")
 async def root():
     """Корневой endpoint"""
@@ -85,7 +113,9 @@ async def root():
             "/payment/auto - Настроить автоматический платеж",
             "/payment/status - Статус платежей",
             "/payment/balance - Баланс кошелька",
-            "/payment/callback - Регистрация callback"
+            "/payment/callback - Регистрация callback",
+            "/events/tron - Прием событий Transfer (push)",
+            "/ws/payments - WebSocket подписка на события платежей"
         ]
     }
 
@@ -95,12 +125,35 @@ async def health_check():
     return {
         "status": "healthy",
         "payment_system": "active",
-        "database": "connected"
+        "database": "connected",
+        "ingestion": payment_system.events.stats(),
+        "confirmations": payment_system.confirmations.stats(),
+        "ledger": payment_system.ledger.stats(),
+        "sweeper": payment_system.sweeper.stats(),
+        "stream": payment_system.stream.stats(),
+        "callbacks": payment_system.callbacks.stats(),
+        "auth": api_auth.stats(),
+        "idempotency": idempotency.stats(),
+        "response_cache": response_cache.stats(),
+        "worker": poller_leader.stats(),
+        "shared_bus": shared_bus.stats()
     }
 
 @app.post("/payment/create", response_model=PaymentStatusResponse)
-async def create_payment(request: PaymentRequest):
-    """Создание платежа"""
+async def create_payment(request: PaymentRequest, response: Response,
+                         idempotency_key: Optional[str] = Header(None)):
+    """
+    Создание платежа
+    
+    С заголовком Idempotency-Key повтор запроса получает ответ первого,
+    второй ожидающий платеж не создается.
+    """
+    if idempotency_key:
+        replay = idempotency.begin('payment_api', idempotency_key, request.model_dump())
+        if replay is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return PaymentStatusResponse(**replay)
+    
     try:
         result = await payment_system.create_payment_request(
             user_id=request.user_id,
@@ -108,20 +161,27 @@ async def create_payment(request: PaymentRequest):
             currency=request.currency,
             description=request.description
         )
-        
-        if result['success']:
-            return PaymentStatusResponse(
-                success=True,
-                data=result
-            )
-        else:
-            return PaymentStatusResponse(
-                success=False,
-                error=result['error']
-            )
     except Exception as e:
         logger.error(f"Ошибка создания платежа: {e}")
+        if idempotency_key:
+            idempotency.release('payment_api', idempotency_key)
         raise HTTPException(status_code=500, detail=str(e))
+    
+    if not result['success']:
+        if idempotency_key:
+            idempotency.release('payment_api', idempotency_key)
+        return PaymentStatusResponse(
+            success=False,
+            error=result['error']
+        )
+    
+    created = PaymentStatusResponse(
+        success=True,
+        data=result
+    )
+    if idempotency_key:
+        idempotency.complete('payment_api', idempotency_key, created.model_dump())
+    return created
 
 @app.post("/payment/auto", response_model=PaymentStatusResponse)
 async def setup_auto_payment(request: AutoPaymentRequest):
@@ -148,21 +208,34 @@ async def setup_auto_payment(request: AutoPaymentRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/payment/status/{user_id}", response_model=PaymentStatusResponse)
-async def get_payment_status(user_id: int, payment_id: Optional[int] = None):
-    """Получение статуса платежей"""
-    try:
+async def get_payment_status(user_id: int, payment_id: Optional[int] = None,
+                             if_none_match: Optional[str] = Header(None)):
+    """
+    Получение статуса платежей
+    
+    ETag - версия платежей пользователя (поднимается при создании,
+    подтверждении, истечении и откате платежа): при совпадении
+    If-None-Match ответ 304, иначе тело из кеша по версии. Ответ с
+    ошибкой не кешируется.
+    """
+    async def build():
         result = await payment_system.check_payment_status(user_id, payment_id)
         
         if result['success']:
             return PaymentStatusResponse(
                 success=True,
                 data=result
-            )
+            ), True
         else:
+            # Ответ с ошибкой не кешируется: ошибка может быть временной
             return PaymentStatusResponse(
                 success=False,
                 error=result['error']
-            )
+            ), False
+    
+    try:
+        version = payment_system.db.get_version(f"user:{user_id}")
+        return await response_cache.respond(f"status:{user_id}:{payment_id}", version, build, if_none_match)
     except Exception as e:
         logger.error(f"Ошибка получения статуса платежей: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -191,11 +264,9 @@ async def get_wallet_balance(user_id: int):
 
 @app.post("/payment/callback/{user_id}")
 async def register_callback(user_id: int, callback_url: str):
-    """Регистрация callback URL для уведомлений о платежах"""
+    """Регистрация callback URL для уведомлений о платежах (доставка через outbox с повторами)"""
     try:
-        # Здесь можно добавить логику для HTTP callback'ов
-        # Пока просто сохраняем URL
-        payment_callbacks[user_id] = callback_url
+        payment_system.db.set_callback_url(user_id, callback_url)
         
         logger.info(f"Зарегистрирован callback для пользователя {user_id}: {callback_url}")
         
@@ -212,8 +283,7 @@ async def register_callback(user_id: int, callback_url: str):
 async def unregister_callback(user_id: int):
     """Отмена регистрации callback"""
     try:
-        if user_id in payment_callbacks:
-            del payment_callbacks[user_id]
+        if payment_system.db.delete_callback_url(user_id):
             logger.info(f"Отменена регистрация callback для пользователя {user_id}")
             return {
                 "success": True,
@@ -230,33 +300,169 @@ async def unregister_callback(user_id: int):
 
 @app.get("/payment/callbacks")
 async def list_callbacks():
-    """Список зарегистрированных callback'ов"""
+    """Список зарегистрированных callback'ов и dead-letter доставки"""
+    callback_urls = payment_system.db.get_callback_urls()
     return {
         "success": True,
-        "callbacks": list(payment_callbacks.keys()),
-        "count": len(payment_callbacks)
+        "callbacks": list(callback_urls.keys()),
+        "count": len(callback_urls),
+        "dead_letter": payment_system.db.get_dead_callbacks()
     }
 
 @app.get("/payment/info")
-async def get_payment_info():
-    """Информация о платежной системе"""
-    try:
-        info = payment_system.get_integration_info()
+async def get_payment_info(if_none_match: Optional[str] = Header(None)):
+    """Информация о платежной системе (меняется только с версией сервиса)"""
+    def build():
         return {
             "success": True,
-            "info": info
-        }
+            "info": payment_system.get_integration_info()
+        }, True
+    
+    try:
+        return await response_cache.respond("payment-info", app.version, build, if_none_match,
+                                            cache_control="public, max-age=3600")
     except Exception as e:
         logger.error(f"Ошибка получения информации: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/api-keys", dependencies=[Depends(require_admin)])
+async def create_api_key(request: ApiKeyRequest):
+    """
+    Выпуск API ключа (заголовок X-Admin-Token)
+    
+    scope 'user' - только события пользователя user_id, 'merchant' - все
+    пользователи. Ключ возвращается один раз, в базе хранится хеш.
+    """
+    if request.scope not in (API_KEY_SCOPE_USER, API_KEY_SCOPE_MERCHANT):
+        raise HTTPException(status_code=400, detail="scope должен быть 'user' или 'merchant'")
+    api_key = api_auth.create_key(request.user_id, request.scope)
+    return {"success": True, "api_key": api_key, "user_id": request.user_id, "scope": request.scope}
+
+@app.post("/events/tron")
+async def receive_tron_events(request: Request, x_event_token: Optional[str] = Header(None)):
+    """
+    Прием событий Transfer от TronGrid event server или event plugin ноды
+    
+    Тело - список событий, {"events": [...]} или одно событие. Пустой
+    список - heartbeat: поток жив, опрос кошельков не нужен. Без
+    EVENT_PUSH_TOKEN прием выключен: иначе любой мог бы подменить
+    события и остановить опрос кошельков heartbeat'ами. Событие может
+    прийти в любой воркер: heartbeat и курсор доходят до лидера опроса
+    через SharedBus (EventIngestor.share).
+    """
+    if not config.EVENT_PUSH_TOKEN or not secrets.compare_digest(x_event_token or '', config.EVENT_PUSH_TOKEN):
+        raise HTTPException(status_code=401, detail="Неверный X-Event-Token")
+    
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Тело запроса должно быть JSON")
+    
+    if isinstance(body, dict):
+        events = body.get('events', [body] if body else [])
+    elif isinstance(body, list):
+        events = body
+    else:
+        raise HTTPException(status_code=400, detail="Ожидается список событий")
+    
+    # Сверка с сетью - запросы к Tron API, вне цикла событий
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
+        None, payment_system.events.ingest, [event for event in events if isinstance(event, dict)])
+    return {"success": True, **result}
+
+def _id_set(value: Optional[str]) -> set:
+    """'1,2,3' -> {'1', '2', '3'}"""
+    return {item.strip() for item in (value or '').split(',') if item.strip()}
+
+@app.websocket("/ws/payments")
+async def payment_events_socket(websocket: WebSocket):
+    """
+    Подписка мерчанта на события платежей (WebSocket)
+    
+    Параметры запроса:
+    - api_key (или заголовок X-API-Key): ключ мерчанта (scope 'merchant',
+      выпускается через POST /admin/api-keys) видит всех пользователей,
+      остальные ключи - только платежи своего user_id
+    - user_ids, wallets: подписка на набор пользователей / кошельков
+      через запятую (без них - все доступные ключу события)
+    - since: последний полученный seq - пропущенные события отдаются
+      после переподключения
+    
+    Сообщения: {"seq", "type", "timestamp", "data"}, type - payment.created,
+    payment.confirmed, payment.expired, payment.reversed или reset (часть
+    пропущенных событий недоступна - состояние нужно перечитать). Клиент,
+    не успевающий читать WS_SEND_QUEUE_SIZE событий, отключается с кодом
+    1013 и переподключается с since.
+    """
+    params = websocket.query_params
+    api_key = params.get('api_key') or websocket.headers.get('x-api-key')
+    principal = api_auth.authenticate(api_key) if api_key else None
+    if principal is None:
+        await websocket.close(code=1008, reason="Неверный API ключ")
+        return
+    
+    key_user = principal['user_id']
+    merchant = principal.get('scope') == API_KEY_SCOPE_MERCHANT
+    
+    try:
+        user_ids = {int(user_id) for user_id in _id_set(params.get('user_ids'))}
+        since = int(params['since']) if params.get('since') else None
+    except ValueError:
+        await websocket.close(code=1008, reason="user_ids и since должны быть числами")
+        return
+    wallets = _id_set(params.get('wallets'))
+    
+    def accepts(event: Dict) -> bool:
+        data = event['data']
+        if not merchant and data.get('user_id') != key_user:
+            return False
+        if user_ids and data.get('user_id') not in user_ids:
+            return False
+        if wallets and data.get('wallet_address') not in wallets:
+            return False
+        return True
+    
+    await websocket.accept()
+    with payment_system.stream.subscribe(accepts, since) as subscription:
+        # Входящие сообщения не нужны, но без чтения не узнать об отключении клиента
+        receiver = asyncio.create_task(websocket.receive())
+        sender = asyncio.create_task(subscription.next())
+        try:
+            while True:
+                done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+                if receiver in done:
+                    if receiver.result()['type'] == 'websocket.disconnect':
+                        return
+                    receiver = asyncio.create_task(websocket.receive())
+                if sender in done:
+                    event = sender.result()
+                    if event is None:
+                        await websocket.close(code=1013, reason="Клиент не успевает читать события")
+                        return
+                    await websocket.send_json(event)
+                    sender = asyncio.create_task(subscription.next())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receiver.cancel()
+            sender.cancel()
+
 # Фоновая задача для обработки платежей
 async def process_payments_task():
     """Фоновая задача для обработки платежей"""
     while True:
         try:
+            if not poller_leader.is_leader:
+                # Опрашивает другой воркер; аренда перепроверяется фоновой задачей
+                await asyncio.sleep(poller_leader.ttl / 3)
+                continue
             await payment_system.process_payments()
-            await asyncio.sleep(config.CHECK_INTERVAL)
+            # Пока идут push-события, цикл только продвигает подтверждения - раз в блок
+            if payment_system.events.push_active():
+                await asyncio.sleep(config.TRON_BLOCK_TIME)
+            else:
+                await asyncio.sleep(config.CHECK_INTERVAL)
         except Exception as e:
             logger.error(f"Ошибка в фоновой задаче обработки платежей: {e}")
             await asyncio.sleep(60)  # Ждем минуту при ошибке
@@ -266,8 +472,16 @@ async def startup_event():
     """Событие запуска приложения"""
     logger.info("🚀 Запуск Payment Bot API...")
     
+    # Лидер опроса выбирается до запуска задач; события других воркеров - через канал
+    poller_leader.renew()
+    asyncio.create_task(poller_leader.run())
+    asyncio.create_task(shared_bus.run())
     # Запускаем фоновую задачу обработки платежей
     asyncio.create_task(process_payments_task())
+    # Доставка HTTP callback'ов из outbox
+    asyncio.create_task(payment_system.callbacks.run())
+    asyncio.create_task(api_auth.run())
+    asyncio.create_task(idempotency.run())
     
     logger.info("✅ Payment Bot API запущен успешно")
 
@@ -275,6 +489,8 @@ async def startup_event():
 async def shutdown_event():
     """Событие остановки приложения"""
     logger.info("🛑 Остановка Payment Bot API...")
+    api_auth.flush_usage()
+    poller_leader.release()
 
 if __name__ == "__main__":
     # Запуск сервера
@@ -37,7 +37,8 @@ class PaymentClient:
         if self.session:
             await self.session.close()
     
-    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict[str, Any]:
+    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None,
+                            headers: Optional[Dict] = None) -> Dict[str, Any]:
         """
         Выполнение HTTP запроса
         
@@ -45,6 +46,7 @@ class PaymentClient:
             method: HTTP метод
             endpoint: Endpoint API
             data: Данные для отправки
+            headers: Дополнительные заголовки
             
         Returns:
             Ответ от API
@@ -59,7 +61,7 @@ class PaymentClient:
                 async with self.session.get(url) as response:
                     result = await response.json()
             elif method.upper() == "POST":
-                async with self.session.post(url, json=data) as response:
+                async with self.session.post(url, json=data, headers=headers) as response:
                     result = await response.json()
             elif method.upper() == "DELETE":
                 async with self.session.delete(url) as response:
@@ -80,7 +82,8 @@ class PaymentClient:
             raise
     
     async def create_payment(self, user_id: int, amount: float, 
-                           currency: str = "USDT", description: Optional[str] = None) -> Dict[str, Any]:
+                           currency: str = "USDT", description: Optional[str] = None,
+                           idempotency_key: Optional[str] = None) -> Dict[str, Any]:
         """
         Создание платежа
         
@@ -89,6 +92,8 @@ class PaymentClient:
             amount: Сумма платежа
             currency: Валюта
             description: Описание платежа
+            idempotency_key: Ключ идемпотентности: повтор с тем же ключом
+                вернет уже созданный платеж
             
         Returns:
             Результат создания платежа
@@ -100,7 +105,8 @@ class PaymentClient:
             "description": description
         }
         
-        return await self._make_request("POST", "/payment/create", data)
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        return await self._make_request("POST", "/payment/create", data, headers=headers)
     
     async def setup_auto_payment(self, user_id: int, wallet_address: str, 
                                description: Optional[str] = None) -> Dict[str, Any]:
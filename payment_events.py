@@ -0,0 +1,185 @@
+"""
+Внутрипроцессные события об изменении статуса платежей
+
+Long-poll и SSE эндпоинты подписываются на ключ (ID платежа или кошелек)
+и держат соединение, пока фоновый опрос не опубликует событие - без
+повторных проверок upstream на каждый запрос клиента. Подписка
+оформляется до чтения текущего статуса, поэтому событие между чтением и
+ожиданием не теряется. publish можно вызывать из любого потока.
+
+PaymentEventLog - общий поток событий для WebSocket подписок мерчантов:
+каждое событие получает возрастающий номер (seq), последние
+WS_REPLAY_SIZE событий хранятся для продолжения после переподключения.
+Очередь подписчика ограничена WS_SEND_QUEUE_SIZE: медленный потребитель
+отключается и продолжает с последнего полученного seq, а не копит
+память сервера.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentEvents:
+    """Подписки asyncio.Queue по ключу и публикация событий"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # ключ -> [(цикл событий подписчика, очередь)]
+        self._subscribers: Dict[object, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self.published_total = 0
+        self.delivered_total = 0
+
+    @contextmanager
+    def subscription(self, key):
+        """Подписка на события ключа на время блока with (внутри цикла событий)"""
+        entry = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers.setdefault(key, []).append(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(key, [])
+                if entry in subscribers:
+                    subscribers.remove(entry)
+                if not subscribers:
+                    self._subscribers.pop(key, None)
+
+    def publish(self, key, event: Dict) -> int:
+        """Разбудить подписчиков ключа; возвращает их число"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+            self.published_total += 1
+            self.delivered_total += len(subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # Цикл подписчика уже закрыт
+                logger.debug(f"Подписчик {key} недоступен")
+        return len(subscribers)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'keys': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'published_total': self.published_total,
+                'delivered_total': self.delivered_total,
+            }
+
+
+class Subscription:
+    """Подписка на поток событий: очередь и фильтр"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue_size: int,
+                 accepts: Callable[[Dict], bool]):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size + 1)
+        self.queue_size = queue_size
+        self.accepts = accepts
+        self.overflowed = False
+        # Пропущенные события из буфера отдаются до новых и не занимают очередь
+        self.backlog: deque = deque()
+
+    def offer(self, event: Dict):
+        """Положить событие в очередь (в цикле подписчика)"""
+        if self.overflowed:
+            return
+        if self.queue.qsize() >= self.queue_size:
+            # Потребитель не успевает: очередь сбрасывается, None - сигнал отключения
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(event)
+
+    async def next(self) -> Optional[Dict]:
+        """Следующее событие; None - очередь переполнена, клиент отключается"""
+        if self.backlog:
+            return self.backlog.popleft()
+        return await self.queue.get()
+
+
+class PaymentEventLog:
+    """Нумерованный поток событий платежей с буфером для продолжения"""
+
+    def __init__(self, replay_size: int = None, queue_size: int = None):
+        self.replay_size = replay_size if replay_size is not None else config.WS_REPLAY_SIZE
+        self.queue_size = queue_size if queue_size is not None else config.WS_SEND_QUEUE_SIZE
+        self._lock = threading.Lock()
+        self._events: deque = deque(maxlen=self.replay_size)
+        self._subscriptions: List[Subscription] = []
+        self.seq = 0
+        self.counters = {'published': 0, 'replayed': 0, 'resets': 0, 'overflows': 0}
+
+    def publish(self, event_type: str, data: Dict, seq: Optional[int] = None) -> Dict:
+        """
+        Опубликовать событие (payment.created, payment.confirmed, ...) из любого потока
+
+        seq - номер события, общий для всех воркеров (номер в канале
+        SharedBus); без него номер следующий по порядку в процессе.
+        """
+        with self._lock:
+            self.seq = max(self.seq, seq) if seq is not None else self.seq + 1
+            event = {'seq': seq if seq is not None else self.seq, 'type': event_type,
+                     'timestamp': time.time(), 'data': data}
+            self._events.append(event)
+            self.counters['published'] += 1
+            subscriptions = [s for s in self._subscriptions if s.accepts(event)]
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, event)
+            except RuntimeError:
+                logger.debug("Цикл подписчика уже закрыт")
+        return event
+
+    @contextmanager
+    def subscribe(self, accepts: Callable[[Dict], bool], since: Optional[int] = None):
+        """
+        Подписка на события, прошедшие фильтр accepts (внутри цикла событий)
+
+        since - последний полученный клиентом seq: сначала отдаются
+        пропущенные события из буфера. Если часть пропущенных уже вытеснена
+        (или seq из прошлого запуска сервера), первым идет событие 'reset' -
+        клиенту нужно перечитать состояние через REST.
+        """
+        subscription = Subscription(asyncio.get_running_loop(), self.queue_size, accepts)
+        with self._lock:
+            if since is not None:
+                oldest = self._events[0]['seq'] if self._events else self.seq + 1
+                if since > self.seq or since + 1 < oldest:
+                    self.counters['resets'] += 1
+                    subscription.backlog.append({'seq': oldest - 1, 'type': 'reset', 'timestamp': time.time(),
+                                                 'data': {'oldest_seq': oldest}})
+                    since = 0
+                for event in self._events:
+                    if event['seq'] > since and accepts(event):
+                        subscription.backlog.append(event)
+                        self.counters['replayed'] += 1
+            self._subscriptions.append(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                self._subscriptions.remove(subscription)
+                if subscription.overflowed:
+                    self.counters['overflows'] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats['seq'] = self.seq
+            stats['buffered'] = len(self._events)
+            stats['subscriptions'] = len(self._subscriptions)
+        return stats
@@ -6,10 +6,18 @@
 
 import asyncio
 import logging
+import time
 from typing import Optional, Dict, List, Callable
 from database import Database
 from tron_tracker import TronTracker
+from chain_ledger import ChainLedger
+from confirmation_pipeline import ConfirmationPipeline
+from event_ingestion import EventIngestor
+from payment_sweeper import PaymentSweeper
+from payment_events import PaymentEventLog
+from callback_outbox import CallbackDispatcher
 import config
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +35,24 @@ class PaymentIntegration:
         """
         self.db = Database()
         self.tron_tracker = TronTracker()
+        # Зачисление только после CONFIRMATION_BLOCKS блоков
+        self.confirmations = ConfirmationPipeline(self.db, self.tron_tracker)
+        # Журнал зачислений с хешем блока, откат при реорганизации
+        self.ledger = ChainLedger(self.db, self.tron_tracker)
+        # Push-прием событий; при тишине потока process_payments опрашивает кошельки
+        self.events = EventIngestor(self.confirmations, self.get_auto_mode_wallets)
+        # Истечение неоплаченных платежей (не чаще SWEEP_INTERVAL)
+        self.sweeper = PaymentSweeper(self.db, callback_payload=self._expired_callback)
+        # Поток событий платежей для WebSocket подписок (payment_api /ws/payments)
+        self.stream = PaymentEventLog()
+        # Канал событий между воркерами (share_events); без него поток только в этом процессе
+        self.bus = None
+        # HTTP callback'и на URL пользователей (payment_api /payment/callback) через outbox
+        self.callbacks = CallbackDispatcher(self.db)
         self.bot_token = bot_token
-        self.payment_callbacks = {}  # Словарь для хранения callback функций
+        # Функции этого процесса (бот со встроенной интеграцией); HTTP callback'и - через outbox в базе
+        self.payment_callbacks = {}
+        self.expiry_callbacks = {}  # callback при истечении платежа пользователя
         
     def register_payment_callback(self, user_id: int, callback: Callable):
         """
@@ -52,6 +76,48 @@ class PaymentIntegration:
             del self.payment_callbacks[user_id]
             logger.info(f"Отменена регистрация callback для пользователя {user_id}")
     
+    def share_events(self, bus):
+        """
+        Публиковать события потока через SharedBus
+
+        Событие, опубликованное в любом воркере (например, зачисление в
+        воркере-лидере опроса), доходит до WebSocket подписчиков всех
+        воркеров с общим номером seq. Через тот же канал воркеры делятся
+        состоянием push-потока событий Transfer.
+        """
+        self.bus = bus
+        self.events.share(bus)
+        bus.subscribe('payment_stream',
+                      lambda event, event_id: self.stream.publish(event['type'], event['data'], seq=event_id))
+    
+    def publish_event(self, event_type: str, data: Dict):
+        """Событие потока платежей (payment.created, payment.confirmed, ...)"""
+        if self.bus is not None:
+            self.bus.publish('payment_stream', {'type': event_type, 'data': data})
+        else:
+            self.stream.publish(event_type, data)
+    
+    def register_expiry_callback(self, user_id: int, callback: Callable):
+        """
+        Регистрация callback функции для уведомления об истечении платежей
+        
+        Args:
+            user_id: ID пользователя
+            callback: Функция (user_id, payment_id, amount, currency)
+        """
+        self.expiry_callbacks[user_id] = callback
+    
+    @staticmethod
+    def _expired_callback(table: str, payment: Dict) -> Dict:
+        """Тело HTTP callback'а об истечении платежа"""
+        return {
+            'event': 'payment.expired',
+            'payment_id': payment['id'],
+            'user_id': payment['user_id'],
+            'amount': payment['amount'],
+            'currency': payment['currency']
+        }
+    
     async def create_payment_request(self, user_id: int, amount: float, 
                                    currency: str = "USDT", 
                                    description: str = None) -> Dict:
@@ -82,10 +148,13 @@ class PaymentIntegration:
             payment_id = self.db.add_pending_payment(
                 user_id, amount, currency, wallet_address
             )
-            
-            # Регистрируем callback для уведомлений
-            if user_id not in self.payment_callbacks:
-                self.payment_callbacks[user_id] = None
+            self.publish_event('payment.created', {
+                'payment_id': payment_id,
+                'user_id': user_id,
+                'wallet_address': wallet_address,
+                'amount': amount,
+                'currency': currency
+            })
             
             return {
                 'success': True,
@@ -127,10 +196,6 @@ class PaymentIntegration:
             # Добавляем кошелек для отслеживания
             self.db.add_tracked_wallet(wallet_address, user_id)
             
-            # Регистрируем callback для уведомлений
-            if user_id not in self.payment_callbacks:
-                self.payment_callbacks[user_id] = None
-            
             return {
                 'success': True,
                 'wallet_address': wallet_address,
@@ -256,66 +321,135 @@ class PaymentIntegration:
                 'error': str(e)
             }
     
+    def get_auto_mode_wallets(self) -> Dict[str, int]:
+        """Кошельки пользователей с автоматическим режимом: {кошелек: user_id}"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, wallet_address 
+            FROM users 
+            WHERE wallet_address IS NOT NULL AND wallet_address != '' AND auto_mode = 1
+        ''')
+        users = cursor.fetchall()
+        conn.close()
+        return {wallet_address: user_id for user_id, wallet_address in users}
+    
     async def process_payments(self):
         """
         Обработка платежей (вызывается периодически)
+        
+        Пока жив push-поток событий, кошельки не опрашиваются - переводы
+        приходят через self.events. При тишине потока - опрос с курсора.
         """
+        started = time.perf_counter()
         try:
-            # Получаем всех пользователей с включенным автоматическим режимом
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, wallet_address 
-                FROM users 
-                WHERE wallet_address IS NOT NULL AND wallet_address != '' AND auto_mode = 1
-            ''')
-            users = cursor.fetchall()
-            conn.close()
-            
+            # Новый цикл опроса - бюджет повторов Tron API восстанавливается
+            self.tron_tracker.start_cycle()
+
+            if not self.events.push_active():
+                # Получаем всех пользователей с включенным автоматическим режимом
+                users = [(user_id, wallet) for wallet, user_id in self.get_auto_mode_wallets().items()]
+                min_timestamp = self.events.poll_cursor()
+            else:
+                users = []
+
             for user_id, wallet_address in users:
                 try:
-                    # Получаем новые транзакции
-                    new_transfers = self.tron_tracker.get_new_transfers(wallet_address)
+                    # Новые транзакции ждут подтверждений в состоянии 'seen'
+                    new_transfers = self.tron_tracker.get_new_transfers(wallet_address, min_timestamp)
+                    self.confirmations.observe(user_id, wallet_address, new_transfers)
+                    self.events.record_poll(new_transfers)
+                
+                except Exception as e:
+                    logger.error(f"Ошибка обработки платежей для пользователя {user_id}: {e}")
+            
+            # Один запрос текущего блока на цикл, подтвержденные зачисляются пачкой
+            credited = []
+            for transfer in self.confirmations.promote():
+                user_id = transfer['user_id']
+                wallet_address = transfer['wallet_address']
+                try:
+                    # Проверяем, не обработан ли уже этот платеж
+                    if self.db.is_transaction_confirmed(transfer['tx_hash']):
+                        continue
                     
-                    for transfer in new_transfers:
-                        # Проверяем, не обработан ли уже этот платеж
-                        conn = self.db.get_connection()
-                        cursor = conn.cursor()
-                        cursor.execute('''
-                            SELECT COUNT(*) FROM confirmed_payments 
-                            WHERE transaction_hash = ?
-                        ''', (transfer['tx_hash'],))
-                        already_processed = cursor.fetchone()[0] > 0
-                        conn.close()
-                        
-                        if not already_processed:
-                            # Автоматически зачисляем платеж
-                            self.db.confirm_payment(
-                                user_id,
-                                transfer['amount'],
-                                'USDT',
-                                transfer['tx_hash'],
-                                wallet_address
+                    # Автоматически зачисляем платеж; HTTP callback - в той же транзакции
+                    confirmed = {
+                        'user_id': user_id,
+                        'wallet_address': wallet_address,
+                        'amount': transfer['amount'],
+                        'currency': 'USDT',
+                        'transaction_hash': transfer['tx_hash']
+                    }
+                    if not self.db.confirm_payment(
+                        user_id,
+                        transfer['amount'],
+                        'USDT',
+                        transfer['tx_hash'],
+                        wallet_address,
+                        callback_payload=dict(confirmed, event='payment.confirmed')
+                    ):
+                        # Кошелек не привязан к пользователю: перевод отклонен, не зачислен
+                        continue
+                    credited.append(transfer)
+                    metrics.observe_detection('payment_api', transfer.get('block_timestamp'))
+                    # Событие - только после зачисления (confirm_payment вернул True)
+                    self.publish_event('payment.confirmed', confirmed)
+                    
+                    # Вызываем callback если зарегистрирован
+                    if user_id in self.payment_callbacks and self.payment_callbacks[user_id]:
+                        try:
+                            await self.payment_callbacks[user_id](
+                                user_id=user_id,
+                                amount=transfer['amount'],
+                                currency='USDT',
+                                transaction_hash=transfer['tx_hash'],
+                                wallet_address=wallet_address
                             )
-                            
-                            # Вызываем callback если зарегистрирован
-                            if user_id in self.payment_callbacks and self.payment_callbacks[user_id]:
-                                try:
-                                    await self.payment_callbacks[user_id](
-                                        user_id=user_id,
-                                        amount=transfer['amount'],
-                                        currency='USDT',
-                                        transaction_hash=transfer['tx_hash'],
-                                        wallet_address=wallet_address
-                                    )
-                                except Exception as e:
-                                    logger.error(f"Ошибка вызова callback для пользователя {user_id}: {e}")
+                        except Exception as e:
+                            logger.error(f"Ошибка вызова callback для пользователя {user_id}: {e}")
                 
                 except Exception as e:
-                    logger.error(f"Ошибка обработки платежей для пользователя {user_id}: {e}")
+                    logger.error(f"Ошибка зачисления платежа {transfer['tx_hash']}: {e}")
+            
+            # Запись зачислений в журнал и откат зачислений из сиротских блоков
+            for credit in self.ledger.sync(credited):
+                self.publish_event('payment.reversed', {
+                    'user_id': credit['user_id'],
+                    'wallet_address': credit['wallet_address'],
+                    'amount': credit['amount'],
+                    'currency': credit['currency'],
+                    'transaction_hash': credit['tx_hash']
+                })
+            
+            # Истекшие неоплаченные платежи
+            expired = self.sweeper.maybe_sweep().get('pending_payments', [])
+            if credited or expired:
+                self.callbacks.notify()
+            for payment in expired:
+                self.publish_event('payment.expired', {
+                    'payment_id': payment['id'],
+                    'user_id': payment['user_id'],
+                    'wallet_address': payment['wallet_address'],
+                    'amount': payment['amount'],
+                    'currency': payment['currency']
+                })
+                callback = self.expiry_callbacks.get(payment['user_id'])
+                if callback:
+                    try:
+                        await callback(
+                            user_id=payment['user_id'],
+                            payment_id=payment['id'],
+                            amount=payment['amount'],
+                            currency=payment['currency']
+                        )
+                    except Exception as e:
+                        logger.error(f"Ошибка вызова callback истечения для пользователя {payment['user_id']}: {e}")
                     
         except Exception as e:
             logger.error(f"Ошибка в задаче обработки платежей: {e}")
+        finally:
+            metrics.POLL_CYCLE_SECONDS.labels('payment_integration').observe(time.perf_counter() - started)
     
     def get_integration_info(self) -> Dict:
         """
@@ -29,18 +29,26 @@ class PaymentBotClient:
         }
         self.tron_tracker = TronTracker()
     
-    def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, params: Optional[Dict] = None) -> Dict[str, Any]:
+    def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, params: Optional[Dict] = None,
+                      timeout: float = 10) -> Dict[str, Any]:
         """Выполнить HTTP запрос к API"""
         url = f"{self.base_url}{endpoint}"
         
         try:
             if method.upper() == "GET":
-                response = requests.get(url, headers=self.headers, params=params, timeout=10)
+                response = requests.get(url, headers=self.headers, params=params, timeout=timeout)
             elif method.upper() == "POST":
-                response = requests.post(url, headers=self.headers, json=data, timeout=10)
+                response = requests.post(url, headers=self.headers, json=data, timeout=timeout)
             else:
                 raise ValueError(f"Неподдерживаемый HTTP метод: {method}")
             
+            if response.status_code == 429:
+                # Лимит запросов ключа: повтор не раньше Retry-After
+                return {
+                    "success": False,
+                    "error": "Ошибка запроса: лимит запросов (HTTP 429)",
+                    "retry_after": float(response.headers.get("Retry-After", 1))
+                }
             response.raise_for_status()
             return response.json()
             
@@ -134,26 +142,34 @@ class PaymentBotClient:
         """
         Ожидать подтверждения платежа
         
+        Использует long-poll /payments/{id}/wait: сервер отвечает при смене
+        статуса, повторный запрос - только после long-poll таймаута.
+        
         Args:
             payment_id: ID платежа
             timeout: Максимальное время ожидания в секундах
-            check_interval: Интервал проверки в секундах
+            check_interval: Пауза перед повтором после ошибки запроса в секундах
             
         Returns:
             Словарь со статусом платежа
         """
-        start_time = time.time()
+        deadline = time.time() + timeout
         
-        while time.time() - start_time < timeout:
-            status = self.get_payment_status(payment_id)
+        while time.time() < deadline:
+            wait = max(1, min(int(deadline - time.time()), 60))
+            status = self._make_request("GET", f"/payments/{payment_id}/wait",
+                                        params={"timeout": wait}, timeout=wait + 10)
             
             if not status.get("success", False):
-                return status
+                if not str(status.get("error", "")).startswith("Ошибка запроса"):
+                    return status
+                # Ошибка соединения или лимит запросов - повтор после паузы
+                pause = max(check_interval, status.get("retry_after", 0))
+                time.sleep(min(pause, max(0, deadline - time.time())))
+                continue
             
-            if status.get("status") == "confirmed":
+            if status.get("status") in ("confirmed", "completed", "expired", "failed"):
                 return status
-            
-            time.sleep(check_interval)
         
         # Таймаут
         return {
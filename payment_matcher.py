@@ -0,0 +1,154 @@
+"""
+Сопоставление входящих переводов с ожидающими платежами в памяти
+
+Открытые платежи хранятся в индексе (кошелек получателя, корзина суммы);
+платежи с указанным кошельком отправителя - в отдельном индексе
+(получатель, отправитель, корзина). Ширина корзины равна допуску, поэтому
+кандидаты на перевод лежат в трех соседних корзинах: пачка переводов
+сопоставляется за O(число переводов) без запросов к базе.
+
+Индекс загружается при старте (load) и обновляется вызывающим кодом при
+создании (add), истечении (expire) и подтверждении (confirm) платежей.
+"""
+
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+USDT_UNITS = 1000000  # USDT имеет 6 знаков
+
+
+class PaymentMatcher:
+    """Индекс ожидающих платежей по кошельку и сумме"""
+
+    def __init__(self, tolerance: float = 0.01):
+        """
+        Args:
+            tolerance: Допустимое расхождение суммы перевода и платежа (USDT)
+        """
+        self.tolerance_units = max(1, round(tolerance * USDT_UNITS))
+        self._lock = threading.Lock()
+        self._payments: Dict[object, Dict] = {}
+        # (кошелек, корзина) и (кошелек, отправитель, корзина) -> {id платежа: платеж}
+        self._by_amount: Dict[Tuple, Dict[object, Dict]] = {}
+        self._by_sender: Dict[Tuple, Dict[object, Dict]] = {}
+        self.matched_total = 0
+
+    @staticmethod
+    def _units(amount: float) -> int:
+        return round(amount * USDT_UNITS)
+
+    def _key(self, payment: Dict) -> Tuple[Dict, Tuple]:
+        bucket = self._units(payment['amount']) // self.tolerance_units
+        sender = payment.get('from_address')
+        if sender:
+            return self._by_sender, (payment['wallet_address'], sender, bucket)
+        return self._by_amount, (payment['wallet_address'], bucket)
+
+    def _insert(self, payment: Dict):
+        index, key = self._key(payment)
+        self._payments[payment['id']] = payment
+        index.setdefault(key, {})[payment['id']] = payment
+
+    def _discard(self, payment_id) -> Optional[Dict]:
+        payment = self._payments.pop(payment_id, None)
+        if payment is None:
+            return None
+        index, key = self._key(payment)
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(payment_id, None)
+            if not bucket:
+                del index[key]
+        return payment
+
+    def load(self, payments: Iterable[Dict]) -> int:
+        """Заменить индекс открытыми платежами из базы; возвращает их число"""
+        with self._lock:
+            self._payments.clear()
+            self._by_amount.clear()
+            self._by_sender.clear()
+            for payment in payments:
+                self._insert(payment)
+            return len(self._payments)
+
+    def add(self, payment: Dict):
+        """Новый ожидающий платеж: id, user_id, amount, wallet_address[, from_address]"""
+        with self._lock:
+            self._discard(payment['id'])
+            self._insert(payment)
+
+    def expire(self, payment_ids: Iterable) -> int:
+        """Убрать истекшие или отмененные платежи"""
+        with self._lock:
+            return sum(1 for payment_id in payment_ids if self._discard(payment_id) is not None)
+
+    def confirm(self, payment: Dict) -> List[Dict]:
+        """
+        Убрать подтвержденный платеж
+
+        Database.confirm_payment подтверждает все ожидающие платежи
+        пользователя на ту же сумму и кошелек - они тоже убираются.
+        """
+        with self._lock:
+            # Платежи на ту же сумму лежат в той же корзине
+            index, key = self._key(payment)
+            siblings = [other['id'] for other in index.get(key, {}).values()
+                        if other['id'] != payment['id']
+                        and other.get('user_id') == payment.get('user_id')
+                        and other['amount'] == payment['amount']]
+            removed = [self._discard(payment_id) for payment_id in [payment['id']] + siblings]
+        return [item for item in removed if item is not None]
+
+    def _candidates(self, index: Dict, prefix: Tuple, units: int) -> Optional[Dict]:
+        """Ближайший по сумме платеж в соседних корзинах (при равенстве - более ранний)"""
+        bucket = units // self.tolerance_units
+        best, best_diff = None, None
+        for key in (prefix + (bucket - 1,), prefix + (bucket,), prefix + (bucket + 1,)):
+            for payment in index.get(key, {}).values():
+                diff = abs(self._units(payment['amount']) - units)
+                if diff < self.tolerance_units and (best is None or diff < best_diff):
+                    best, best_diff = payment, diff
+        return best
+
+    def match(self, transfers: Iterable[Dict]) -> List[Tuple[Dict, Dict]]:
+        """
+        Сопоставить пачку переводов с платежами
+
+        Каждый платеж закрывается не больше одним переводом: найденные
+        платежи сразу убираются из индекса. Платеж с указанным отправителем
+        закрывается только переводом от него. Возвращает [(перевод, платеж)].
+        """
+        matches = []
+        with self._lock:
+            for transfer in transfers:
+                wallet = transfer.get('to') or transfer.get('to_address')
+                units = self._units(transfer['amount'])
+                sender = transfer.get('from') or transfer.get('from_address')
+                payment = None
+                if sender and self._by_sender:
+                    payment = self._candidates(self._by_sender, (wallet, sender), units)
+                if payment is None:
+                    payment = self._candidates(self._by_amount, (wallet,), units)
+                if payment is not None:
+                    self._discard(payment['id'])
+                    matches.append((transfer, payment))
+            self.matched_total += len(matches)
+        return matches
+
+    def wallets(self) -> List[str]:
+        """Кошельки получателей, на которые ждут платежи (для опроса)"""
+        with self._lock:
+            return sorted({payment['wallet_address'] for payment in self._payments.values()})
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._payments)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'pending': len(self._payments),
+                'amount_buckets': len(self._by_amount),
+                'sender_buckets': len(self._by_sender),
+                'matched_total': self.matched_total,
+            }
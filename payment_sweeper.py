@@ -0,0 +1,92 @@
+"""
+Фоновое истечение ожидающих платежей
+
+Платеж получает срок жизни при создании (expires_at, PENDING_PAYMENT_TTL).
+Очистка выбирает истекшие строки по индексу (status, expires_at) пачками
+по SWEEP_BATCH_SIZE, переводит их в 'expired', освобождает
+зарезервированные уникальные суммы и вызывает обработчики истечения
+(уведомления, синхронизация индекса PaymentMatcher). Callback'и об
+истечении ставятся в outbox в той же транзакции, что и смена статуса.
+Так число живых 'pending' остается пропорциональным реальным оплатам.
+"""
+
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import config
+from amount_allocator import AmountAllocator
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentSweeper:
+    """Пакетное истечение платежей с обработчиками"""
+
+    def __init__(self, db: Database, tables: Iterable[str] = ('pending_payments',),
+                 allocator: Optional[AmountAllocator] = None, batch_size: int = None,
+                 interval: float = None,
+                 callback_payload: Optional[Callable[[str, Dict], Optional[Dict]]] = None):
+        """
+        Args:
+            tables: Таблицы платежей (pending_payments, simple_payments)
+            allocator: Уникальные суммы, истекшие резервы которых освобождаются
+            callback_payload: (таблица, строка) -> тело callback'а об истечении или None
+        """
+        self.db = db
+        self.tables = list(tables)
+        self.allocator = allocator
+        self.batch_size = batch_size if batch_size is not None else config.SWEEP_BATCH_SIZE
+        self.interval = interval if interval is not None else config.SWEEP_INTERVAL
+        self.callback_payload = callback_payload
+        self._listeners: List[Callable[[str, List[Dict]], None]] = []
+        self.last_sweep: Optional[float] = None
+        self.expired_total = 0
+
+    def on_expired(self, listener: Callable[[str, List[Dict]], None]):
+        """Обработчик пачки истекших платежей: listener(таблица, строки)"""
+        self._listeners.append(listener)
+
+    def sweep(self) -> Dict[str, List[Dict]]:
+        """Истечь все просроченные платежи; возвращает {таблица: строки}"""
+        self.last_sweep = time.time()
+        expired = {}
+        for table in self.tables:
+            rows = []
+            while True:
+                batch = self.db.expire_payments(table, self.batch_size, self._payload_for(table))
+                if batch:
+                    rows.extend(batch)
+                    for listener in self._listeners:
+                        try:
+                            listener(table, batch)
+                        except Exception as e:
+                            logger.error(f"Ошибка обработчика истечения платежей: {e}")
+                if len(batch) < self.batch_size:
+                    break
+            if rows:
+                expired[table] = rows
+                self.expired_total += len(rows)
+                logger.info(f"Истекло платежей в {table}: {len(rows)}")
+
+        if self.allocator:
+            self.allocator.release_expired()
+        return expired
+
+    def _payload_for(self, table: str) -> Optional[Callable[[Dict], Optional[Dict]]]:
+        if not self.callback_payload:
+            return None
+        return lambda row: self.callback_payload(table, row)
+
+    def maybe_sweep(self) -> Dict[str, List[Dict]]:
+        """Очистка не чаще раза в SWEEP_INTERVAL (для частых циклов обработки)"""
+        if self.last_sweep is not None and time.time() - self.last_sweep < self.interval:
+            return {}
+        return self.sweep()
+
+    def stats(self) -> Dict:
+        return {
+            'expired_total': self.expired_total,
+            'last_sweep': self.last_sweep,
+        }
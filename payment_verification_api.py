@@ -7,16 +7,26 @@ API для проверки поступления USDT платежей
 
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, Depends, Header
+import time
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 import uvicorn
 import secrets
 import hashlib
 from datetime import datetime, timedelta
 from database import Database
 from tron_tracker import TronTracker
+from request_executor import TronAPIError
+from amount_allocator import to_units
+from transfer_window import TransferWindow
+from payment_events import PaymentEvents
+from api_auth import ApiKeyAuth
+from rate_limiter import RateLimiter, require_admin
+from response_cache import ResponseCache
+from shared_state import SharedBus, LeaderLease
+import metrics
 import config
 
 # Настройка логирования
@@ -39,12 +49,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Метрики Prometheus: GET /metrics
+metrics.install(app, 'payment_verification_api')
+
 # Инициализация
 db = Database()
 tron_tracker = TronTracker()
+transfer_window = TransferWindow()
+
+# Новые переводы в окне будят long-poll проверки (ключ - кошелек приема)
+payment_events = PaymentEvents()
+
+# Кошелек для приема платежей, пока в базе нет активного кошелька
+OUR_WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+# API ключи: хеши в базе (общие для всех воркеров), кеш проверки в процессе
+api_auth = ApiKeyAuth(db)
+
+# Лимиты частоты и суточные квоты ключей: каждая проверка может стоить запросов к TronGrid
+rate_limiter = RateLimiter(db)
 
-# Хранилище API ключей
-api_keys = {}
+# Готовый ответ /wallet-info: баланс не запрашивается на каждый опрос
+response_cache = ResponseCache()
+
+# Несколько воркеров: кошелек приема опрашивает лидер, новые переводы
+# попадают в окна остальных воркеров через канал в базе
+shared_bus = SharedBus(db)
+poller_leader = LeaderLease(db, 'payment_verification_api.poller')
 
 # Модели данных
 class PaymentVerificationRequest(BaseModel):
@@ -62,6 +93,14 @@ class PaymentVerificationResponse(BaseModel):
     confirmed_at: Optional[str] = None
     user_wallet: str
     message: str
+    already_confirmed: bool = False  # Резерв суммы оплачен раньше этим же переводом
+
+class BatchVerificationRequest(BaseModel):
+    payments: List[PaymentVerificationRequest]  # Не больше BATCH_MAX_ITEMS
+
+class BatchVerificationResponse(BaseModel):
+    success: bool
+    results: List[PaymentVerificationResponse]  # В порядке запроса
 
 class APIKeyResponse(BaseModel):
     success: bool
@@ -75,9 +114,67 @@ async def verify_api_key(x_api_key: str = Header(None)):
     if not x_api_key:
         raise HTTPException(status_code=401, detail="API ключ не предоставлен")
     
-    # В реальном проекте проверяйте ключ в базе данных
-    # Здесь для простоты принимаем любой ключ
-    return x_api_key
+    principal = api_auth.authenticate(x_api_key)
+    if not principal:
+        raise HTTPException(status_code=401, detail="Неверный API ключ")
+    
+    return principal
+
+# Проверка ключа с лимитом группы эндпоинтов (429 при превышении)
+verify_limit = rate_limiter.per_key('verify', verify_api_key)
+default_limit = rate_limiter.per_key('default', verify_api_key)
+
+def receiving_wallet() -> str:
+    """
+    Кошелек приема - тот же, что выдает /get-payment-wallet simple_payment_api
+    и на котором резервируются уникальные суммы (общая база)
+    """
+    return db.get_receiving_wallet() or OUR_WALLET
+
+def on_transfers(event: dict, event_id: int):
+    """Новые переводы из опроса любого воркера: в окно и разбудить long-poll проверки"""
+    transfer_window.add(event['transfers'])  # в окне воркера-лидера они уже есть
+    payment_events.publish(event['wallet'], {'added': len(event['transfers'])})
+
+shared_bus.subscribe('verification.transfers', on_transfers)
+
+async def refresh_transfers() -> int:
+    """Один опрос кошелька приема; новые переводы расходятся по всем воркерам"""
+    loop = asyncio.get_running_loop()
+    wallet = await loop.run_in_executor(None, receiving_wallet)
+    added = await loop.run_in_executor(None, transfer_window.refresh, tron_tracker, wallet)
+    if added:
+        await loop.run_in_executor(None, shared_bus.publish, 'verification.transfers',
+                                   {'wallet': wallet, 'transfers': added})
+    return len(added)
+
+async def poll_transfers_task():
+    """Фоновое пополнение окна переводов кошелька приема"""
+    while True:
+        try:
+            if poller_leader.is_leader:
+                with metrics.POLL_CYCLE_SECONDS.labels('payment_verification_api').time():
+                    await refresh_transfers()
+        except Exception as e:
+            logger.error(f"Ошибка опроса переводов кошелька приема: {e}")
+        await asyncio.sleep(config.TRANSFER_WINDOW_POLL_INTERVAL)
+
+@app.on_event("startup")
+async def startup_event():
+    """Запуск фонового опроса переводов и записи использования ключей"""
+    poller_leader.renew()
+    asyncio.create_task(poller_leader.run())
+    asyncio.create_task(shared_bus.run())
+    asyncio.create_task(poll_transfers_task())
+    asyncio.create_task(api_auth.run())
+    asyncio.create_task(rate_limiter.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Запись накопленного использования API ключей и лимитов, передача лидерства"""
+    api_auth.flush_usage()
+    rate_limiter.sync()
+    poller_leader.release()
 
 @app.get("/")
 async def root():
@@ -89,22 +186,18 @@ async def root():
         "endpoints": {
             "get_api_key": "GET /get-api-key",
             "verify_payment": "POST /verify-payment",
+            "verify_payments": "POST /verify-payments",
+            "wait_payment": "POST /verify-payment/wait?timeout=30",
             "health": "GET /health"
         }
     }
 
-@app.get("/get-api-key", response_model=APIKeyResponse)
+@app.get("/get-api-key", response_model=APIKeyResponse,
+         dependencies=[Depends(rate_limiter.per_client('get-api-key'))])
 async def get_api_key():
     """Получить API ключ для интеграции"""
-    # Генерируем новый API ключ
-    api_key = secrets.token_urlsafe(32)
-    
-    # Сохраняем ключ (в реальном проекте в базе данных)
-    api_keys[api_key] = {
-        "created_at": datetime.now(),
-        "last_used": None,
-        "usage_count": 0
-    }
+    # Генерируем новый API ключ; в базе сохраняется только хеш
+    api_key = api_auth.create_key(0)
     
     return APIKeyResponse(
         success=True,
@@ -116,10 +209,109 @@ async def get_api_key():
         }
     )
 
+def failed_verification(request: PaymentVerificationRequest, message: str) -> PaymentVerificationResponse:
+    return PaymentVerificationResponse(
+        success=False,
+        payment_found=False,
+        received_amount=0.0,
+        currency=request.currency,
+        user_wallet=request.user_wallet,
+        message=message
+    )
+
+async def ensure_transfer_window(wallet: str):
+    """
+    Переводы на наш кошелек ищутся в окне, которое пополняет фоновый
+    опрос; до первого опроса окно заполняется здесь же
+    """
+    if not transfer_window.is_ready(wallet):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, transfer_window.refresh, tron_tracker, wallet)
+
+def resolve_verification(request: PaymentVerificationRequest, wallet: str,
+                         reservation: Optional[Dict]) -> Tuple[PaymentVerificationResponse, Optional[Tuple[int, str]]]:
+    """
+    Найти платеж в окне переводов без запросов к upstream
+    
+    reservation - резерв ожидаемой суммы на кошельке приема wallet (или None).
+    Возвращает ответ и (id резерва, хеш перевода), если резерв нужно
+    отметить оплаченным.
+    """
+    found_tx = None
+    paid_reservation = None
+    if reservation:
+        if reservation['user_wallet'] and reservation['user_wallet'] != request.user_wallet:
+            # Сумма выдана другому покупателю - чужой резерв не проверяется и не тратится
+            return not_found_verification(request), None
+        if reservation['status'] == 'paid':
+            return paid_verification(request, wallet, reservation), None
+        # Сумма выдана /get-payment-wallet и уникальна на кошельке - отправитель
+        # не проверяется, учитываются только переводы после резерва
+        candidates = transfer_window.by_amount(wallet, request.expected_amount,
+                                               since_ms=int(reservation['created_at'] * 1000))
+        if candidates:
+            found_tx = candidates[0]
+            paid_reservation = (reservation['id'], found_tx['tx_hash'])
+            metrics.observe_detection('payment_verification_api', found_tx.get('timestamp'))
+    else:
+        # Общая сумма: платеж от кошелька пользователя (с небольшой погрешностью 0.01 USDT)
+        candidates = transfer_window.by_sender(wallet, request.user_wallet, request.expected_amount)
+        if candidates:
+            found_tx = candidates[0]
+    
+    if found_tx:
+        return PaymentVerificationResponse(
+            success=True,
+            payment_found=True,
+            received_amount=found_tx['amount'],
+            currency=request.currency,
+            transaction_hash=found_tx['tx_hash'],
+            confirmed_at=str(found_tx.get('timestamp')),
+            user_wallet=request.user_wallet,
+            message=f"Платеж найден: {found_tx['amount']} {request.currency}"
+        ), paid_reservation
+    
+    return not_found_verification(request), None
+
+def not_found_verification(request: PaymentVerificationRequest) -> PaymentVerificationResponse:
+    return PaymentVerificationResponse(
+        success=True,
+        payment_found=False,
+        received_amount=0.0,
+        currency=request.currency,
+        user_wallet=request.user_wallet,
+        message=f"Платеж от {request.user_wallet} на сумму {request.expected_amount} {request.currency} не найден"
+    )
+
+def paid_verification(request: PaymentVerificationRequest, wallet: str,
+                      reservation: Dict) -> PaymentVerificationResponse:
+    """
+    Ответ по уже оплаченному резерву: тот же перевод, что зачел его первым
+    
+    already_confirmed=True - это не новая находка, повторно платеж не засчитывается.
+    """
+    tx_hash = reservation['transaction_hash']
+    if not tx_hash:
+        # Резерв оплачен до появления transaction_hash - перевод неизвестен
+        return not_found_verification(request)
+    found_tx = next((t for t in transfer_window.by_amount(wallet, request.expected_amount)
+                     if t['tx_hash'] == tx_hash), {})
+    return PaymentVerificationResponse(
+        success=True,
+        payment_found=True,
+        already_confirmed=True,
+        received_amount=found_tx.get('amount', request.expected_amount),
+        currency=request.currency,
+        transaction_hash=tx_hash,
+        confirmed_at=str(found_tx['timestamp']) if found_tx.get('timestamp') else None,
+        user_wallet=request.user_wallet,
+        message=f"Платеж уже подтвержден ранее: {tx_hash}"
+    )
+
 @app.post("/verify-payment", response_model=PaymentVerificationResponse)
 async def verify_payment(
     request: PaymentVerificationRequest,
-    api_key: str = Depends(verify_api_key)
+    api_data: dict = Depends(verify_limit)
 ):
     """
     Проверить поступление платежа от пользователя
@@ -140,89 +332,105 @@ async def verify_payment(
         
         # Валидация кошелька пользователя
         if not tron_tracker.validate_address(request.user_wallet):
-            return PaymentVerificationResponse(
-                success=False,
-                payment_found=False,
-                received_amount=0.0,
-                currency=request.currency,
-                user_wallet=request.user_wallet,
-                message="Неверный формат кошелька пользователя"
-            )
-        
-        # Получаем наш кошелек для приема платежей
-        our_wallet = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
-        
-        # Получаем последние транзакции нашего кошелька
-        transactions = tron_tracker.get_new_transfers(our_wallet)
-        
-        if not transactions:
-            return PaymentVerificationResponse(
-                success=True,
-                payment_found=False,
-                received_amount=0.0,
-                currency=request.currency,
-                user_wallet=request.user_wallet,
-                message="Транзакции не найдены"
-            )
-        
-        # Ищем платеж от пользователя
-        found_payment = None
-        for tx in transactions:
-            # Проверяем, что это USDT транзакция
-            if (tx.get('token_info', {}).get('contract_address') == config.USDT_CONTRACT_ADDRESS and
-                tx.get('from') == request.user_wallet and
-                tx.get('to') == our_wallet):
-                
-                # Получаем сумму в USDT (6 знаков после запятой)
-                amount = float(tx.get('value', 0)) / 1000000
-                
-                # Проверяем, что сумма соответствует ожидаемой (с небольшой погрешностью)
-                if abs(amount - request.expected_amount) <= 0.01:  # Погрешность 0.01 USDT
-                    found_payment = {
-                        'amount': amount,
-                        'transaction_hash': tx.get('transaction_id'),
-                        'confirmed_at': tx.get('block_timestamp'),
-                        'from': tx.get('from'),
-                        'to': tx.get('to')
-                    }
-                    break
+            return failed_verification(request, "Неверный формат кошелька пользователя")
         
-        if found_payment:
-            # Обновляем статистику API ключа
-            if api_key in api_keys:
-                api_keys[api_key]['last_used'] = datetime.now()
-                api_keys[api_key]['usage_count'] += 1
-            
-            return PaymentVerificationResponse(
-                success=True,
-                payment_found=True,
-                received_amount=found_payment['amount'],
-                currency=request.currency,
-                transaction_hash=found_payment['transaction_hash'],
-                confirmed_at=found_payment['confirmed_at'],
-                user_wallet=request.user_wallet,
-                message=f"Платеж найден: {found_payment['amount']} {request.currency}"
-            )
-        else:
-            return PaymentVerificationResponse(
-                success=True,
-                payment_found=False,
-                received_amount=0.0,
-                currency=request.currency,
-                user_wallet=request.user_wallet,
-                message=f"Платеж от {request.user_wallet} на сумму {request.expected_amount} {request.currency} не найден"
-            )
+        wallet = receiving_wallet()
+        await ensure_transfer_window(wallet)
+        reservation = db.find_amount_reservation(wallet, to_units(request.expected_amount))
+        result, paid_reservation = resolve_verification(request, wallet, reservation)
+        if paid_reservation and not db.mark_amount_reservations_paid(dict([paid_reservation])):
+            # Резерв успел оплатить параллельный запрос - отвечаем по его переводу
+            result, _ = resolve_verification(request, wallet,
+                                             db.find_amount_reservation(wallet, reservation['amount_units']))
+        return result
     
     except Exception as e:
         logger.error(f"Ошибка проверки платежа: {e}")
-        return PaymentVerificationResponse(
-            success=False,
-            payment_found=False,
-            received_amount=0.0,
-            currency=request.currency,
-            user_wallet=request.user_wallet,
-            message=f"Ошибка проверки платежа: {str(e)}"
-        )
+        return failed_verification(request, f"Ошибка проверки платежа: {str(e)}")
+
+@app.post("/verify-payments", response_model=BatchVerificationResponse)
+async def verify_payments(
+    request: BatchVerificationRequest,
+    api_data: dict = Depends(verify_limit)
+):
+    """
+    Проверить несколько платежей одним запросом (не больше BATCH_MAX_ITEMS)
+    
+    Все платежи ищутся в одном окне переводов, резервы сумм читаются
+    одним запросом к базе. Результаты - в порядке запроса, по одному на
+    платеж, как у /verify-payment. Для лимитов пачка - один запрос.
+    """
+    if len(request.payments) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400,
+                            detail=f"Не больше {config.BATCH_MAX_ITEMS} платежей в одном запросе")
+    logger.info(f"Пакетная проверка: {len(request.payments)} платежей")
+    
+    valid = [item for item in request.payments if tron_tracker.validate_address(item.user_wallet)]
+    try:
+        wallet = receiving_wallet()
+        await ensure_transfer_window(wallet)
+        reservations = db.find_amount_reservations(wallet, [to_units(item.expected_amount) for item in valid])
+    except Exception as e:
+        logger.error(f"Ошибка пакетной проверки платежей: {e}")
+        return BatchVerificationResponse(success=False, results=[
+            failed_verification(item, f"Ошибка проверки платежа: {str(e)}") for item in request.payments
+        ])
+    
+    results = []
+    paid_reservations = {}
+    for item in request.payments:
+        if not tron_tracker.validate_address(item.user_wallet):
+            results.append(failed_verification(item, "Неверный формат кошелька пользователя"))
+            continue
+        units = to_units(item.expected_amount)
+        result, paid_reservation = resolve_verification(item, wallet, reservations.get(units))
+        results.append(result)
+        if paid_reservation:
+            reservation_id, tx_hash = paid_reservation
+            paid_reservations[reservation_id] = (len(results) - 1, tx_hash)
+            # Повтор той же суммы в пачке - уже не новая находка
+            reservations[units] = dict(reservations[units], status='paid', transaction_hash=tx_hash)
+    marked = set(db.mark_amount_reservations_paid(
+        {reservation_id: tx_hash for reservation_id, (_, tx_hash) in paid_reservations.items()}))
+    for reservation_id, (index, _) in paid_reservations.items():
+        if reservation_id not in marked:
+            # Резерв успел оплатить параллельный запрос
+            item = request.payments[index]
+            reservation = db.find_amount_reservation(wallet, to_units(item.expected_amount))
+            results[index] = resolve_verification(item, wallet, reservation)[0]
+    
+    return BatchVerificationResponse(success=True, results=results)
+
+@app.post("/verify-payment/wait", response_model=PaymentVerificationResponse)
+async def wait_payment(
+    request: PaymentVerificationRequest,
+    timeout: float = Query(30, ge=0),
+    api_data: dict = Depends(verify_limit)
+):
+    """
+    Дождаться поступления платежа (long-poll)
+    
+    Как /verify-payment, но если платеж еще не найден, соединение
+    держится до timeout секунд (не больше LONG_POLL_MAX_TIMEOUT):
+    проверка повторяется по окну переводов, когда фоновый опрос
+    добавляет в него новые переводы.
+    """
+    deadline = time.monotonic() + min(timeout, config.LONG_POLL_MAX_TIMEOUT)
+    with payment_events.subscription(receiving_wallet()) as queue:
+        while True:
+            result = await verify_payment(request, api_data)
+            remaining = deadline - time.monotonic()
+            if result.payment_found or not result.success or remaining <= 0:
+                return result
+            try:
+                await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return result
+
+@app.get("/admin/usage", dependencies=[Depends(require_admin)])
+async def admin_usage():
+    """Потребление API ключей за сутки и лимиты (заголовок X-Admin-Token)"""
+    return rate_limiter.usage_report()
 
 @app.get("/health")
 async def health_check():
@@ -232,8 +440,10 @@ async def health_check():
         conn = db.get_connection()
         conn.close()
         
-        # Проверяем Tron API
-        balance = tron_tracker.get_balance("TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx")
+        # Проверяем Tron API (повторы с паузами - вне цикла событий)
+        loop = asyncio.get_running_loop()
+        wallet = await loop.run_in_executor(None, receiving_wallet)
+        balance = await loop.run_in_executor(None, tron_tracker.get_balance, wallet)
         
         return {
             "status": "healthy",
@@ -242,7 +452,19 @@ async def health_check():
                 "database": "ok",
                 "tron_api": "ok",
                 "wallet_balance": balance
-            }
+            },
+            "upstream": {
+                "providers": tron_tracker.router.health_report(),
+                "coalescing": tron_tracker.coalescing_stats(),
+                "retries": tron_tracker.retry_stats()
+            },
+            "transfer_window": transfer_window.stats(),
+            "waiters": payment_events.stats(),
+            "auth": api_auth.stats(),
+            "rate_limits": rate_limiter.stats(),
+            "response_cache": response_cache.stats(),
+            "worker": poller_leader.stats(),
+            "shared_bus": shared_bus.stats()
         }
     except Exception as e:
         return {
@@ -252,18 +474,41 @@ async def health_check():
         }
 
 @app.get("/wallet-info")
-async def get_wallet_info(api_key: str = Depends(verify_api_key)):
-    """Получить информацию о кошельке для приема платежей"""
-    our_wallet = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
-    balance = tron_tracker.get_balance(our_wallet)
+async def get_wallet_info(
+    response: Response,
+    api_data: dict = Depends(default_limit),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Получить информацию о кошельке для приема платежей
     
-    return {
-        "success": True,
-        "wallet_address": our_wallet,
-        "balance": balance,
-        "currency": "USDT",
-        "message": "Информация о кошельке для приема платежей"
-    }
+    Баланс запрашивается в Tron API не чаще раза в WALLET_INFO_MAX_AGE
+    секунд и при каждом новом переводе в окне; версия (ETag) - число
+    переводов в окне и номер интервала.
+    """
+    loop = asyncio.get_running_loop()
+    wallet = await loop.run_in_executor(None, receiving_wallet)
+    
+    async def build():
+        try:
+            # Повторы с паузами при сбоях провайдеров не должны останавливать цикл событий
+            balance = await loop.run_in_executor(None, tron_tracker.get_balance, wallet)
+        except TronAPIError as e:
+            logger.warning(f"Tron API недоступен: {e}")
+            raise HTTPException(status_code=503, detail="Tron API временно недоступен")
+        
+        return {
+            "success": True,
+            "wallet_address": wallet,
+            "balance": balance,
+            "currency": "USDT",
+            "message": "Информация о кошельке для приема платежей"
+        }, True
+    
+    version = f"{transfer_window.version(wallet)}.{int(time.time() // config.WALLET_INFO_MAX_AGE)}"
+    return await response_cache.respond(f"wallet-info:{wallet}", version, build, if_none_match,
+                                        cache_control=f"private, max-age={config.WALLET_INFO_MAX_AGE}",
+                                        response=response)
 
 if __name__ == "__main__":
     print("🚀 Запуск Payment Verification API...")
@@ -272,6 +517,7 @@ if __name__ == "__main__":
     print("📋 Документация: http://localhost:8002/docs")
     print("🔑 Получить API ключ: GET /get-api-key")
     print("💳 Проверить платеж: POST /verify-payment")
+    print("📦 Проверить пачку платежей: POST /verify-payments")
     print("=" * 50)
     
     uvicorn.run(
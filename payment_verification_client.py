@@ -7,7 +7,7 @@
 import requests
 import json
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 class PaymentVerificationClient:
@@ -28,18 +28,26 @@ class PaymentVerificationClient:
             "Content-Type": "application/json"
         }
     
-    def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict[str, Any]:
+    def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None,
+                      params: Optional[Dict] = None, timeout: float = 10) -> Dict[str, Any]:
         """Выполнить HTTP запрос к API"""
         url = f"{self.base_url}{endpoint}"
         
         try:
             if method.upper() == "GET":
-                response = requests.get(url, headers=self.headers, timeout=10)
+                response = requests.get(url, headers=self.headers, params=params, timeout=timeout)
             elif method.upper() == "POST":
-                response = requests.post(url, headers=self.headers, json=data, timeout=10)
+                response = requests.post(url, headers=self.headers, json=data, params=params, timeout=timeout)
             else:
                 raise ValueError(f"Неподдерживаемый HTTP метод: {method}")
             
+            if response.status_code == 429:
+                # Лимит запросов ключа: повтор не раньше Retry-After
+                return {
+                    "success": False,
+                    "error": "Ошибка запроса: лимит запросов (HTTP 429)",
+                    "retry_after": float(response.headers.get("Retry-After", 1))
+                }
             response.raise_for_status()
             return response.json()
             
@@ -76,6 +84,31 @@ class PaymentVerificationClient:
         
         return self._make_request("POST", "/verify-payment", data=data)
     
+    def verify_payments(self, payments: List[Dict[str, Any]], batch_size: int = 100) -> Dict[str, Any]:
+        """
+        Проверить несколько платежей пачками через /verify-payments
+        
+        Args:
+            payments: Список {"user_wallet", "expected_amount", "currency"?, "description"?}
+            batch_size: Платежей в одном запросе (не больше BATCH_MAX_ITEMS сервера)
+            
+        Returns:
+            {"success": True, "results": [...]} - результаты в порядке payments,
+            каждый как у verify_payment; при ошибке запроса - ответ с "error"
+        """
+        results = []
+        success = True
+        for start in range(0, len(payments), batch_size):
+            batch = [{"currency": "USDT", "description": "", **payment}
+                     for payment in payments[start:start + batch_size]]
+            response = self._make_request("POST", "/verify-payments", data={"payments": batch})
+            if "results" not in response:
+                return response
+            results.extend(response["results"])
+            success = success and response.get("success", False)
+        
+        return {"success": success, "results": results}
+    
     def get_wallet_info(self) -> Dict[str, Any]:
         """
         Получить информацию о кошельке для приема платежей
@@ -89,27 +122,41 @@ class PaymentVerificationClient:
         """
         Ожидать поступления платежа от пользователя
         
+        Запрос /verify-payment/wait держится сервером, пока фоновый опрос
+        не найдет перевод (long-poll), - клиент не проверяет платеж в цикле.
+        
         Args:
             user_wallet: Кошелек пользователя
             expected_amount: Ожидаемая сумма
             timeout: Максимальное время ожидания в секундах
-            check_interval: Интервал проверки в секундах
+            check_interval: Пауза перед повтором после ошибки запроса в секундах
             
         Returns:
             Словарь с результатом проверки
         """
-        start_time = time.time()
+        deadline = time.time() + timeout
+        data = {
+            "user_wallet": user_wallet,
+            "expected_amount": expected_amount,
+            "currency": "USDT"
+        }
         
-        while time.time() - start_time < timeout:
-            result = self.verify_payment(user_wallet, expected_amount)
+        while time.time() < deadline:
+            wait = max(1, min(int(deadline - time.time()), 60))
+            result = self._make_request("POST", "/verify-payment/wait", data=data,
+                                        params={"timeout": wait}, timeout=wait + 10)
+            
+            if "error" in result:
+                # Ошибка соединения или лимит запросов - повтор после паузы
+                pause = max(check_interval, result.get("retry_after", 0))
+                time.sleep(min(pause, max(0, deadline - time.time())))
+                continue
             
             if not result.get("success", False):
                 return result
             
             if result.get("payment_found", False):
                 return result
-            
-            time.sleep(check_interval)
         
         # Таймаут
         return {
@@ -10,6 +10,8 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from database import Database
 from tron_tracker import TronTracker
+from chain_ledger import ChainLedger
+from confirmation_pipeline import ConfirmationPipeline
 import config
 
 # Настройка логирования
@@ -23,6 +25,10 @@ class PrivatePaymentBot:
     def __init__(self):
         self.db = Database()
         self.tron_tracker = TronTracker()
+        # Зачисление только после CONFIRMATION_BLOCKS блоков
+        self.confirmations = ConfirmationPipeline(self.db, self.tron_tracker)
+        # Журнал зачислений с хешем блока, откат при реорганизации
+        self.ledger = ChainLedger(self.db, self.tron_tracker)
         self.application = None
         
         # Whitelist пользователей (можно расширить)
@@ -488,42 +494,70 @@ class PrivatePaymentBot:
             users_in_auto_mode = cursor.fetchall()
             conn.close()
 
+            # Новый цикл опроса - бюджет повторов Tron API восстанавливается
+            self.tron_tracker.start_cycle()
+
             for user_id, wallet_address in users_in_auto_mode:
                 if not wallet_address:
                     continue
 
                 try:
-                    # Получаем новые транзакции
+                    # Новые транзакции ждут подтверждений в состоянии 'seen'
                     new_transfers = self.tron_tracker.get_new_transfers(wallet_address)
-                    
-                    for transfer in new_transfers:
-                        # Проверяем, был ли этот платеж уже подтвержден
-                        if not self.db.is_transaction_confirmed(transfer['tx_hash']):
-                            # Автоматически подтверждаем любой платеж
-                            self.db.confirm_payment(
-                                user_id, 
-                                transfer['amount'], 
-                                transfer['currency'],
-                                transfer['tx_hash'],
-                                wallet_address
-                            )
-                            
-                            # Отправляем уведомление пользователю
-                            try:
-                                await context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=f"🎉 **Получен автоматический платеж!**\n\n"
-                                         f"💰 **Сумма:** {transfer['amount']} {transfer['currency']}\n"
-                                         f"🔗 **Транзакция:** `{transfer['tx_hash']}`\n"
-                                         f"📱 **Кошелек:** `{wallet_address}`\n\n"
-                                         f"✅ **Платеж автоматически зачислен!**",
-                                    parse_mode='Markdown'
-                                )
-                            except Exception as e:
-                                logger.error(f"Ошибка отправки уведомления об авто-платеже: {e}")
+                    self.confirmations.observe(user_id, wallet_address, new_transfers)
                 
                 except Exception as e:
                     logger.error(f"Ошибка обработки платежей для пользователя {user_id}: {e}")
+
+            # Один запрос текущего блока на цикл, подтвержденные зачисляются пачкой
+            credited = []
+            for transfer in self.confirmations.promote():
+                user_id = transfer['user_id']
+                wallet_address = transfer['wallet_address']
+                try:
+                    # Проверяем, был ли этот платеж уже подтвержден
+                    if self.db.is_transaction_confirmed(transfer['tx_hash']):
+                        continue
+                    # Автоматически подтверждаем любой платеж
+                    if not self.db.confirm_payment(
+                        user_id, 
+                        transfer['amount'], 
+                        transfer['currency'],
+                        transfer['tx_hash'],
+                        wallet_address
+                    ):
+                        # Кошелек не привязан к пользователю: перевод отклонен, не зачислен
+                        continue
+                    credited.append(transfer)
+                    
+                    # Отправляем уведомление пользователю
+                    try:
+                        await context.bot.send_message(
+                            chat_id=user_id,
+                            text=f"🎉 **Получен автоматический платеж!**\n\n"
+                                 f"💰 **Сумма:** {transfer['amount']} {transfer['currency']}\n"
+                                 f"🔗 **Транзакция:** `{transfer['tx_hash']}`\n"
+                                 f"📱 **Кошелек:** `{wallet_address}`\n\n"
+                                 f"✅ **Платеж автоматически зачислен!**",
+                            parse_mode='Markdown'
+                        )
+                    except Exception as e:
+                        logger.error(f"Ошибка отправки уведомления об авто-платеже: {e}")
+                
+                except Exception as e:
+                    logger.error(f"Ошибка зачисления платежа {transfer['tx_hash']}: {e}")
+            
+            # Запись зачислений в журнал и откат зачислений из сиротских блоков
+            for credit in self.ledger.sync(credited):
+                try:
+                    await context.bot.send_message(
+                        chat_id=credit['user_id'],
+                        text=f"⚠️ Платеж {credit['amount']} {credit['currency']} отменен: блок с транзакцией "
+                             f"`{credit['tx_hash']}` не вошел в основную цепочку сети",
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка отправки уведомления об откате: {e}")
                     
         except Exception as e:
             logger.error(f"Ошибка в задаче проверки платежей: {e}")
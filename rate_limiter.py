@@ -0,0 +1,309 @@
+"""
+Ограничение частоты запросов и суточные квоты API ключей
+
+Каждый запрос списывает токен из бакета (ключ, группа эндпоинтов):
+бакет вмещает N запросов и пополняется со скоростью N за S секунд
+(RATE_LIMIT_* в формате "N/S"), так что короткий всплеск допустим, а
+средняя частота ограничена. Дополнительно запросы ключа считаются за
+сутки (UTC) и сверяются с квотой (API_KEY_DAILY_QUOTA или
+api_keys.daily_quota). Запрос списывается из бакета в памяти воркера
+без обращения к базе; раз в RATE_LIMIT_SYNC_INTERVAL воркер одной
+транзакцией записывает списанное и забирает общее состояние всех
+воркеров uvicorn (бакет или ключ, впервые встреченный воркером, читается
+из базы вне цикла событий). Поэтому N воркеров могут превысить лимит не
+больше чем на то, что каждый успеет списать за один интервал сверки.
+Отказ - HTTP 429 с Retry-After и X-RateLimit-* заголовками; те же
+заголовки добавляются к успешным ответам.
+"""
+
+import asyncio
+import hmac
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import Depends, Header, HTTPException, Request, Response
+
+import config
+import metrics
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять неиспользуемые бакеты, секунды
+PURGE_INTERVAL = 3600
+
+
+def parse_limit(spec: str) -> Tuple[int, float]:
+    """'N/S' -> (N запросов, за S секунд)"""
+    requests, seconds = spec.split('/')
+    return int(requests), float(seconds)
+
+
+def utc_day(now: float) -> str:
+    return datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%d')
+
+
+def seconds_to_utc_midnight(now: float) -> float:
+    return 86400 - now % 86400
+
+
+async def require_admin(x_admin_token: str = Header(None)):
+    """Зависимость FastAPI для админ-эндпоинтов: заголовок X-Admin-Token равен ADMIN_API_TOKEN"""
+    if not config.ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Админ-доступ не настроен (ADMIN_API_TOKEN)")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, config.ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Неверный админ-токен")
+
+
+class RateLimiter:
+    """Token bucket на ключ и группу эндпоинтов плюс суточная квота ключа"""
+
+    def __init__(self, db: Database, limits: Dict[str, str] = None, daily_quota: int = None,
+                 sync_interval: float = None):
+        """
+        Args:
+            limits: Группа эндпоинтов -> "N/S" (по умолчанию RATE_LIMIT_*; неизвестная группа - 'default')
+            daily_quota: Запросов на ключ в сутки по умолчанию (0 - без квоты)
+            sync_interval: Как часто сверять бакеты и квоты с базой, секунды
+        """
+        self.db = db
+        limits = limits or {
+            'default': config.RATE_LIMIT_DEFAULT,
+            'verify': config.RATE_LIMIT_VERIFY,
+            'check': config.RATE_LIMIT_CHECK,
+            'create': config.RATE_LIMIT_CREATE,
+            'get-api-key': config.RATE_LIMIT_GET_API_KEY,
+        }
+        self.limits = {scope: parse_limit(spec) for scope, spec in limits.items()}
+        self.daily_quota = daily_quota if daily_quota is not None else config.API_KEY_DAILY_QUOTA
+        self.sync_interval = sync_interval if sync_interval is not None else config.RATE_LIMIT_SYNC_INTERVAL
+        self._lock = threading.Lock()
+        # бакет -> [токены, время обновления]; списано токенов с прошлой сверки
+        self._buckets: Dict[str, List[float]] = {}
+        self._spent: Dict[str, int] = {}
+        # хеш ключа -> {'day', 'quota', 'used'}; (ключ, сутки) -> [запросов, отказов] до записи в базу
+        self._quotas: Dict[str, Dict] = {}
+        self._usage: Dict[Tuple[str, str], List[int]] = {}
+        self._last_purge = time.time()
+        self.counters = {'allowed': 0, 'limited': 0, 'quota_exceeded': 0, 'loads': 0, 'syncs': 0}
+
+    def limit_for(self, scope: str) -> Tuple[int, float]:
+        return self.limits.get(scope) or self.limits['default']
+
+    def _loaded(self, bucket: str, quota_key: Optional[str], day: str) -> bool:
+        with self._lock:
+            return bucket in self._buckets and (
+                not quota_key or self._quotas.get(quota_key, {}).get('day') == day)
+
+    def load(self, bucket: str, capacity: int, quota_key: Optional[str], day: str, now: float):
+        """Общее состояние бакета и квоты ключа из базы (первый запрос в этом процессе)"""
+        state = self.db.get_rate_limit_state(bucket, quota_key, day, self.daily_quota)
+        with self._lock:
+            self.counters['loads'] += 1
+            if state['tokens'] is None:
+                self._buckets.setdefault(bucket, [capacity, now])
+            else:
+                self._buckets.setdefault(bucket, [state['tokens'], state['updated_at']])
+            if quota_key and self._quotas.get(quota_key, {}).get('day') != day:
+                pending = self._usage.get((quota_key, day), [0, 0])[0]
+                self._quotas[quota_key] = {'day': day, 'quota': state['quota'], 'used': state['used'] + pending}
+
+    async def prepare(self, identity: str, scope: str, quota_key: str = None):
+        """Подгрузить из базы неизвестный процессу бакет или ключ вне цикла событий"""
+        now = time.time()
+        bucket, day = f"{scope}:{identity}", utc_day(now)
+        if not self._loaded(bucket, quota_key, day):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.load, bucket, self.limit_for(scope)[0], quota_key, day, now)
+
+    def hit(self, identity: str, scope: str, quota_key: str = None,
+            now: float = None) -> Tuple[Optional[str], Dict[str, str]]:
+        """
+        Засчитать запрос: (причина отказа 'rate'/'quota' или None, заголовки ответа)
+
+        identity - хеш ключа или 'ip:<адрес>'; quota_key - хеш ключа, чьи
+        запросы считаются в суточную квоту. Списание - в памяти, в базу
+        оно попадает при следующей сверке (sync).
+        """
+        now = now if now is not None else time.time()
+        capacity, seconds = self.limit_for(scope)
+        rate = capacity / seconds
+        bucket, day = f"{scope}:{identity}", utc_day(now)
+        if not self._loaded(bucket, quota_key, day):
+            self.load(bucket, capacity, quota_key, day, now)
+
+        reason, quota, used = None, 0, 0
+        with self._lock:
+            if quota_key:
+                state = self._quotas[quota_key]
+                quota, used = state['quota'], state['used']
+                if quota and used >= quota:
+                    reason = 'quota'
+
+            tokens, updated_at = self._buckets.get(bucket, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - updated_at) * rate)
+            if reason is None:
+                if tokens >= 1:
+                    tokens -= 1
+                    self._spent[bucket] = self._spent.get(bucket, 0) + 1
+                else:
+                    reason = 'rate'
+            self._buckets[bucket] = [tokens, now]
+
+            if quota_key:
+                usage = self._usage.setdefault((quota_key, day), [0, 0])
+                if reason is None:
+                    usage[0] += 1
+                    state['used'] += 1
+                    used += 1
+                else:
+                    usage[1] += 1
+
+            if reason is None:
+                self.counters['allowed'] += 1
+            elif reason == 'quota':
+                self.counters['quota_exceeded'] += 1
+            else:
+                self.counters['limited'] += 1
+
+        headers = {
+            'X-RateLimit-Limit': str(capacity),
+            'X-RateLimit-Remaining': str(int(tokens)),
+            # Через сколько секунд бакет снова полный
+            'X-RateLimit-Reset': str(math.ceil((capacity - tokens) / rate)),
+        }
+        if quota_key and quota:
+            headers['X-Quota-Limit'] = str(quota)
+            headers['X-Quota-Remaining'] = str(max(0, quota - used))
+
+        if reason:
+            metrics.RATE_LIMIT_REJECTIONS.labels(scope, reason).inc()
+        if reason == 'quota':
+            headers['Retry-After'] = str(math.ceil(seconds_to_utc_midnight(now)))
+        elif reason == 'rate':
+            headers['Retry-After'] = str(max(1, math.ceil((1 - tokens) / rate)))
+        return reason, headers
+
+    def sync(self, now: float = None) -> int:
+        """
+        Сверить бакеты и квоты процесса с базой одной транзакцией
+
+        Списанное с прошлой сверки записывается, взамен приходит общее
+        состояние всех воркеров: бакет процесса не может быть полнее
+        общего. Давно полные бакеты и квоты прошлых суток забываются.
+        Возвращает число сверенных бакетов.
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            spent, self._spent = self._spent, {}
+            usage, self._usage = self._usage, {}
+            buckets = {}
+            for bucket in self._buckets:
+                capacity, seconds = self.limit_for(bucket.split(':', 1)[0])
+                buckets[bucket] = (spent.get(bucket, 0), capacity, capacity / seconds)
+            quota_keys = [(key, state['day']) for key, state in self._quotas.items()]
+
+        try:
+            shared = self.db.sync_rate_limits(buckets, usage, quota_keys, now, self.daily_quota)
+        except Exception:
+            # Вернуть списанное, чтобы записать его при следующей сверке
+            with self._lock:
+                for bucket, count in spent.items():
+                    self._spent[bucket] = self._spent.get(bucket, 0) + count
+                for key, (requests, rejected) in usage.items():
+                    pending = self._usage.setdefault(key, [0, 0])
+                    pending[0] += requests
+                    pending[1] += rejected
+            raise
+
+        today = utc_day(now)
+        with self._lock:
+            for bucket, tokens in shared['tokens'].items():
+                local = self._buckets.get(bucket)
+                if local is None:
+                    continue
+                _, capacity, rate = buckets[bucket]
+                refilled = min(capacity, local[0] + max(0, now - local[1]) * rate)
+                # Списанное процессом во время сверки в базу еще не попало
+                shared_tokens = max(0.0, tokens - self._spent.get(bucket, 0))
+                self._buckets[bucket] = [min(refilled, shared_tokens), max(now, local[1])]
+                if self._buckets[bucket][0] >= capacity and bucket not in self._spent:
+                    del self._buckets[bucket]
+            for (key, day), (quota, used) in shared['quotas'].items():
+                state = self._quotas.get(key)
+                if state is None or state['day'] != day:
+                    continue
+                if day != today:
+                    del self._quotas[key]
+                    continue
+                state['quota'] = quota
+                state['used'] = used + self._usage.get((key, day), [0, 0])[0]
+            exhausted = sum(1 for state in self._quotas.values() if state['quota'] and state['used'] >= state['quota'])
+            self.counters['syncs'] += 1
+        metrics.API_KEYS_QUOTA_EXHAUSTED.set(exhausted)
+        return len(buckets)
+
+    def enforce(self, identity: str, scope: str, response: Optional[Response] = None, quota_key: str = None):
+        """Засчитать запрос или поднять HTTP 429; заголовки лимита - в response"""
+        refused, headers = self.hit(identity, scope, quota_key)
+        if refused:
+            detail = "Суточная квота API ключа исчерпана" if refused == 'quota' else "Слишком много запросов"
+            raise HTTPException(status_code=429, detail=detail, headers=headers)
+        if response is not None:
+            response.headers.update(headers)
+
+    def per_key(self, scope: str, verify_api_key: Callable) -> Callable:
+        """Зависимость FastAPI: проверка ключа, лимит группы scope и квота; возвращает данные ключа"""
+        async def dependency(response: Response, api_data: dict = Depends(verify_api_key)):
+            await self.prepare(api_data['key_id'], scope, api_data['key_id'])
+            self.enforce(api_data['key_id'], scope, response, quota_key=api_data['key_id'])
+            return api_data
+        return dependency
+
+    def per_client(self, scope: str) -> Callable:
+        """Зависимость FastAPI для эндпоинтов без ключа: лимит по IP клиента"""
+        async def dependency(request: Request, response: Response):
+            client = request.client.host if request.client else 'unknown'
+            await self.prepare(f"ip:{client}", scope)
+            self.enforce(f"ip:{client}", scope, response)
+        return dependency
+
+    async def run(self):
+        """Фоновая сверка с базой раз в sync_interval и удаление бакетов, которые давно полные"""
+        longest = max(seconds for _, seconds in self.limits.values())
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await loop.run_in_executor(None, self.sync)
+                if time.time() - self._last_purge >= PURGE_INTERVAL:
+                    self._last_purge = time.time()
+                    await loop.run_in_executor(None, self.db.purge_rate_limit_buckets,
+                                               self._last_purge - max(longest, PURGE_INTERVAL))
+            except Exception as e:
+                logger.error(f"Ошибка сверки лимитов с базой: {e}")
+
+    def usage_report(self) -> Dict:
+        """Потребление и остаток квот ключей за текущие сутки (для админ-эндпоинта), с несверенными запросами процесса"""
+        self.sync()
+        now = time.time()
+        with self._lock:
+            counters = dict(self.counters)
+        keys = self.db.get_api_key_usage_report(utc_day(now), self.daily_quota)
+        for row in keys:
+            row['quota_remaining'] = max(0, row['daily_quota'] - row['requests_today']) if row['daily_quota'] else None
+        return {
+            'day': utc_day(now),
+            'limits': {scope: f"{capacity}/{seconds:g}" for scope, (capacity, seconds) in self.limits.items()},
+            'default_daily_quota': self.daily_quota,
+            'process': counters,
+            'keys': keys,
+        }
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self.counters)
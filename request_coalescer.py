@@ -0,0 +1,122 @@
+"""
+Объединение одинаковых запросов к upstream (single-flight)
+
+Параллельные вызовы с одним ключом ждут один общий запрос и получают
+его результат. После завершения успешный результат хранится короткое
+время (micro-cache), чтобы волна запросов сразу после ответа тоже не
+уходила в upstream.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import config
+
+
+class _Flight:
+    """Запрос, который сейчас выполняется"""
+
+    __slots__ = ('event', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class RequestCoalescer:
+    """Single-flight с TTL micro-cache и счетчиками сэкономленных вызовов"""
+
+    def __init__(self, ttl: float = None, max_entries: int = None):
+        self.ttl = ttl if ttl is not None else config.COALESCE_TTL
+        self.max_entries = max_entries if max_entries is not None else config.COALESCE_MAX_ENTRIES
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self._cache: Dict[Hashable, tuple] = {}  # ключ -> (результат, время истечения)
+
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def call(self, key: Hashable, func: Callable[[], Any],
+             cacheable: Callable[[Any], bool] = None) -> Any:
+        """
+        Выполнить func() или присоединиться к уже идущему вызову с тем же ключом
+
+        Args:
+            key: Ключ запроса (endpoint + параметры)
+            func: Сам запрос к upstream
+            cacheable: Нужно ли класть результат в micro-cache (по умолчанию - да)
+
+        Ошибки передаются всем ожидающим, но не кэшируются.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[1] > now:
+                    self.cache_hits += 1
+                    return cached[0]
+                del self._cache[key]
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.upstream_calls += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.error is None and self.ttl > 0 and (cacheable is None or cacheable(flight.result)):
+                    if len(self._cache) >= self.max_entries:
+                        self._evict_expired()
+                    self._cache[key] = (flight.result, time.monotonic() + self.ttl)
+            flight.event.set()
+
+        return flight.result
+
+    def _evict_expired(self):
+        """Очистка устаревших записей (вызывается под блокировкой)"""
+        now = time.monotonic()
+        for key in [key for key, (_, expires) in self._cache.items() if expires <= now]:
+            del self._cache[key]
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+
+    def invalidate(self, key: Hashable = None):
+        """Сбросить micro-cache (весь или по ключу)"""
+        with self._lock:
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики: сколько запросов ушло в upstream и сколько сэкономлено"""
+        with self._lock:
+            return {
+                'upstream_calls': self.upstream_calls,
+                'coalesced': self.coalesced,
+                'cache_hits': self.cache_hits,
+                'saved_calls': self.coalesced + self.cache_hits,
+                'in_flight': len(self._inflight),
+                'cached_keys': len(self._cache),
+            }
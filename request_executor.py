@@ -0,0 +1,235 @@
+"""
+Выполнение запросов к Tron API с повторами
+
+Ошибки делятся на временные (таймаут, 429, 5xx - имеет смысл повторить)
+и постоянные (прочие 4xx, некорректный ответ). Временные повторяются с
+экспоненциальной задержкой и jitter, для 429 учитывается Retry-After.
+Общее число повторов ограничено бюджетом на цикл опроса, чтобы при
+недоступности upstream цикл не растягивался на повторы по каждому кошельку.
+"""
+
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterable, Optional
+
+import requests
+
+import config
+from tron_providers import ProviderError
+
+logger = logging.getLogger(__name__)
+
+
+class TronAPIError(Exception):
+    """Базовая ошибка запроса к Tron API"""
+
+    def __init__(self, call_type: str, message: str, status_code: Optional[int] = None):
+        super().__init__(f"{call_type}: {message}")
+        self.call_type = call_type
+        self.status_code = status_code
+
+
+class TransientError(TronAPIError):
+    """Временная ошибка: таймаут, обрыв соединения, 5xx"""
+
+
+class RateLimitError(TransientError):
+    """429 от провайдера; retry_after - пауза из заголовка Retry-After (секунды)"""
+
+    def __init__(self, call_type: str, message: str, retry_after: Optional[float] = None):
+        super().__init__(call_type, message, status_code=429)
+        self.retry_after = retry_after
+
+
+class ProvidersUnavailableError(TransientError):
+    """Все circuit breaker'ы открыты - повтор в том же цикле бесполезен"""
+
+
+class UpstreamResponseError(TronAPIError):
+    """Постоянная ошибка: 4xx или ответ, который нельзя разобрать"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах: число секунд или HTTP дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(call_type: str, error: BaseException) -> TronAPIError:
+    """Привести исключение запроса к типизированной ошибке"""
+    if isinstance(error, TronAPIError):
+        return error
+    if isinstance(error, ProviderError):
+        if not error.available:
+            return ProvidersUnavailableError(call_type, str(error))
+        response = error.last_response
+        if response is not None:
+            return classify_response(call_type, response)
+        return TransientError(call_type, str(error))
+    if isinstance(error, requests.RequestException):
+        return TransientError(call_type, f"{type(error).__name__}: {error}")
+    return UpstreamResponseError(call_type, f"{type(error).__name__}: {error}")
+
+
+def classify_response(call_type: str, response) -> TronAPIError:
+    """Ошибка по неуспешному HTTP ответу"""
+    status = response.status_code
+    if status == 429:
+        return RateLimitError(call_type, "HTTP 429",
+                              retry_after=parse_retry_after(response.headers.get('Retry-After')))
+    if status >= 500:
+        return TransientError(call_type, f"HTTP {status}", status_code=status)
+    return UpstreamResponseError(call_type, f"HTTP {status}", status_code=status)
+
+
+class RetryBudget:
+    """
+    Бюджет повторов на цикл опроса
+
+    Сбрасывается явно через new_cycle() в начале цикла или сам по
+    истечении window секунд, если цикл не размечен.
+    """
+
+    def __init__(self, per_cycle: int = None, window: float = None):
+        self.per_cycle = per_cycle if per_cycle is not None else config.TRON_RETRY_BUDGET
+        self.window = window if window is not None else config.CHECK_INTERVAL
+        self._lock = threading.Lock()
+        self._remaining = self.per_cycle
+        self._started = time.monotonic()
+
+    def new_cycle(self):
+        with self._lock:
+            self._remaining = self.per_cycle
+            self._started = time.monotonic()
+
+    def try_spend(self) -> bool:
+        """Списать один повтор; False - бюджет исчерпан"""
+        with self._lock:
+            if time.monotonic() - self._started >= self.window:
+                self._remaining = self.per_cycle
+                self._started = time.monotonic()
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            return self._remaining
+
+
+class RequestExecutor:
+    """
+    Повторы временных ошибок с ограниченной экспоненциальной задержкой
+
+    Задержка попытки n - случайная в [0, min(max_delay, base_delay * 2^n)]
+    (full jitter). Для 429 ждем Retry-After, если он не больше
+    max_retry_after, иначе сразу отдаем ошибку вызывающему.
+    """
+
+    def __init__(self, max_attempts: int = None, base_delay: float = None, max_delay: float = None,
+                 max_retry_after: float = None, budget: RetryBudget = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.max_attempts = max_attempts if max_attempts is not None else config.TRON_RETRY_MAX_ATTEMPTS
+        self.base_delay = base_delay if base_delay is not None else config.TRON_RETRY_BASE_DELAY
+        self.max_delay = max_delay if max_delay is not None else config.TRON_RETRY_MAX_DELAY
+        self.max_retry_after = max_retry_after if max_retry_after is not None else config.TRON_RETRY_AFTER_MAX
+        self.budget = budget or RetryBudget()
+        self._sleep = sleep
+        self._rng = random.Random()
+        self._lock = threading.Lock()
+        self._counters = {
+            'calls': 0,
+            'attempts': 0,
+            'retries': 0,
+            'give_ups': 0,
+            'rate_limited': 0,
+            'budget_exhausted': 0,
+            'permanent_errors': 0,
+            'retry_sleep_ms': 0,
+        }
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def backoff(self, attempt: int) -> float:
+        """Задержка перед повтором номер attempt (с 1)"""
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def execute(self, call_type: str, func: Callable, accept: Iterable[int] = (200,)):
+        """
+        Выполнить func() с повторами
+
+        func возвращает requests.Response или (провайдер, ответ). Ответ со
+        статусом из accept возвращается как есть, иначе поднимается
+        TronAPIError соответствующего типа.
+        """
+        self._count('calls')
+        attempt = 0
+        while True:
+            attempt += 1
+            self._count('attempts')
+            try:
+                result = func()
+                response = result[1] if isinstance(result, tuple) else result
+                if response.status_code in accept:
+                    return result
+                error = classify_response(call_type, response)
+            except Exception as e:
+                error = classify_error(call_type, e)
+
+            if not isinstance(error, TransientError):
+                self._count('permanent_errors')
+                raise error
+
+            delay = self._retry_delay(error, attempt)
+            if delay is None:
+                self._count('give_ups')
+                logger.warning(f"Отказ от {call_type} после {attempt} попыток: {error}")
+                raise error
+
+            self._count('retries')
+            self._count('retry_sleep_ms', int(delay * 1000))
+            self._sleep(delay)
+
+    def _retry_delay(self, error: TransientError, attempt: int) -> Optional[float]:
+        """Пауза перед повтором или None, если повторять не нужно"""
+        if isinstance(error, RateLimitError):
+            self._count('rate_limited')
+        if isinstance(error, ProvidersUnavailableError) or attempt >= self.max_attempts:
+            return None
+
+        delay = self.backoff(attempt)
+        if isinstance(error, RateLimitError) and error.retry_after is not None:
+            if error.retry_after > self.max_retry_after:
+                return None
+            delay = max(delay, error.retry_after)
+
+        if not self.budget.try_spend():
+            self._count('budget_exhausted')
+            return None
+        return delay
+
+    def new_cycle(self):
+        """Начало цикла опроса - бюджет повторов восстанавливается"""
+        self.budget.new_cycle()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попыток, повторов и отказов"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['budget_remaining'] = self.budget.remaining
+        return stats
@@ -0,0 +1,113 @@
+"""
+Условные GET по версиям сущностей и кеш готовых ответов
+
+Смена состояния платежа в той же транзакции поднимает счетчик версии
+сущности в таблице versions ('payment:<id>' - платеж Simple Payment API,
+'user:<id>' - платежи пользователя Payment Bot API). ETag строится из
+ресурса и версии, поэтому для If-None-Match достаточно одного чтения
+версии по первичному ключу: неизменившийся ресурс отдается как 304 без
+запроса данных и сериализации. Готовое тело ответа хранится в кеше
+процесса вместе с версией; запись устаревшей версии не отдается, а
+перестраивается, так что смену статуса кеш видит во всех воркерах сразу.
+Кеш ограничен RESPONSE_CACHE_SIZE записями, вытесняются давно не
+использованные.
+"""
+
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import config
+
+# Cache-Control статусов: меняются в любой момент, клиент каждый раз сверяет ETag (дешевый 304)
+REVALIDATE = "private, no-cache"
+
+
+def version_etag(resource: str, version: Any) -> str:
+    """ETag ресурса версии version"""
+    return '"' + hashlib.sha1(f"{resource}:{version}".encode()).hexdigest()[:16] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Заголовок If-None-Match содержит etag (слабые W/ теги сравниваются как сильные)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+
+
+class ResponseCache:
+    """Тела JSON ответов по ресурсу с версией; LRU на max_size записей"""
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or config.RESPONSE_CACHE_SIZE
+        self._lock = threading.Lock()
+        # ресурс -> (версия, тело ответа)
+        self._entries: OrderedDict = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'not_modified': 0, 'uncacheable': 0}
+
+    def _lookup(self, resource: str, version: Any) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(resource)
+            if entry is None or entry[0] != version:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(resource)
+            self.counters['hits'] += 1
+            return entry[1]
+
+    def _store(self, resource: str, version: Any, body: bytes):
+        with self._lock:
+            self._entries[resource] = (version, body)
+            self._entries.move_to_end(resource)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    async def respond(self, resource: str, version: Any, build: Callable[[], Tuple[Any, bool]],
+                      if_none_match: Optional[str] = None, cache_control: str = REVALIDATE,
+                      response: Optional[Response] = None) -> Response:
+        """
+        Ответ на GET ресурса текущей версии
+
+        build() (функция или корутина) -> (тело ответа, можно ли кешировать);
+        вызывается только при промахе кеша. Некешируемый ответ (например,
+        "не найден") отдается без ETag. response - Response зависимостей
+        FastAPI: его заголовки (лимиты запросов) копируются в ответ.
+        """
+        etag = version_etag(resource, version)
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if response is not None:
+            headers.update({name: value for name, value in response.headers.items()
+                            if name not in ('content-length', 'content-type')})
+
+        if etag_matches(if_none_match, etag):
+            with self._lock:
+                self.counters['not_modified'] += 1
+            return Response(status_code=304, headers=headers)
+
+        body = self._lookup(resource, version)
+        if body is None:
+            result = build()
+            content, cacheable = await result if inspect.isawaitable(result) else result
+            body = JSONResponse(jsonable_encoder(content)).body
+            if not cacheable:
+                with self._lock:
+                    self.counters['uncacheable'] += 1
+                del headers["ETag"]
+                headers["Cache-Control"] = "no-store"
+                return Response(content=body, media_type="application/json", headers=headers)
+            self._store(resource, version, body)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+        return stats
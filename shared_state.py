@@ -0,0 +1,205 @@
+"""
+Общее состояние воркеров uvicorn: канал событий и лидер фоновых опросов
+
+Под uvicorn --workers N у каждого воркера свои объекты в памяти. Все,
+что должно быть общим, хранится в базе (ключи, лимиты, платежи,
+outbox), а состояние в памяти (индекс ожидающих платежей, окно
+переводов, подписки long-poll/SSE/WebSocket) синхронизируется через
+SharedBus: событие записывается в таблицу bus_events, обработчики
+этого процесса вызываются сразу, остальные воркеры читают новые строки
+по курсору раз в SHARED_BUS_POLL_INTERVAL. Номер события растет во
+всех процессах, поэтому годится как общий seq для продолжения потока.
+
+Опрос Tron API выполняет один воркер - держатель аренды LeaderLease
+(таблица leases, продление раз в треть LEADER_LEASE_TTL). Если лидер
+упал, аренда истекает и ее занимает другой воркер; при остановке
+аренда освобождается сразу.
+"""
+
+import asyncio
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from typing import Callable, Dict, List
+
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор процесса: держатель аренды и источник событий канала
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+# Событий за одно чтение канала
+BUS_READ_LIMIT = 500
+
+# Как часто удалять старые события канала, секунды
+BUS_PURGE_INTERVAL = 60
+
+
+class SharedBus:
+    """Канал событий между воркерами через таблицу bus_events"""
+
+    def __init__(self, db: Database, poll_interval: float = None, retention: float = None,
+                 origin: str = None):
+        """
+        Args:
+            poll_interval: Как часто читать новые события других воркеров, секунды
+            retention: Сколько секунд хранятся события
+            origin: Идентификатор процесса (по умолчанию WORKER_ID)
+        """
+        self.db = db
+        self.poll_interval = poll_interval if poll_interval is not None else config.SHARED_BUS_POLL_INTERVAL
+        self.retention = retention if retention is not None else config.SHARED_BUS_RETENTION
+        self.origin = origin or WORKER_ID
+        self._lock = threading.Lock()
+        # канал -> [handler(payload, номер события)]
+        self._handlers: Dict[str, List[Callable[[Dict, int], None]]] = {}
+        # События до создания канала не нужны: состояние при запуске читается из базы
+        self._cursor = db.get_last_bus_event_id()
+        self._last_purge = time.time()
+        self.counters = {'published': 0, 'received': 0, 'handler_errors': 0, 'purged': 0}
+
+    def subscribe(self, channel: str, handler: Callable[[Dict, int], None]):
+        """Обработчик событий канала: handler(payload, номер события)"""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def _dispatch(self, channel: str, payload: Dict, event_id: int):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(payload, event_id)
+            except Exception as e:
+                with self._lock:
+                    self.counters['handler_errors'] += 1
+                logger.error(f"Ошибка обработчика события {channel}: {e}")
+
+    def publish(self, channel: str, payload: Dict) -> int:
+        """Записать событие для всех воркеров и сразу обработать в этом процессе"""
+        event_id = self.db.add_bus_event(channel, payload, self.origin, time.time())
+        with self._lock:
+            self.counters['published'] += 1
+        self._dispatch(channel, payload, event_id)
+        return event_id
+
+    def poll(self) -> int:
+        """Обработать новые события других воркеров; возвращает их число"""
+        received = 0
+        while True:
+            events = self.db.get_bus_events(self._cursor, BUS_READ_LIMIT)
+            for event in events:
+                self._cursor = event['id']
+                if event['origin'] == self.origin:
+                    continue
+                self._dispatch(event['channel'], event['payload'], event['id'])
+                received += 1
+            if len(events) < BUS_READ_LIMIT:
+                break
+        with self._lock:
+            self.counters['received'] += received
+        return received
+
+    async def run(self):
+        """Фоновое чтение канала и удаление старых событий"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.poll)
+                if time.time() - self._last_purge >= BUS_PURGE_INTERVAL:
+                    self._last_purge = time.time()
+                    purged = await loop.run_in_executor(None, self.db.purge_bus_events,
+                                                        self._last_purge - self.retention)
+                    with self._lock:
+                        self.counters['purged'] += purged
+            except Exception as e:
+                logger.error(f"Ошибка чтения канала событий: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.counters)
+        stats['cursor'] = self._cursor
+        stats['channels'] = sorted(self._handlers)
+        return stats
+
+
+class LeaderLease:
+    """Аренда лидерства name в таблице leases: фоновые опросы выполняет только лидер"""
+
+    def __init__(self, db: Database, name: str, ttl: float = None, holder: str = None):
+        """
+        Args:
+            name: Имя аренды (одна на сервис)
+            ttl: Срок аренды без продления, секунды
+            holder: Идентификатор претендента (по умолчанию WORKER_ID)
+        """
+        self.db = db
+        self.name = name
+        self.ttl = ttl if ttl is not None else config.LEADER_LEASE_TTL
+        self.holder = holder or WORKER_ID
+        self._expires_at = 0.0
+        self._leader = False
+        self._listeners: List[Callable[[], None]] = []
+        self.counters = {'elected': 0, 'lost': 0}
+
+    @property
+    def is_leader(self) -> bool:
+        """Аренда у этого процесса и не истекла (зависший лидер перестает опрашивать сам)"""
+        return self._leader and time.time() < self._expires_at
+
+    def on_elected(self, listener: Callable[[], None]):
+        """Обработчик получения лидерства (например, перечитать состояние из базы)"""
+        self._listeners.append(listener)
+
+    def renew(self, now: float = None) -> bool:
+        """Занять или продлить аренду; возвращает, лидер ли этот процесс"""
+        now = now if now is not None else time.time()
+        try:
+            leader = self.db.acquire_lease(self.name, self.holder, now, self.ttl)
+        except Exception as e:
+            logger.error(f"Ошибка продления аренды {self.name}: {e}")
+            leader = False
+
+        if leader:
+            self._expires_at = now + self.ttl
+        if leader and not self._leader:
+            self.counters['elected'] += 1
+            logger.info(f"Воркер {self.holder} - лидер {self.name}")
+            self._leader = True
+            for listener in self._listeners:
+                try:
+                    listener()
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика лидерства {self.name}: {e}")
+        elif not leader and self._leader:
+            self.counters['lost'] += 1
+            logger.warning(f"Воркер {self.holder} больше не лидер {self.name}")
+            self._leader = False
+        return leader
+
+    async def run(self):
+        """Фоновое продление аренды раз в треть ttl"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(None, self.renew)
+            await asyncio.sleep(self.ttl / 3)
+
+    def release(self):
+        """Отдать аренду при остановке: другой воркер займет ее без ожидания ttl"""
+        if self._leader:
+            self._leader = False
+            try:
+                self.db.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.error(f"Ошибка освобождения аренды {self.name}: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            'name': self.name,
+            'worker': self.holder,
+            'leader': self.is_leader,
+            'elected': self.counters['elected'],
+            'lost': self.counters['lost'],
+        }
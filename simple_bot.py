@@ -10,6 +10,7 @@ from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
 from database import Database
 from tron_tracker import TronTracker
+from request_executor import TronAPIError
 import config
 
 # Настройка логирования
@@ -220,10 +221,15 @@ class SimplePaymentBot:
         wallet_address = user_data['wallet_address']
         
         # Получаем информацию об аккаунте
-        account_info = self.tron_tracker.get_account_info(wallet_address)
+        try:
+            account_info = self.tron_tracker.get_account_info(wallet_address)
+            balance = self.tron_tracker.get_balance(wallet_address) if account_info else None
+        except TronAPIError as e:
+            logger.warning(f"Tron API недоступен: {e}")
+            await update.message.reply_text("⏳ Tron API временно недоступен. Попробуйте позже.")
+            return
         
         if account_info:
-            balance = self.tron_tracker.get_balance(wallet_address)
             
             await update.message.reply_text(
                 f"💰 Баланс кошелька:\n\n"
@@ -240,12 +246,20 @@ class SimplePaymentBot:
         try:
             tracked_wallets = self.db.get_tracked_wallets()
             
+            # Новый цикл опроса - бюджет повторов восстанавливается
+            self.tron_tracker.start_cycle()
+            
             for wallet in tracked_wallets:
                 wallet_address = wallet['wallet_address']
                 user_id = wallet['user_id']
                 
-                # Получаем новые транзакции
-                new_transfers = self.tron_tracker.check_new_transactions(wallet_address)
+                # Получаем новые транзакции; при недоступности API кошелек
+                # проверяется в следующем цикле, остальные - как обычно
+                try:
+                    new_transfers = self.tron_tracker.check_new_transactions(wallet_address)
+                except TronAPIError as e:
+                    logger.warning(f"Пропуск {wallet_address} в этом цикле: {e}")
+                    continue
                 
                 for transfer in new_transfers:
                     # Проверяем, есть ли ожидающие платежи на эту сумму
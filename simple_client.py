@@ -7,7 +7,7 @@
 import requests
 import time
 import json
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 class SimplePaymentClient:
     """
@@ -31,7 +31,8 @@ class SimplePaymentClient:
         }
     
     def create_payment(self, amount: float, currency: str = "USDT", 
-                      description: str = None, callback_url: str = None) -> Dict[str, Any]:
+                      description: str = None, callback_url: str = None,
+                      idempotency_key: str = None) -> Dict[str, Any]:
         """
         Создать платеж
         
@@ -40,6 +41,8 @@ class SimplePaymentClient:
             currency: Валюта (по умолчанию USDT)
             description: Описание платежа
             callback_url: URL для callback уведомлений
+            idempotency_key: Ключ идемпотентности (например, ID заказа): повтор
+                с тем же ключом после таймаута вернет уже созданный платеж
             
         Returns:
             Результат создания платежа
@@ -52,9 +55,12 @@ class SimplePaymentClient:
         }
         
         try:
+            headers = dict(self.headers)
+            if idempotency_key:
+                headers['Idempotency-Key'] = idempotency_key
             response = requests.post(
                 f"{self.api_url}/create-payment",
-                headers=self.headers,
+                headers=headers,
                 json=data,
                 timeout=10
             )
@@ -104,30 +110,90 @@ class SimplePaymentClient:
                 "error": str(e)
             }
     
+    def check_payments(self, payment_ids: List[str], batch_size: int = 100) -> Dict[str, Any]:
+        """
+        Проверить статусы нескольких платежей пачками через /payments/status
+        
+        Args:
+            payment_ids: ID платежей
+            batch_size: Платежей в одном запросе (не больше BATCH_MAX_ITEMS сервера)
+            
+        Returns:
+            {"success": True, "results": [...]} - статусы в порядке payment_ids,
+            каждый как у check_payment; при ошибке запроса - ответ с "error"
+        """
+        results = []
+        success = True
+        try:
+            for start in range(0, len(payment_ids), batch_size):
+                response = requests.post(
+                    f"{self.api_url}/payments/status",
+                    headers=self.headers,
+                    json={"payment_ids": payment_ids[start:start + batch_size]},
+                    timeout=10
+                )
+                
+                if response.status_code != 200:
+                    return {
+                        "success": False,
+                        "error": f"HTTP {response.status_code}: {response.text}"
+                    }
+                batch = response.json()
+                results.extend(batch["results"])
+                success = success and batch["success"]
+                
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+        
+        return {"success": success, "results": results}
+    
     def wait_for_payment(self, payment_id: str, timeout: int = 300, 
                         check_interval: int = 10) -> Dict[str, Any]:
         """
         Ждать завершения платежа
         
+        Сервер держит запрос /payments/{id}/wait до смены статуса, поэтому
+        клиент не опрашивает статус в цикле: повторный запрос уходит только
+        по истечении long-poll таймаута сервера.
+        
         Args:
             payment_id: ID платежа
             timeout: Максимальное время ожидания в секундах
-            check_interval: Интервал проверки в секундах
+            check_interval: Пауза перед повтором после ошибки запроса в секундах
             
         Returns:
             Результат платежа
         """
-        start_time = time.time()
+        deadline = time.time() + timeout
         
-        while time.time() - start_time < timeout:
-            result = self.check_payment(payment_id)
+        while time.time() < deadline:
+            wait = max(1, min(int(deadline - time.time()), 60))
+            try:
+                response = requests.get(
+                    f"{self.api_url}/payments/{payment_id}/wait",
+                    headers=self.headers,
+                    params={"timeout": wait},
+                    timeout=wait + 10
+                )
+                result = response.json() if response.status_code == 200 else {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}",
+                    "retry_after": float(response.headers.get("Retry-After", 0))
+                }
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
             
-            if result.get('success') and result.get('status') == 'completed':
+            if result.get('success') and result.get('status') in ('completed', 'failed', 'expired'):
                 return result
-            elif result.get('success') and result.get('status') == 'failed':
-                return result
-            
-            time.sleep(check_interval)
+            if not result.get('success'):
+                if result.get('error') == "Платеж не найден":
+                    return result
+                # При лимите запросов (429) - не раньше Retry-After
+                pause = max(check_interval, result.get('retry_after', 0))
+                time.sleep(min(pause, max(0, deadline - time.time())))
         
         return {
             "success": False,
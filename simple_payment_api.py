@@ -5,17 +5,33 @@
 """
 
 import asyncio
+import json
 import logging
-from fastapi import FastAPI, HTTPException, Depends, Header
+import sqlite3
+import time
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import uvicorn
 import secrets
 import hashlib
 from datetime import datetime, timedelta
 from database import Database
 from tron_tracker import TronTracker
+from payment_matcher import PaymentMatcher
+from amount_allocator import AmountAllocator, AmountAllocationError
+from payment_sweeper import PaymentSweeper
+from payment_events import PaymentEvents
+from transfer_window import TransferWindow
+from callback_outbox import CallbackDispatcher
+from api_auth import ApiKeyAuth
+from rate_limiter import RateLimiter, require_admin
+from idempotency import IdempotencyStore
+from response_cache import ResponseCache
+from shared_state import SharedBus, LeaderLease
+import metrics
 import config
 
 # Настройка логирования
@@ -38,12 +54,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Метрики Prometheus: GET /metrics
+metrics.install(app, 'simple_payment_api')
+
 # Инициализация
 db = Database()
 tron_tracker = TronTracker()
 
-# Хранилище API ключей (в реальном проекте используйте базу данных)
-api_keys = {}
+# API ключи: хеши в базе, кеш проверки в процессе
+api_auth = ApiKeyAuth(db)
+
+# Лимиты частоты и суточные квоты ключей (общие для воркеров через базу)
+rate_limiter = RateLimiter(db)
+
+# Ожидающие платежи в памяти: сопоставление переводов без перебора в базе
+payment_matcher = PaymentMatcher()
+
+# Уникальные суммы для покупателей одного активного кошелька
+amount_allocator = AmountAllocator(db)
+
+def expired_callback(table: str, payment: dict) -> dict:
+    """Тело callback'а об истечении платежа (ставится в outbox вместе со статусом)"""
+    return {
+        "payment_id": payment['payment_id'],
+        "status": "expired",
+        "amount": payment['amount'],
+        "currency": payment['currency']
+    }
+
+# Истечение неоплаченных платежей и резервов сумм
+payment_sweeper = PaymentSweeper(db, tables=('simple_payments',), allocator=amount_allocator,
+                                 callback_payload=expired_callback)
+payment_sweeper.on_expired(lambda table, rows: payment_matcher.expire(row['payment_id'] for row in rows))
+
+# Переводы на кошельки платежей: курсор фонового опроса и отсев уже виденных
+payment_transfers = TransferWindow()
+
+# Переводы, не закрывшие платеж (зачисление не записалось в базу, платеж
+# еще не дошел до индекса или уже не 'pending'): окно их уже не вернет,
+# поэтому они повторяются в следующих циклах (tx_hash -> перевод)
+retry_transfers = {}
+
+# Смена статуса будит long-poll и SSE клиентов, ждущих платеж
+payment_events = PaymentEvents()
+
+# Доставка callback'ов мерчантам из outbox с повторами
+callback_dispatcher = CallbackDispatcher(db)
+metrics.track_callback_backlog(lambda: db)
+
+# Idempotency-Key создания платежей: повтор после таймаута не создает второй платеж
+idempotency = IdempotencyStore(db)
+
+# Готовые ответы /check-payment по версии платежа (ETag, 304)
+response_cache = ResponseCache()
+
+# Несколько воркеров: новые платежи и смены статусов расходятся по воркерам
+# через канал в базе, переводы опрашивает и зачисляет только лидер
+shared_bus = SharedBus(db)
+poller_leader = LeaderLease(db, 'simple_payment_api.poller')
+
+# Статусы, после которых платеж больше не меняется
+FINAL_STATUSES = ('completed', 'expired', 'failed')
 
 # Модели данных
 class CreatePaymentRequest(BaseModel):
@@ -70,28 +141,30 @@ class PaymentStatusResponse(BaseModel):
     transaction_hash: Optional[str] = None
     error: Optional[str] = None
 
+class BatchStatusRequest(BaseModel):
+    payment_ids: List[str]  # Не больше BATCH_MAX_ITEMS
+
+class BatchStatusResponse(BaseModel):
+    success: bool
+    results: List[PaymentStatusResponse]  # В порядке запроса
+
 # Функция проверки API ключа
 async def verify_api_key(x_api_key: str = Header(None)):
     """Проверка API ключа"""
     if not x_api_key:
         raise HTTPException(status_code=401, detail="API ключ не предоставлен")
     
-    # Проверяем API ключ в базе данных
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT user_id FROM api_keys 
-        WHERE api_key = ? AND is_active = 1
-    ''', (x_api_key,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
+    # Кеш проверки; база - только при промахе кеша
+    principal = api_auth.authenticate(x_api_key)
+    if not principal:
         raise HTTPException(status_code=401, detail="Неверный API ключ")
     
-    return result[0]
+    return principal
+
+# Проверка ключа с лимитом группы эндпоинтов (429 при превышении)
+create_limit = rate_limiter.per_key('create', verify_api_key)
+check_limit = rate_limiter.per_key('check', verify_api_key)
+default_limit = rate_limiter.per_key('default', verify_api_key)
 
 @app.get("/")
 async def root():
@@ -103,6 +176,9 @@ async def root():
         "endpoints": [
             "/create-payment - Создать платеж",
             "/check-payment/{payment_id} - Проверить статус платежа",
+            "/payments/status - Статусы нескольких платежей (POST)",
+            "/payments/{payment_id}/wait?timeout=30 - Дождаться смены статуса (long-poll)",
+            "/payments/{payment_id}/events - Поток статусов платежа (SSE)",
             "/get-api-key - Получить API ключ",
             "/get-payment-wallet - Получить кошелек для платежа",
             "/check-user-payments - Проверить платежи пользователя",
@@ -110,41 +186,11 @@ async def root():
         ]
     }
 
-@app.get("/get-api-key")
+@app.get("/get-api-key", dependencies=[Depends(rate_limiter.per_client('get-api-key'))])
 async def get_api_key():
     """Получить API ключ для интеграции"""
-    # Генерируем уникальный API ключ
-    api_key = secrets.token_urlsafe(32)
-    
-    # Создаем запись в базе данных
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    # Создаем таблицу для API ключей если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_keys (
-            api_key TEXT PRIMARY KEY,
-            user_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
-        )
-    ''')
-    
-    # Сохраняем API ключ
-    cursor.execute('''
-        INSERT INTO api_keys (api_key, user_id)
-        VALUES (?, ?)
-    ''', (api_key, 0))  # 0 означает системный ключ
-    
-    conn.commit()
-    conn.close()
-    
-    # Сохраняем в памяти
-    api_keys[api_key] = {
-        "user_id": 0,
-        "created_at": datetime.now(),
-        "is_active": True
-    }
+    # Генерируем уникальный API ключ (0 означает системный ключ); в базе - только хеш
+    api_key = api_auth.create_key(0)
     
     return {
         "success": True,
@@ -159,9 +205,23 @@ async def get_api_key():
 @app.post("/create-payment", response_model=PaymentResponse)
 async def create_payment(
     request: CreatePaymentRequest,
-    api_data: dict = Depends(verify_api_key)
+    response: Response,
+    api_data: dict = Depends(create_limit),
+    idempotency_key: Optional[str] = Header(None)
 ):
-    """Создать платеж"""
+    """
+    Создать платеж
+    
+    С заголовком Idempotency-Key повтор запроса (например, после таймаута)
+    получает ответ первого запроса, новый платеж не создается.
+    """
+    scope = f"simple:{api_data['key_id']}"
+    if idempotency_key:
+        replay = idempotency.begin(scope, idempotency_key, request.model_dump())
+        if replay is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return PaymentResponse(**replay)
+    
     try:
         # Генерируем уникальный ID платежа
         payment_id = secrets.token_urlsafe(16)
@@ -170,35 +230,29 @@ async def create_payment(
         # В реальном проекте здесь должна быть логика получения адреса
         wallet_address = "TYourPaymentWallet1234567890123456789012345"
         
-        # Сохраняем платеж в базе данных
+        # Сохраняем платеж в базе данных (таблица создается в Database.init_database)
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        # Создаем таблицу для платежей если её нет
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS simple_payments (
-                payment_id TEXT PRIMARY KEY,
-                amount REAL,
-                currency TEXT,
-                wallet_address TEXT,
-                status TEXT DEFAULT 'pending',
-                callback_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                api_key TEXT
-            )
-        ''')
-        
         cursor.execute('''
             INSERT INTO simple_payments 
-            (payment_id, amount, currency, wallet_address, callback_url, api_key)
-            VALUES (?, ?, ?, ?, ?, ?)
+            (payment_id, amount, currency, wallet_address, callback_url, api_key, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))
         ''', (payment_id, request.amount, request.currency, wallet_address, 
-              request.callback_url, api_data.get('api_key', '')))
+              request.callback_url, api_data['key_id'], f'{config.PENDING_PAYMENT_TTL:+d} seconds'))
         
         conn.commit()
         conn.close()
-        
-        return PaymentResponse(
+        # Платеж попадает в индекс сопоставления всех воркеров, в том числе лидера опроса
+        shared_bus.publish('simple.payment_created', {
+            'id': payment_id,
+            'amount': request.amount,
+            'currency': request.currency,
+            'wallet_address': wallet_address,
+            'callback_url': request.callback_url
+        })
+        
+        result = PaymentResponse(
             success=True,
             payment_id=payment_id,
             wallet_address=wallet_address,
@@ -209,105 +263,335 @@ async def create_payment(
         
     except Exception as e:
         logger.error(f"Ошибка создания платежа: {e}")
+        if idempotency_key:
+            idempotency.release(scope, idempotency_key)
         return PaymentResponse(
             success=False,
             error=str(e)
         )
+    
+    if idempotency_key:
+        idempotency.complete(scope, idempotency_key, result.model_dump())
+    return result
 
 @app.get("/check-payment/{payment_id}", response_model=PaymentStatusResponse)
 async def check_payment(
     payment_id: str,
-    api_data: dict = Depends(verify_api_key)
+    response: Response,
+    api_data: dict = Depends(check_limit),
+    if_none_match: Optional[str] = Header(None)
 ):
-    """Проверить статус платежа"""
+    """
+    Проверить статус платежа
+    
+    Статус обновляет фоновое зачисление (resolve_payments_task). ETag -
+    версия платежа, которую поднимает каждая смена статуса: с If-None-Match,
+    равным ETag прошлого ответа, неизменившийся статус отдается как 304
+    после одного чтения версии, остальные ответы - из кеша по версии.
+    """
+    key_id = api_data['key_id']
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT amount, currency, wallet_address, status, callback_url
-            FROM simple_payments 
-            WHERE payment_id = ? AND api_key = ?
-        ''', (payment_id, api_data.get('api_key', '')))
-        
-        payment = cursor.fetchone()
-        conn.close()
-        
-        if not payment:
-            return PaymentStatusResponse(
-                success=False,
-                error="Платеж не найден"
-            )
-        
-        amount, currency, wallet_address, status, callback_url = payment
-        
-        # Если платеж еще pending, проверяем поступления
-        if status == "pending":
-            try:
-                # Проверяем новые транзакции
-                new_transfers = tron_tracker.get_new_transfers(wallet_address)
-                
-                for transfer in new_transfers:
-                    # Проверяем, соответствует ли сумма
-                    if abs(transfer['amount'] - amount) < 0.01:  # Допуск 0.01 USDT
-                        # Обновляем статус платежа
-                        conn = db.get_connection()
-                        cursor = conn.cursor()
-                        
-                        cursor.execute('''
-                            UPDATE simple_payments 
-                            SET status = 'completed', transaction_hash = ?
-                            WHERE payment_id = ?
-                        ''', (transfer['tx_hash'], payment_id))
-                        
-                        conn.commit()
-                        conn.close()
-                        
-                        # Отправляем callback если указан
-                        if callback_url:
-                            await send_callback(callback_url, {
-                                "payment_id": payment_id,
-                                "status": "completed",
-                                "amount": amount,
-                                "currency": currency,
-                                "transaction_hash": transfer['tx_hash']
-                            })
-                        
-                        return PaymentStatusResponse(
-                            success=True,
-                            payment_id=payment_id,
-                            status="completed",
-                            amount=amount,
-                            currency=currency,
-                            transaction_hash=transfer['tx_hash']
-                        )
-            except Exception as e:
-                logger.error(f"Ошибка проверки платежа: {e}")
-        
-        return PaymentStatusResponse(
-            success=True,
-            payment_id=payment_id,
-            status=status,
-            amount=amount,
-            currency=currency
-        )
-        
+        version = db.get_version(f"payment:{payment_id}")
     except Exception as e:
         logger.error(f"Ошибка проверки статуса платежа: {e}")
         return PaymentStatusResponse(
             success=False,
             error=str(e)
         )
+    
+    def build():
+        try:
+            payment = get_payment_status(payment_id, key_id)
+        except Exception as e:
+            logger.error(f"Ошибка проверки статуса платежа: {e}")
+            return PaymentStatusResponse(success=False, error=str(e)), False
+        if not payment:
+            return PaymentStatusResponse(success=False, error="Платеж не найден"), False
+        return PaymentStatusResponse(success=True, **payment), True
+    
+    return await response_cache.respond(f"check:{key_id}:{payment_id}", version, build,
+                                        if_none_match, response=response)
 
-async def send_callback(url: str, data: dict):
-    """Отправка callback уведомления"""
+def get_payment_status(payment_id: str, key_id: str) -> Optional[dict]:
+    """Текущий статус платежа из базы (None - платеж не найден)"""
+    return db.get_simple_payments([payment_id], key_id).get(payment_id)
+
+@app.post("/payments/status", response_model=BatchStatusResponse)
+async def payments_status(
+    request: BatchStatusRequest,
+    api_data: dict = Depends(check_limit)
+):
+    """
+    Статусы нескольких платежей одним запросом (не больше BATCH_MAX_ITEMS)
+    
+    Все платежи читаются одним запросом по первичному ключу. Результаты -
+    в порядке запроса, по одному на платеж, как у /check-payment. Для
+    лимитов пачка - один запрос.
+    """
+    if len(request.payment_ids) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400,
+                            detail=f"Не больше {config.BATCH_MAX_ITEMS} платежей в одном запросе")
     try:
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=data, timeout=10) as response:
-                logger.info(f"Callback отправлен: {response.status}")
+        payments = db.get_simple_payments(request.payment_ids, api_data['key_id'])
     except Exception as e:
-        logger.error(f"Ошибка отправки callback: {e}")
+        logger.error(f"Ошибка пакетной проверки статусов: {e}")
+        return BatchStatusResponse(success=False, results=[
+            PaymentStatusResponse(success=False, payment_id=payment_id, error=str(e))
+            for payment_id in request.payment_ids
+        ])
+    
+    return BatchStatusResponse(success=True, results=[
+        PaymentStatusResponse(success=True, **payments[payment_id]) if payment_id in payments
+        else PaymentStatusResponse(success=False, payment_id=payment_id, error="Платеж не найден")
+        for payment_id in request.payment_ids
+    ])
+
+@app.get("/payments/{payment_id}/wait", response_model=PaymentStatusResponse)
+async def wait_payment(
+    payment_id: str,
+    timeout: float = Query(30, ge=0),
+    api_data: dict = Depends(check_limit)
+):
+    """
+    Дождаться смены статуса платежа (long-poll)
+    
+    Ответ приходит сразу, если платеж уже не pending, иначе - при
+    зачислении или истечении платежа либо по истечении timeout секунд
+    (не больше LONG_POLL_MAX_TIMEOUT) со статусом pending.
+    """
+    timeout = min(timeout, config.LONG_POLL_MAX_TIMEOUT)
+    with payment_events.subscription(payment_id) as queue:
+        payment = get_payment_status(payment_id, api_data['key_id'])
+        if not payment:
+            return PaymentStatusResponse(success=False, error="Платеж не найден")
+        
+        if payment['status'] not in FINAL_STATUSES:
+            try:
+                payment = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    return PaymentStatusResponse(success=True, **payment)
+
+@app.get("/payments/{payment_id}/events")
+async def payment_events_stream(
+    payment_id: str,
+    request: Request,
+    api_data: dict = Depends(check_limit)
+):
+    """
+    Поток статусов платежа (Server-Sent Events)
+    
+    Первое событие - текущий статус, затем каждое изменение. Поток
+    закрывается после финального статуса (completed, expired, failed).
+    Между событиями раз в SSE_HEARTBEAT_INTERVAL отправляется комментарий.
+    """
+    payment = get_payment_status(payment_id, api_data['key_id'])
+    if not payment:
+        raise HTTPException(status_code=404, detail="Платеж не найден")
+    
+    async def stream():
+        with payment_events.subscription(payment_id) as queue:
+            # Статус перечитывается после подписки, чтобы не пропустить зачисление
+            current = get_payment_status(payment_id, api_data['key_id'])
+            while True:
+                if current is not None:
+                    yield f"event: status\ndata: {json.dumps(current)}\n\n"
+                    if current['status'] in FINAL_STATUSES:
+                        return
+                try:
+                    current = await asyncio.wait_for(queue.get(), config.SSE_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    current = None
+                    yield ": keepalive\n\n"
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def unused_transfers(transfers: list) -> list:
+    """Переводы, еще не закрывшие ни один платеж (один запрос на пачку)"""
+    if not transfers:
+        return []
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(transfers))
+    cursor.execute(f'''
+        SELECT transaction_hash FROM simple_payments WHERE transaction_hash IN ({placeholders})
+    ''', [transfer['tx_hash'] for transfer in transfers])
+    used = {row[0] for row in cursor.fetchall()}
+    conn.close()
+    return [transfer for transfer in transfers if transfer['tx_hash'] not in used]
+
+def record_completions(matches: list) -> list:
+    """Отметить пачку платежей оплаченными одной транзакцией с callback'ами в outbox"""
+    return db.complete_simple_payments([{
+        'payment_id': payment['id'],
+        'transaction_hash': transfer['tx_hash'],
+        'callback_url': payment.get('callback_url'),
+        'payload': {
+            "payment_id": payment['id'],
+            "status": "completed",
+            "amount": payment['amount'],
+            "currency": payment['currency'],
+            "transaction_hash": transfer['tx_hash']
+        }
+    } for transfer, payment in matches])
+
+async def complete_payments(matches: list, completed: list):
+    """Разбудить ждущих и отправить callback'и записанных платежей"""
+    completed_ids = {item['payment_id'] for item in completed}
+    for transfer, payment in matches:
+        if payment['id'] in completed_ids:
+            metrics.observe_detection('simple_payment_api', transfer.get('timestamp'))
+    for item in completed:
+        shared_bus.publish('simple.payment_status', item['payload'])
+    if any(item['callback_url'] for item in completed):
+        callback_dispatcher.notify()
+
+def load_pending_payments() -> int:
+    """Загрузить ожидающие платежи в индекс сопоставления"""
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT payment_id, amount, currency, wallet_address, callback_url
+            FROM simple_payments WHERE status = 'pending'
+        ''')
+        rows = cursor.fetchall()
+    except sqlite3.OperationalError:
+        rows = []  # Таблица создается при первом платеже
+    finally:
+        conn.close()
+    
+    return payment_matcher.load({
+        'id': payment_id,
+        'amount': amount,
+        'currency': currency,
+        'wallet_address': wallet_address,
+        'callback_url': callback_url
+    } for payment_id, amount, currency, wallet_address, callback_url in rows)
+
+def on_payment_created(payment: dict, event_id: int):
+    """Платеж, созданный в любом воркере, - в индекс сопоставления"""
+    payment_matcher.add(payment)
+
+def on_payment_status(event: dict, event_id: int):
+    """Смена статуса в любом воркере будит long-poll и SSE клиентов этого воркера"""
+    payment_matcher.expire([event['payment_id']])
+    payment_events.publish(event['payment_id'], event)
+
+shared_bus.subscribe('simple.payment_created', on_payment_created)
+shared_bus.subscribe('simple.payment_status', on_payment_status)
+# Новый лидер перечитывает ожидающие платежи: события до его запуска могли пройти мимо
+poller_leader.on_elected(lambda: load_pending_payments())
+
+@app.on_event("startup")
+async def startup_event():
+    """Загрузка ожидающих платежей при старте"""
+    logger.info(f"Загружено ожидающих платежей: {load_pending_payments()}")
+    logger.info(f"Загружено зарезервированных сумм: {amount_allocator.load()}")
+    poller_leader.renew()
+    asyncio.create_task(poller_leader.run())
+    asyncio.create_task(shared_bus.run())
+    asyncio.create_task(expire_payments_task())
+    asyncio.create_task(resolve_payments_task())
+    asyncio.create_task(callback_dispatcher.run())
+    asyncio.create_task(api_auth.run())
+    asyncio.create_task(rate_limiter.run())
+    asyncio.create_task(idempotency.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Запись накопленного использования API ключей и лимитов, передача лидерства"""
+    api_auth.flush_usage()
+    rate_limiter.sync()
+    poller_leader.release()
+
+async def resolve_pending_payments() -> int:
+    """
+    Один цикл фонового зачисления
+    
+    Все кошельки с ожидающими платежами опрашиваются параллельно с курсора,
+    новые переводы отсеиваются от использованных одним запросом и
+    сопоставляются пачкой, статусы обновляются одной транзакцией. Если
+    запись не удалась, платежи возвращаются в индекс, а переводы - в
+    retry_transfers до следующего цикла; туда же попадают переводы, не
+    закрывшие ни один платеж. Возвращает число зачисленных платежей.
+    """
+    loop = asyncio.get_running_loop()
+    wallets = payment_matcher.wallets()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(None, payment_transfers.refresh, tron_tracker, wallet_address)
+        for wallet_address in wallets
+    ], return_exceptions=True)
+    
+    new_transfers = []
+    for wallet_address, result in zip(wallets, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка опроса платежей на {wallet_address}: {result}")
+        else:
+            new_transfers.extend(result)
+    
+    transfers = list(retry_transfers.values()) + new_transfers
+    retry_transfers.clear()
+    matches = []
+    try:
+        transfers = unused_transfers(transfers)
+        matches = payment_matcher.match(transfers)
+        completed = record_completions(matches) if matches else []
+    except Exception:
+        for _, payment in matches:
+            payment_matcher.add(payment)
+        for transfer in transfers:
+            retry_transfers.setdefault(transfer['tx_hash'], transfer)
+        raise
+    
+    # Перевод без платежа или к платежу, который уже не 'pending' (закрыт
+    # другим воркером, истек), ждет платеж следующего цикла, пока платеж,
+    # созданный до него, еще мог бы не истечь
+    completed_ids = {item['payment_id'] for item in completed}
+    credited = {transfer['tx_hash'] for transfer, payment in matches if payment['id'] in completed_ids}
+    keep_since_ms = (time.time() - config.PENDING_PAYMENT_TTL) * 1000
+    for transfer in transfers:
+        if transfer['tx_hash'] not in credited and (transfer.get('timestamp') or 0) >= keep_since_ms:
+            retry_transfers.setdefault(transfer['tx_hash'], transfer)
+    
+    if completed:
+        await complete_payments(matches, completed)
+        logger.info(f"Зачислено платежей: {len(completed)}")
+    return len(completed)
+
+async def resolve_payments_task():
+    """Фоновое зачисление ожидающих платежей"""
+    while True:
+        try:
+            if poller_leader.is_leader:
+                with metrics.POLL_CYCLE_SECONDS.labels('simple_payment_api').time():
+                    await resolve_pending_payments()
+        except Exception as e:
+            logger.error(f"Ошибка фонового зачисления платежей: {e}")
+        await asyncio.sleep(config.PAYMENT_POLL_INTERVAL)
+
+async def expire_payments_task():
+    """Фоновое истечение неоплаченных платежей (callback 'expired' уходит через outbox)"""
+    while True:
+        try:
+            expired = payment_sweeper.sweep() if poller_leader.is_leader else {}
+            for payment in expired.get('simple_payments', []):
+                shared_bus.publish('simple.payment_status', {
+                    "payment_id": payment['payment_id'],
+                    "status": "expired",
+                    "amount": payment['amount'],
+                    "currency": payment['currency'],
+                    "transaction_hash": None
+                })
+            if any(payment.get('callback_url') for payment in expired.get('simple_payments', [])):
+                callback_dispatcher.notify()
+        except Exception as e:
+            logger.error(f"Ошибка истечения платежей: {e}")
+        await asyncio.sleep(config.SWEEP_INTERVAL)
 
 # =============================================================================
 # НОВЫЕ ЭНДПОИНТЫ ДЛЯ ИНТЕГРАЦИИ С ОСНОВНЫМ БОТОМ
@@ -315,75 +599,66 @@ async def send_callback(url: str, data: dict):
 
 class GetPaymentWalletRequest(BaseModel):
     user_wallet: str
+    amount: Optional[float] = None  # Цена: вернется уникальная сумма к оплате
 
 class CheckUserPaymentsRequest(BaseModel):
     user_wallet: str
 
 @app.post("/get-payment-wallet")
-async def get_payment_wallet(request: GetPaymentWalletRequest, api_key: str = Depends(verify_api_key)):
+async def get_payment_wallet(request: GetPaymentWalletRequest, api_key: dict = Depends(default_limit)):
     """Получить активный кошелек для приема платежей"""
     try:
         user_wallet = request.user_wallet
         
-        # Получаем самый новый активный кошелек для всех пользователей
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT wallet_address FROM user_wallets 
-            WHERE is_active = 1 
-            ORDER BY created_at DESC
-            LIMIT 1
-        ''')
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if not result:
+        # Самый новый активный кошелек для всех пользователей; на нем же
+        # payment_verification_api ищет резервы сумм
+        active_wallet = db.get_receiving_wallet()
+        if not active_wallet:
             raise HTTPException(status_code=404, detail="Нет доступных активных кошельков")
         
-        active_wallet = result[0]
-        
         logger.info(f"Возвращаем актуальный активный кошелек для {user_wallet}: {active_wallet}")
         
+        if request.amount is None:
+            return {
+                "success": True,
+                "wallet_address": active_wallet
+            }
+        
+        # Уникальная сумма: платеж находится по точной сумме, без проверки отправителя
+        try:
+            reservation = amount_allocator.allocate(active_wallet, request.amount, user_wallet=user_wallet)
+        except AmountAllocationError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        
         return {
             "success": True,
-            "wallet_address": active_wallet
+            "wallet_address": active_wallet,
+            "amount": reservation['amount'],
+            "reference": reservation['reference'],
+            "expires_at": datetime.fromtimestamp(reservation['expires_at']).isoformat()
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка получения кошелька для платежа: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
 
 @app.post("/check-user-payments")
-async def check_user_payments(request: CheckUserPaymentsRequest, api_key: str = Depends(verify_api_key)):
+async def check_user_payments(request: CheckUserPaymentsRequest, api_key: dict = Depends(default_limit)):
     """Проверить переводы с кошелька пользователя на активный кошелек"""
     try:
         user_wallet = request.user_wallet
         
         # Получаем текущий активный кошелек (тот же, что возвращает /get-payment-wallet)
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT wallet_address FROM user_wallets 
-            WHERE is_active = 1 
-            ORDER BY created_at DESC
-            LIMIT 1
-        ''')
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if not result:
+        active_wallet = db.get_receiving_wallet()
+        if not active_wallet:
             return {
                 "success": True,
                 "payments": [],
                 "message": "Нет доступных активных кошельков"
             }
         
-        active_wallet = result[0]
-        
         # Создаем связь для отслеживания платежей (если её еще нет)
         existing_link = db.get_active_wallet_for_user(user_wallet)
         if not existing_link:
@@ -416,13 +691,29 @@ async def check_user_payments(request: CheckUserPaymentsRequest, api_key: str =
         logger.error(f"Ошибка проверки платежей пользователя: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
 
+@app.get("/admin/usage", dependencies=[Depends(require_admin)])
+async def admin_usage():
+    """Потребление API ключей за сутки и лимиты (заголовок X-Admin-Token)"""
+    return rate_limiter.usage_report()
+
 @app.get("/health")
 async def health_check():
     """Проверка здоровья API"""
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "version": "2.1.0"
+        "version": "2.1.0",
+        "rate_limits": rate_limiter.stats(),
+        "idempotency": idempotency.stats(),
+        "response_cache": response_cache.stats(),
+        "resolver": {
+            "pending": payment_matcher.stats(),
+            "transfers": payment_transfers.stats()
+        },
+        "callbacks": callback_dispatcher.stats(),
+        "auth": api_auth.stats(),
+        "worker": poller_leader.stats(),
+        "shared_bus": shared_bus.stats()
     }
 
 if __name__ == "__main__":
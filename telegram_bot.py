@@ -4,6 +4,9 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from database import Database
 from tron_tracker import TronTracker
+from payment_matcher import PaymentMatcher
+from payment_sweeper import PaymentSweeper
+from request_executor import TronAPIError
 import config
 
 # Настройка логирования
@@ -17,6 +20,12 @@ class PaymentBot:
     def __init__(self):
         self.db = Database()
         self.tron_tracker = TronTracker()
+        # Ожидающие платежи в памяти: сопоставление без запросов на каждый перевод
+        self.matcher = PaymentMatcher()
+        self.matcher.load(self.db.get_all_pending_payments())
+        # Истекшие платежи уходят из базы 'pending' и из индекса
+        self.sweeper = PaymentSweeper(self.db)
+        self.sweeper.on_expired(lambda table, rows: self.matcher.expire(row['id'] for row in rows))
         self.application = None
         
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -162,6 +171,13 @@ class PaymentBot:
             payment_id = self.db.add_pending_payment(
                 user_id, amount, currency, user_data['wallet_address']
             )
+            self.matcher.add({
+                'id': payment_id,
+                'user_id': user_id,
+                'amount': amount,
+                'currency': currency,
+                'wallet_address': user_data['wallet_address']
+            })
             
             await update.message.reply_text(
                 f"✅ Ожидающий платеж создан!\n\n"
@@ -217,10 +233,15 @@ class PaymentBot:
         wallet_address = user_data['wallet_address']
         
         # Получаем информацию об аккаунте
-        account_info = self.tron_tracker.get_account_info(wallet_address)
+        try:
+            account_info = self.tron_tracker.get_account_info(wallet_address)
+            balance = self.tron_tracker.get_balance(wallet_address) if account_info else None
+        except TronAPIError as e:
+            logger.warning(f"Tron API недоступен: {e}")
+            await update.message.reply_text("⏳ Tron API временно недоступен. Попробуйте позже.")
+            return
         
         if account_info:
-            balance = self.tron_tracker.get_balance(wallet_address)
             
             await update.message.reply_text(
                 f"💰 Баланс кошелька:\n\n"
@@ -236,50 +257,90 @@ class PaymentBot:
         """Задача для проверки новых платежей"""
         try:
             tracked_wallets = self.db.get_tracked_wallets()
+            transfers = []
+            
+            # Новый цикл опроса - бюджет повторов восстанавливается
+            self.tron_tracker.start_cycle()
             
             for wallet in tracked_wallets:
                 wallet_address = wallet['wallet_address']
                 user_id = wallet['user_id']
                 
-                # Получаем новые транзакции
-                new_transfers = self.tron_tracker.check_new_transactions(wallet_address)
+                # Получаем новые транзакции; при недоступности API кошелек
+                # проверяется в следующем цикле, остальные - как обычно
+                try:
+                    new_transfers = self.tron_tracker.check_new_transactions(wallet_address)
+                except TronAPIError as e:
+                    logger.warning(f"Пропуск {wallet_address} в этом цикле: {e}")
+                    continue
                 
-                for transfer in new_transfers:
-                    # Проверяем, есть ли ожидающие платежи на эту сумму
-                    pending_payments = self.db.get_pending_payments(wallet_address)
-                    
-                    for payment in pending_payments:
-                        if (abs(transfer['amount'] - payment['amount']) < 0.01 and 
-                            payment['status'] == 'pending'):
-                            
-                            # Подтверждаем платеж
-                            self.db.confirm_payment(
-                                user_id, 
-                                payment['amount'], 
-                                payment['currency'],
-                                transfer['tx_hash'],
-                                wallet_address
-                            )
-                            
-                            # Отправляем уведомление пользователю
-                            try:
-                                await context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=f"🎉 Платеж подтвержден!\n\n"
-                                         f"💰 Сумма: {payment['amount']} {payment['currency']}\n"
-                                         f"🔗 Транзакция: `{transfer['tx_hash']}`\n"
-                                         f"📱 Кошелек: `{wallet_address}`\n\n"
-                                         f"Платеж ID: {payment['id']}",
-                                    parse_mode='Markdown'
-                                )
-                            except Exception as e:
-                                logger.error(f"Ошибка отправки уведомления: {e}")
-                            
-                            break
+                # Переводы на сам отслеживаемый кошелек; сопоставление - одной пачкой ниже
+                transfers.extend(transfer for transfer in new_transfers
+                                 if transfer.get('to_address') == wallet_address)
+            
+            # Уже зачисленные транзакции отбрасываются одним запросом на цикл
+            # (кошелек может отслеживаться несколькими пользователями - дубли убираются)
+            transfers = list({transfer['tx_hash']: transfer for transfer in transfers}.values())
+            confirmed = self.db.get_confirmed_hashes([transfer['tx_hash'] for transfer in transfers])
+            transfers = [transfer for transfer in transfers if transfer['tx_hash'] not in confirmed]
+            
+            for transfer, payment in self.matcher.match(transfers):
+                wallet_address = payment['wallet_address']
+                user_id = payment['user_id']
+                
+                # Подтверждаем платеж; если не удалось - платеж возвращается в индекс
+                try:
+                    if self.db.confirm_payment(
+                        user_id, 
+                        payment['amount'], 
+                        payment['currency'],
+                        transfer['tx_hash'],
+                        wallet_address
+                    ) is False:
+                        self.matcher.add(payment)
+                        continue
+                except Exception as e:
+                    logger.error(f"Ошибка подтверждения платежа {payment['id']}: {e}")
+                    self.matcher.add(payment)
+                    continue
+                self.matcher.confirm(payment)
+                
+                # Отправляем уведомление пользователю
+                try:
+                    await context.bot.send_message(
+                        chat_id=user_id,
+                        text=f"🎉 Платеж подтвержден!\n\n"
+                             f"💰 Сумма: {payment['amount']} {payment['currency']}\n"
+                             f"🔗 Транзакция: `{transfer['tx_hash']}`\n"
+                             f"📱 Кошелек: `{wallet_address}`\n\n"
+                             f"Платеж ID: {payment['id']}",
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка отправки уведомления: {e}")
                             
         except Exception as e:
             logger.error(f"Ошибка в задаче проверки платежей: {e}")
     
+    async def expire_payments_task(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача истечения неоплаченных платежей"""
+        try:
+            expired = self.sweeper.sweep()
+        except Exception as e:
+            logger.error(f"Ошибка истечения платежей: {e}")
+            return
+        
+        for payment in expired.get('pending_payments', []):
+            try:
+                await context.bot.send_message(
+                    chat_id=payment['user_id'],
+                    text=f"⌛ Срок ожидания платежа ID {payment['id']} "
+                         f"({payment['amount']} {payment['currency']}) истек.\n\n"
+                         f"Создайте новый платеж командой /payment"
+                )
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомления: {e}")
+    
     def run(self):
         """Запуск бота"""
         if not config.TELEGRAM_BOT_TOKEN:
@@ -304,6 +365,11 @@ class PaymentBot:
             interval=config.CHECK_INTERVAL,
             first=10
         )
+        job_queue.run_repeating(
+            self.expire_payments_task,
+            interval=config.SWEEP_INTERVAL,
+            first=30
+        )
         
         print("🤖 Бот запущен!")
         print(f"⏰ Интервал проверки: {config.CHECK_INTERVAL} секунд")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Тест выдачи уникальных сумм: суффиксы, освобождение, несколько процессов, проверка платежа
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import payment_verification_api
+import simple_payment_api
+from amount_allocator import AmountAllocator, AmountAllocationError, to_units
+from database import Database
+from fake_tron_server import FakeTronServer, SyntheticChain
+from request_coalescer import RequestCoalescer
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+from transfer_window import TransferWindow
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+BUYER = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+
+def test_unique_suffixes_and_release():
+    """Одна цена - разные суммы; освобожденный суффикс выдается снова"""
+    print("🧪 Уникальные суффиксы...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        allocator = AmountAllocator(db, slots=3, step_units=1, ttl=60)
+
+        amounts = [allocator.allocate(WALLET, 10.0)['amount'] for _ in range(3)]
+        assert amounts == [10.000001, 10.000002, 10.000003]
+        try:
+            allocator.allocate(WALLET, 10.0)
+            assert False, "суффиксы должны закончиться"
+        except AmountAllocationError:
+            pass
+        # Другой кошелек и другая цена независимы
+        assert allocator.allocate("TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t", 10.0)['amount'] == 10.000001
+
+        assert allocator.lookup(WALLET, 10.000002)['amount_units'] == to_units(10.000002)
+        assert allocator.release(WALLET, 10.000002)
+        assert allocator.lookup(WALLET, 10.000002) is None
+        assert allocator.allocate(WALLET, 10.0)['amount'] == 10.000002
+
+        # Сумма другой цены с тем же значением пропускается
+        assert allocator.allocate(WALLET, 20.000001)['amount'] == 20.000002
+        assert [allocator.allocate(WALLET, 20.0)['amount'] for _ in range(2)] == [20.000001, 20.000003]
+    print("   ✅ OK")
+
+
+def test_expiry_and_second_process():
+    """Истекшие резервы освобождаются; второй процесс не выдает занятые суммы"""
+    print("🧪 Истечение и несколько процессов...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        first = AmountAllocator(db, slots=10, ttl=0.05)
+        second = AmountAllocator(db, slots=10, ttl=60)
+
+        reserved = first.allocate(WALLET, 5.0)
+        assert second.allocate(WALLET, 5.0)['amount'] != reserved['amount'], "уникальный индекс в базе"
+
+        time.sleep(0.1)
+        assert [r['id'] for r in first.release_expired()] == [reserved['id']]
+        assert db.find_amount_reservation(WALLET, reserved['amount_units']) is None
+
+        restarted = AmountAllocator(db, slots=10)
+        assert restarted.load() == 1
+        assert restarted.allocate(WALLET, 5.0)['amount'] == reserved['amount'], "суффикс снова свободен"
+    print("   ✅ OK")
+
+
+def test_verify_payment_by_exact_amount():
+    """POST /verify-payment находит платеж по зарезервированной сумме без проверки отправителя"""
+    print("🧪 Проверка платежа по точной сумме...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.02)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake']}, hedged_calls=[])
+        original = (payment_verification_api.db, payment_verification_api.tron_tracker,
+                    payment_verification_api.transfer_window)
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        payment_verification_api.db = db
+        payment_verification_api.tron_tracker = tracker
+        payment_verification_api.transfer_window = window = TransferWindow()
+        try:
+            allocator = AmountAllocator(db)
+            mine = allocator.allocate(WALLET, 15.0, user_wallet=BUYER)
+            other = allocator.allocate(WALLET, 15.0)
+            # Платит другой покупатель (с другого кошелька) своей суммой
+            chain.inject_transfer(WALLET, other['amount'])
+            time.sleep(0.05)
+
+            client = TestClient(payment_verification_api.app)
+            headers = {'X-API-Key': payment_verification_api.api_auth.create_key()}
+            response = client.post("/verify-payment", headers=headers,
+                                   json={'user_wallet': BUYER, 'expected_amount': mine['amount']})
+            assert response.json()['payment_found'] is False
+
+            tx_hash = chain.inject_transfer(WALLET, mine['amount'], from_address="TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t")
+            time.sleep(0.05)
+            window.refresh(tracker, WALLET)  # фоновый опрос
+            result = client.post("/verify-payment", headers=headers,
+                                 json={'user_wallet': BUYER, 'expected_amount': mine['amount']}).json()
+            assert result['payment_found'] and result['transaction_hash'] == tx_hash
+            assert db.find_amount_reservation(WALLET, mine['amount_units'])['status'] == 'paid'
+        finally:
+            (payment_verification_api.db, payment_verification_api.tron_tracker,
+             payment_verification_api.transfer_window) = original
+    print("   ✅ OK")
+
+
+def test_reservation_bound_to_buyer_and_paid_once():
+    """Чужой кошелек не получает резерв покупателя; оплаченный резерв - не новая находка"""
+    print("🧪 Резерв покупателя и повторная проверка...")
+    stranger = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.02)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake']}, hedged_calls=[])
+        original = (payment_verification_api.db, payment_verification_api.tron_tracker,
+                    payment_verification_api.transfer_window)
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        payment_verification_api.db = db
+        payment_verification_api.tron_tracker = tracker
+        payment_verification_api.transfer_window = TransferWindow()
+        try:
+            mine = AmountAllocator(db).allocate(WALLET, 15.0, user_wallet=BUYER)
+            chain.advance()
+            tx_hash = chain.inject_transfer(WALLET, mine['amount'])
+            time.sleep(0.05)
+
+            client = TestClient(payment_verification_api.app)
+            headers = {'X-API-Key': payment_verification_api.api_auth.create_key()}
+            # Другой держатель ключа подставляет чужую сумму
+            result = client.post("/verify-payment", headers=headers,
+                                 json={'user_wallet': stranger, 'expected_amount': mine['amount']}).json()
+            assert result['payment_found'] is False, result
+            assert db.find_amount_reservation(WALLET, mine['amount_units'])['status'] == 'reserved'
+
+            result = client.post("/verify-payment", headers=headers,
+                                 json={'user_wallet': BUYER, 'expected_amount': mine['amount']}).json()
+            assert result['payment_found'] and not result['already_confirmed'], result
+            reservation = db.find_amount_reservation(WALLET, mine['amount_units'])
+            assert reservation['status'] == 'paid' and reservation['transaction_hash'] == tx_hash
+
+            # Повтор - тот же перевод, но отмечен как уже подтвержденный, в том числе в пачке
+            result = client.post("/verify-payment", headers=headers,
+                                 json={'user_wallet': BUYER, 'expected_amount': mine['amount']}).json()
+            assert result['payment_found'] and result['already_confirmed'], result
+            assert result['transaction_hash'] == tx_hash
+            batch = client.post("/verify-payments", headers=headers, json={'payments': [
+                {'user_wallet': BUYER, 'expected_amount': mine['amount']},
+                {'user_wallet': stranger, 'expected_amount': mine['amount']},
+            ]}).json()['results']
+            assert batch[0]['already_confirmed'] and batch[0]['transaction_hash'] == tx_hash
+            assert batch[1]['payment_found'] is False
+        finally:
+            (payment_verification_api.db, payment_verification_api.tron_tracker,
+             payment_verification_api.transfer_window) = original
+    print("   ✅ OK")
+
+
+def test_reserved_and_verified_on_same_wallet():
+    """Сумма резервируется и ищется на одном кошельке приема - активном кошельке из базы"""
+    print("🧪 Общий кошелек приема...")
+    rotated = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+    chain = SyntheticChain(wallets=[rotated], rate=0, block_interval=0.02)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        db.add_user_wallet(1, rotated)
+        db.set_active_wallet(1, db.get_user_wallets(1)[0]['id'])
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake']}, hedged_calls=[])
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        original = (payment_verification_api.db, payment_verification_api.tron_tracker,
+                    payment_verification_api.transfer_window,
+                    simple_payment_api.db, simple_payment_api.amount_allocator)
+        payment_verification_api.db = simple_payment_api.db = db
+        payment_verification_api.tron_tracker = tracker
+        payment_verification_api.transfer_window = TransferWindow()
+        simple_payment_api.amount_allocator = AmountAllocator(db)
+        try:
+            shop = TestClient(simple_payment_api.app)
+            issued = shop.post("/get-payment-wallet", json={'user_wallet': BUYER, 'amount': 12.0},
+                               headers={'X-API-Key': simple_payment_api.api_auth.create_key()}).json()
+            assert issued['wallet_address'] == rotated != payment_verification_api.OUR_WALLET
+
+            chain.advance()  # блоки создаются лениво - перевод попадает в блок позже резерва
+            tx_hash = chain.inject_transfer(rotated, issued['amount'])
+            time.sleep(0.05)
+            client = TestClient(payment_verification_api.app)
+            result = client.post("/verify-payment", json={'user_wallet': BUYER, 'expected_amount': issued['amount']},
+                                 headers={'X-API-Key': payment_verification_api.api_auth.create_key()}).json()
+            assert result['payment_found'] and result['transaction_hash'] == tx_hash, result
+            assert db.find_amount_reservation(rotated, to_units(issued['amount']))['status'] == 'paid'
+        finally:
+            (payment_verification_api.db, payment_verification_api.tron_tracker,
+             payment_verification_api.transfer_window,
+             simple_payment_api.db, simple_payment_api.amount_allocator) = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_unique_suffixes_and_release,
+        test_expiry_and_second_process,
+        test_verify_payment_by_exact_amount,
+        test_reservation_bound_to_buyer_and_paid_once,
+        test_reserved_and_verified_on_same_wallet,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
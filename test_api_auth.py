@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Тест проверки API ключей: хеши в базе, кеш, отзыв по версии, счетчики использования
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import payment_verification_api
+from api_auth import ApiKeyAuth
+from database import Database, hash_api_key
+from transfer_window import TransferWindow
+
+
+class NoTransfers:
+    """Tron API без переводов"""
+
+    def get_new_transfers(self, address, min_timestamp=None, limit=10):
+        return []
+
+
+def test_hashed_keys_and_cache():
+    """В базе только хеш; повторные и неверные ключи отвечают из кеша, кеш ограничен"""
+    print("🧪 Хеши ключей и кеш...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        auth = ApiKeyAuth(db, cache_size=3, version_check_interval=60)
+        api_key = auth.create_key(user_id=3)
+
+        conn = db.get_connection()
+        stored = [row[0] for row in conn.execute("SELECT api_key FROM api_keys")]
+        conn.close()
+        assert stored == [hash_api_key(api_key)] and api_key not in stored[0]
+
+        for _ in range(5):
+            assert auth.authenticate(api_key) == {'key_id': hash_api_key(api_key), 'user_id': 3, 'scope': 'user'}
+        for _ in range(3):
+            assert auth.authenticate('wrong') is None
+        stats = auth.stats()
+        assert (stats['lookups'], stats['hits'], stats['negative_hits']) == (2, 4, 2), stats
+
+        for i in range(5):
+            auth.authenticate(f"wrong-{i}")
+        assert auth.stats()['cached'] == 3
+    print("   ✅ OK")
+
+
+def test_revocation_reaches_other_workers():
+    """Отзыв действует сразу в своем процессе и после сверки версии - в остальных"""
+    print("🧪 Отзыв ключа...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        worker_a = ApiKeyAuth(db, version_check_interval=60)
+        worker_b = ApiKeyAuth(db, version_check_interval=0.05)
+        api_key = worker_a.create_key()
+        assert worker_a.authenticate(api_key) and worker_b.authenticate(api_key)
+
+        assert worker_a.revoke(hash_api_key(api_key))
+        assert worker_a.authenticate(api_key) is None
+        time.sleep(0.06)
+        assert worker_b.authenticate(api_key) is None
+        assert worker_b.stats()['invalidations'] == 1
+        assert worker_a.revoke(hash_api_key(api_key)) is False
+    print("   ✅ OK")
+
+
+def test_usage_flushed_in_batches():
+    """Использование копится в памяти и пишется одной транзакцией"""
+    print("🧪 Счетчики использования...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        auth = ApiKeyAuth(db)
+        api_key = auth.create_key()
+        key_id = hash_api_key(api_key)
+        for _ in range(10):
+            auth.authenticate(api_key)
+
+        assert db.get_api_key_usage(key_id)['usage_count'] == 0, "без записи на каждый запрос"
+        assert auth.flush_usage() == 1
+        usage = db.get_api_key_usage(key_id)
+        assert usage['usage_count'] == 10 and usage['last_used_at'] is not None
+        assert auth.flush_usage() == 0
+        auth.authenticate(api_key)
+        auth.flush_usage()
+        assert db.get_api_key_usage(key_id)['usage_count'] == 11
+    print("   ✅ OK")
+
+
+def test_plaintext_keys_migrated():
+    """Ключи и привязка платежей из старых баз переводятся в хеши"""
+    print("🧪 Миграция ключей в открытом виде...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.db')
+        conn = sqlite3.connect(path)
+        conn.execute('''
+            CREATE TABLE api_keys (
+                api_key TEXT PRIMARY KEY, user_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, is_active BOOLEAN DEFAULT 1
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE simple_payments (
+                payment_id TEXT PRIMARY KEY, amount REAL, currency TEXT, wallet_address TEXT,
+                status TEXT DEFAULT 'pending', callback_url TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, api_key TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO api_keys (api_key, user_id) VALUES ('legacy-key', 0)")
+        conn.execute("INSERT INTO simple_payments (payment_id, amount, api_key) VALUES ('pay_1', 1.0, 'legacy-key')")
+        conn.commit()
+        conn.close()
+
+        db = Database(path)
+        Database(path)  # повторный запуск не хеширует хеши
+        assert ApiKeyAuth(db).authenticate('legacy-key')['user_id'] == 0
+        conn = db.get_connection()
+        assert conn.execute("SELECT api_key FROM simple_payments").fetchone()[0] == hash_api_key('legacy-key')
+        conn.close()
+    print("   ✅ OK")
+
+
+def test_service_requires_valid_key():
+    """Payment Verification API больше не принимает произвольный ключ"""
+    print("🧪 Проверка ключей в сервисе...")
+    original = payment_verification_api.transfer_window
+    payment_verification_api.transfer_window = window = TransferWindow()
+    window.refresh(NoTransfers(), payment_verification_api.OUR_WALLET)
+    try:
+        client = TestClient(payment_verification_api.app)
+        body = {'user_wallet': 'TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7', 'expected_amount': 1.0}
+        assert client.post("/verify-payment", json=body).status_code == 401
+        assert client.post("/verify-payment", json=body, headers={'X-API-Key': 'test'}).status_code == 401
+
+        api_key = payment_verification_api.api_auth.create_key()
+        response = client.post("/verify-payment", json=body, headers={'X-API-Key': api_key})
+        assert response.status_code == 200 and response.json()['payment_found'] is False
+
+        payment_verification_api.api_auth.revoke(hash_api_key(api_key))
+        assert client.post("/verify-payment", json=body, headers={'X-API-Key': api_key}).status_code == 401
+    finally:
+        payment_verification_api.transfer_window = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_hashed_keys_and_cache,
+        test_revocation_reaches_other_workers,
+        test_usage_flushed_in_batches,
+        test_plaintext_keys_migrated,
+        test_service_requires_valid_key,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
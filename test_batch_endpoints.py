@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Тест пакетных проверок: /verify-payments и /payments/status отвечают по каждому элементу
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import config
+import payment_verification_api
+import simple_payment_api
+from amount_allocator import AmountAllocator
+from database import Database
+from payment_matcher import PaymentMatcher
+from transfer_window import TransferWindow
+
+WALLET = payment_verification_api.OUR_WALLET
+BUYER = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+
+class CountingTransfers:
+    """Tron API без переводов, считает запросы"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_new_transfers(self, address, min_timestamp=None, limit=10):
+        self.calls += 1
+        return []
+
+
+def test_verify_payments_batch():
+    """Пачка проверяется по одному окну переводов, результаты - в порядке запроса"""
+    print("🧪 POST /verify-payments...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        original = (payment_verification_api.db, payment_verification_api.transfer_window,
+                    config.BATCH_MAX_ITEMS)
+        tracker = CountingTransfers()
+        payment_verification_api.db = db
+        payment_verification_api.transfer_window = window = TransferWindow()
+        try:
+            reserved = AmountAllocator(db).allocate(WALLET, 20.0)
+            now_ms = int(time.time() * 1000) + 1000
+            window.add([
+                {'tx_hash': 'tx-sender', 'amount': 7.5, 'from': BUYER, 'to': WALLET, 'timestamp': now_ms},
+                {'tx_hash': 'tx-reserved', 'amount': reserved['amount'], 'from': 'TOther', 'to': WALLET,
+                 'timestamp': now_ms},
+            ])
+            window.refresh(tracker, WALLET)  # фоновый опрос
+
+            client = TestClient(payment_verification_api.app)
+            headers = {'X-API-Key': payment_verification_api.api_auth.create_key()}
+            payments = [
+                {'user_wallet': BUYER, 'expected_amount': 7.5},
+                {'user_wallet': BUYER, 'expected_amount': reserved['amount']},
+                {'user_wallet': BUYER, 'expected_amount': 99.0},
+                {'user_wallet': 'not-a-wallet', 'expected_amount': 7.5},
+            ]
+            response = client.post("/verify-payments", headers=headers, json={'payments': payments}).json()
+            results = response['results']
+            assert response['success'] and len(results) == 4
+            assert [r['transaction_hash'] for r in results] == ['tx-sender', 'tx-reserved', None, None]
+            assert [r['success'] for r in results] == [True, True, True, False]
+            assert tracker.calls == 1, "без запросов к upstream"
+            assert db.find_amount_reservation(WALLET, reserved['amount_units'])['status'] == 'paid'
+
+            config.BATCH_MAX_ITEMS = 3
+            assert client.post("/verify-payments", headers=headers,
+                               json={'payments': payments}).status_code == 400
+        finally:
+            (payment_verification_api.db, payment_verification_api.transfer_window,
+             config.BATCH_MAX_ITEMS) = original
+    print("   ✅ OK")
+
+
+def test_payments_status_batch():
+    """Статусы пачки платежей одним запросом; чужие и неизвестные - 'не найден'"""
+    print("🧪 POST /payments/status...")
+    with tempfile.TemporaryDirectory() as tmp:
+        original = simple_payment_api.db, simple_payment_api.payment_matcher
+        simple_payment_api.db = db = Database(os.path.join(tmp, 'payments.db'))
+        simple_payment_api.payment_matcher = PaymentMatcher()
+        try:
+            client = TestClient(simple_payment_api.app)
+            headers = {'X-API-Key': simple_payment_api.api_auth.create_key()}
+            other = {'X-API-Key': simple_payment_api.api_auth.create_key()}
+            ids = [client.post("/create-payment", headers=headers, json={'amount': 3.0 + i}).json()['payment_id']
+                   for i in range(2)]
+            foreign = client.post("/create-payment", headers=other, json={'amount': 9.0}).json()['payment_id']
+            db.complete_simple_payments([{'payment_id': ids[1], 'transaction_hash': 'tx-1'}])
+
+            response = client.post("/payments/status", headers=headers,
+                                   json={'payment_ids': [ids[1], 'unknown', ids[0], foreign]}).json()
+            results = response['results']
+            assert [(r['payment_id'], r['status']) for r in results] == [
+                (ids[1], 'completed'), ('unknown', None), (ids[0], 'pending'), (foreign, None)], results
+            assert results[0]['transaction_hash'] == 'tx-1' and results[0]['amount'] == 4.0
+            assert results[3]['error'] == "Платеж не найден"
+        finally:
+            simple_payment_api.db, simple_payment_api.payment_matcher = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_verify_payments_batch,
+        test_payments_status_batch,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Тест outbox callback'ов: запись в транзакции статуса, повторы, dead-letter, метрики
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fastapi.testclient import TestClient
+
+import payment_api
+from callback_outbox import CallbackDispatcher, verify_signature
+from database import Database
+from payment_sweeper import PaymentSweeper
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+class CallbackSink:
+    """Локальный HTTP приемник callback'ов: первые fail_first запросов получают 500"""
+
+    def __init__(self, fail_first=0):
+        self.fail_first = fail_first
+        self.requests = []
+        self.received = []
+        self.raw = []
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers['Content-Length']))
+                body = json.loads(raw)
+                sink.requests.append(body)
+                sink.raw.append((dict(self.headers), raw))
+                if self.path == '/gone':
+                    status = 404
+                elif len(sink.requests) <= sink.fail_first:
+                    status = 500
+                else:
+                    status = 200
+                    sink.received.append(body)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def deliver(dispatcher):
+    """Один проход доставки с закрытием пула соединений"""
+    async def run():
+        try:
+            return await dispatcher.run_once()
+        finally:
+            await dispatcher.close()
+    return asyncio.run(run())
+
+
+def outbox(db):
+    conn = db.get_connection()
+    rows = conn.execute("SELECT url, status, attempts FROM callback_outbox ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def test_enqueue_with_status_change():
+    """Callback пишется вместе со сменой статуса и только для реально закрытых платежей"""
+    print("🧪 Запись в outbox...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        for user_id in (7, 8):
+            db.add_user_wallet(user_id, WALLET)
+        db.set_callback_url(7, 'http://merchant/hook')
+        db.confirm_payment(7, 10.0, 'USDT', 'tx-7', WALLET, callback_payload={'event': 'payment.confirmed'})
+        db.confirm_payment(8, 11.0, 'USDT', 'tx-8', WALLET, callback_payload={'event': 'payment.confirmed'})
+        assert outbox(db) == [('http://merchant/hook', 'pending', 0)], "только пользователь с URL"
+
+        conn = db.get_connection()
+        conn.execute("INSERT INTO simple_payments (payment_id, amount, currency, wallet_address, callback_url) "
+                     "VALUES ('pay_1', 5.0, 'USDT', ?, 'http://shop/cb')", (WALLET,))
+        conn.commit()
+        conn.close()
+        completion = {'payment_id': 'pay_1', 'transaction_hash': 'tx-1', 'callback_url': 'http://shop/cb',
+                      'payload': {'payment_id': 'pay_1', 'status': 'completed'}}
+        assert len(db.complete_simple_payments([completion])) == 1
+        assert db.complete_simple_payments([completion]) == [], "повторное зачисление не ставит callback"
+        assert len(outbox(db)) == 2
+        assert db.get_callback_backlog(float('inf'))['due'] == 2
+    print("   ✅ OK")
+
+
+def test_retry_then_delivered():
+    """Неудачные попытки повторяются с паузой, затем доставка; метрики задержки и очереди"""
+    print("🧪 Повторы доставки...")
+    with tempfile.TemporaryDirectory() as tmp, CallbackSink(fail_first=2) as sink:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        db.add_user_wallet(1, WALLET)
+        db.set_callback_url(1, sink.url + '/hook')
+        db.confirm_payment(1, 3.0, 'USDT', 'tx-retry', WALLET, callback_payload={'tx': 'tx-retry'})
+
+        dispatcher = CallbackDispatcher(db, retry_base=60)
+        assert 30 <= dispatcher.retry_delay(1) <= 60 and 60 <= dispatcher.retry_delay(2) <= 120
+        assert deliver(dispatcher) == 1
+        assert outbox(db)[0][1:] == ('pending', 1)
+        assert deliver(dispatcher) == 0, "следующая попытка - после паузы"
+
+        dispatcher.retry_base = 0
+        conn = db.get_connection()
+        conn.execute("UPDATE callback_outbox SET next_attempt_at = 0")
+        conn.commit()
+        conn.close()
+        assert deliver(dispatcher) == 2
+        assert sink.received == [{'tx': 'tx-retry'}] and len(sink.requests) == 3
+
+        stats = dispatcher.stats()
+        assert (stats['delivered'], stats['retried'], stats['dead']) == (1, 2, 0), stats
+        assert stats['latency_p95_ms'] is not None and stats['backlog']['pending'] == 0
+        assert db.purge_delivered_callbacks(float('inf')) == 1
+    print(f"   ✅ задержка p95 {stats['latency_p95_ms']} мс")
+
+
+def test_dead_letter():
+    """Исчерпанные попытки и постоянные ошибки уходят в dead-letter"""
+    print("🧪 Dead-letter...")
+    with tempfile.TemporaryDirectory() as tmp, CallbackSink(fail_first=100) as sink:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        db.set_callback_url(1, sink.url + '/down')
+        db.set_callback_url(2, sink.url + '/gone')
+        for user_id in (1, 2):
+            db.add_user_wallet(user_id, WALLET)
+            db.confirm_payment(user_id, 1.0, 'USDT', f"tx-{user_id}", WALLET, callback_payload={'user': user_id})
+
+        dispatcher = CallbackDispatcher(db, max_attempts=3, retry_base=0)
+        deliver(dispatcher)
+        assert sorted(outbox(db)) == [(sink.url + '/down', 'dead', 3), (sink.url + '/gone', 'dead', 1)]
+        assert dispatcher.stats()['backlog']['dead'] == 2
+        errors = {callback['url']: callback['last_error'] for callback in db.get_dead_callbacks()}
+        assert errors == {sink.url + '/down': 'HTTP 500', sink.url + '/gone': 'permanent: HTTP 404'}
+    print("   ✅ OK")
+
+
+def enqueue(db, url, payload):
+    conn = db.get_connection()
+    Database._enqueue_callback(conn.cursor(), payload, url=url)
+    conn.commit()
+    conn.close()
+
+
+def test_batched_signed_delivery():
+    """Пакетный режим: события адреса одним подписанным POST, повторы платежа схлопываются"""
+    print("🧪 Пакетные подписанные webhook'и...")
+    with tempfile.TemporaryDirectory() as tmp, CallbackSink() as sink:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        shop, other = sink.url + '/shop', sink.url + '/other'
+        for payment_id in ('pay_1', 'pay_2', 'pay_3'):
+            enqueue(db, shop, {'payment_id': payment_id, 'status': 'pending'})
+        enqueue(db, shop, {'payment_id': 'pay_2', 'status': 'completed'})
+        enqueue(db, other, {'payment_id': 'pay_9', 'status': 'completed'})
+
+        dispatcher = CallbackDispatcher(db, batch=True, batch_window=60, batch_size=10, secret='s3cret')
+        assert deliver(dispatcher) == 0, "пачка ждет окна"
+        dispatcher.batch_size = 4
+        assert deliver(dispatcher) == 4, "полная пачка уходит сразу"
+        headers, raw = sink.raw[0]
+        events = json.loads(raw)['events']
+        assert [(event['seq'], event['data']['payment_id']) for event in events] == [(1, 'pay_1'), (3, 'pay_3'),
+                                                                                     (4, 'pay_2')]
+        assert events[-1]['data']['status'] == 'completed' and headers['X-Webhook-Seq'] == '4'
+        assert verify_signature('s3cret', raw, headers['X-Webhook-Signature'])
+        assert not verify_signature('s3cret', raw.replace(b'pay_1', b'pay_0'), headers['X-Webhook-Signature'])
+        assert not verify_signature('other', raw, headers['X-Webhook-Signature'])
+
+        dispatcher.batch_window = 0
+        assert deliver(dispatcher) == 1
+        assert [event['seq'] for event in sink.requests[1]['events']] == [1], "seq у каждого адреса свой"
+        stats = dispatcher.stats()
+        assert (stats['requests'], stats['delivered'], stats['coalesced']) == (2, 5, 1), stats
+    print("   ✅ 5 событий за 2 запроса")
+
+
+def test_payment_api_callback_url():
+    """URL из /payment/callback хранится в базе и получает callback об истечении платежа"""
+    print("🧪 Callback пользователя Payment Bot API...")
+    system = payment_api.payment_system
+    original = system.db, system.sweeper, system.callbacks
+    with tempfile.TemporaryDirectory() as tmp, CallbackSink() as sink:
+        system.db = db = Database(os.path.join(tmp, 'payments.db'))
+        system.sweeper = PaymentSweeper(db, callback_payload=system._expired_callback)
+        system.callbacks = CallbackDispatcher(db, retry_base=0)
+        try:
+            client = TestClient(payment_api.app)
+            assert client.post("/payment/callback/5", params={'callback_url': sink.url + '/hook'}).json()['success']
+            assert client.get("/payment/callbacks").json()['callbacks'] == [5]
+
+            payment_id = db.add_pending_payment(5, 9.5, 'USDT', WALLET, ttl=-60)
+            system.sweeper.sweep()
+            assert deliver(system.callbacks) == 1
+            assert sink.received == [{'event': 'payment.expired', 'payment_id': payment_id, 'user_id': 5,
+                                      'amount': 9.5, 'currency': 'USDT'}]
+            assert client.get("/health").json()['callbacks']['delivered'] == 1
+
+            assert client.delete("/payment/callback/5").json()['success']
+            assert client.delete("/payment/callback/5").json()['success'] is False
+        finally:
+            system.db, system.sweeper, system.callbacks = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_enqueue_with_status_change,
+        test_retry_then_delivered,
+        test_dead_letter,
+        test_batched_signed_delivery,
+        test_payment_api_callback_url,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
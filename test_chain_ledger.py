@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Тест журнала зачислений: хеш блока, проверка последних блоков, откат при реорганизации
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from chain_ledger import ChainLedger
+from confirmation_pipeline import ConfirmationPipeline
+from database import Database
+from fake_tron_server import FakeTronServer, SyntheticChain
+from request_coalescer import RequestCoalescer
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+OTHER_WALLET = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+BLOCK_INTERVAL = 0.05
+
+
+def make_tracker(server: FakeTronServer) -> TronTracker:
+    router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                            routes={'trc20_transactions': ['fake'], 'block': ['fake']},
+                            hedged_calls=[])
+    return TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+
+
+def credit_cycle(db: Database, tracker: TronTracker, pipeline: ConfirmationPipeline,
+                 ledger: ChainLedger, wallets) -> list:
+    """Один цикл как в process_payments: опрос, продвижение, зачисление, журнал"""
+    for user_id, wallet in wallets:
+        pipeline.observe(user_id, wallet, tracker.get_new_transfers(wallet))
+    credited = []
+    for transfer in pipeline.promote():
+        db.confirm_payment(transfer['user_id'], transfer['amount'], 'USDT',
+                           transfer['tx_hash'], transfer['wallet_address'])
+        credited.append(transfer)
+    return ledger.sync(credited)
+
+
+def test_reorg_reverses_credit():
+    """Зачисление из сиротского блока откатывается, журнал только дополняется"""
+    print("🧪 Откат зачисления при реорганизации...")
+    chain = SyntheticChain(wallets=[WALLET, OTHER_WALLET], rate=0, block_interval=BLOCK_INTERVAL)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        db.add_user_wallet(1, WALLET)
+        db.add_user_wallet(2, OTHER_WALLET)
+        db.add_pending_payment(1, 4.0, 'USDT', WALLET)
+        tracker = make_tracker(server)
+        pipeline = ConfirmationPipeline(db, tracker, confirmations=2, block_time=BLOCK_INTERVAL)
+        ledger = ChainLedger(db, tracker, window=40, block_time=BLOCK_INTERVAL)
+        wallets = [(1, WALLET), (2, OTHER_WALLET)]
+
+        # Нечего записывать и проверять - блоки не запрашиваются
+        assert credit_cycle(db, tracker, pipeline, ledger, wallets) == []
+        assert ledger.block_requests == 0
+
+        stable_tx = chain.inject_transfer(OTHER_WALLET, 9.0)
+        time.sleep(BLOCK_INTERVAL * 4)
+        chain.advance()  # блоки создаются лениво - stable_tx уходит в свой блок
+        orphan_tx = chain.inject_transfer(WALLET, 4.0)
+        time.sleep(BLOCK_INTERVAL * 1.5)
+        credit_cycle(db, tracker, pipeline, ledger, wallets)
+        time.sleep(BLOCK_INTERVAL * 4)
+        assert credit_cycle(db, tracker, pipeline, ledger, wallets) == []
+        assert db.is_transaction_confirmed(orphan_tx) and db.is_transaction_confirmed(stable_tx)
+
+        credits = {credit['tx_hash']: credit for credit in db.get_chain_credits(0)}
+        assert set(credits) == {orphan_tx, stable_tx}
+        assert all(credit['block_hash'] and credit['block_number'] for credit in credits.values())
+
+        # Ветка без перевода orphan_tx заменяет последние блоки
+        depth = chain.head()['number'] - credits[orphan_tx]['block_number'] + 1
+        assert orphan_tx in chain.reorg(depth)
+        requests_before = server.stats['latest_blocks']
+        reversed_credits = credit_cycle(db, tracker, pipeline, ledger, wallets)
+        assert [credit['tx_hash'] for credit in reversed_credits] == [orphan_tx]
+        assert server.stats['latest_blocks'] - requests_before == 1, "один запрос блоков на цикл"
+
+        assert not db.is_transaction_confirmed(orphan_tx)
+        assert db.is_transaction_confirmed(stable_tx)
+        assert [p['amount'] for p in db.get_pending_payments(WALLET)] == [4.0], "счет снова ожидает оплаты"
+        assert [credit['tx_hash'] for credit in db.get_chain_credits(0)] == [stable_tx]
+
+        # Повторная проверка ничего не откатывает второй раз
+        assert credit_cycle(db, tracker, pipeline, ledger, wallets) == []
+        assert ledger.stats()['reversed_total'] == 1
+
+        conn = db.get_connection()
+        entries = conn.execute("SELECT entry FROM chain_transfers WHERE tx_hash = ? ORDER BY id",
+                               (orphan_tx,)).fetchall()
+        assert [entry[0] for entry in entries] == ['credit', 'reversal']
+        try:
+            conn.execute("DELETE FROM chain_transfers")
+            assert False, "журнал должен запрещать удаление"
+        except sqlite3.IntegrityError:
+            pass
+        finally:
+            conn.close()
+        print(f"   ✅ {ledger.stats()}")
+
+
+class BlocksStub:
+    """Последние блоки, которые отдает Tron API в тесте"""
+
+    def __init__(self):
+        self.blocks = []
+
+    def get_recent_blocks(self, count: int) -> list:
+        return self.blocks[-count:]
+
+
+def block(number: int, timestamp: int, transactions: list) -> dict:
+    return {'number': number, 'hash': f"hash-{number}-{'-'.join(transactions)}", 'parent_hash': '',
+            'timestamp': timestamp, 'transactions': transactions}
+
+
+def test_credit_outside_fetched_blocks():
+    """Транзакции нет в блоках: блок на ее месте в окне - откат, блок вне окна - повторная проверка"""
+    print("🧪 Зачисление без блока...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        db.add_user_wallet(1, WALLET)
+        db.add_pending_payment(1, 2.0, 'USDT', WALLET)
+        now_ms = int(time.time() * 1000)
+        transfers = {
+            'tx_orphan': {'tx_hash': 'tx_orphan', 'amount': 2.0, 'block_timestamp': now_ms - 3000},
+            'tx_late': {'tx_hash': 'tx_late', 'amount': 3.0, 'block_timestamp': now_ms},
+        }
+        credited = []
+        for transfer in transfers.values():
+            transfer.update(user_id=1, wallet_address=WALLET, currency='USDT', block_number=None)
+            db.confirm_payment(1, transfer['amount'], 'USDT', transfer['tx_hash'], WALLET)
+            credited.append(transfer)
+
+        # В блоке на месте tx_orphan другие транзакции; tx_late новее полученных блоков
+        tracker = BlocksStub()
+        tracker.blocks = [block(100, now_ms - 6000, []), block(101, now_ms - 3000, ['tx_other'])]
+        ledger = ChainLedger(db, tracker, window=10, block_time=3)
+        reversed_credits = ledger.sync(credited)
+        assert [credit['tx_hash'] for credit in reversed_credits] == ['tx_orphan']
+        assert not db.is_transaction_confirmed('tx_orphan')
+        assert [p['amount'] for p in db.get_pending_payments(WALLET)] == [2.0]
+        assert db.get_chain_credits(0) == [], "хеш чужого блока не записывается"
+        assert [credit['tx_hash'] for credit in db.get_unlocated_chain_credits(0)] == ['tx_late']
+
+        # В следующем цикле транзакция находится и записывается с хешем своего блока
+        tracker.blocks.append(block(102, now_ms, ['tx_late']))
+        assert ledger.sync([]) == []
+        assert [(credit['tx_hash'], credit['block_number']) for credit in db.get_chain_credits(0)] == [('tx_late', 102)]
+        assert db.get_unlocated_chain_credits(0) == []
+        assert ledger.stats()['recorded_total'] == 2 and ledger.stats()['reversed_total'] == 1
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_reorg_reverses_credit,
+        test_credit_outside_fetched_blocks,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
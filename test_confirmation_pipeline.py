@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Тест стадии подтверждений: seen -> confirmed по глубине блоков
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import payment_integration
+from confirmation_pipeline import ConfirmationPipeline
+from database import Database
+from fake_tron_server import FakeTronServer, SyntheticChain
+from request_coalescer import RequestCoalescer
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+BLOCK_INTERVAL = 0.05
+
+
+def test_transfers_wait_for_depth():
+    """Перевод зачисляется только после CONFIRMATION_BLOCKS блоков, head - раз за цикл"""
+    print("🧪 Подтверждения по глубине блоков...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=BLOCK_INTERVAL)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake'], 'block': ['fake']},
+                                hedged_calls=[])
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        pipeline = ConfirmationPipeline(db, tracker, confirmations=3, block_time=BLOCK_INTERVAL)
+
+        # Нет ожидающих переводов - текущий блок не запрашивается
+        assert pipeline.promote() == []
+        assert pipeline.head_requests == 0
+
+        tx_hash = chain.inject_transfer(WALLET, 7.5)
+        chain.inject_transfer(WALLET, 1.0)
+        time.sleep(BLOCK_INTERVAL * 1.5)
+        transfers = tracker.get_new_transfers(WALLET)
+        assert pipeline.observe(1, WALLET, transfers) == 2
+        assert pipeline.observe(1, WALLET, transfers) == 0, "повторно не добавляются"
+
+        assert pipeline.promote() == []
+        assert pipeline.head_requests == 1
+
+        time.sleep(BLOCK_INTERVAL * 5)
+        promoted = pipeline.promote()
+        assert {transfer['tx_hash'] for transfer in promoted} >= {tx_hash}
+        assert len(promoted) == 2, "оба перевода продвигаются одной пачкой"
+        assert pipeline.head_requests == 2
+
+        # Кошелек не привязан к пользователю - перевод отклоняется и больше не продвигается
+        first, second = promoted
+        assert db.confirm_payment(1, first['amount'], 'USDT', first['tx_hash'], WALLET) is False
+        assert [t['tx_hash'] for t in db.get_seen_transfers()] == [second['tx_hash']]
+        # Незачисленный (например, ошибка базы) остается в 'seen' и возвращается снова
+        retried = pipeline.promote()
+        assert [t['tx_hash'] for t in retried] == [second['tx_hash']]
+
+        # Уже зачисленный закрывается при следующем продвижении
+        conn = db.get_connection()
+        conn.execute("INSERT INTO confirmed_payments (user_id, amount, currency, transaction_hash, wallet_address) "
+                     "VALUES (1, ?, 'USDT', ?, ?)", (second['amount'], second['tx_hash'], WALLET))
+        conn.commit()
+        conn.close()
+        assert pipeline.promote() == []
+        assert db.get_seen_transfers() == []
+
+        # Перевод на привязанный кошелек закрывается вместе с зачислением
+        db.add_user_wallet(1, WALLET)
+        third = chain.inject_transfer(WALLET, 2.0)
+        time.sleep(BLOCK_INTERVAL * 1.5)
+        assert pipeline.observe(1, WALLET, tracker.get_new_transfers(WALLET)) == 1
+        time.sleep(BLOCK_INTERVAL * 5)
+        [ready] = pipeline.promote()
+        assert ready['tx_hash'] == third
+        assert db.confirm_payment(1, ready['amount'], 'USDT', ready['tx_hash'], WALLET) is True
+        assert db.get_seen_transfers() == []
+
+        stats = pipeline.stats()
+        assert stats['confirmed_total'] == 3 and stats['latency_p50_ms'] is not None
+        print(f"   ✅ {stats}")
+
+
+def test_credited_transfers_are_skipped():
+    """Уже зачисленные транзакции не попадают в 'seen'"""
+    print("🧪 Пропуск зачисленных транзакций...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        conn = db.get_connection()
+        conn.execute("INSERT INTO confirmed_payments (user_id, amount, currency, transaction_hash, wallet_address) "
+                     "VALUES (1, 5, 'USDT', 'old_tx', ?)", (WALLET,))
+        conn.commit()
+        conn.close()
+
+        transfers = [{'tx_hash': 'old_tx', 'amount': 5.0, 'timestamp': 1},
+                     {'tx_hash': 'new_tx', 'amount': 6.0, 'timestamp': 1}]
+        assert db.add_seen_transfers(1, WALLET, transfers, time.time()) == 1
+        assert [t['tx_hash'] for t in db.get_seen_transfers()] == ['new_tx']
+    print("   ✅ OK")
+
+
+def test_unlinked_wallet_is_not_announced():
+    """process_payments: отклоненный перевод не публикуется и не продвигается снова"""
+    print("🧪 Перевод на непривязанный кошелек...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=BLOCK_INTERVAL)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake'], 'block': ['fake']},
+                                hedged_calls=[])
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        original = payment_integration.Database, payment_integration.TronTracker
+        payment_integration.Database = lambda: db
+        payment_integration.TronTracker = lambda: tracker
+        try:
+            system = payment_integration.PaymentIntegration()
+        finally:
+            payment_integration.Database, payment_integration.TronTracker = original
+        system.confirmations = ConfirmationPipeline(db, tracker, confirmations=3, block_time=BLOCK_INTERVAL)
+        published = []
+        system.publish_event = lambda event_type, data: published.append(event_type)
+
+        # Кошелек задан через update_user_wallet - есть только в users, не в user_wallets
+        db.add_user(1, 'buyer')
+        db.update_user_wallet(1, WALLET)
+        db.update_user_auto_mode(1, True)
+        chain.inject_transfer(WALLET, 3.0)
+        time.sleep(BLOCK_INTERVAL * 1.5)
+
+        asyncio.run(system.process_payments())
+        assert len(db.get_seen_transfers()) == 1
+        time.sleep(BLOCK_INTERVAL * 5)
+        for _ in range(3):
+            asyncio.run(system.process_payments())
+        head_requests = system.confirmations.head_requests
+        asyncio.run(system.process_payments())
+
+        assert 'payment.confirmed' not in published, published
+        assert db.get_seen_transfers() == []
+        assert system.confirmations.head_requests == head_requests, "отклоненный перевод не продвигается"
+        conn = db.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM confirmed_payments").fetchone()[0] == 0
+        conn.close()
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_transfers_wait_for_depth,
+        test_credited_transfers_are_skipped,
+        test_unlinked_wallet_is_not_announced,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
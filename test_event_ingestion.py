@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Тест push-приема событий Transfer: нормализация, дедупликация, fallback на опрос
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import config
+import payment_api
+from confirmation_pipeline import ConfirmationPipeline
+from database import Database
+from event_ingestion import EventIngestor, normalize_event
+from fake_tron_server import EventEmitter, FakeTronServer, SyntheticChain
+from request_coalescer import RequestCoalescer
+from shared_state import SharedBus
+from tron_address import base58_to_hex
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+def make_ingestor(tmp: str, server: FakeTronServer = None, **kwargs) -> EventIngestor:
+    db = Database(os.path.join(tmp, 'payments.db'))
+    tracker = None
+    if server is not None:
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'transaction': ['fake']}, hedged_calls=[])
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+    pipeline = ConfirmationPipeline(db, tracker=tracker, confirmations=3)
+    return EventIngestor(pipeline, lambda: {WALLET: 42}, **kwargs)
+
+
+def transfer_event(tx_hash: str, amount: int, to: str = WALLET) -> dict:
+    return {'transaction_id': tx_hash, 'block_timestamp': 1000, 'event_name': 'Transfer',
+            'contract_address': config.USDT_CONTRACT_ADDRESS,
+            'result': {'from': '0x' + '11' * 20, 'to': '0x' + base58_to_hex(to)[2:], 'value': str(amount)}}
+
+
+def test_normalize_formats():
+    """TronGrid event API и event plugin ноды приводятся к одному виду"""
+    print("🧪 Форматы событий...")
+    trongrid = normalize_event({
+        'transaction_id': 'aa', 'block_number': 10, 'block_timestamp': 1000,
+        'contract_address': config.USDT_CONTRACT_ADDRESS, 'event_name': 'Transfer',
+        'result': {'from': '0x' + '11' * 20, 'to': '0x' + base58_to_hex(WALLET)[2:], 'value': '2500000'},
+    })
+    plugin = normalize_event({
+        'transactionId': 'bb', 'blockNumber': 11, 'timeStamp': 2000,
+        'contractAddress': base58_to_hex(config.USDT_CONTRACT_ADDRESS),
+        'eventName': 'Transfer(address,address,uint256)',
+        'topicMap': {'from': '41' + '11' * 20, 'to': WALLET}, 'dataMap': {'value': '1000000'},
+    })
+    assert trongrid['to'] == WALLET and trongrid['amount'] == 2.5 and trongrid['block_number'] == 10
+    assert plugin['to'] == WALLET and plugin['amount'] == 1.0 and plugin['timestamp'] == 2000
+    assert normalize_event({'event_name': 'Approval', 'contract_address': config.USDT_CONTRACT_ADDRESS}) is None
+    print("   ✅ OK")
+
+
+def test_emitter_feeds_pipeline_with_dedupe():
+    """События от локального эмиттера попадают в 'seen', повторы отбрасываются"""
+    print("🧪 Эмиттер -> прием -> стадия подтверждений...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.02)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        ingestor = make_ingestor(tmp, server)
+        batches = []
+        emitter = EventEmitter(chain, send=lambda events: batches.append(events) or ingestor.ingest(events))
+
+        tx_hash = chain.inject_transfer(WALLET, 3.0)
+        chain.inject_transfer("TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t", 1.0)  # чужой кошелек
+        time.sleep(0.05)
+        assert emitter.emit_once() == 2
+
+        seen = ingestor.pipeline.db.get_seen_transfers()
+        assert [t['tx_hash'] for t in seen] == [tx_hash]
+        assert seen[0]['user_id'] == 42 and seen[0]['block_number']
+
+        # Повторная доставка той же пачки
+        result = ingestor.ingest(batches[0])
+        assert result['duplicates'] == 1 and result['accepted'] == 0
+        assert ingestor.stats()['accepted'] == 1
+    print("   ✅ OK")
+
+
+def test_events_verified_on_chain():
+    """Подделанные события отклоняются, еще не видимые в сети - сверяются повторно"""
+    print("🧪 Сверка событий с сетью...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.02)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        ingestor = make_ingestor(tmp, server, verify_attempts=2)
+        tx_hash = chain.inject_transfer(WALLET, 3.0)
+        other = chain.inject_transfer("TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t", 5.0)
+        time.sleep(0.05)
+
+        result = ingestor.ingest([
+            transfer_event(tx_hash, 300000000),  # сумма завышена
+            transfer_event(other, 5000000),  # перевод на другой адрес
+        ])
+        assert result['rejected'] == 2 and result['accepted'] == 0
+
+        # Транзакции еще нет в сети - сверка откладывается, затем отказ
+        assert ingestor.ingest([transfer_event('f' * 64, 1000000)])['unverified'] == 1
+        result = ingestor.ingest([])  # heartbeat тоже повторяет сверку
+        assert result['rejected'] == 1, "попытки исчерпаны"
+        assert ingestor.stats()['unverified'] == 1 and ingestor.stats()['rejected'] == 3
+
+        assert ingestor.ingest([transfer_event(tx_hash, 3000000)])['accepted'] == 1
+        assert [t['tx_hash'] for t in ingestor.pipeline.db.get_seen_transfers()] == [tx_hash]
+    print("   ✅ OK")
+
+
+def test_quiet_stream_falls_back_to_polling():
+    """Тишина потока дольше quiet_seconds включает опрос с курсора"""
+    print("🧪 Fallback на опрос...")
+    with tempfile.TemporaryDirectory() as tmp:
+        ingestor = make_ingestor(tmp, quiet_seconds=0.1, poll_overlap=5)
+        assert not ingestor.push_active() and ingestor.poll_cursor() is None
+
+        ingestor.ingest([])  # heartbeat
+        assert ingestor.push_active()
+        time.sleep(0.15)
+        assert not ingestor.push_active()
+        assert ingestor.stats()['mode'] == 'polling'
+
+        ingestor.record_poll([{'timestamp': 100000}])
+        assert ingestor.poll_cursor() == 95000
+    print("   ✅ OK")
+
+
+def test_push_state_shared_between_workers():
+    """Push, принятый одним воркером, останавливает опрос у лидера: heartbeat, курсор, дедупликация"""
+    print("🧪 Состояние push-потока между воркерами...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.02)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        worker = make_ingestor(tmp, server, quiet_seconds=0.3, poll_overlap=0)
+        leader = make_ingestor(tmp, server, quiet_seconds=0.3, poll_overlap=0)
+        worker.share(SharedBus(worker.pipeline.db, origin='worker'))
+        leader_bus = SharedBus(leader.pipeline.db, origin='leader')
+        leader.share(leader_bus)
+
+        tx_hash = chain.inject_transfer(WALLET, 3.0)
+        time.sleep(0.05)
+        event = transfer_event(tx_hash, 3000000)
+        event['block_timestamp'] = 5000
+        assert worker.ingest([event])['accepted'] == 1
+        assert not leader.push_active()
+        assert leader_bus.poll() == 1
+        assert leader.push_active() and leader.poll_cursor() == 5000
+        assert leader.ingest([event])['duplicates'] == 1, "повтор в другом воркере отсеивается"
+
+        # Heartbeat'ы публикуются не чаще трети quiet_seconds
+        time.sleep(0.35)
+        assert not leader.push_active()
+        worker.ingest([])
+        worker.ingest([])
+        assert leader_bus.poll() == 1 and leader.push_active()
+    print("   ✅ OK")
+
+
+def test_push_endpoint():
+    """POST /events/tron принимает пачку и heartbeat"""
+    print("🧪 Endpoint /events/tron...")
+    client = TestClient(payment_api.app)
+    events = payment_api.payment_system.events
+    original = config.EVENT_PUSH_TOKEN
+    try:
+        # Без настроенного токена прием выключен, heartbeat не учитывается
+        config.EVENT_PUSH_TOKEN = None
+        events.last_event_at = None
+        assert client.post("/events/tron", json=[]).status_code == 401
+        config.EVENT_PUSH_TOKEN = 'push-secret'
+        assert client.post("/events/tron", json=[], headers={'X-Event-Token': 'wrong'}).status_code == 401
+        assert not events.push_active()
+
+        headers = {'X-Event-Token': 'push-secret'}
+        response = client.post("/events/tron", json=[], headers=headers)
+        assert response.status_code == 200 and response.json()['success']
+        assert events.push_active()
+
+        event = {'transaction_id': 'cc', 'contract_address': config.USDT_CONTRACT_ADDRESS,
+                 'event_name': 'Transfer', 'result': {'to': WALLET, 'value': '1'}}
+        response = client.post("/events/tron", json={'events': [event]}, headers=headers)
+        assert response.json()['ignored'] == 1, "кошелек не отслеживается"
+        assert client.post("/events/tron", content=b"not json", headers=headers).status_code == 400
+    finally:
+        config.EVENT_PUSH_TOKEN = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_normalize_formats,
+        test_emitter_feeds_pipeline_with_dedupe,
+        test_events_verified_on_chain,
+        test_quiet_stream_falls_back_to_polling,
+        test_push_state_shared_between_workers,
+        test_push_endpoint,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
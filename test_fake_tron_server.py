@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Тест TronTracker против локального фейкового Tron API (без сети)
+"""
+
+import random
+import sys
+import time
+
+import requests
+
+from fake_tron_server import FakeTronServer, SyntheticChain, random_address
+from request_coalescer import RequestCoalescer
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID, KIND_TRONSCAN
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+def make_tracker(url: str) -> TronTracker:
+    router = ProviderRouter(
+        [TronProvider('trongrid', url, KIND_TRONGRID, timeout=2),
+         TronProvider('tronscan', url, KIND_TRONSCAN, timeout=2)],
+        hedged_calls=[]
+    )
+    return TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+
+
+def test_tracker_sees_injected_transfer():
+    """Перевод из синтетической цепочки виден во всех методах TronTracker"""
+    print("🧪 TronTracker на фейковом API...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.05, seed=1)
+    with FakeTronServer(chain) as server:
+        tracker = make_tracker(server.url)
+        tx_hash = chain.inject_transfer(WALLET, 12.5)
+        time.sleep(0.1)
+
+        transfers = tracker.get_new_transfers(WALLET)
+        assert [t['tx_hash'] for t in transfers] == [tx_hash]
+        assert transfers[0]['amount'] == 12.5
+
+        parsed = tracker.check_new_transactions(WALLET)
+        assert parsed[0]['to_address'] == WALLET and parsed[0]['amount'] == 12.5
+
+        assert tracker.get_balance(WALLET) == 12.5
+        assert tracker._get_balance_from_trongrid(WALLET) == 12.5
+        assert tracker.account_exists(WALLET)
+        assert not tracker.account_exists(random_address(random.Random(7)))
+    print("   ✅ OK")
+
+
+def test_synthetic_rate():
+    """Генератор создает переводы с заданной частотой"""
+    print("🧪 Синтетическая цепочка...")
+    chain = SyntheticChain(wallets=[WALLET], rate=200, block_interval=0.01,
+                           watched_share=1.0, seed=2)
+    time.sleep(0.2)
+    transfers = chain.trc20_transactions(WALLET, limit=200)
+    assert 10 < len(transfers) <= 200, len(transfers)
+    assert chain.head_number > 60000000
+    print(f"   ✅ {len(transfers)} переводов за 0.2 с, блок {chain.head_number}")
+
+
+def test_fault_injection():
+    """Сервер отдает 429 с Retry-After и 503 с заданной вероятностью"""
+    print("🧪 Внедрение ошибок...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0)
+    with FakeTronServer(chain, rate_429=1.0, retry_after=3) as server:
+        response = requests.get(f"{server.url}/v1/accounts/{WALLET}", timeout=2)
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '3'
+
+        server.rate_429, server.error_rate = 0.0, 1.0
+        assert requests.get(f"{server.url}/v1/accounts/{WALLET}", timeout=2).status_code == 503
+
+        server.error_rate = 0.0
+        assert requests.get(f"{server.url}/v1/accounts/{WALLET}", timeout=2).status_code == 200
+        assert server.stats['injected_429'] == 1 and server.stats['injected_errors'] == 1
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_tracker_sees_injected_transfer,
+        test_synthetic_rate,
+        test_fault_injection,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
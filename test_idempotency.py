@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Тест Idempotency-Key: повтор создания платежа отдает первый ответ без новой строки
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import payment_api
+import simple_payment_api
+from database import Database
+from idempotency import IdempotencyStore
+from payment_matcher import PaymentMatcher
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+def rejected(call):
+    try:
+        call()
+    except HTTPException as e:
+        return e.status_code
+    return None
+
+
+def count_rows(db, table):
+    conn = db.get_connection()
+    count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_store_lifecycle():
+    """Ключ занимается одним запросом, ответ отдается повторам, истекшие ключи удаляются"""
+    print("🧪 Жизненный цикл ключа...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        store = IdempotencyStore(db, ttl=60, lock_timeout=0.05)
+        body = {'amount': 5.0}
+
+        assert store.begin('shop', 'order-1', body) is None
+        assert rejected(lambda: store.begin('shop', 'order-1', body)) == 409, "первый запрос еще выполняется"
+        assert rejected(lambda: store.begin('shop', 'order-1', {'amount': 6.0})) == 422
+        assert store.begin('other-shop', 'order-1', body) is None, "ключи разных клиентов не пересекаются"
+
+        store.complete('shop', 'order-1', {'payment_id': 'pay_1'})
+        assert store.begin('shop', 'order-1', body) == {'payment_id': 'pay_1'}
+
+        assert store.begin('shop', 'order-2', body) is None
+        store.release('shop', 'order-2')
+        assert store.begin('shop', 'order-2', body) is None, "после неудачи ключ свободен"
+        time.sleep(0.06)
+        assert store.begin('shop', 'order-2', body) is None, "занятый ключ упавшего процесса истекает"
+        assert rejected(lambda: store.begin('shop', 'x' * 300, body)) == 400
+
+        time.sleep(0.06)
+        assert db.purge_idempotency_keys(time.time()) == 2, "занятые ключи без ответа"
+        assert db.purge_idempotency_keys(time.time() + 61) == 1
+        stats = store.stats()
+        assert (stats['claimed'], stats['replayed'], stats['in_progress'], stats['mismatched']) == (5, 1, 1, 1), stats
+    print("   ✅ OK")
+
+
+def test_simple_api_replay():
+    """Повтор /create-payment с тем же ключом не создает второй платеж"""
+    print("🧪 Повтор /create-payment...")
+    with tempfile.TemporaryDirectory() as tmp:
+        original = simple_payment_api.db, simple_payment_api.payment_matcher, simple_payment_api.idempotency
+        simple_payment_api.db = db = Database(os.path.join(tmp, 'payments.db'))
+        simple_payment_api.payment_matcher = PaymentMatcher()
+        simple_payment_api.idempotency = IdempotencyStore(db)
+        try:
+            client = TestClient(simple_payment_api.app)
+            headers = {'X-API-Key': simple_payment_api.api_auth.create_key(), 'Idempotency-Key': 'order-42'}
+            first = client.post("/create-payment", headers=headers, json={'amount': 12.0})
+            replay = client.post("/create-payment", headers=headers, json={'amount': 12.0})
+            assert first.json()['success'] and replay.json() == first.json()
+            assert replay.headers['Idempotent-Replayed'] == 'true' and 'Idempotent-Replayed' not in first.headers
+            assert count_rows(db, 'simple_payments') == 1
+            assert simple_payment_api.payment_matcher.stats()['pending'] == 1
+
+            assert client.post("/create-payment", headers=headers, json={'amount': 13.0}).status_code == 422
+            other = dict(headers, **{'X-API-Key': simple_payment_api.api_auth.create_key()})
+            assert client.post("/create-payment", headers=other, json={'amount': 12.0}).json()['payment_id'] != \
+                first.json()['payment_id'], "ключ действует в пределах API ключа"
+            client.post("/create-payment", headers={'X-API-Key': headers['X-API-Key']}, json={'amount': 12.0})
+            assert count_rows(db, 'simple_payments') == 3, "без заголовка - как раньше"
+        finally:
+            simple_payment_api.db, simple_payment_api.payment_matcher, simple_payment_api.idempotency = original
+    print("   ✅ OK")
+
+
+def test_payment_api_replay():
+    """Повтор /payment/create возвращает тот же ожидающий платеж; ошибка ключ не занимает"""
+    print("🧪 Повтор /payment/create...")
+    system = payment_api.payment_system
+    with tempfile.TemporaryDirectory() as tmp:
+        original = system.db, payment_api.idempotency
+        system.db = db = Database(os.path.join(tmp, 'payments.db'))
+        payment_api.idempotency = IdempotencyStore(db)
+        try:
+            client = TestClient(payment_api.app)
+            headers = {'Idempotency-Key': 'invoice-7'}
+            body = {'user_id': 7, 'amount': 25.0}
+            assert client.post("/payment/create", headers=headers, json=body).json()['success'] is False
+
+            db.add_user(7, 'buyer', WALLET)
+            first = client.post("/payment/create", headers=headers, json=body).json()
+            replay = client.post("/payment/create", headers=headers, json=body).json()
+            assert first['success'] and replay == first
+            assert count_rows(db, 'pending_payments') == 1
+        finally:
+            system.db, payment_api.idempotency = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_store_lifecycle,
+        test_simple_api_replay,
+        test_payment_api_replay,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Тест метрик: формат Prometheus, запросы к Tron API, задержка базы, /metrics сервисов
+"""
+
+import math
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import metrics
+import payment_api
+import payment_verification_api
+import simple_payment_api
+from database import Database
+from fake_tron_server import FakeTronServer, SyntheticChain
+from rate_limiter import RateLimiter
+from request_coalescer import RequestCoalescer
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID, CALL_TRC20_TRANSACTIONS
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+def count(histogram, *labels):
+    return histogram.labels(*labels).snapshot()[2]
+
+
+def test_exposition_format():
+    """Счетчики, значения и гистограммы в текстовом формате Prometheus"""
+    print("🧪 Формат exposition...")
+    registry = metrics.Registry()
+    requests = metrics.Counter('demo_requests_total', 'Запросы', ('path',), registry=registry)
+    latency = metrics.Histogram('demo_seconds', 'Задержка', buckets=(0.1, 1), registry=registry)
+    queue = metrics.Gauge('demo_queue', 'Очередь', registry=registry)
+    broken = metrics.Gauge('demo_broken', 'Ошибка вычисления', registry=registry)
+
+    requests.labels('/a"b\\').inc()
+    requests.labels(path='/a"b\\').inc(2)
+    for value in (0.05, 0.5, 3):
+        latency.observe(value)
+    queue.set_function(lambda: 7)
+    broken.set_function(lambda: 1 / 0)
+
+    text = registry.render()
+    assert '# TYPE demo_requests_total counter' in text
+    assert 'demo_requests_total{path="/a\\"b\\\\"} 3' in text
+    assert 'demo_seconds_bucket{le="0.1"} 1' in text and 'demo_seconds_bucket{le="1"} 2' in text
+    assert 'demo_seconds_bucket{le="+Inf"} 3' in text and 'demo_seconds_count 3' in text
+    assert 'demo_seconds_sum 3.55' in text
+    assert 'demo_queue 7' in text and 'demo_broken NaN' in text.replace('nan', 'NaN')
+    assert text.endswith('\n')
+
+    try:
+        requests.labels('/a', 'лишняя')
+        assert False, "неверное число меток"
+    except ValueError:
+        pass
+    try:
+        metrics.Counter('demo_requests_total', 'Повтор', registry=registry)
+        assert False, "повторная регистрация"
+    except ValueError:
+        pass
+    assert math.isnan(broken.labels().get())
+    print("   ✅ OK")
+
+
+def test_upstream_and_database():
+    """Запросы TronTracker по провайдеру и вызову, задержка методов Database"""
+    print("🧪 Tron API и база...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.05, seed=3)
+    with FakeTronServer(chain) as server:
+        router = ProviderRouter([TronProvider('trongrid', server.url, KIND_TRONGRID, timeout=2)],
+                                hedged_calls=[])
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        before = metrics.TRON_API_REQUESTS.labels('trongrid', CALL_TRC20_TRANSACTIONS, 200).get()
+        tracker.get_new_transfers(WALLET)
+        tracker.get_new_transfers(WALLET)
+    assert metrics.TRON_API_REQUESTS.labels('trongrid', CALL_TRC20_TRANSACTIONS, 200).get() == before + 2
+    assert count(metrics.TRON_API_REQUEST_SECONDS, 'trongrid', CALL_TRC20_TRANSACTIONS) >= 2
+
+    quota = metrics.UpstreamQuota(daily_quota=3)
+    day = int(time.time()) // 86400 * 86400
+    quota.record(now=day + 10)
+    quota.record(now=day + 20)
+    assert metrics.TRON_API_QUOTA_REMAINING.labels().get() == 1
+    quota.record(now=day + 86400 + 5)
+    assert metrics.TRON_API_QUOTA_REMAINING.labels().get() == 2, "квота считается по суткам UTC"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        before = count(metrics.DB_QUERY_SECONDS, 'add_user')
+        db.add_user(7, 'buyer', WALLET)
+        assert db.get_user(7)['username'] == 'buyer'
+        assert count(metrics.DB_QUERY_SECONDS, 'add_user') == before + 1
+        assert Database.add_user.__name__ == 'add_user'
+
+        limiter = RateLimiter(db, limits={'default': '1/60'}, daily_quota=5)
+        key = db.add_api_key('sk_metrics', 7)
+        rejected = metrics.RATE_LIMIT_REJECTIONS.labels('default', 'rate').get()
+        limiter.hit(key, 'default', quota_key=key)
+        limiter.hit(key, 'default', quota_key=key)
+        assert metrics.RATE_LIMIT_REJECTIONS.labels('default', 'rate').get() == rejected + 1
+        usage = [row for row in limiter.usage_report()['keys'] if row['key_id'] == key][0]
+        assert usage['quota_remaining'] == 4, "отказ не списывает квоту"
+        assert 'key=' not in metrics.REGISTRY.render(), "остаток квоты ключа - не метка метрики"
+
+        db.set_api_key_quota(key, 1)
+        limiter.sync()
+        assert metrics.API_KEYS_QUOTA_EXHAUSTED.labels().get() == 1
+    print("   ✅ OK")
+
+
+def test_detection_latency():
+    """Задержка обнаружения: от времени блока до зачисления"""
+    print("🧪 Задержка обнаружения...")
+    before = count(metrics.PAYMENT_DETECTION_SECONDS, 'test')
+    now = time.time()
+    metrics.observe_detection('test', int((now - 12) * 1000), now=now)
+    metrics.observe_detection('test', None)
+    counts, total, observed = metrics.PAYMENT_DETECTION_SECONDS.labels('test').snapshot()
+    assert observed == before + 1 and 11.9 < total < 12.1
+    print("   ✅ OK")
+
+
+def test_metrics_endpoints():
+    """GET /metrics в каждом сервисе; HTTP запросы учитываются по шаблону пути"""
+    print("🧪 /metrics сервисов...")
+    for app, service in ((simple_payment_api.app, 'simple_payment_api'),
+                         (payment_verification_api.app, 'payment_verification_api'),
+                         (payment_api.app, 'payment_api')):
+        client = TestClient(app)
+        client.get("/health")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers['content-type'] == metrics.CONTENT_TYPE
+        assert f'http_requests_total{{service="{service}",method="GET",route="/health",status="200"}}' \
+            in response.text
+
+    with tempfile.TemporaryDirectory() as tmp:
+        original = simple_payment_api.db
+        simple_payment_api.db = Database(os.path.join(tmp, 'payments.db'))
+        try:
+            client = TestClient(simple_payment_api.app)
+            client.get("/check-payment/pay_1")
+            client.get("/check-payment/pay_2")
+            text = client.get("/metrics").text
+            assert 'route="/check-payment/{payment_id}",status="401"} ' in text
+            assert 'pay_1' not in text, "id из пути не попадает в метки"
+            assert 'callback_backlog{state="pending"} 0' in text
+            assert '# TYPE poll_cycle_seconds histogram' in text
+        finally:
+            simple_payment_api.db = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_exposition_format,
+        test_upstream_and_database,
+        test_detection_latency,
+        test_metrics_endpoints,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
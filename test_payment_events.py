@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Тест статуса платежа на сервере: фоновое зачисление, ETag, long-poll, SSE
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+import payment_verification_api
+import simple_payment_api
+from database import Database
+from fake_tron_server import FakeTronServer, SyntheticChain
+from payment_matcher import PaymentMatcher
+from request_coalescer import RequestCoalescer
+from transfer_window import TransferWindow
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+BUYER = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+
+class TransfersFromList:
+    """Tron API с заранее заданными переводами на кошельки"""
+
+    def __init__(self):
+        self.transfers = []
+        self.calls = 0
+
+    def get_new_transfers(self, address, min_timestamp=None, limit=10):
+        self.calls += 1
+        return [transfer for transfer in self.transfers if transfer['to'] == address]
+
+
+def run_later(delay, coroutine_function):
+    """Запустить цикл фонового опроса в другом потоке через delay секунд"""
+    def target():
+        time.sleep(delay)
+        asyncio.run(coroutine_function())
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+
+class SimpleApiFixture:
+    """simple_payment_api с временной базой и подменным Tron API"""
+
+    def __enter__(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original = (simple_payment_api.db, simple_payment_api.tron_tracker, simple_payment_api.payment_matcher,
+                         simple_payment_api.payment_transfers, simple_payment_api.retry_transfers)
+        self.tracker = TransfersFromList()
+        simple_payment_api.db = Database(os.path.join(self.tmp.name, 'payments.db'))
+        simple_payment_api.tron_tracker = self.tracker
+        simple_payment_api.payment_matcher = PaymentMatcher()
+        simple_payment_api.payment_transfers = TransferWindow()
+        simple_payment_api.retry_transfers = {}
+        self.client = TestClient(simple_payment_api.app)
+        api_key = simple_payment_api.api_auth.create_key()
+        self.headers = {'X-API-Key': api_key}
+        return self
+
+    def create_payment(self, amount):
+        payment = self.client.post("/create-payment", headers=self.headers, json={'amount': amount}).json()
+        assert payment['success'], payment
+        return payment
+
+    def pay(self, payment, tx_hash):
+        self.tracker.transfers.append({'tx_hash': tx_hash, 'amount': payment['amount'], 'from': BUYER,
+                                       'to': payment['wallet_address'], 'timestamp': int(time.time() * 1000)})
+
+    def __exit__(self, *exc):
+        (simple_payment_api.db, simple_payment_api.tron_tracker, simple_payment_api.payment_matcher,
+         simple_payment_api.payment_transfers, simple_payment_api.retry_transfers) = self.original
+        self.tmp.cleanup()
+
+
+def test_check_payment_is_lookup():
+    """Чтение статуса не ходит в upstream; зачисление - пачкой в фоне; ETag и 304"""
+    print("🧪 Фоновое зачисление и ETag...")
+    with SimpleApiFixture() as api:
+        payments = [api.create_payment(5.0 + i) for i in range(3)]
+        url = f"/check-payment/{payments[0]['payment_id']}"
+
+        response = api.client.get(url, headers=api.headers)
+        assert response.json()['status'] == 'pending' and api.tracker.calls == 0
+        etag = response.headers['etag']
+        assert api.client.get(url, headers=dict(api.headers, **{'If-None-Match': etag})).status_code == 304
+
+        for i, payment in enumerate(payments[:2]):
+            api.pay(payment, f"tx-{i}")
+        assert asyncio.run(simple_payment_api.resolve_pending_payments()) == 2
+        assert api.tracker.calls == 1, "один кошелек - один запрос на цикл"
+        assert asyncio.run(simple_payment_api.resolve_pending_payments()) == 0, "переводы не зачисляются дважды"
+
+        response = api.client.get(url, headers=dict(api.headers, **{'If-None-Match': etag}))
+        assert response.status_code == 200 and response.json()['transaction_hash'] == 'tx-0'
+        assert response.headers['etag'] != etag
+        assert api.client.get(f"/check-payment/{payments[2]['payment_id']}",
+                              headers=api.headers).json()['status'] == 'pending'
+        assert api.client.get("/check-payment/unknown", headers=api.headers).json()['success'] is False
+    print("   ✅ OK")
+
+
+def test_failed_write_is_retried():
+    """Ошибка записи зачисления не теряет платеж: он и перевод повторяются в следующем цикле"""
+    print("🧪 Повтор после ошибки записи...")
+    with SimpleApiFixture() as api:
+        payment = api.create_payment(6.0)
+        api.pay(payment, "tx-retry")
+        db = simple_payment_api.db
+        complete = db.complete_simple_payments
+
+        def failing(completions):
+            raise RuntimeError("database is locked")
+
+        db.complete_simple_payments = failing
+        try:
+            asyncio.run(simple_payment_api.resolve_pending_payments())
+            assert False, "ошибка записи поднимается"
+        except RuntimeError:
+            pass
+        assert simple_payment_api.payment_matcher.pending_count() == 1
+        assert list(simple_payment_api.retry_transfers) == ["tx-retry"]
+
+        db.complete_simple_payments = complete
+        assert asyncio.run(simple_payment_api.resolve_pending_payments()) == 1
+        assert simple_payment_api.retry_transfers == {}
+        status = api.client.get(f"/check-payment/{payment['payment_id']}", headers=api.headers).json()
+        assert status['status'] == 'completed' and status['transaction_hash'] == "tx-retry"
+    print("   ✅ OK")
+
+
+def test_unmatched_transfer_is_retried():
+    """Перевод без платежа в индексе или к уже закрытому платежу ждет следующего цикла"""
+    print("🧪 Повтор несопоставленных переводов...")
+    with SimpleApiFixture() as api:
+        first, second, closed = (api.create_payment(7.0 + i) for i in range(3))
+        matcher = simple_payment_api.payment_matcher
+        # second еще не дошел до индекса лидера, closed закрыл другой воркер
+        matcher.expire([second['payment_id']])
+        conn = simple_payment_api.db.get_connection()
+        conn.execute("UPDATE simple_payments SET status = 'completed' WHERE payment_id = ?",
+                     (closed['payment_id'],))
+        conn.commit()
+        conn.close()
+        api.pay(first, "tx-first")
+        api.pay(second, "tx-second")
+        api.pay(closed, "tx-closed")
+
+        assert asyncio.run(simple_payment_api.resolve_pending_payments()) == 1, "считаются только записанные"
+        assert sorted(simple_payment_api.retry_transfers) == ["tx-closed", "tx-second"]
+
+        assert simple_payment_api.load_pending_payments() == 1
+        assert asyncio.run(simple_payment_api.resolve_pending_payments()) == 1
+        assert list(simple_payment_api.retry_transfers) == ["tx-closed"]
+        status = api.client.get(f"/check-payment/{second['payment_id']}", headers=api.headers).json()
+        assert status['status'] == 'completed' and status['transaction_hash'] == "tx-second"
+    print("   ✅ OK")
+
+
+def test_long_poll_wakes_on_credit():
+    """Запрос /wait держится до зачисления фоновым опросом, без опроса клиентом"""
+    print("🧪 Long-poll до зачисления...")
+    with SimpleApiFixture() as api:
+        payment = api.create_payment(11.5)
+        url = f"/payments/{payment['payment_id']}/wait"
+
+        started = time.time()
+        result = api.client.get(url, headers=api.headers, params={'timeout': 0.2}).json()
+        assert result['status'] == 'pending' and time.time() - started >= 0.2
+
+        api.pay(payment, 'tx-long-poll')
+        poller = run_later(0.3, simple_payment_api.resolve_pending_payments)
+        started = time.time()
+        result = api.client.get(url, headers=api.headers, params={'timeout': 10}).json()
+        elapsed = time.time() - started
+        poller.join()
+        assert result['status'] == 'completed' and result['transaction_hash'] == 'tx-long-poll', result
+        assert elapsed < 5, f"ответ по событию, а не по таймауту: {elapsed:.1f}s"
+
+        # Завершенный платеж отвечает сразу
+        result = api.client.get(url, headers=api.headers, params={'timeout': 10}).json()
+        assert result['status'] == 'completed'
+        assert simple_payment_api.payment_events.stats()['subscribers'] == 0
+        assert api.client.get("/payments/unknown/wait", headers=api.headers).json()['success'] is False
+    print(f"   ✅ ответ через {elapsed:.2f}s")
+
+
+def test_sse_stream():
+    """SSE отдает текущий статус, затем зачисление, и закрывается"""
+    print("🧪 Поток SSE...")
+    with SimpleApiFixture() as api:
+        payment = api.create_payment(12.5)
+        api.pay(payment, 'tx-sse')
+        poller = run_later(0.3, simple_payment_api.resolve_pending_payments)
+
+        events = []
+        with api.client.stream("GET", f"/payments/{payment['payment_id']}/events", headers=api.headers) as response:
+            assert response.headers['content-type'].startswith('text/event-stream')
+            for line in response.iter_lines():
+                if line.startswith('data: '):
+                    events.append(json.loads(line[len('data: '):]))
+        poller.join()
+        assert [event['status'] for event in events] == ['pending', 'completed'], events
+        assert events[-1]['transaction_hash'] == 'tx-sse'
+        assert api.client.get("/payments/unknown/events", headers=api.headers).status_code == 404
+    print("   ✅ OK")
+
+
+def test_verify_payment_wait():
+    """POST /verify-payment/wait просыпается, когда фоновый опрос добавляет перевод в окно"""
+    print("🧪 Long-poll проверки платежа...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.01)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake']}, hedged_calls=[])
+        original = (payment_verification_api.db, payment_verification_api.tron_tracker,
+                    payment_verification_api.transfer_window)
+        payment_verification_api.db = Database(os.path.join(tmp, 'payments.db'))  # кошелек приема - WALLET
+        payment_verification_api.tron_tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+        payment_verification_api.transfer_window = TransferWindow()
+        try:
+            client = TestClient(payment_verification_api.app)
+            headers = {'X-API-Key': payment_verification_api.api_auth.create_key()}
+
+            def pay_and_poll():
+                tx_hash.append(chain.inject_transfer(WALLET, 21.75, from_address=BUYER))
+                time.sleep(0.05)
+                asyncio.run(payment_verification_api.refresh_transfers())
+
+            tx_hash = []
+            thread = threading.Thread(target=lambda: (time.sleep(0.3), pay_and_poll()))
+            thread.start()
+            started = time.time()
+            result = client.post("/verify-payment/wait", headers=headers, params={'timeout': 10},
+                                 json={'user_wallet': BUYER, 'expected_amount': 21.75}).json()
+            elapsed = time.time() - started
+            thread.join()
+            assert result['payment_found'] and result['transaction_hash'] == tx_hash[0], result
+            assert elapsed < 5, f"{elapsed:.1f}s"
+        finally:
+            (payment_verification_api.db, payment_verification_api.tron_tracker,
+             payment_verification_api.transfer_window) = original
+    print(f"   ✅ ответ через {elapsed:.2f}s")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_check_payment_is_lookup,
+        test_failed_write_is_retried,
+        test_unmatched_transfer_is_retried,
+        test_long_poll_wakes_on_credit,
+        test_sse_stream,
+        test_verify_payment_wait,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
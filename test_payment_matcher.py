@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Тест индекса ожидающих платежей: корзины сумм, отправитель, синхронизация
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from database import Database
+from payment_matcher import PaymentMatcher
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+OTHER_WALLET = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+SENDER = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+
+def payment(payment_id, amount, wallet=WALLET, user_id=1, **extra):
+    return dict(id=payment_id, user_id=user_id, amount=amount, currency='USDT', wallet_address=wallet, **extra)
+
+
+def test_tolerance_and_buckets():
+    """Сумма в пределах допуска находится и на границе корзины; ближайший платеж выигрывает"""
+    print("🧪 Допуск и корзины сумм...")
+    matcher = PaymentMatcher(tolerance=0.01)
+    matcher.load([payment(1, 10.0), payment(2, 10.009), payment(3, 5.0, wallet=OTHER_WALLET)])
+
+    matches = matcher.match([
+        {'tx_hash': 'a', 'to': WALLET, 'amount': 10.008},       # ближе к платежу 2
+        {'tx_hash': 'b', 'to': WALLET, 'amount': 9.995},        # соседняя корзина
+        {'tx_hash': 'c', 'to': WALLET, 'amount': 5.0},          # другой кошелек
+        {'tx_hash': 'd', 'to_address': OTHER_WALLET, 'amount': 5.02},  # вне допуска
+    ])
+    assert [(t['tx_hash'], p['id']) for t, p in matches] == [('a', 2), ('b', 1)]
+    assert matcher.pending_count() == 1
+    print("   ✅ OK")
+
+
+def test_sender_index():
+    """Платеж с отправителем закрывается только его переводом и имеет приоритет"""
+    print("🧪 Индекс по отправителю...")
+    matcher = PaymentMatcher()
+    matcher.load([payment(1, 20.0), payment(2, 20.0, from_address=SENDER)])
+
+    matches = matcher.match([{'tx_hash': 'a', 'to': WALLET, 'from': SENDER, 'amount': 20.0}])
+    assert [p['id'] for _, p in matches] == [2]
+    matches = matcher.match([{'tx_hash': 'b', 'to': WALLET, 'from': OTHER_WALLET, 'amount': 20.0},
+                             {'tx_hash': 'c', 'to': WALLET, 'from': OTHER_WALLET, 'amount': 20.0}])
+    assert [p['id'] for _, p in matches] == [1], "один платеж - один перевод"
+    print("   ✅ OK")
+
+
+def test_sync_with_database():
+    """Индекс загружается из базы одним запросом и синхронизируется при создании/истечении/подтверждении"""
+    print("🧪 Синхронизация с базой...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        db.add_user_wallet(1, WALLET)
+        first = db.add_pending_payment(1, 7.0, 'USDT', WALLET)
+        second = db.add_pending_payment(1, 7.0, 'USDT', WALLET)
+        expired = db.add_pending_payment(1, 3.0, 'USDT', WALLET)
+
+        matcher = PaymentMatcher()
+        assert matcher.load(db.get_all_pending_payments()) == 3
+        matcher.add(payment(db.add_pending_payment(1, 4.0, 'USDT', WALLET), 4.0))
+        assert matcher.expire([expired, 999]) == 1
+
+        (transfer, matched), = matcher.match([{'tx_hash': 'tx1', 'to': WALLET, 'amount': 7.0}])
+        assert matched['id'] == first
+        db.confirm_payment(matched['user_id'], matched['amount'], 'USDT', transfer['tx_hash'], WALLET)
+        # confirm_payment закрывает все платежи пользователя на эту сумму - индекс тоже
+        # (сам matched убран из индекса еще в match)
+        assert [p['id'] for p in matcher.confirm(matched)] == [second]
+        assert db.get_confirmed_hashes(['tx1', 'tx2']) == {'tx1'}
+
+        # В базе остались истекший (его статус меняет вызывающий код) и платеж на 4.0
+        pending_in_db = [p['amount'] for p in db.get_all_pending_payments()]
+        assert pending_in_db == [3.0, 4.0]
+        assert matcher.stats()['pending'] == 1
+    print("   ✅ OK")
+
+
+def test_batch_is_linear():
+    """Пачка переводов сопоставляется без перебора всех платежей"""
+    print("🧪 Пачка переводов...")
+    matcher = PaymentMatcher()
+    matcher.load(payment(i, 1 + i / 100, wallet=f"W{i % 100}") for i in range(50000))
+    transfers = [{'tx_hash': str(i), 'to': f"W{i % 100}", 'amount': 1 + i / 100} for i in range(0, 50000, 5)]
+
+    started = time.perf_counter()
+    matches = matcher.match(transfers)
+    elapsed = time.perf_counter() - started
+    assert len(matches) == len(transfers)
+    assert elapsed < 1.0, f"{elapsed:.2f}s"
+    print(f"   ✅ {len(transfers)} переводов за {elapsed * 1000:.0f} мс")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_tolerance_and_buckets,
+        test_sender_index,
+        test_sync_with_database,
+        test_batch_is_linear,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Тест WebSocket подписки мерчанта: фильтры, продолжение по seq, медленный клиент
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import config
+import payment_api
+from api_auth import ApiKeyAuth
+from database import API_KEY_SCOPE_MERCHANT, Database
+from payment_events import PaymentEventLog
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+OTHER_WALLET = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+
+class StreamFixture:
+    """payment_api с временной базой и своим потоком событий"""
+
+    def __init__(self, replay_size=100, queue_size=100):
+        self.replay_size, self.queue_size = replay_size, queue_size
+
+    def __enter__(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        system = payment_api.payment_system
+        self.original = system.db, system.stream, payment_api.api_auth
+        system.db = Database(os.path.join(self.tmp.name, 'payments.db'))
+        payment_api.api_auth = ApiKeyAuth(system.db)
+        system.stream = PaymentEventLog(replay_size=self.replay_size, queue_size=self.queue_size)
+        system.db.add_api_key('merchant', 0, API_KEY_SCOPE_MERCHANT)
+        system.db.add_api_key('public', 0)
+        system.db.add_api_key('user-7', 7)
+        self.system = system
+        self.client = TestClient(payment_api.app)
+        return self
+
+    def __exit__(self, *exc):
+        self.system.db, self.system.stream, payment_api.api_auth = self.original
+        self.tmp.cleanup()
+
+
+def test_subscribe_and_filters():
+    """Ключ мерчанта видит всех, ключ пользователя - только себя; фильтр по кошелькам"""
+    print("🧪 Подписка и фильтры...")
+    with StreamFixture() as fx:
+        fx.system.db.add_user(7, 'buyer', WALLET)
+        try:
+            with fx.client.websocket_connect("/ws/payments?api_key=wrong"):
+                assert False, "неверный ключ"
+        except WebSocketDisconnect as e:
+            assert e.code == 1008
+
+        with fx.client.websocket_connect("/ws/payments?api_key=merchant") as everything, \
+                fx.client.websocket_connect("/ws/payments", headers={'X-API-Key': 'user-7'}) as own, \
+                fx.client.websocket_connect(f"/ws/payments?api_key=merchant&wallets={OTHER_WALLET}") as other:
+            created = asyncio.run(fx.system.create_payment_request(7, 15.0))
+            assert created['success'], created
+            fx.system.stream.publish('payment.confirmed', {'user_id': 8, 'wallet_address': OTHER_WALLET,
+                                                           'amount': 3.0, 'currency': 'USDT'})
+
+            first, second = everything.receive_json(), everything.receive_json()
+            assert (first['type'], first['data']['payment_id']) == ('payment.created', created['payment_id'])
+            assert second['type'] == 'payment.confirmed' and second['seq'] == first['seq'] + 1
+            assert own.receive_json()['seq'] == first['seq']
+            assert other.receive_json()['seq'] == second['seq']
+            assert fx.system.stream.stats()['subscriptions'] == 3
+    print("   ✅ OK")
+
+
+def test_key_scope():
+    """Ключ с user_id 0 без scope мерчанта не видит чужих событий; ключ мерчанта выпускает только админ"""
+    print("🧪 Область ключа...")
+    original = config.ADMIN_API_TOKEN
+    try:
+        config.ADMIN_API_TOKEN = 'admin-secret'
+        with StreamFixture() as fx:
+            request = {'user_id': 0, 'scope': 'merchant'}
+            assert fx.client.post("/admin/api-keys", json=request).status_code == 403
+            assert fx.client.post("/admin/api-keys", json={'scope': 'root'},
+                                  headers={'X-Admin-Token': 'admin-secret'}).status_code == 400
+            issued = fx.client.post("/admin/api-keys", json=request,
+                                    headers={'X-Admin-Token': 'admin-secret'}).json()
+            assert issued['scope'] == 'merchant'
+
+            with fx.client.websocket_connect("/ws/payments?api_key=public") as public, \
+                    fx.client.websocket_connect(f"/ws/payments?api_key={issued['api_key']}") as merchant:
+                fx.system.stream.publish('payment.created', {'user_id': 8, 'payment_id': 1})
+                fx.system.stream.publish('payment.created', {'user_id': 0, 'payment_id': 2})
+                assert [merchant.receive_json()['data']['payment_id'] for _ in range(2)] == [1, 2]
+                assert public.receive_json()['data']['payment_id'] == 2, "событие user_id 8 отфильтровано"
+    finally:
+        config.ADMIN_API_TOKEN = original
+    print("   ✅ OK")
+
+
+def test_resume_after_reconnect():
+    """Переподключение с since отдает пропущенные события; вытесненные - через reset"""
+    print("🧪 Продолжение по seq...")
+    with StreamFixture(replay_size=5) as fx:
+        with fx.client.websocket_connect("/ws/payments?api_key=merchant") as ws:
+            fx.system.stream.publish('payment.created', {'user_id': 1, 'payment_id': 1})
+            last_seq = ws.receive_json()['seq']
+
+        for payment_id in range(2, 5):
+            fx.system.stream.publish('payment.confirmed', {'user_id': 1, 'payment_id': payment_id})
+        with fx.client.websocket_connect(f"/ws/payments?api_key=merchant&since={last_seq}") as ws:
+            missed = [ws.receive_json() for _ in range(3)]
+            assert [event['data']['payment_id'] for event in missed] == [2, 3, 4]
+
+        for payment_id in range(5, 15):
+            fx.system.stream.publish('payment.confirmed', {'user_id': 1, 'payment_id': payment_id})
+        with fx.client.websocket_connect(f"/ws/payments?api_key=merchant&since={missed[-1]['seq']}") as ws:
+            reset = ws.receive_json()
+            assert reset['type'] == 'reset' and reset['data']['oldest_seq'] == 10
+            assert [ws.receive_json()['data']['payment_id'] for _ in range(5)] == [10, 11, 12, 13, 14]
+    print("   ✅ OK")
+
+
+def test_slow_consumer_is_disconnected():
+    """Клиент, не читающий события, отключается с 1013, очередь сервера ограничена"""
+    print("🧪 Медленный клиент...")
+    with StreamFixture(queue_size=3) as fx:
+        system = fx.system
+
+        async def scenario():
+            with system.stream.subscribe(lambda event: True) as subscription:
+                for payment_id in range(10):
+                    system.stream.publish('payment.created', {'user_id': 1, 'payment_id': payment_id})
+                await asyncio.sleep(0.05)
+                assert subscription.queue.qsize() == 1
+                return await subscription.next()
+
+        assert asyncio.run(scenario()) is None, "сигнал отключения"
+        assert system.stream.stats()['overflows'] == 1
+
+        with fx.client.websocket_connect("/ws/payments?api_key=merchant&since=0") as ws:
+            # Буфер больше очереди: пропущенные события не вызывают отключения
+            assert [ws.receive_json()['data']['payment_id'] for _ in range(10)] == list(range(10))
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_subscribe_and_filters,
+        test_key_scope,
+        test_resume_after_reconnect,
+        test_slow_consumer_is_disconnected,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
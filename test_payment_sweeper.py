@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Тест истечения ожидающих платежей: срок жизни, пакетная очистка, миграция старых баз
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+
+from amount_allocator import AmountAllocator
+from database import Database
+from payment_matcher import PaymentMatcher
+from payment_sweeper import PaymentSweeper
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+def test_sweep_in_batches():
+    """Истекшие платежи уходят пачками, обработчики синхронизируют индекс"""
+    print("🧪 Пакетное истечение...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        stale = [db.add_pending_payment(1, 1.0 + i, 'USDT', WALLET, ttl=-60) for i in range(7)]
+        live = db.add_pending_payment(1, 50.0, 'USDT', WALLET)
+
+        # Истекшие, но еще не очищенные платежи уже не считаются ожидающими
+        assert [p['id'] for p in db.get_pending_payments(WALLET)] == [live]
+
+        matcher = PaymentMatcher()
+        matcher.load([dict(id=payment_id, user_id=1, amount=1.0, wallet_address=WALLET)
+                      for payment_id in stale + [live]])
+        allocator = AmountAllocator(db, ttl=-1)
+        allocator.allocate(WALLET, 10.0)
+
+        batches = []
+        sweeper = PaymentSweeper(db, allocator=allocator, batch_size=3)
+        sweeper.on_expired(lambda table, rows: batches.append(len(rows)))
+        sweeper.on_expired(lambda table, rows: matcher.expire(row['id'] for row in rows))
+
+        expired = sweeper.sweep()
+        assert sorted(row['id'] for row in expired['pending_payments']) == stale
+        assert batches == [3, 3, 1]
+        assert matcher.pending_count() == 1
+        assert allocator.stats()['reserved'] == 0, "резервы сумм освобождаются"
+
+        conn = db.get_connection()
+        statuses = dict(conn.execute("SELECT status, COUNT(*) FROM pending_payments GROUP BY status").fetchall())
+        plan = ' '.join(str(row) for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM pending_payments "
+            "WHERE status = 'pending' AND expires_at <= datetime('now') ORDER BY expires_at LIMIT 3"))
+        conn.close()
+        assert statuses == {'expired': 7, 'pending': 1}
+        assert 'idx_pending_payments_status_expires' in plan, plan
+
+        assert sweeper.sweep() == {}
+        assert sweeper.maybe_sweep() == {}, "не чаще SWEEP_INTERVAL"
+        print(f"   ✅ {sweeper.stats()['expired_total']} истекло")
+
+
+def test_old_database_is_migrated():
+    """Базы без expires_at получают колонку и срок от created_at"""
+    print("🧪 Миграция старой базы...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.db')
+        conn = sqlite3.connect(path)
+        conn.execute('''
+            CREATE TABLE pending_payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, currency TEXT,
+                wallet_address TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'pending'
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE simple_payments (
+                payment_id TEXT PRIMARY KEY, amount REAL, currency TEXT, wallet_address TEXT,
+                status TEXT DEFAULT 'pending', callback_url TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, api_key TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO pending_payments (user_id, amount, currency, wallet_address, created_at) "
+                     "VALUES (1, 3.0, 'USDT', ?, '2020-01-01 00:00:00')", (WALLET,))
+        conn.execute("INSERT INTO simple_payments (payment_id, amount, currency, wallet_address, created_at) "
+                     "VALUES ('old', 4.0, 'USDT', ?, '2020-01-01 00:00:00')", (WALLET,))
+        conn.commit()
+        conn.close()
+
+        db = Database(path)
+        assert db.get_pending_payments(WALLET) == []
+        expired = PaymentSweeper(db, tables=('pending_payments', 'simple_payments')).sweep()
+        assert [row['amount'] for row in expired['pending_payments']] == [3.0]
+        assert [row['payment_id'] for row in expired['simple_payments']] == ['old']
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_sweep_in_batches,
+        test_old_database_is_migrated,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Тест лимитов частоты и суточных квот API ключей: общий бакет, 429, админ-просмотр
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import config
+import payment_verification_api
+from database import Database, hash_api_key
+from rate_limiter import RateLimiter, utc_day
+from transfer_window import TransferWindow
+
+
+class NoTransfers:
+    """Tron API без переводов"""
+
+    def get_new_transfers(self, address, min_timestamp=None, limit=10):
+        return []
+
+
+def test_bucket_shared_between_workers():
+    """Два процесса с одной базой сверяют общий бакет; токены пополняются со временем"""
+    print("🧪 Общий token bucket...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.db')
+        workers = [RateLimiter(Database(path), limits={'default': '3/60'}) for _ in range(2)]
+        now = time.time()
+
+        assert [workers[0].hit('key', 'verify', now=now)[0] for _ in range(2)] == [None, None]
+        assert workers[0].sync(now=now) == 1
+        # Второй процесс впервые видит бакет и читает его из базы
+        assert [workers[1].hit('key', 'verify', now=now)[0] for _ in range(2)] == [None, 'rate']
+        workers[1].sync(now=now)
+        workers[0].sync(now=now)
+        refused, headers = workers[0].hit('key', 'verify', now=now)
+        assert refused == 'rate', "списанное другим процессом приходит при сверке"
+        assert headers['X-RateLimit-Remaining'] == '0' and headers['Retry-After'] == '20', headers
+        assert workers[1].hit('other-key', 'verify', now=now)[0] is None, "у ключа свой бакет"
+        assert workers[1].hit('key', 'verify', now=now + 20)[0] is None
+        assert workers[1].db.get_rate_limit_state('verify:key')['tokens'] == 0, "до сверки - только в памяти"
+    print("   ✅ OK")
+
+
+def test_sync_failure_keeps_usage():
+    """Ошибка сверки не теряет списанное: оно записывается при следующей"""
+    print("🧪 Повтор сверки...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        key_id = db.add_api_key('merchant-key')
+        limiter = RateLimiter(db, limits={'default': '10/60'}, daily_quota=100)
+        now = time.time()
+        assert [limiter.hit(key_id, 'check', key_id, now=now)[0] for _ in range(3)] == [None] * 3
+
+        sync = db.sync_rate_limits
+
+        def failing(*args):
+            raise RuntimeError("database is locked")
+
+        db.sync_rate_limits = failing
+        try:
+            limiter.sync(now=now)
+            assert False, "ошибка сверки поднимается"
+        except RuntimeError:
+            pass
+        db.sync_rate_limits = sync
+        limiter.sync(now=now)
+        state = db.get_rate_limit_state('check:' + key_id, key_id, utc_day(now), 100)
+        assert (state['tokens'], state['used']) == (7, 3), state
+    print("   ✅ OK")
+
+
+def test_daily_quota_is_persistent():
+    """Суточная квота хранится в базе, переживает перезапуск и сбрасывается в новые сутки"""
+    print("🧪 Суточная квота...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'payments.db'))
+        key_id = db.add_api_key('merchant-key')
+        limiter = RateLimiter(db, limits={'default': '100/1'}, daily_quota=2)
+        now = time.time()
+
+        assert [limiter.hit(key_id, 'check', key_id, now=now)[0] for _ in range(3)] == [None, None, 'quota']
+        limiter.sync(now=now)  # при остановке сервиса
+        restarted = RateLimiter(db, limits={'default': '100/1'}, daily_quota=2)
+        refused, headers = restarted.hit(key_id, 'check', key_id, now=now)
+        assert refused == 'quota' and headers['X-Quota-Remaining'] == '0'
+        assert 0 < int(headers['Retry-After']) <= 86400
+        assert restarted.hit(key_id, 'check', key_id, now=now + 86400)[0] is None, "новые сутки"
+
+        db.set_api_key_quota(key_id, 5)
+        assert restarted.hit(key_id, 'check', key_id, now=now)[0] is None
+        report = restarted.usage_report()['keys']
+        today = [row for row in report if row['key_id'] == key_id][0]
+        assert (today['requests_today'], today['rejected_today'], today['daily_quota']) == (3, 2, 5), today
+    print("   ✅ OK")
+
+
+def test_http_429_and_admin_view():
+    """Сервис отвечает 429 с заголовками; /admin/usage показывает потребление"""
+    print("🧪 HTTP 429 и админ-просмотр...")
+    limiter = payment_verification_api.rate_limiter
+    original = (limiter.db, limiter.limits, payment_verification_api.transfer_window, config.ADMIN_API_TOKEN)
+    with tempfile.TemporaryDirectory() as tmp:
+        limiter.db = db = Database(os.path.join(tmp, 'payments.db'))
+        limiter.limits = {'default': (100, 60), 'verify': (2, 60), 'get-api-key': (1, 3600)}
+        payment_verification_api.transfer_window = window = TransferWindow()
+        window.refresh(NoTransfers(), payment_verification_api.OUR_WALLET)
+        try:
+            client = TestClient(payment_verification_api.app)
+            first = client.get("/get-api-key")
+            assert first.status_code == 200 and first.headers['X-RateLimit-Limit'] == '1'
+            second = client.get("/get-api-key")
+            assert second.status_code == 429 and int(second.headers['Retry-After']) > 0
+
+            api_key = first.json()['api_key']
+            db.add_api_key(api_key)
+            body = {'user_wallet': 'TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7', 'expected_amount': 1.0}
+            remaining = [client.post("/verify-payment", json=body, headers={'X-API-Key': api_key})
+                         .headers.get('X-RateLimit-Remaining') for _ in range(2)]
+            assert remaining == ['1', '0'], remaining
+            limited = client.post("/verify-payment", json=body, headers={'X-API-Key': api_key})
+            assert limited.status_code == 429 and 'Retry-After' in limited.headers
+
+            config.ADMIN_API_TOKEN = ''
+            assert client.get("/admin/usage").status_code == 403
+            config.ADMIN_API_TOKEN = 'admin-secret'
+            assert client.get("/admin/usage", headers={'X-Admin-Token': 'wrong'}).status_code == 403
+            report = client.get("/admin/usage", headers={'X-Admin-Token': 'admin-secret'}).json()
+            usage = [row for row in report['keys'] if row['key_id'] == hash_api_key(api_key)][0]
+            assert (usage['requests_today'], usage['rejected_today']) == (2, 1), usage
+            assert report['limits']['verify'] == '2/60'
+        finally:
+            (limiter.db, limiter.limits, payment_verification_api.transfer_window,
+             config.ADMIN_API_TOKEN) = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_bucket_shared_between_workers,
+        test_sync_failure_keeps_usage,
+        test_daily_quota_is_persistent,
+        test_http_429_and_admin_view,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Тест объединения одинаковых запросов к upstream (single-flight + micro-cache)
+"""
+
+import sys
+import threading
+import time
+
+from request_coalescer import RequestCoalescer
+
+
+def test_concurrent_calls_share_one_request():
+    """200 параллельных вызовов с одним ключом - один запрос к upstream"""
+    print("🧪 200 параллельных одинаковых запросов...")
+    coalescer = RequestCoalescer(ttl=1.0)
+    upstream = []
+    start = threading.Barrier(200)
+    results = []
+
+    def fetch():
+        upstream.append(1)
+        time.sleep(0.2)
+        return ['transfer']
+
+    def worker():
+        start.wait()
+        results.append(coalescer.call(('trc20', 'TWallet'), fetch))
+
+    threads = [threading.Thread(target=worker) for _ in range(200)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = coalescer.stats()
+    assert len(upstream) == 1
+    assert len(results) == 200 and all(result == ['transfer'] for result in results)
+    assert stats['upstream_calls'] == 1
+    assert stats['saved_calls'] == 199
+    print(f"   ✅ Запросов к upstream: {len(upstream)}, сэкономлено: {stats['saved_calls']}")
+
+
+def test_micro_cache_expires():
+    """После TTL запрос снова уходит в upstream"""
+    print("🧪 TTL micro-cache...")
+    coalescer = RequestCoalescer(ttl=0.1)
+    calls = []
+    coalescer.call('key', lambda: calls.append(1) or len(calls))
+    assert coalescer.call('key', lambda: calls.append(1) or len(calls)) == 1
+    time.sleep(0.15)
+    assert coalescer.call('key', lambda: calls.append(1) or len(calls)) == 2
+    assert coalescer.stats()['cache_hits'] == 1
+    print("   ✅ OK")
+
+
+def test_errors_are_not_cached():
+    """Ошибка получают все ожидающие, но следующий вызов идет заново"""
+    print("🧪 Ошибки не кэшируются...")
+    coalescer = RequestCoalescer(ttl=10)
+
+    def failing():
+        raise TimeoutError("upstream timeout")
+
+    try:
+        coalescer.call('key', failing)
+        assert False, "ожидалась ошибка"
+    except TimeoutError:
+        pass
+    assert coalescer.call('key', lambda: 'ok') == 'ok'
+
+    # Результат, который cacheable отклонил, тоже не кэшируется
+    coalescer.call('other', lambda: 'bad', cacheable=lambda result: result != 'bad')
+    assert coalescer.call('other', lambda: 'fresh') == 'fresh'
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_concurrent_calls_share_one_request,
+        test_micro_cache_expires,
+        test_errors_are_not_cached,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Тест повторов запросов к Tron API: backoff, Retry-After, бюджет и типы ошибок
+"""
+
+import sys
+
+from fake_tron_server import FakeTronServer, SyntheticChain
+from request_coalescer import RequestCoalescer
+from request_executor import (
+    RequestExecutor, RetryBudget, RateLimitError, TransientError, UpstreamResponseError
+)
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+class Response:
+    """Минимальный ответ для проверки классификации"""
+
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def scripted(*statuses):
+    """Функция, которая по очереди возвращает ответы с заданными статусами"""
+    queue = list(statuses)
+    calls = []
+
+    def func():
+        calls.append(1)
+        status, headers = queue.pop(0) if isinstance(queue[0], tuple) else (queue.pop(0), None)
+        return Response(status, headers)
+
+    return func, calls
+
+
+def make_executor(**kwargs):
+    sleeps = []
+    kwargs.setdefault('budget', RetryBudget(per_cycle=100, window=60))
+    executor = RequestExecutor(max_attempts=3, base_delay=0.1, max_delay=1.0,
+                               max_retry_after=5, sleep=sleeps.append, **kwargs)
+    return executor, sleeps
+
+
+def test_transient_errors_are_retried():
+    """503 повторяется с задержкой, успешный ответ возвращается"""
+    print("🧪 Повтор временных ошибок...")
+    executor, sleeps = make_executor()
+    func, calls = scripted(503, 503, 200)
+    assert executor.execute('account', func).status_code == 200
+    assert len(calls) == 3 and len(sleeps) == 2
+    assert all(0 <= delay <= 1.0 for delay in sleeps)
+    assert executor.stats()['retries'] == 2
+    print(f"   ✅ Паузы: {[round(d, 3) for d in sleeps]}")
+
+
+def test_retry_after_is_respected():
+    """429 ждет Retry-After, слишком длинный Retry-After - сразу отказ"""
+    print("🧪 Retry-After...")
+    executor, sleeps = make_executor()
+    func, _ = scripted((429, {'Retry-After': '2'}), 200)
+    executor.execute('balance', func)
+    assert len(sleeps) == 1 and sleeps[0] >= 2.0
+
+    func, calls = scripted((429, {'Retry-After': '60'}), 200)
+    try:
+        executor.execute('balance', func)
+        assert False, "ожидалась RateLimitError"
+    except RateLimitError as e:
+        assert e.retry_after == 60
+    assert len(calls) == 1
+    assert executor.stats()['give_ups'] == 1
+    print("   ✅ OK")
+
+
+def test_permanent_errors_are_not_retried():
+    """4xx (кроме 429) - постоянная ошибка без повторов"""
+    print("🧪 Постоянные ошибки...")
+    executor, sleeps = make_executor()
+    func, calls = scripted(400, 200)
+    try:
+        executor.execute('transaction', func)
+        assert False, "ожидалась UpstreamResponseError"
+    except UpstreamResponseError as e:
+        assert e.status_code == 400
+    assert len(calls) == 1 and not sleeps
+
+    # Разрешенный статус возвращается как есть
+    func, _ = scripted(404)
+    assert executor.execute('transaction', func, accept=(200, 404)).status_code == 404
+    print("   ✅ OK")
+
+
+def test_retry_budget_per_cycle():
+    """Бюджет ограничивает число повторов за цикл"""
+    print("🧪 Бюджет повторов...")
+    executor, sleeps = make_executor(budget=RetryBudget(per_cycle=2, window=60))
+    for _ in range(5):
+        func, _ = scripted(503, 503, 503)
+        try:
+            executor.execute('trc20_transactions', func)
+        except TransientError:
+            pass
+    stats = executor.stats()
+    assert stats['retries'] == 2 and len(sleeps) == 2
+    assert stats['budget_exhausted'] >= 3
+    executor.new_cycle()
+    assert executor.stats()['budget_remaining'] == 2
+    print(f"   ✅ {stats}")
+
+
+def test_tracker_raises_instead_of_empty_result():
+    """TronTracker поднимает ошибку, а не возвращает 'нет переводов'"""
+    print("🧪 TronTracker при постоянных 429...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0)
+    with FakeTronServer(chain, rate_429=1.0, retry_after=1) as server:
+        router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                                routes={'trc20_transactions': ['fake']}, hedged_calls=[])
+        executor, sleeps = make_executor()
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0), executor=executor)
+        try:
+            tracker.get_new_transfers(WALLET)
+            assert False, "ожидалась RateLimitError"
+        except RateLimitError:
+            pass
+        assert server.stats['injected_429'] >= 2, "запрос должен повторяться"
+
+        server.rate_429 = 0.0
+        for provider in router.providers.values():
+            provider.health.record_success(0.01)
+        assert tracker.get_new_transfers(WALLET) == []
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_transient_errors_are_retried,
+        test_retry_after_is_respected,
+        test_permanent_errors_are_not_retried,
+        test_retry_budget_per_cycle,
+        test_tracker_raises_instead_of_empty_result,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
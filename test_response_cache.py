@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Тест ETag по версиям: 304 без чтения данных, кеш ответов, сброс при смене статуса
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import config
+import payment_api
+import payment_verification_api
+import simple_payment_api
+from database import Database
+from payment_matcher import PaymentMatcher
+from response_cache import ResponseCache
+from transfer_window import TransferWindow
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+
+
+class CountingBalance:
+    """Tron API с балансом кошелька, считает запросы"""
+
+    def __init__(self):
+        self.calls = 0
+        self.on_event_loop = 0
+
+    def get_balance(self, address):
+        self.calls += 1
+        try:
+            asyncio.get_running_loop()
+            self.on_event_loop += 1
+        except RuntimeError:
+            pass
+        return 100.0 + self.calls
+
+
+def test_check_payment_versions():
+    """/check-payment: 304 по версии, тело из кеша, новая версия после зачисления"""
+    print("🧪 ETag /check-payment...")
+    with tempfile.TemporaryDirectory() as tmp:
+        original = simple_payment_api.db, simple_payment_api.payment_matcher, simple_payment_api.response_cache
+        simple_payment_api.db = db = Database(os.path.join(tmp, 'payments.db'))
+        simple_payment_api.payment_matcher = PaymentMatcher()
+        simple_payment_api.response_cache = cache = ResponseCache()
+        try:
+            client = TestClient(simple_payment_api.app)
+            headers = {'X-API-Key': simple_payment_api.api_auth.create_key()}
+            payment_id = client.post("/create-payment", headers=headers, json={'amount': 4.0}).json()['payment_id']
+            url = f"/check-payment/{payment_id}"
+
+            first = client.get(url, headers=headers)
+            etag = first.headers['etag']
+            assert first.json()['status'] == 'pending' and first.headers['cache-control'] == 'private, no-cache'
+            assert client.get(url, headers=headers).json() == first.json()
+            cached = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            assert cached.status_code == 304 and 'x-ratelimit-remaining' in cached.headers
+            assert (cache.stats()['misses'], cache.stats()['hits'], cache.stats()['not_modified']) == (1, 1, 1)
+
+            other = {'X-API-Key': simple_payment_api.api_auth.create_key()}
+            assert client.get(url, headers=dict(other, **{'If-None-Match': etag})).json()['success'] is False, \
+                "чужой ключ не получает 304 по ETag владельца"
+
+            db.complete_simple_payments([{'payment_id': payment_id, 'transaction_hash': 'tx-1'}])
+            changed = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            assert changed.status_code == 200 and changed.json()['status'] == 'completed'
+            assert changed.headers['etag'] != etag
+        finally:
+            simple_payment_api.db, simple_payment_api.payment_matcher, simple_payment_api.response_cache = original
+    print("   ✅ OK")
+
+
+def test_user_status_versions():
+    """/payment/status/{user_id}: версия пользователя меняется при создании и истечении платежа"""
+    print("🧪 ETag /payment/status...")
+    system = payment_api.payment_system
+    with tempfile.TemporaryDirectory() as tmp:
+        original = system.db, payment_api.response_cache
+        system.db = db = Database(os.path.join(tmp, 'payments.db'))
+        payment_api.response_cache = ResponseCache()
+        try:
+            client = TestClient(payment_api.app)
+            db.add_user(7, 'buyer', WALLET)
+            etags = []
+            for change in (lambda: None, lambda: db.add_pending_payment(7, 5.0, 'USDT', WALLET, ttl=-60),
+                           lambda: db.expire_payments('pending_payments', 10)):
+                change()
+                response = client.get("/payment/status/7")
+                assert response.status_code == 200 and response.json()['success']
+                etags.append(response.headers['etag'])
+                assert client.get("/payment/status/7", headers={'If-None-Match': etags[-1]}).status_code == 304
+            assert len(set(etags)) == 3
+            assert client.get("/payment/status/8", headers={'If-None-Match': etags[-1]}).status_code == 200
+            assert payment_api.response_cache.stats()['uncacheable'] == 1, "ошибка не кешируется"
+
+            info = client.get("/payment/info")
+            assert info.headers['cache-control'] == 'public, max-age=3600'
+            assert client.get("/payment/info", headers={'If-None-Match': info.headers['etag']}).status_code == 304
+        finally:
+            system.db, payment_api.response_cache = original
+    print("   ✅ OK")
+
+
+def test_wallet_info_cached():
+    """/wallet-info не запрашивает баланс на каждый опрос, новый перевод сбрасывает кеш"""
+    print("🧪 Кеш /wallet-info...")
+    original = (payment_verification_api.db, payment_verification_api.tron_tracker,
+                payment_verification_api.transfer_window, payment_verification_api.response_cache,
+                config.WALLET_INFO_MAX_AGE)
+    tmp = tempfile.TemporaryDirectory()
+    config.WALLET_INFO_MAX_AGE = 3600  # интервал не сменится посреди теста
+    payment_verification_api.db = Database(os.path.join(tmp.name, 'payments.db'))  # кошелек приема - OUR_WALLET
+    payment_verification_api.tron_tracker = tracker = CountingBalance()
+    payment_verification_api.transfer_window = window = TransferWindow()
+    payment_verification_api.response_cache = ResponseCache()
+    try:
+        client = TestClient(payment_verification_api.app)
+        headers = {'X-API-Key': payment_verification_api.api_auth.create_key()}
+        first = client.get("/wallet-info", headers=headers)
+        assert [client.get("/wallet-info", headers=headers).json()['balance'] for _ in range(3)] == [101.0] * 3
+        assert tracker.calls == 1 and first.headers['cache-control'].startswith('private, max-age=')
+        assert client.get("/wallet-info", headers=dict(headers, **{'If-None-Match': first.headers['etag']})
+                          ).status_code == 304
+
+        window.add([{'tx_hash': 'tx-1', 'amount': 1.0, 'from': 'TBuyer', 'to': payment_verification_api.OUR_WALLET,
+                     'timestamp': int(time.time() * 1000)}])
+        assert client.get("/wallet-info", headers=headers).json()['balance'] == 102.0
+        assert tracker.on_event_loop == 0, "баланс запрашивается вне цикла событий"
+    finally:
+        (payment_verification_api.db, payment_verification_api.tron_tracker,
+         payment_verification_api.transfer_window, payment_verification_api.response_cache,
+         config.WALLET_INFO_MAX_AGE) = original
+        tmp.cleanup()
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_check_payment_versions,
+        test_user_status_versions,
+        test_wallet_info_cached,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Тест нескольких воркеров: один лидер опроса, канал событий между процессами, uvicorn --workers 2
+"""
+
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from database import Database
+from shared_state import LeaderLease, SharedBus
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def contend(path: str, ttl: float, results):
+    """
+    Процесс-претендент: лидер держит аренду ttl секунд и завершается без
+    release (как упавший воркер), остальные ждут истечения аренды
+    """
+    lease = LeaderLease(Database(path), 'test.poller', ttl=ttl)
+    deadline = time.time() + ttl * 8
+    while time.time() < deadline:
+        if lease.renew():
+            results.put((os.getpid(), time.time()))
+            time.sleep(ttl * 0.8)
+            return
+        time.sleep(ttl / 10)
+    results.put((os.getpid(), None))
+
+
+def listen(path: str, ready, results, expected: int):
+    """Процесс-подписчик канала: получает события других процессов и отвечает своим"""
+    bus = SharedBus(Database(path), origin='listener')
+    received = []
+    bus.subscribe('test.channel', lambda payload, event_id: received.append((event_id, payload['n'])))
+    ready.set()
+    deadline = time.time() + 10
+    while len(received) < expected and time.time() < deadline:
+        bus.poll()
+        time.sleep(0.02)
+    bus.publish('test.reply', {'received': [n for _, n in received]})
+    results.put(received)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_single_leader_across_processes():
+    """Аренду держит один процесс; после падения лидера ее занимает следующий"""
+    print("🧪 Лидер среди процессов...")
+    ttl = 0.5
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.db')
+        Database(path)
+        results = context.Queue()
+        processes = [context.Process(target=contend, args=(path, ttl, results)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join(timeout=10)
+
+    elected = sorted(started for _, started in outcomes if started is not None)
+    assert len(elected) == 4, f"каждый процесс по очереди стал лидером: {outcomes}"
+    gaps = [later - earlier for earlier, later in zip(elected, elected[1:])]
+    assert all(gap >= ttl * 0.9 for gap in gaps), f"два лидера одновременно: {gaps}"
+    print("   ✅ OK")
+
+
+def test_bus_across_processes():
+    """События одного процесса доходят до другого по порядку, свои не возвращаются"""
+    print("🧪 Канал событий между процессами...")
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.db')
+        db = Database(path)
+        bus = SharedBus(db, origin='publisher')
+        replies = []
+        bus.subscribe('test.reply', lambda payload, event_id: replies.append(payload['received']))
+        local = []
+        bus.subscribe('test.channel', lambda payload, event_id: local.append(payload['n']))
+
+        ready, results = context.Event(), context.Queue()
+        listener = context.Process(target=listen, args=(path, ready, results, 3))
+        listener.start()
+        assert ready.wait(30)
+        ids = [bus.publish('test.channel', {'n': n}) for n in (1, 2, 3)]
+        received = results.get(timeout=30)
+        listener.join(timeout=10)
+
+        assert local == [1, 2, 3], "обработчики процесса вызываются сразу"
+        assert received == list(zip(ids, [1, 2, 3])), received
+        assert bus.poll() == 1 and replies == [[1, 2, 3]], "свои события не читаются повторно"
+        assert db.purge_bus_events(time.time() + 1) == 4
+    print("   ✅ OK")
+
+
+def test_uvicorn_workers():
+    """uvicorn --workers 2: один лидер, ключи и платежи видны всем, истечение будит ждущих в любом воркере"""
+    print("🧪 uvicorn --workers 2...")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, PYTHONPATH=REPO, PENDING_PAYMENT_TTL='3', SWEEP_INTERVAL='1',
+               SHARED_BUS_POLL_INTERVAL='0.1', LEADER_LEASE_TTL='5', TRON_API_URL='http://127.0.0.1:9')
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'simple_payment_api:app', '--workers', '2',
+             '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            workers = {}
+            deadline = time.time() + 30
+            while len(workers) < 2 and time.time() < deadline:
+                try:
+                    worker = requests.get(f"{url}/health", headers={'Connection': 'close'}, timeout=2).json()['worker']
+                    workers[worker['worker']] = worker['leader']
+                except requests.RequestException:
+                    time.sleep(0.2)
+            assert len(workers) == 2, f"ответили не оба воркера: {workers}"
+            assert sorted(workers.values()) == [False, True], f"ровно один лидер опроса: {workers}"
+
+            headers = {'X-API-Key': requests.get(f"{url}/get-api-key").json()['api_key']}
+            payment_id = requests.post(f"{url}/create-payment", headers=headers,
+                                       json={'amount': 3.0}).json()['payment_id']
+            statuses = [requests.get(f"{url}/check-payment/{payment_id}",
+                                     headers=dict(headers, Connection='close')).json() for _ in range(10)]
+            assert all(status['success'] and status['status'] == 'pending' for status in statuses), statuses
+
+            # Истекает платеж у лидера; ждущие на обоих воркерах узнают об этом из канала
+            waits = []
+
+            def wait():
+                started = time.time()
+                result = requests.get(f"{url}/payments/{payment_id}/wait", params={'timeout': 15},
+                                      headers=dict(headers, Connection='close'), timeout=20).json()
+                waits.append((result['status'], time.time() - started))
+
+            threads = [threading.Thread(target=wait) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=25)
+            assert len(waits) == 8 and all(status == 'expired' and elapsed < 12 for status, elapsed in waits), waits
+        finally:
+            server.terminate()
+            server.wait(timeout=15)
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_single_leader_across_processes,
+        test_bus_across_processes,
+        test_uvicorn_workers,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
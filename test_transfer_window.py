@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Тест окна последних переводов: курсор опроса, вытеснение, проверка платежа без upstream
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+import payment_verification_api
+from database import Database
+from fake_tron_server import FakeTronServer, SyntheticChain
+from request_coalescer import RequestCoalescer
+from transfer_window import TransferWindow
+from tron_providers import TronProvider, ProviderRouter, KIND_TRONGRID
+from tron_tracker import TronTracker
+
+WALLET = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+BUYER = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+
+def make_tracker(server):
+    router = ProviderRouter([TronProvider('fake', server.url, KIND_TRONGRID, timeout=2)],
+                            routes={'trc20_transactions': ['fake']}, hedged_calls=[])
+    return TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+
+
+def transfer(tx_hash, amount, timestamp, sender=BUYER):
+    return {'tx_hash': tx_hash, 'amount': amount, 'currency': 'USDT',
+            'from': sender, 'to': WALLET, 'timestamp': timestamp}
+
+
+def test_eviction_by_age_and_size():
+    """Окно ограничено возрастом и размером, индексы чистятся вместе с переводами"""
+    print("🧪 Вытеснение из окна...")
+    now_ms = int(time.time() * 1000)
+    window = TransferWindow(max_age=60, max_size=3)
+    window.add([transfer('old', 1.0, now_ms - 120000)] +
+               [transfer(f"t{i}", 2.0 + i, now_ms) for i in range(4)])
+    assert window.add([transfer('t3', 5.0, now_ms)]) == 0, "повтор по tx_hash"
+
+    assert window.stats()['transfers'] == 3
+    assert window.by_amount(WALLET, 1.0) == [] and window.by_amount(WALLET, 2.0) == []
+    assert [t['tx_hash'] for t in window.by_amount(WALLET, 5.0)] == ['t3']
+    assert [t['tx_hash'] for t in window.by_sender(WALLET, BUYER, 4.005)] == ['t2']
+    assert window.by_amount(WALLET, 5.0, since_ms=now_ms + 1) == []
+    print("   ✅ OK")
+
+
+def test_refresh_keeps_every_transfer():
+    """Опрос с курсора не теряет переводы, сколько бы их ни пришло между проверками"""
+    print("🧪 Опрос с курсора...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.01)
+    with FakeTronServer(chain) as server:
+        tracker = make_tracker(server)
+        window = TransferWindow(poll_limit=50)
+        hashes = []
+        for batch in range(3):
+            for i in range(25):
+                hashes.append(chain.inject_transfer(WALLET, 1 + batch + i / 100))
+            time.sleep(0.03)
+            window.refresh(tracker, WALLET)
+
+        stats = window.stats()
+        assert stats['transfers'] == 75 and stats['full_pages'] == 0, stats
+        found = {t['tx_hash'] for batch in range(3) for i in range(25)
+                 for t in window.by_amount(WALLET, 1 + batch + i / 100)}
+        assert found == set(hashes)
+    print("   ✅ OK")
+
+
+def test_refresh_pages_to_cursor():
+    """Больше poll_limit переводов между опросами - опрос идет по страницам до курсора"""
+    print("🧪 Постраничный опрос...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.01)
+    with FakeTronServer(chain) as server:
+        tracker = make_tracker(server)
+        window = TransferWindow(poll_limit=10, overlap=0)
+        chain.inject_transfer(WALLET, 0.5)
+        time.sleep(0.02)
+        window.refresh(tracker, WALLET)
+
+        hashes = []
+        for block in range(7):  # по 5 переводов в блоке
+            hashes += [chain.inject_transfer(WALLET, 1 + block + i / 100) for i in range(5)]
+            time.sleep(0.015)
+            chain.advance()
+        polls, pages = server.stats['trc20_transactions'], window.stats()['pages']
+        added = window.refresh(tracker, WALLET)
+        assert {t['tx_hash'] for t in added} == set(hashes)
+        # Блок на границе страницы запрашивается повторно: каждая следующая страница - 5 новых
+        assert server.stats['trc20_transactions'] - polls == window.stats()['pages'] - pages == 7
+        assert window.stats()['full_pages'] == 0
+
+        # Страниц не хватило - предупреждение и счетчик
+        window.max_pages = 2
+        for block in range(8):
+            chain.inject_transfer(WALLET, 20 + block)
+            chain.inject_transfer(WALLET, 30 + block)
+            chain.inject_transfer(WALLET, 40 + block)
+            time.sleep(0.015)
+            chain.advance()
+        assert len(window.refresh(tracker, WALLET)) < 24
+        assert window.stats()['full_pages'] == 1
+    print("   ✅ OK")
+
+
+def test_verify_payment_uses_window():
+    """POST /verify-payment отвечает из окна, не обращаясь к upstream"""
+    print("🧪 Проверка платежа по окну...")
+    chain = SyntheticChain(wallets=[WALLET], rate=0, block_interval=0.01)
+    with tempfile.TemporaryDirectory() as tmp, FakeTronServer(chain) as server:
+        tracker = make_tracker(server)
+        original = (payment_verification_api.db, payment_verification_api.tron_tracker,
+                    payment_verification_api.transfer_window)
+        payment_verification_api.db = Database(os.path.join(tmp, 'payments.db'))  # кошелек приема - WALLET
+        payment_verification_api.tron_tracker = tracker
+        payment_verification_api.transfer_window = window = TransferWindow()
+        try:
+            # Больше 10 платежей между проверками - старые не выпадают из окна
+            tx_hash = chain.inject_transfer(WALLET, 12.34, from_address=BUYER)
+            for i in range(15):
+                chain.inject_transfer(WALLET, 1 + i)
+            time.sleep(0.03)
+            window.refresh(tracker, WALLET)
+
+            client = TestClient(payment_verification_api.app)
+            headers = {'X-API-Key': payment_verification_api.api_auth.create_key()}
+            polls = server.stats['trc20_transactions']
+            for _ in range(5):
+                result = client.post("/verify-payment", headers=headers,
+                                     json={'user_wallet': BUYER, 'expected_amount': 12.34}).json()
+                assert result['payment_found'] and result['transaction_hash'] == tx_hash, result
+            assert server.stats['trc20_transactions'] == polls, "без запросов к upstream"
+        finally:
+            (payment_verification_api.db, payment_verification_api.tron_tracker,
+             payment_verification_api.transfer_window) = original
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_eviction_by_age_and_size,
+        test_refresh_keeps_every_transfer,
+        test_refresh_pages_to_cursor,
+        test_verify_payment_uses_window,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
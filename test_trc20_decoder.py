@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Тест пакетного декодера TRC20: transfer, transferFrom и события Transfer
+"""
+
+import sys
+
+import trc20_decoder
+from trc20_decoder import decode_calls, decode_event_logs, decode_call, TRANSFER_EVENT_TOPIC
+from tron_address import base58_to_hex
+
+TO = "TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx"
+FROM = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+
+
+def word_address(address: str) -> str:
+    return '0' * 24 + base58_to_hex(address)[2:]
+
+
+def word_amount(value: int) -> str:
+    return format(value, '064x')
+
+
+def transfer(to: str, value: int) -> str:
+    return 'a9059cbb' + word_address(to) + word_amount(value)
+
+
+def transfer_from(sender: str, to: str, value: int) -> str:
+    return '23b872dd' + word_address(sender) + word_address(to) + word_amount(value)
+
+
+def check_batch(calls):
+    """Общая проверка результата для пакета из 3 типов вызовов"""
+    batch = decode_calls(calls)
+    rows = {row['index']: row for row in batch.rows()}
+    assert batch.skipped == len(calls) // 3
+    for position in range(0, len(calls), 3):
+        assert rows[position]['type'] == 'transfer'
+        assert rows[position]['to'] == TO
+        assert rows[position]['amount'] == 12.5
+        assert rows[position + 1]['type'] == 'transferFrom'
+        assert rows[position + 1]['from'] == FROM
+        assert rows[position + 1]['value'] == 2 ** 70  # больше uint64
+        assert position + 2 not in rows  # approve пропускается
+
+
+def test_decode_calls_vectorized_and_plain():
+    """Векторный путь и путь без numpy дают одинаковый результат"""
+    print("🧪 Пакет вызовов...")
+    calls = []
+    for _ in range(100):
+        calls += [transfer(TO, 12500000), transfer_from(FROM, TO, 2 ** 70), '095ea7b3' + word_address(TO) + word_amount(1)]
+
+    check_batch(calls)
+    check_batch([bytes.fromhex(call) for call in calls])
+
+    saved = trc20_decoder.np
+    trc20_decoder.np = None
+    try:
+        check_batch(calls)
+    finally:
+        trc20_decoder.np = saved
+    print("   ✅ OK")
+
+
+def test_decode_single_call():
+    """Один вызов, в т.ч. с префиксом 0x и лишними байтами"""
+    print("🧪 Одиночный вызов...")
+    assert decode_call(transfer(TO, 1000000))['amount'] == 1.0
+    assert decode_call('0x' + transfer(TO, 1000000) + '00' * 4)['to'] == TO
+    assert decode_call('deadbeef') is None
+    assert decode_call('zz') is None
+    print("   ✅ OK")
+
+
+def test_decode_event_logs():
+    """События Transfer из логов"""
+    print("🧪 События Transfer...")
+    logs = [
+        {'topics': [TRANSFER_EVENT_TOPIC.hex(), word_address(FROM), word_address(TO)], 'data': word_amount(5000000)},
+        {'topics': ['00' * 32, word_address(FROM), word_address(TO)], 'data': word_amount(1)},
+        {'topics': [TRANSFER_EVENT_TOPIC.hex()], 'data': ''},
+        # Испорченные записи не прерывают разбор пакета
+        {'topics': [TRANSFER_EVENT_TOPIC.hex(), word_address(FROM)[1:], word_address(TO)], 'data': word_amount(1)},
+        {'topics': [TRANSFER_EVENT_TOPIC.hex(), 'zz' * 32, word_address(TO)], 'data': word_amount(1)},
+        {'topics': [TRANSFER_EVENT_TOPIC.hex(), None, word_address(TO)], 'data': word_amount(1)},
+    ]
+    batch = decode_event_logs(logs)
+    rows = list(batch.rows())
+    assert len(rows) == 1 and batch.skipped == 5
+    assert rows[0]['from'] == FROM and rows[0]['to'] == TO and rows[0]['amount'] == 5.0
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_decode_calls_vectorized_and_plain,
+        test_decode_single_call,
+        test_decode_event_logs,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Тест локальной валидации Tron адресов и преобразования hex <-> base58
+"""
+
+import sys
+
+from tron_address import is_valid_address, hex_to_base58, base58_to_hex, b58decode, b58encode
+from tron_tracker import TronTracker
+
+USDT_BASE58 = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+USDT_HEX = "41a614f803b6fd780986a42c78ec9c7f77e6ded13c"
+
+
+def test_valid_addresses():
+    """Корректные адреса проходят проверку"""
+    print("🧪 Корректные адреса...")
+    assert is_valid_address(USDT_BASE58)
+    assert is_valid_address("TWJ5wQPnJTk2keYXjEgf19i17ZzACBY4Mx")
+    print("   ✅ OK")
+
+
+def test_invalid_addresses():
+    """Адреса с ошибками отклоняются без запроса к сети"""
+    print("🧪 Некорректные адреса...")
+    # Последний символ изменен - контрольная сумма не совпадает
+    assert not is_valid_address("TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6u")
+    # Правильная длина и префикс, но не base58check
+    assert not is_valid_address("TTestAddress123456789012345678901234")
+    # Недопустимые для base58 символы
+    assert not is_valid_address("T0OIl" + "1" * 29)
+    assert not is_valid_address("")
+    assert not is_valid_address(None)
+    print("   ✅ OK")
+
+
+def test_hex_conversion():
+    """hex <-> base58 в обе стороны"""
+    print("🧪 Преобразование hex <-> base58...")
+    assert base58_to_hex(USDT_BASE58) == USDT_HEX
+    assert hex_to_base58(USDT_HEX) == USDT_BASE58
+    # 20 байт без префикса, как в ABI данных transfer
+    assert hex_to_base58(USDT_HEX[2:]) == USDT_BASE58
+    assert b58decode(b58encode(b'\0\0abc')) == b'\0\0abc'
+    print("   ✅ OK")
+
+
+def test_tracker_validation_is_offline():
+    """validate_address по умолчанию не обращается к сети"""
+    print("🧪 TronTracker.validate_address без сети...")
+    tracker = TronTracker()
+
+    def no_network(address):
+        raise AssertionError("запрос к сети")
+
+    tracker.get_account_info = no_network
+    assert tracker.validate_address(USDT_BASE58)
+    assert not tracker.validate_address("invalid_address")
+
+    calls = []
+    tracker.get_account_info = lambda address: calls.append(address) or {'data': [{'address': address}]}
+    assert tracker.validate_address(USDT_BASE58, check_onchain=True)
+    assert tracker.validate_address(USDT_BASE58, check_onchain=True)
+    assert len(calls) == 1, "проверка существования должна кэшироваться"
+    print("   ✅ OK")
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_valid_addresses,
+        test_invalid_addresses,
+        test_hex_conversion,
+        test_tracker_validation_is_offline,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Тест маршрутизации провайдеров Tron API на локальных фейковых провайдерах
+Проверяет circuit breaker, hedged-запросы и выбор провайдера по типу вызова
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import config
+from tron_providers import (
+    TronProvider, ProviderRouter, ProviderError, KIND_TRONGRID, KIND_TRONSCAN,
+    CALL_ACCOUNT, CALL_BALANCE
+)
+from request_coalescer import RequestCoalescer
+from tron_tracker import TronTracker
+
+
+class FakeProvider:
+    """Локальный HTTP провайдер с управляемой задержкой и ошибками"""
+
+    def __init__(self, latency: float = 0.0, status: int = 200, body: dict = None):
+        self.latency = latency
+        self.status = status
+        self.body = body if body is not None else {'data': [], 'success': True}
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests += 1
+                time.sleep(fake.latency)
+                payload = json.dumps(fake.body).encode()
+                self.send_response(fake.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_circuit_breaker_skips_failing_provider():
+    """Провайдер с 5xx выводится из ротации, запросы идут к здоровому"""
+    print("🧪 Circuit breaker...")
+    broken = FakeProvider(status=503)
+    healthy = FakeProvider()
+    try:
+        router = ProviderRouter(
+            [TronProvider('broken', broken.url, timeout=2), TronProvider('healthy', healthy.url, timeout=2)],
+            routes={CALL_ACCOUNT: ['broken', 'healthy']},
+            hedged_calls=[]
+        )
+        # micro-cache выключен: каждый вызов должен дойти до провайдера
+        tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+
+        for _ in range(10):
+            assert tracker.get_account_info('TXYZ') is not None
+
+        # Сломанный провайдер уходит в конец очереди и не тормозит вызовы
+        assert broken.requests <= config.PROVIDER_CONSECUTIVE_FAILURES
+        assert healthy.requests == 10
+        print(f"   ✅ broken: {broken.requests} запросов, healthy: {healthy.requests}")
+    finally:
+        broken.close()
+        healthy.close()
+
+
+def test_hedged_request_beats_slow_provider():
+    """Медленный основной провайдер не задерживает hedged-вызов"""
+    print("🧪 Hedged-запросы...")
+    slow = FakeProvider(latency=2.0)
+    fast = FakeProvider(latency=0.01)
+    try:
+        router = ProviderRouter(
+            [TronProvider('slow', slow.url, timeout=5), TronProvider('fast', fast.url, timeout=5)],
+            routes={CALL_ACCOUNT: ['slow', 'fast']},
+            hedged_calls=[CALL_ACCOUNT],
+            hedge_delay=0.1
+        )
+
+        started = time.monotonic()
+        provider, response = router.execute(
+            CALL_ACCOUNT, lambda p: requests.get(p.url('/v1/accounts/T'), timeout=p.timeout)
+        )
+        elapsed = time.monotonic() - started
+
+        assert provider.name == 'fast'
+        assert response.status_code == 200
+        assert elapsed < 1.0
+        print(f"   ✅ Ответ от {provider.name} за {elapsed * 1000:.0f} мс")
+    finally:
+        slow.close()
+        fast.close()
+
+
+def test_routing_per_call_type():
+    """Баланс идет в TronScan-совместимый провайдер, аккаунт - в TronGrid"""
+    print("🧪 Маршрутизация по типу вызова...")
+    tronscan = FakeProvider(body={
+        'trc20token_balances': [{'tokenId': config.USDT_CONTRACT_ADDRESS, 'balance': '12500000'}]
+    })
+    trongrid = FakeProvider(body={'data': [{'address': 'T'}], 'success': True})
+    try:
+        router = ProviderRouter(
+            [TronProvider('trongrid', trongrid.url, KIND_TRONGRID, timeout=2),
+             TronProvider('tronscan', tronscan.url, KIND_TRONSCAN, timeout=2)],
+            routes={CALL_BALANCE: ['tronscan', 'trongrid'], CALL_ACCOUNT: ['trongrid']},
+            hedged_calls=[]
+        )
+        tracker = TronTracker(router=router)
+
+        assert tracker.get_balance('TXYZ') == 12.5
+        assert tracker.get_account_info('TXYZ') is not None
+        assert tronscan.requests == 1
+        assert trongrid.requests == 1
+        print("   ✅ balance -> tronscan, account -> trongrid")
+    finally:
+        tronscan.close()
+        trongrid.close()
+
+
+def test_tronscan_4xx_falls_back_to_trongrid():
+    """4xx TronScan на баланс - ответ берется у TronGrid (и в hedged-режиме)"""
+    print("🧪 4xx TronScan -> TronGrid...")
+    tronscan = FakeProvider(status=403, body={'message': 'rate limit'})
+    trongrid = FakeProvider(body={'data': [{'trc20': [{config.USDT_CONTRACT_ADDRESS: '7000000'}]}]})
+    try:
+        for hedged in ([], [CALL_BALANCE]):
+            router = ProviderRouter(
+                [TronProvider('tronscan', tronscan.url, KIND_TRONSCAN, timeout=2),
+                 TronProvider('trongrid', trongrid.url, KIND_TRONGRID, timeout=2)],
+                routes={CALL_BALANCE: ['tronscan', 'trongrid']},
+                hedged_calls=hedged, hedge_delay=1.0
+            )
+            tracker = TronTracker(router=router, coalescer=RequestCoalescer(ttl=0))
+            assert tracker.get_balance('TXYZ') == 7.0
+            assert router.providers['tronscan'].health.is_available(), "4xx не открывает breaker"
+        assert tronscan.requests == 2 and trongrid.requests == 2
+        print("   ✅ Баланс получен от TronGrid")
+    finally:
+        tronscan.close()
+        trongrid.close()
+
+
+def test_bad_body_closes_probe():
+    """Испорченный ответ (не JSON) - сбой провайдера; пробный запрос half-open не зависает"""
+    print("🧪 Испорченный ответ провайдера...")
+    provider = TronProvider('flaky', 'http://127.0.0.1:9', timeout=2)
+    provider.health.open_seconds = 0
+    router = ProviderRouter([provider], routes={CALL_ACCOUNT: ['flaky']}, hedged_calls=[])
+    provider.health.state, provider.health.opened_at = provider.health.OPEN, 0.0
+
+    def bad_body(p):
+        raise ValueError("Expecting value: line 1 column 1")
+
+    try:
+        router.execute(CALL_ACCOUNT, bad_body)
+        assert False, "ожидалась ProviderError"
+    except ProviderError:
+        pass
+    assert not provider.health.probe_in_flight and provider.health.failures == 1
+
+    ok = requests.models.Response()
+    ok.status_code = 200
+    provider, response = router.execute(CALL_ACCOUNT, lambda p: ok)
+    assert response is ok and provider.health.state == provider.health.CLOSED
+    print("   ✅ OK")
+
+
+def test_all_providers_down():
+    """Когда все провайдеры недоступны, вызов завершается быстро"""
+    print("🧪 Все провайдеры недоступны...")
+    broken = FakeProvider(status=500)
+    try:
+        router = ProviderRouter([TronProvider('broken', broken.url, timeout=2)],
+                                routes={CALL_ACCOUNT: ['broken']}, hedged_calls=[])
+        for _ in range(config.PROVIDER_CONSECUTIVE_FAILURES):
+            try:
+                router.execute(CALL_ACCOUNT, lambda p: requests.get(p.url('/'), timeout=2))
+            except ProviderError:
+                pass
+
+        requests_before = broken.requests
+        try:
+            router.execute(CALL_ACCOUNT, lambda p: requests.get(p.url('/'), timeout=2))
+            assert False, "ожидалась ProviderError"
+        except ProviderError:
+            pass
+        assert broken.requests == requests_before
+        print("   ✅ Открытый breaker отклоняет запрос без обращения к провайдеру")
+    finally:
+        broken.close()
+
+
+def main():
+    """Запуск тестов"""
+    tests = [
+        test_circuit_breaker_skips_failing_provider,
+        test_hedged_request_beats_slow_provider,
+        test_routing_per_call_type,
+        test_tronscan_4xx_falls_back_to_trongrid,
+        test_bad_body_closes_probe,
+        test_all_providers_down,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Пройдено {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
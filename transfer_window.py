@@ -0,0 +1,177 @@
+"""
+Окно последних входящих переводов по кошелькам приема
+
+Фоновый опрос (refresh) забирает переводы кошелька с курсора - времени
+последнего известного перевода с запасом TRANSFER_WINDOW_OVERLAP - по
+страницам, пока не дойдет до курсора, и складывает их в окно с индексами
+по точной сумме и по отправителю.
+Проверка платежа становится поиском в словаре без запроса к upstream, а
+переводы не выпадают из выборки при любом числе платежей между
+проверками. Окно ограничено возрастом (TRANSFER_WINDOW_SECONDS) и
+размером (TRANSFER_WINDOW_SIZE): старые переводы вытесняются первыми.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+import config
+from amount_allocator import to_units
+
+logger = logging.getLogger(__name__)
+
+
+class TransferWindow:
+    """Скользящее окно переводов с индексами (кошелек, сумма) и (кошелек, отправитель)"""
+
+    def __init__(self, max_age: float = None, max_size: int = None, poll_limit: int = None,
+                 overlap: float = None, max_pages: int = None):
+        """
+        Args:
+            max_age: Сколько секунд (по времени блока) перевод хранится в окне
+            max_size: Максимум переводов в окне по всем кошелькам
+            poll_limit: Переводов за один запрос опроса
+            overlap: Запас курсора опроса назад, секунды (поздно проиндексированные переводы)
+            max_pages: Максимум запросов за один опрос
+        """
+        self.max_age = max_age if max_age is not None else config.TRANSFER_WINDOW_SECONDS
+        self.max_size = max_size if max_size is not None else config.TRANSFER_WINDOW_SIZE
+        self.poll_limit = poll_limit if poll_limit is not None else config.TRANSFER_WINDOW_POLL_LIMIT
+        self.max_pages = max_pages if max_pages is not None else config.TRANSFER_WINDOW_MAX_PAGES
+        self.overlap_ms = int((overlap if overlap is not None else config.TRANSFER_WINDOW_OVERLAP) * 1000)
+
+        self._lock = threading.Lock()
+        # tx_hash -> перевод в порядке добавления (вытеснение с начала)
+        self._transfers: OrderedDict = OrderedDict()
+        self._by_amount: Dict[Tuple[str, int], List[Dict]] = {}
+        self._by_sender: Dict[Tuple[str, str], List[Dict]] = {}
+        # Кошелек -> время блока последнего перевода (мс), курсор опроса
+        self._cursors: Dict[str, int] = {}
+        self._refreshed: Dict[str, float] = {}
+        # Кошелек -> число добавленных переводов (версия для ETag ответов о кошельке)
+        self._versions: Dict[str, int] = {}
+        self.counters = {'added': 0, 'evicted': 0, 'polls': 0, 'pages': 0, 'full_pages': 0}
+
+    def add(self, transfers: Iterable[Dict]) -> int:
+        """Добавить переводы (формат get_new_transfers); повторы по tx_hash пропускаются"""
+        return len(self._add(transfers))
+
+    def _add(self, transfers: Iterable[Dict]) -> List[Dict]:
+        added = []
+        with self._lock:
+            for transfer in transfers:
+                wallet = transfer.get('to')
+                if not wallet or transfer['tx_hash'] in self._transfers:
+                    continue
+                self._transfers[transfer['tx_hash']] = transfer
+                self._by_amount.setdefault((wallet, to_units(transfer['amount'])), []).append(transfer)
+                self._by_sender.setdefault((wallet, transfer.get('from', '')), []).append(transfer)
+                self._cursors[wallet] = max(self._cursors.get(wallet, 0), transfer.get('timestamp') or 0)
+                self._versions[wallet] = self._versions.get(wallet, 0) + 1
+                added.append(transfer)
+            self.counters['added'] += len(added)
+            self._evict(time.time())
+        return added
+
+    def _unindex(self, index: Dict, key: Tuple, transfer: Dict):
+        bucket = index.get(key)
+        if bucket is None:
+            return
+        bucket[:] = [t for t in bucket if t is not transfer]
+        if not bucket:
+            del index[key]
+
+    def _evict(self, now: float):
+        """Вытеснить переводы старше max_age и сверх max_size (под self._lock)"""
+        oldest_ms = (now - self.max_age) * 1000
+        while self._transfers:
+            tx_hash, transfer = next(iter(self._transfers.items()))
+            if len(self._transfers) <= self.max_size and (transfer.get('timestamp') or 0) >= oldest_ms:
+                break
+            del self._transfers[tx_hash]
+            wallet = transfer['to']
+            self._unindex(self._by_amount, (wallet, to_units(transfer['amount'])), transfer)
+            self._unindex(self._by_sender, (wallet, transfer.get('from', '')), transfer)
+            self.counters['evicted'] += 1
+
+    def refresh(self, tracker, wallet_address: str) -> List[Dict]:
+        """
+        Опросить кошелек с курсора и дополнить окно (вызывается фоновой задачей)
+
+        Возвращает новые, ранее не виденные переводы. Полная страница, не
+        дошедшая до курсора, значит, что между опросами пришло больше
+        poll_limit переводов: следующая страница запрашивается с
+        max_timestamp - временем самого старого перевода страницы (переводы
+        на границе придут повторно и отсеются по tx_hash). Первый опрос
+        кошелька берет одну страницу. Если за max_pages страниц курсор не
+        достигнут, часть переводов может не попасть в окно.
+        """
+        with self._lock:
+            cursor = self._cursors.get(wallet_address)
+        min_timestamp = max(0, cursor - self.overlap_ms) if cursor else None
+        page = tracker.get_new_transfers(wallet_address, min_timestamp, limit=self.poll_limit)
+        transfers = list(page)
+        pages = 1
+        max_timestamp = None
+        truncated = False
+        while cursor and len(page) >= self.poll_limit:
+            oldest = min(t.get('timestamp') or 0 for t in page)
+            if oldest <= cursor:
+                break
+            # Вся страница в одну миллисекунду - max_timestamp дальше не сдвинуть
+            if oldest == max_timestamp or pages >= self.max_pages:
+                truncated = True
+                break
+            max_timestamp = oldest
+            page = tracker.get_new_transfers(wallet_address, min_timestamp, limit=self.poll_limit,
+                                             max_timestamp=max_timestamp)
+            transfers += page
+            pages += 1
+
+        with self._lock:
+            self.counters['polls'] += 1
+            self.counters['pages'] += pages
+            self._refreshed[wallet_address] = time.time()
+            if truncated:
+                self.counters['full_pages'] += 1
+                logger.warning(f"Окно переводов {wallet_address}: {pages} полных страниц не дошли до курсора, "
+                               f"часть переводов могла не попасть в окно")
+        return self._add(transfers)
+
+    def is_ready(self, wallet_address: str) -> bool:
+        """Кошелек уже опрашивался - поиск по окну достоверен"""
+        with self._lock:
+            return wallet_address in self._refreshed
+
+    def version(self, wallet_address: str) -> int:
+        """Счетчик переводов, добавленных на кошелек (растет с каждым новым переводом)"""
+        with self._lock:
+            return self._versions.get(wallet_address, 0)
+
+    def by_amount(self, wallet_address: str, amount: float, since_ms: int = 0) -> List[Dict]:
+        """Переводы на кошелек с точной суммой (не раньше since_ms)"""
+        with self._lock:
+            bucket = self._by_amount.get((wallet_address, to_units(amount)), ())
+            return [t for t in bucket if (t.get('timestamp') or 0) >= since_ms]
+
+    def by_sender(self, wallet_address: str, sender: str, amount: float = None,
+                  tolerance: float = 0.01) -> List[Dict]:
+        """Переводы на кошелек от отправителя (при amount - в пределах допуска)"""
+        with self._lock:
+            bucket = list(self._by_sender.get((wallet_address, sender), ()))
+        if amount is None:
+            return bucket
+        return [t for t in bucket if abs(t['amount'] - amount) <= tolerance]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            now = time.time()
+            stats = dict(self.counters)
+            stats['transfers'] = len(self._transfers)
+            stats['wallets'] = {
+                wallet: {'cursor_ms': self._cursors.get(wallet), 'refreshed_ago': round(now - refreshed, 1)}
+                for wallet, refreshed in self._refreshed.items()
+            }
+        return stats
@@ -0,0 +1,300 @@
+"""
+Пакетный декодер TRC20 данных: вызовы transfer / transferFrom и события Transfer
+
+Работает с байтами, а не со строками: пакет переводится в один буфер одним
+вызовом bytes.fromhex. Если установлен numpy, селекторы, адреса и суммы
+извлекаются векторно индексированием по всему пакету; без numpy записи
+разбираются по одной срезами байтов.
+"""
+
+import struct
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from tron_address import hex_to_base58
+
+try:
+    import numpy as np
+except ImportError:  # numpy не обязателен, есть чистый Python путь
+    np = None
+
+SELECTOR_TRANSFER = bytes.fromhex('a9059cbb')       # transfer(address,uint256)
+SELECTOR_TRANSFER_FROM = bytes.fromhex('23b872dd')  # transferFrom(address,address,uint256)
+TRANSFER_EVENT_TOPIC = bytes.fromhex(
+    'ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+)  # Transfer(address,address,uint256)
+
+_SELECTOR_TRANSFER_HEX = SELECTOR_TRANSFER.hex()
+_SELECTOR_TRANSFER_FROM_HEX = SELECTOR_TRANSFER_FROM.hex()
+_TRANSFER_EVENT_TOPIC_HEX = TRANSFER_EVENT_TOPIC.hex()
+
+KIND_TRANSFER = 'transfer'
+KIND_TRANSFER_FROM = 'transferFrom'
+KIND_EVENT = 'event'
+
+WORD = 32
+TRANSFER_SIZE = 4 + 2 * WORD
+TRANSFER_FROM_SIZE = 4 + 3 * WORD
+
+# Раскладка вызовов: тип, селектор, размер, смещения from / to / value
+_CALL_LAYOUTS = (
+    (KIND_TRANSFER, SELECTOR_TRANSFER, TRANSFER_SIZE, None, 16, 36),
+    (KIND_TRANSFER_FROM, SELECTOR_TRANSFER_FROM, TRANSFER_FROM_SIZE, 16, 48, 68),
+)
+# Запись события: topic0, from, to, value (адреса - младшие 20 байт слова)
+_EVENT_RECORD = struct.Struct('>32x12x20s12x20s32s')
+
+# Минимальный размер группы, для которой выгодно использовать numpy
+VECTORIZE_MIN_ROWS = 64
+
+RawData = Union[str, bytes, bytearray, memoryview]
+
+
+@lru_cache(maxsize=65536)
+def _address(raw20: bytes) -> str:
+    """20 байт адреса -> base58 (адреса в пакетах сильно повторяются)"""
+    return hex_to_base58(raw20.hex())
+
+
+class TransferBatch:
+    """
+    Результат пакетного декодирования в колоночном виде
+
+    index[i] - позиция записи во входном пакете, amount[i] - сумма в
+    минимальных единицах токена (для USDT 6 знаков), адреса - 20 байт.
+    """
+
+    __slots__ = ('index', 'kind', 'from_raw', 'to_raw', 'amount', 'skipped')
+
+    def __init__(self):
+        self.index: List[int] = []
+        self.kind: List[str] = []
+        self.from_raw: List[Optional[bytes]] = []
+        self.to_raw: List[bytes] = []
+        self.amount: List[int] = []
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def rows(self, decimals: int = 6) -> Iterator[Dict]:
+        """Записи в виде словарей с base58 адресами"""
+        scale = 10 ** decimals
+        for i in range(len(self.index)):
+            from_raw = self.from_raw[i]
+            yield {
+                'index': self.index[i],
+                'type': self.kind[i],
+                'from': _address(from_raw) if from_raw is not None else None,
+                'to': _address(self.to_raw[i]),
+                'value': self.amount[i],
+                'amount': self.amount[i] / scale,
+            }
+
+
+def _hex(item: str) -> str:
+    return item[2:] if item.startswith('0x') else item
+
+
+def _split(blob: bytes, size: int) -> List[bytes]:
+    """Разрезать буфер на записи фиксированного размера"""
+    return [blob[i:i + size] for i in range(0, len(blob), size)]
+
+
+def _amounts(words: bytes) -> List[int]:
+    """uint256 суммы из склеенных 32-байтовых слов"""
+    if np is not None and len(words) >= VECTORIZE_MIN_ROWS * WORD:
+        table = np.frombuffer(words, dtype=np.uint8).reshape(-1, WORD)
+        # Старшие 24 байта нулевые - сумма помещается в uint64
+        if not table[:, :WORD - 8].any():
+            return np.ascontiguousarray(table[:, WORD - 8:]).view('>u8').ravel().tolist()
+
+    from_bytes = int.from_bytes
+    return [from_bytes(words[i:i + WORD], 'big') for i in range(0, len(words), WORD)]
+
+
+def _append_rows(batch: 'TransferBatch', kind: str, positions: List[int],
+                 to_blob: bytes, amount_words: bytes, from_blob: bytes = None):
+    """Добавить в результат группу записей одного типа"""
+    batch.index.extend(positions)
+    batch.kind.extend([kind] * len(positions))
+    batch.to_raw.extend(_split(to_blob, 20))
+    batch.from_raw.extend(_split(from_blob, 20) if from_blob is not None else [None] * len(positions))
+    batch.amount.extend(_amounts(amount_words))
+
+
+def _decode_record(batch: 'TransferBatch', position: int, data: bytes):
+    """Разбор одного вызова (путь без numpy и записи нестандартной длины)"""
+    selector = data[:4]
+    if len(data) >= TRANSFER_SIZE and selector == SELECTOR_TRANSFER:
+        from_raw, to_raw, word = None, data[16:36], data[36:68]
+        kind = KIND_TRANSFER
+    elif len(data) >= TRANSFER_FROM_SIZE and selector == SELECTOR_TRANSFER_FROM:
+        from_raw, to_raw, word = data[16:36], data[48:68], data[68:100]
+        kind = KIND_TRANSFER_FROM
+    else:
+        batch.skipped += 1
+        return
+    batch.index.append(position)
+    batch.kind.append(kind)
+    batch.from_raw.append(from_raw)
+    batch.to_raw.append(to_raw)
+    batch.amount.append(int.from_bytes(word, 'big'))
+
+
+def _decode_calls_vectorized(calls: Sequence[RawData], batch: 'TransferBatch'):
+    """
+    Векторный разбор пакета через numpy
+
+    Весь пакет переводится в один буфер, селекторы, адреса и суммы
+    извлекаются индексированием массивов без цикла по записям.
+    """
+    if isinstance(calls[0], str):
+        joined = ''.join(calls)
+        if 'x' in joined:
+            # В hex не бывает 'x' - значит, в пакете есть префиксы 0x
+            calls = [_hex(call) for call in calls]
+            joined = ''.join(calls)
+        buffer = bytes.fromhex(joined)
+        hex_lengths = np.fromiter(map(len, calls), dtype=np.int64, count=len(calls))
+        if (hex_lengths & 1).any():
+            raise ValueError("Нечетная длина hex записи")
+        lengths = hex_lengths // 2
+    else:
+        buffer = b''.join(calls)
+        lengths = np.fromiter(map(len, calls), dtype=np.int64, count=len(calls))
+
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts = np.zeros(len(calls), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+
+    # Селектор как uint32 для записей длиной от 4 байт
+    selectors = np.zeros(len(calls), dtype=np.uint32)
+    has_selector = lengths >= 4
+    head = starts[has_selector]
+    selectors[has_selector] = (
+        (data[head].astype(np.uint32) << 24) | (data[head + 1].astype(np.uint32) << 16)
+        | (data[head + 2].astype(np.uint32) << 8) | data[head + 3]
+    )
+
+    recognized = np.zeros(len(calls), dtype=bool)
+    for kind, selector, size, from_offset, to_offset, amount_offset in _CALL_LAYOUTS:
+        mask = (selectors == int.from_bytes(selector, 'big')) & (lengths >= size)
+        rows = np.nonzero(mask)[0]
+        recognized |= mask
+        if not len(rows):
+            continue
+        # Окна по size байт над буфером без копирования; копируются только нужные строки
+        table = np.lib.stride_tricks.sliding_window_view(data, size)[starts[rows]]
+        from_blob = table[:, from_offset:from_offset + 20].tobytes() if from_offset is not None else None
+        _append_rows(batch, kind, rows.tolist(),
+                     table[:, to_offset:to_offset + 20].tobytes(),
+                     table[:, amount_offset:amount_offset + WORD].tobytes(),
+                     from_blob)
+
+    batch.skipped += int(len(calls) - recognized.sum())
+
+
+def decode_calls(calls: Sequence[RawData]) -> TransferBatch:
+    """
+    Декодировать пакет данных TriggerSmartContract (поле parameter.value.data)
+
+    Распознаются transfer и transferFrom, остальные вызовы пропускаются
+    (учитываются в batch.skipped). Записи сгруппированы по типу вызова,
+    batch.index указывает позицию во входном пакете.
+    """
+    batch = TransferBatch()
+    if not calls:
+        return batch
+
+    if np is not None and len(calls) >= VECTORIZE_MIN_ROWS:
+        try:
+            _decode_calls_vectorized(calls, batch)
+            return batch
+        except (ValueError, TypeError):
+            # Некорректный hex или смешанные типы - разбираем по одной записи
+            batch = TransferBatch()
+
+    for position, call in enumerate(calls):
+        try:
+            data = bytes.fromhex(_hex(call)) if isinstance(call, str) else bytes(call)
+        except ValueError:
+            batch.skipped += 1
+            continue
+        _decode_record(batch, position, data)
+
+    return batch
+
+
+def decode_event_logs(logs: Sequence[Dict]) -> TransferBatch:
+    """
+    Декодировать пакет логов событий Transfer
+
+    Каждый лог - словарь {'topics': [topic0, from, to], 'data': value} в
+    hex (формат log в gettransactioninfobyid и событий ноды). Логи других
+    событий и испорченные записи (не hex, topic не 32 байта) пропускаются.
+    """
+    batch = TransferBatch()
+    records, positions = [], []
+
+    for position, log in enumerate(logs):
+        topics = log.get('topics') or []
+        data = _hex(log.get('data') or '')
+        if (len(topics) < 3 or _hex(topics[0]).lower() != _TRANSFER_EVENT_TOPIC_HEX
+                or len(data) < 2 * WORD):
+            batch.skipped += 1
+            continue
+        # topic0, from, to и value склеиваются в одну запись 128 байт
+        try:
+            record = bytes.fromhex(_hex(topics[0]) + _hex(topics[1]) + _hex(topics[2]) + data[:2 * WORD])
+        except (ValueError, TypeError, AttributeError):
+            batch.skipped += 1
+            continue
+        if len(record) != _EVENT_RECORD.size:
+            batch.skipped += 1
+            continue
+        records.append(record)
+        positions.append(position)
+
+    if not records:
+        return batch
+
+    buffer = b''.join(records)
+    # from, to и value лежат по фиксированным смещениям записи 128 байт
+    if np is not None:
+        table = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, _EVENT_RECORD.size)
+        from_blob = table[:, 44:64].tobytes()
+        to_blob = table[:, 76:96].tobytes()
+        words = table[:, 96:128].tobytes()
+    else:
+        from_raw, to_raw, values = zip(*_EVENT_RECORD.iter_unpack(buffer))
+        from_blob, to_blob, words = b''.join(from_raw), b''.join(to_raw), b''.join(values)
+
+    _append_rows(batch, KIND_EVENT, positions, to_blob, words, from_blob)
+    return batch
+
+
+def decode_call(data: RawData) -> Optional[Dict]:
+    """Декодировать один вызов (обертка над decode_calls)"""
+    batch = decode_calls([data])
+    for row in batch.rows():
+        return row
+    return None
+
+
+def iter_decoded(calls: Iterable[RawData], chunk_size: int = 50000) -> Iterator[Dict]:
+    """Потоковое декодирование большого набора вызовов по частям"""
+    chunk = []
+    base = 0
+    for call in calls:
+        chunk.append(call)
+        if len(chunk) >= chunk_size:
+            for row in decode_calls(chunk).rows():
+                row['index'] += base
+                yield row
+            base += len(chunk)
+            chunk = []
+    if chunk:
+        for row in decode_calls(chunk).rows():
+            row['index'] += base
+            yield row
@@ -0,0 +1,119 @@
+"""
+Локальная работа с Tron адресами: base58check, проверка контрольной суммы
+и преобразование hex <-> base58 без запросов к сети
+"""
+
+import hashlib
+from typing import Union
+
+ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_ALPHABET_INDEX = {char: index for index, char in enumerate(ALPHABET)}
+
+# Префикс адресов основной сети Tron (base58 адрес начинается с 'T')
+ADDRESS_PREFIX = 0x41
+ADDRESS_SIZE = 21  # префикс + 20 байт
+CHECKSUM_SIZE = 4
+
+
+def _checksum(payload: bytes) -> bytes:
+    """Первые 4 байта двойного SHA256"""
+    return hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:CHECKSUM_SIZE]
+
+
+def b58encode(data: bytes) -> str:
+    """Кодирование байтов в base58"""
+    number = int.from_bytes(data, 'big')
+    encoded = []
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded.append(ALPHABET[remainder])
+
+    # Ведущие нулевые байты кодируются символом '1'
+    leading_zeros = len(data) - len(data.lstrip(b'\0'))
+    return '1' * leading_zeros + ''.join(reversed(encoded))
+
+
+def b58decode(text: str) -> bytes:
+    """Декодирование base58 в байты"""
+    number = 0
+    for char in text:
+        index = _ALPHABET_INDEX.get(char)
+        if index is None:
+            raise ValueError(f"Недопустимый символ base58: {char!r}")
+        number = number * 58 + index
+
+    leading_ones = len(text) - len(text.lstrip('1'))
+    body = number.to_bytes((number.bit_length() + 7) // 8, 'big') if number else b''
+    return b'\0' * leading_ones + body
+
+
+def b58check_encode(payload: bytes) -> str:
+    """base58 с контрольной суммой"""
+    return b58encode(payload + _checksum(payload))
+
+
+def b58check_decode(text: str) -> bytes:
+    """
+    Декодирование base58check с проверкой контрольной суммы
+
+    Raises:
+        ValueError: если строка не base58 или контрольная сумма не совпала
+    """
+    raw = b58decode(text)
+    if len(raw) <= CHECKSUM_SIZE:
+        raise ValueError("Слишком короткая строка base58check")
+
+    payload, checksum = raw[:-CHECKSUM_SIZE], raw[-CHECKSUM_SIZE:]
+    if _checksum(payload) != checksum:
+        raise ValueError("Неверная контрольная сумма адреса")
+    return payload
+
+
+def is_valid_address(address: str) -> bool:
+    """Проверка Tron адреса (base58, префикс 0x41, контрольная сумма)"""
+    if not isinstance(address, str) or len(address) != 34 or not address.startswith('T'):
+        return False
+    try:
+        payload = b58check_decode(address)
+    except ValueError:
+        return False
+    return len(payload) == ADDRESS_SIZE and payload[0] == ADDRESS_PREFIX
+
+
+def to_base58(address: Union[str, bytes]) -> str:
+    """
+    Привести адрес к base58 виду
+
+    Принимает base58 адрес, hex с префиксом 41 (42 символа), hex без
+    префикса (40 символов, как в ABI данных) или 20/21 байт.
+    """
+    if isinstance(address, (bytes, bytearray, memoryview)):
+        raw = bytes(address)
+    elif address.startswith('T') and len(address) == 34:
+        if not is_valid_address(address):
+            raise ValueError(f"Неверный Tron адрес: {address}")
+        return address
+    else:
+        hex_address = address[2:] if address.startswith('0x') else address
+        raw = bytes.fromhex(hex_address)
+
+    if len(raw) == ADDRESS_SIZE - 1:
+        raw = bytes([ADDRESS_PREFIX]) + raw
+    if len(raw) != ADDRESS_SIZE or raw[0] != ADDRESS_PREFIX:
+        raise ValueError(f"Неверная длина или префикс адреса: {raw.hex()}")
+    return b58check_encode(raw)
+
+
+def hex_to_base58(hex_address: str) -> str:
+    """hex адрес (с префиксом 41 или без) -> base58"""
+    return to_base58(hex_address)
+
+
+def base58_to_hex(address: str) -> str:
+    """base58 адрес -> hex с префиксом 41"""
+    if len(address) == 42 and address.startswith('41'):
+        return address.lower()
+    payload = b58check_decode(address)
+    if len(payload) != ADDRESS_SIZE or payload[0] != ADDRESS_PREFIX:
+        raise ValueError(f"Неверный Tron адрес: {address}")
+    return payload.hex()
@@ -0,0 +1,376 @@
+"""
+Реестр провайдеров Tron API (TronGrid, TronScan, собственная нода)
+Маршрутизация по типу вызова, оценка здоровья (EWMA задержки и ошибок),
+circuit breaker'ы и hedged-запросы для чувствительных к задержке вызовов
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Типы вызовов, которые выполняет TronTracker
+CALL_ACCOUNT = 'account'
+CALL_TRC20_TRANSACTIONS = 'trc20_transactions'
+CALL_TRANSACTION = 'transaction'
+CALL_BALANCE = 'balance'
+CALL_BLOCK = 'block'
+
+# Виды провайдеров: формат API определяет, какие пути и ответы он понимает
+KIND_TRONGRID = 'trongrid'  # TronGrid и совместимые с ним /v1 API (в т.ч. своя нода)
+KIND_TRONSCAN = 'tronscan'
+
+# Маршруты по умолчанию: порядок - приоритет при равном здоровье
+DEFAULT_ROUTES = {
+    CALL_ACCOUNT: ['trongrid', 'node'],
+    CALL_TRC20_TRANSACTIONS: ['trongrid', 'node'],
+    CALL_TRANSACTION: ['trongrid', 'node'],
+    CALL_BALANCE: ['tronscan', 'trongrid', 'node'],
+    CALL_BLOCK: ['trongrid', 'node'],
+}
+
+
+class ProviderError(Exception):
+    """Ни один провайдер не смог обработать запрос"""
+
+    def __init__(self, call_type: str, message: str, last_response=None, available: bool = True):
+        super().__init__(f"{call_type}: {message}")
+        self.call_type = call_type
+        self.last_response = last_response
+        # False - запрос никуда не отправлялся, все circuit breaker'ы открыты
+        self.available = available
+
+
+class TronProvider:
+    """Описание одного upstream провайдера"""
+
+    def __init__(self, name: str, base_url: str, kind: str = KIND_TRONGRID,
+                 api_key: Optional[str] = None, timeout: float = None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.kind = kind
+        self.timeout = timeout if timeout is not None else config.TRON_API_TIMEOUT
+        self.headers = {'Content-Type': 'application/json'}
+        if api_key:
+            self.headers['TRON-PRO-API-KEY'] = api_key
+        self.health = ProviderHealth()
+
+    def url(self, path: str) -> str:
+        """Полный URL для пути API"""
+        return f"{self.base_url}{path}"
+
+    def __repr__(self):
+        return f"TronProvider({self.name!r}, {self.base_url!r}, kind={self.kind!r})"
+
+
+class ProviderHealth:
+    """
+    Здоровье провайдера: EWMA задержки, EWMA доли ошибок и circuit breaker
+
+    Состояния breaker'а:
+    - closed: запросы идут как обычно
+    - open: провайдер пропускается до истечения open_seconds
+    - half_open: пропускается один пробный запрос, по его итогу breaker
+      закрывается или снова открывается
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, alpha: float = None, error_threshold: float = None,
+                 consecutive_failures: int = None, min_samples: int = 5,
+                 open_seconds: float = None):
+        self.alpha = alpha if alpha is not None else config.PROVIDER_EWMA_ALPHA
+        self.error_threshold = (error_threshold if error_threshold is not None
+                                else config.PROVIDER_ERROR_THRESHOLD)
+        self.consecutive_limit = (consecutive_failures if consecutive_failures is not None
+                                  else config.PROVIDER_CONSECUTIVE_FAILURES)
+        self.min_samples = min_samples
+        self.open_seconds = (open_seconds if open_seconds is not None
+                             else config.PROVIDER_OPEN_SECONDS)
+
+        self.latency_ewma = None
+        self.error_ewma = 0.0
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def _update_latency(self, latency: float):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = self.alpha * latency + (1 - self.alpha) * self.latency_ewma
+
+    def record_success(self, latency: float):
+        """Учесть успешный ответ"""
+        with self._lock:
+            self._update_latency(latency)
+            self.error_ewma = (1 - self.alpha) * self.error_ewma
+            self.samples += 1
+            self.successes += 1
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker закрыт после успешного пробного запроса")
+            self.state = self.CLOSED
+            self.probe_in_flight = False
+
+    def record_failure(self, latency: float):
+        """Учесть ошибку (таймаут, 5xx, 429)"""
+        with self._lock:
+            self._update_latency(latency)
+            self.error_ewma = self.alpha + (1 - self.alpha) * self.error_ewma
+            self.samples += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+
+            trip = (self.state == self.HALF_OPEN
+                    or self.consecutive_failures >= self.consecutive_limit
+                    or (self.samples >= self.min_samples
+                        and self.error_ewma >= self.error_threshold))
+            if trip:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def try_acquire(self) -> bool:
+        """Можно ли отправить запрос этому провайдеру прямо сейчас"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+            # half_open: только один пробный запрос одновременно
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+
+    def is_available(self) -> bool:
+        """Проверка без резервирования пробного запроса"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at >= self.open_seconds
+            return not self.probe_in_flight
+
+    def score(self) -> float:
+        """Оценка для сортировки: меньше - лучше"""
+        latency = self.latency_ewma if self.latency_ewma is not None else 0.0
+        return latency * (1 + 4 * self.error_ewma)
+
+    def snapshot(self) -> Dict:
+        """Текущее состояние для мониторинга"""
+        return {
+            'state': self.state,
+            'latency_ewma_ms': round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            'error_rate': round(self.error_ewma, 3),
+            'successes': self.successes,
+            'failures': self.failures,
+        }
+
+
+def is_provider_failure(response) -> bool:
+    """Ответ, который означает проблему провайдера, а не данных"""
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class ProviderRouter:
+    """
+    Выбор провайдера для каждого вызова
+
+    Кандидаты берутся из маршрута типа вызова, провайдеры с открытым
+    breaker'ом пропускаются, остальные сортируются по здоровью. Для
+    вызовов из hedged_calls, если основной провайдер не ответил за
+    hedge-задержку, параллельно отправляется запрос следующему.
+    """
+
+    def __init__(self, providers: List[TronProvider], routes: Dict[str, List[str]] = None,
+                 hedged_calls: Optional[List[str]] = None, hedge_delay: float = None,
+                 max_workers: int = 8):
+        self.providers = {provider.name: provider for provider in providers}
+        self.routes = routes or DEFAULT_ROUTES
+        self.hedged_calls = set(hedged_calls if hedged_calls is not None else config.TRON_HEDGED_CALLS)
+        self.hedge_delay = hedge_delay if hedge_delay is not None else config.TRON_HEDGE_DELAY
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tron-hedge')
+
+    def candidates(self, call_type: str) -> List[TronProvider]:
+        """Провайдеры для вызова в порядке предпочтения"""
+        route = self.routes.get(call_type)
+        if route is None:
+            route = [name for name, p in self.providers.items() if p.kind == KIND_TRONGRID]
+
+        available = []
+        for position, name in enumerate(route):
+            provider = self.providers.get(name)
+            if provider and provider.health.is_available():
+                available.append((provider.health.score(), position, provider))
+
+        # Провайдеры без статистики сохраняют порядок маршрута
+        available.sort(key=lambda item: (item[0], item[1]))
+        return [provider for _, _, provider in available]
+
+    def _attempt(self, provider: TronProvider, send: Callable) -> Tuple[TronProvider, object, Optional[Exception]]:
+        """Один запрос к провайдеру с учетом здоровья"""
+        started = time.monotonic()
+        try:
+            response = send(provider)
+        except Exception as e:
+            # Не только сетевые ошибки: испорченное тело (ValueError, KeyError) -
+            # тоже сбой провайдера, иначе пробный запрос half-open не завершится
+            provider.health.record_failure(time.monotonic() - started)
+            return provider, None, e
+
+        latency = time.monotonic() - started
+        if is_provider_failure(response):
+            provider.health.record_failure(latency)
+        else:
+            provider.health.record_success(latency)
+        return provider, response, None
+
+    def _hedge_delay_for(self, provider: TronProvider) -> float:
+        """Сколько ждать основной провайдер перед hedged-запросом"""
+        latency = provider.health.latency_ewma
+        if latency is None:
+            return self.hedge_delay
+        return max(self.hedge_delay, min(latency * 2, provider.timeout))
+
+    def execute(self, call_type: str, send: Callable,
+                failover: Optional[Callable] = None) -> Tuple[TronProvider, object]:
+        """
+        Выполнить вызов через лучший доступный провайдер
+
+        Args:
+            call_type: Тип вызова (определяет маршрут)
+            send: Функция provider -> requests.Response
+            failover: (провайдер, ответ) -> True, если этот ответ (например,
+                4xx TronScan) нужно попробовать получить у следующего
+                провайдера; здоровье провайдера при этом не страдает
+
+        Returns:
+            (провайдер, ответ). Ответы 4xx возвращаются как есть (если
+            failover не просит следующего провайдера; когда следующих нет -
+            последний такой ответ), ошибки провайдера (таймаут, 429, 5xx)
+            приводят к переходу к следующему.
+        """
+        candidates = self.candidates(call_type)
+        if not candidates:
+            raise ProviderError(call_type, "нет доступных провайдеров (все circuit breaker'ы открыты)",
+                                available=False)
+
+        if call_type in self.hedged_calls and len(candidates) > 1:
+            return self._execute_hedged(call_type, candidates, send, failover)
+
+        last_error = None
+        last_response = None
+        rejected = None
+        for provider in candidates:
+            if not provider.health.try_acquire():
+                continue
+            provider, response, error = self._attempt(provider, send)
+            if error is None and not is_provider_failure(response):
+                if failover is None or not failover(provider, response):
+                    return provider, response
+                rejected = (provider, response)
+                logger.warning(f"Провайдер {provider.name} отклонил {call_type} (HTTP {response.status_code}), "
+                               f"пробуем следующий")
+                continue
+            last_error = error or f"HTTP {response.status_code}"
+            last_response = response
+            logger.warning(f"Провайдер {provider.name} не ответил на {call_type}: {last_error}")
+
+        if rejected is not None:
+            return rejected
+        raise ProviderError(call_type, f"все провайдеры недоступны, последняя ошибка: {last_error}",
+                            last_response=last_response)
+
+    def _execute_hedged(self, call_type: str, candidates: List[TronProvider],
+                        send: Callable, failover: Optional[Callable] = None) -> Tuple[TronProvider, object]:
+        """Hedged-вызов: запасной провайдер подключается, если основной медлит"""
+        pending = set()
+        remaining = list(candidates)
+        last_error = None
+        last_response = None
+        rejected = None
+
+        def launch_next() -> bool:
+            while remaining:
+                provider = remaining.pop(0)
+                if provider.health.try_acquire():
+                    pending.add(self._executor.submit(self._attempt, provider, send))
+                    return True
+            return False
+
+        launch_next()
+        while pending:
+            primary_delay = self._hedge_delay_for(candidates[0]) if remaining else None
+            done, _ = wait(pending, timeout=primary_delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # Основной провайдер медлит - отправляем hedged-запрос
+                launch_next()
+                continue
+
+            for future in done:
+                pending.discard(future)
+                provider, response, error = future.result()
+                if error is None and not is_provider_failure(response):
+                    if failover is None or not failover(provider, response):
+                        return provider, response
+                    rejected = (provider, response)
+                    logger.warning(f"Провайдер {provider.name} отклонил {call_type} "
+                                   f"(HTTP {response.status_code}), пробуем следующий")
+                    continue
+                last_error = error or f"HTTP {response.status_code}"
+                last_response = response
+                logger.warning(f"Провайдер {provider.name} не ответил на {call_type}: {last_error}")
+
+            if not pending:
+                launch_next()
+
+        if rejected is not None:
+            return rejected
+        raise ProviderError(call_type, f"все провайдеры недоступны, последняя ошибка: {last_error}",
+                            last_response=last_response)
+
+    def health_report(self) -> Dict[str, Dict]:
+        """Здоровье всех провайдеров"""
+        return {name: provider.health.snapshot() for name, provider in self.providers.items()}
+
+
+def parse_routes(spec: str) -> Dict[str, List[str]]:
+    """
+    Разбор переопределения маршрутов из строки вида
+    "balance=tronscan,trongrid;account=node,trongrid"
+    """
+    routes = dict(DEFAULT_ROUTES)
+    for part in (spec or '').split(';'):
+        if '=' not in part:
+            continue
+        call_type, names = part.split('=', 1)
+        routes[call_type.strip()] = [name.strip() for name in names.split(',') if name.strip()]
+    return routes
+
+
+def build_default_router() -> ProviderRouter:
+    """Маршрутизатор из настроек config.py"""
+    providers = [
+        TronProvider('trongrid', config.TRON_API_URL, KIND_TRONGRID, api_key=config.TRON_API_KEY),
+        TronProvider('tronscan', config.TRONSCAN_API_URL, KIND_TRONSCAN, api_key=config.TRONSCAN_API_KEY),
+    ]
+    if config.TRON_NODE_URL:
+        providers.append(TronProvider('node', config.TRON_NODE_URL, KIND_TRONGRID, api_key=config.TRON_NODE_API_KEY))
+
+    return ProviderRouter(providers, routes=parse_routes(config.TRON_PROVIDER_ROUTES))
@@ -1,72 +1,184 @@
 import requests
 import time
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 from datetime import datetime, timedelta
 import config
+import metrics
+from tron_address import is_valid_address, to_base58
+from trc20_decoder import decode_call
+from request_coalescer import RequestCoalescer
+from request_executor import RequestExecutor, TronAPIError, UpstreamResponseError
+from tron_providers import (
+    ProviderRouter, build_default_router, KIND_TRONSCAN,
+    CALL_ACCOUNT, CALL_TRC20_TRANSACTIONS, CALL_TRANSACTION, CALL_BALANCE, CALL_BLOCK
+)
+
+def tronscan_rejected(provider, response) -> bool:
+    """4xx TronScan (лимит без ключа, неподдерживаемый адрес) - спросить следующего провайдера"""
+    return provider.kind == KIND_TRONSCAN and 400 <= response.status_code < 500
 
 class TronTracker:
-    def __init__(self):
+    """
+    Клиент Tron API
+    
+    Ошибки запросов не превращаются в пустой результат: методы поднимают
+    TronAPIError (TransientError - временная недоступность, можно повторить
+    в следующем цикле; UpstreamResponseError - некорректный ответ).
+    """
+    
+    def __init__(self, router: Optional[ProviderRouter] = None,
+                 coalescer: Optional[RequestCoalescer] = None,
+                 executor: Optional[RequestExecutor] = None):
         self.api_url = config.TRON_API_URL
         self.api_key = config.TRON_API_KEY
         self.headers = {
             'TRON-PRO-API-KEY': self.api_key,
             'Content-Type': 'application/json'
         } if self.api_key else {'Content-Type': 'application/json'}
+        # Маршрутизатор провайдеров: TronGrid, TronScan, своя нода
+        self.router = router or build_default_router()
+        # Кэш проверки существования адресов в сети: адрес -> (результат, время)
+        self._existence_cache: Dict[str, tuple] = {}
+        # Одинаковые параллельные запросы делят один вызов upstream
+        self.coalescer = coalescer or RequestCoalescer()
+        # Повторы временных ошибок с backoff и бюджетом на цикл
+        self.executor = executor or RequestExecutor()
     
-    def get_account_info(self, address: str) -> Optional[Dict]:
-        """Получить информацию об аккаунте"""
-        try:
-            url = f"{self.api_url}/v1/accounts/{address}"
-            response = requests.get(url, headers=self.headers, timeout=10)
-            
-            if response.status_code == 200:
-                return response.json()
+    def _get(self, call_type: str, path, params: Optional[Dict] = None, cache_key: str = None,
+             accept: tuple = (200,), failover: Optional[Callable] = None):
+        """
+        GET запрос через маршрутизатор провайдеров с повторами
+        
+        path - путь API или функция provider -> (путь, параметры), если
+        путь зависит от вида провайдера (тогда для объединения запросов
+        нужен cache_key). Возвращает (провайдер, ответ) со статусом из
+        accept, иначе поднимает TronAPIError. failover - см.
+        ProviderRouter.execute.
+        """
+        def send(provider):
+            if callable(path):
+                url_path, query = path(provider)
             else:
-                print(f"Ошибка получения информации об аккаунте: {response.status_code}")
-                return None
-                
-        except Exception as e:
-            print(f"Ошибка при запросе к Tron API: {e}")
-            return None
+                url_path, query = path, params
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                response = requests.get(provider.url(url_path), headers=provider.headers,
+                                        params=query, timeout=provider.timeout)
+                status = response.status_code
+                return response
+            finally:
+                metrics.observe_upstream(provider.name, call_type, status, time.perf_counter() - started)
+        
+        def execute():
+            return self.executor.execute(call_type, lambda: self.router.execute(call_type, send, failover), accept)
+        
+        if callable(path) and cache_key is None:
+            return execute()
+        
+        key = (call_type, cache_key or path, tuple(sorted((params or {}).items())), accept)
+        # В micro-cache попадают только успешные ответы
+        return self.coalescer.call(key, execute, cacheable=lambda result: result[1].status_code == 200)
     
-    def get_trc20_transactions(self, address: str, limit: int = 50) -> List[Dict]:
-        """Получить TRC20 транзакции для адреса"""
+    @staticmethod
+    def _json(call_type: str, response):
+        """Тело ответа; неразборчивый JSON - постоянная ошибка"""
         try:
-            url = f"{self.api_url}/v1/accounts/{address}/transactions/trc20"
-            params = {
-                'limit': limit,
-                'contract_address': config.USDT_CONTRACT_ADDRESS
-            }
-            
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('data', [])
-            else:
-                print(f"Ошибка получения транзакций: {response.status_code}")
-                return []
-                
-        except Exception as e:
-            print(f"Ошибка при запросе транзакций: {e}")
-            return []
+            return response.json()
+        except ValueError as e:
+            raise UpstreamResponseError(call_type, f"некорректный JSON: {e}", response.status_code)
+    
+    def coalescing_stats(self) -> Dict[str, int]:
+        """Сколько вызовов upstream сэкономлено объединением запросов"""
+        return self.coalescer.stats()
+    
+    def retry_stats(self) -> Dict[str, int]:
+        """Счетчики повторов и отказов"""
+        return self.executor.stats()
+    
+    def start_cycle(self):
+        """Начало цикла опроса: восстанавливает бюджет повторов"""
+        self.executor.new_cycle()
+    
+    def get_account_info(self, address: str) -> Dict:
+        """Получить информацию об аккаунте"""
+        _, response = self._get(CALL_ACCOUNT, f"/v1/accounts/{address}")
+        return self._json(CALL_ACCOUNT, response)
+    
+    def get_trc20_transactions(self, address: str, limit: int = 50,
+                               min_timestamp: Optional[int] = None, max_timestamp: Optional[int] = None,
+                               only_to: bool = False) -> List[Dict]:
+        """
+        Получить TRC20 транзакции для адреса, новые первыми
+        
+        min_timestamp / max_timestamp (мс, включительно) - границы выборки,
+        max_timestamp служит курсором следующей страницы; only_to - только
+        входящие.
+        """
+        params = {
+            'limit': limit,
+            'contract_address': config.USDT_CONTRACT_ADDRESS
+        }
+        if min_timestamp:
+            params['min_timestamp'] = min_timestamp
+        if max_timestamp:
+            params['max_timestamp'] = max_timestamp
+        if only_to:
+            params['only_to'] = 'true'
+        
+        _, response = self._get(CALL_TRC20_TRANSACTIONS,
+                                f"/v1/accounts/{address}/transactions/trc20", params)
+        return self._json(CALL_TRC20_TRANSACTIONS, response).get('data', [])
     
     def get_transaction_details(self, tx_hash: str) -> Optional[Dict]:
-        """Получить детали транзакции по хешу"""
-        try:
-            url = f"{self.api_url}/v1/transactions/{tx_hash}"
-            response = requests.get(url, headers=self.headers, timeout=10)
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                print(f"Ошибка получения деталей транзакции: {response.status_code}")
-                return None
-                
-        except Exception as e:
-            print(f"Ошибка при запросе деталей транзакции: {e}")
+        """Получить детали транзакции по хешу (None - транзакция не найдена)"""
+        _, response = self._get(CALL_TRANSACTION, f"/v1/transactions/{tx_hash}", accept=(200, 404))
+        if response.status_code == 404:
             return None
+        return self._json(CALL_TRANSACTION, response)
     
+    def get_now_block(self) -> Dict:
+        """
+        Текущий блок сети: {'number', 'hash', 'timestamp'}
+        
+        Для подтверждений запрашивается один раз за цикл, а не на каждую
+        транзакцию.
+        """
+        _, response = self._get(CALL_BLOCK, "/wallet/getnowblock")
+        block = self._json(CALL_BLOCK, response)
+        header = block.get('block_header', {}).get('raw_data', {})
+        if 'number' not in header:
+            raise UpstreamResponseError(CALL_BLOCK, "в ответе нет номера блока")
+        return {
+            'number': header['number'],
+            'hash': block.get('blockID', ''),
+            'timestamp': header.get('timestamp', 0),
+        }
+
+    def get_recent_blocks(self, count: int) -> List[Dict]:
+        """
+        Последние count блоков одним запросом, по возрастанию номера
+
+        [{'number', 'hash', 'parent_hash', 'timestamp', 'transactions'}],
+        transactions - ID транзакций блока. Нода отдает не больше 100
+        блоков за запрос.
+        """
+        _, response = self._get(CALL_BLOCK, "/wallet/getblockbylatestnum", {'num': count})
+        data = self._json(CALL_BLOCK, response)
+        blocks = []
+        for block in data.get('block', []):
+            header = block.get('block_header', {}).get('raw_data', {})
+            if 'number' not in header:
+                raise UpstreamResponseError(CALL_BLOCK, "в ответе нет номера блока")
+            blocks.append({
+                'number': header['number'],
+                'hash': block.get('blockID', ''),
+                'parent_hash': header.get('parentHash', ''),
+                'timestamp': header.get('timestamp', 0),
+                'transactions': [tx.get('txID') for tx in block.get('transactions', [])],
+            })
+        return sorted(blocks, key=lambda block: block['number'])
+
     def parse_trc20_transfer(self, transaction: Dict) -> Optional[Dict]:
         """Парсинг TRC20 transfer события"""
         try:
@@ -83,199 +195,173 @@ class TronTracker:
                     parameter = log.get('parameter', {}).get('value', {})
                     contract_address = parameter.get('contract_address')
                     
-                    # Проверяем, что это наш USDT контракт
-                    if contract_address == config.USDT_CONTRACT_ADDRESS:
+                    # Проверяем, что это наш USDT контракт (нода отдает адрес в hex)
+                    if contract_address and to_base58(contract_address) == config.USDT_CONTRACT_ADDRESS:
                         data = parameter.get('data')
                         if data and len(data) >= 8:
-                            # Парсим transfer данные
-                            method = data[:8]
-                            if method == 'a9059cbb':  # transfer method signature
-                                # Извлекаем адрес получателя и сумму
-                                to_address = '41' + data[32:72]  # добавляем префикс
-                                amount_hex = data[72:136]
-                                
-                                # Конвертируем hex в decimal
-                                amount = int(amount_hex, 16) / 1000000  # USDT имеет 6 decimals
-                                
+                            # transfer / transferFrom: получатель и сумма из ABI данных
+                            decoded = decode_call(data)
+                            if decoded:
                                 return {
                                     'tx_hash': tx_hash,
-                                    'to_address': to_address,
-                                    'amount': amount,
+                                    'to_address': decoded['to'],
+                                    'amount': decoded['amount'],  # USDT имеет 6 decimals
                                     'timestamp': transaction.get('block_timestamp', 0),
-                                    'block_number': transaction.get('block_number', 0)
+                                    'block_number': transaction.get('block_number') or tx_details.get('blockNumber', 0)
                                 }
             
             return None
             
+        except TronAPIError:
+            raise
         except Exception as e:
             print(f"Ошибка парсинга TRC20 transfer: {e}")
             return None
     
     def check_new_transactions(self, wallet_address: str, last_check_time: int = None) -> List[Dict]:
         """Проверить новые транзакции с последней проверки"""
-        try:
-            transactions = self.get_trc20_transactions(wallet_address, limit=100)
-            new_transfers = []
-            
-            for tx in transactions:
-                tx_time = tx.get('block_timestamp', 0)
-                
-                # Если указано время последней проверки, фильтруем
-                if last_check_time and tx_time <= last_check_time:
-                    continue
-                
-                # Парсим transfer
-                transfer_data = self.parse_trc20_transfer(tx)
-                if transfer_data:
-                    new_transfers.append(transfer_data)
+        transactions = self.get_trc20_transactions(wallet_address, limit=100)
+        new_transfers = []
+        
+        for tx in transactions:
+            tx_time = tx.get('block_timestamp', 0)
             
-            return new_transfers
+            # Если указано время последней проверки, фильтруем
+            if last_check_time and tx_time <= last_check_time:
+                continue
             
-        except Exception as e:
-            print(f"Ошибка проверки новых транзакций: {e}")
-            return []
+            # Парсим transfer
+            transfer_data = self.parse_trc20_transfer(tx)
+            if transfer_data:
+                new_transfers.append(transfer_data)
+        
+        return new_transfers
     
-    def validate_address(self, address: str) -> bool:
-        """Валидация Tron адреса"""
-        try:
-            # Базовая проверка формата
-            if not address or len(address) != 34:
-                return False
-            
-            if not address.startswith('T'):
-                return False
-            
-            # Дополнительная проверка через API
-            account_info = self.get_account_info(address)
-            return account_info is not None
-            
-        except Exception as e:
-            print(f"Ошибка валидации адреса: {e}")
+    def validate_address(self, address: str, check_onchain: bool = False) -> bool:
+        """
+        Валидация Tron адреса
+        
+        Формат и контрольная сумма base58check проверяются локально.
+        Проверка существования аккаунта в сети выполняется только при
+        check_onchain=True, результат кэшируется. Ошибка сети при этом
+        поднимается как TronAPIError, а не считается несуществующим адресом.
+        """
+        if not is_valid_address(address):
             return False
+        
+        if not check_onchain:
+            return True
+        
+        return self.account_exists(address)
+    
+    def account_exists(self, address: str) -> bool:
+        """Существует ли аккаунт в сети (с кэшем на ADDRESS_EXISTENCE_TTL)"""
+        cached = self._existence_cache.get(address)
+        if cached and time.time() - cached[1] < config.ADDRESS_EXISTENCE_TTL:
+            return cached[0]
+        
+        # Ошибка сети поднимается и не кэшируется
+        account_info = self.get_account_info(address)
+        exists = bool(account_info.get('data'))
+        if len(self._existence_cache) >= config.ADDRESS_EXISTENCE_CACHE_SIZE:
+            self._existence_cache.clear()
+        self._existence_cache[address] = (exists, time.time())
+        return exists
     
     def get_balance(self, address: str) -> float:
         """Получить баланс USDT для адреса"""
-        try:
-            # Используем TronScan API (более надежный)
-            url = f"https://apilist.tronscanapi.com/api/account?address={address}"
-            
-            response = requests.get(url, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                # Ищем USDT в trc20token_balances
-                trc20_balances = data.get('trc20token_balances', [])
-                
-                for token in trc20_balances:
-                    if token.get('tokenId') == config.USDT_CONTRACT_ADDRESS:
-                        # USDT имеет 6 знаков после запятой
-                        balance = float(token.get('balance', 0)) / 1000000
-                        return balance
-                
-                return 0.0
-            else:
-                print(f"Ошибка TronScan API: {response.status_code}")
-                # Попробуем альтернативный метод через TronGrid
-                return self._get_balance_from_trongrid(address)
-                
-        except Exception as e:
-            print(f"Ошибка получения баланса: {e}")
-            return 0.0
+        # Провайдер выбирается маршрутизатором: TronScan, TronGrid или своя нода
+        def balance_path(provider):
+            if provider.kind == KIND_TRONSCAN:
+                return "/api/account", {'address': address}
+            return f"/v1/accounts/{address}", None
+        
+        provider, response = self._get(CALL_BALANCE, balance_path, cache_key=f"balance:{address}",
+                                       failover=tronscan_rejected)
+        data = self._json(CALL_BALANCE, response)
+        if provider.kind == KIND_TRONSCAN:
+            return self._parse_tronscan_balance(data)
+        return self._parse_trongrid_balance(data)
+    
+    def _parse_tronscan_balance(self, data: Dict) -> float:
+        """Баланс USDT из ответа TronScan /api/account"""
+        # Ищем USDT в trc20token_balances
+        trc20_balances = data.get('trc20token_balances', [])
+        
+        for token in trc20_balances:
+            if token.get('tokenId') == config.USDT_CONTRACT_ADDRESS:
+                # USDT имеет 6 знаков после запятой
+                return float(token.get('balance', 0)) / 1000000
+        
+        return 0.0
+    
+    def _parse_trongrid_balance(self, data: Dict) -> float:
+        """Баланс USDT из ответа TronGrid /v1/accounts/{address}"""
+        if 'data' in data and isinstance(data['data'], list):
+            for item in data['data']:
+                if item.get('contract_address') == config.USDT_CONTRACT_ADDRESS:
+                    return float(item.get('balance', 0)) / 1000000
+                # Формат TronGrid: trc20 - список словарей {контракт: баланс}
+                for token in item.get('trc20', []):
+                    if config.USDT_CONTRACT_ADDRESS in token:
+                        return float(token[config.USDT_CONTRACT_ADDRESS]) / 1000000
+        
+        return 0.0
     
     def _get_balance_from_trongrid(self, address: str) -> float:
         """Альтернативный метод через TronGrid API"""
-        try:
-            # Используем TronGrid API
-            url = f"{self.api_url}/v1/accounts/{address}"
-            
-            response = requests.get(url, headers=self.headers, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                # Ищем USDT в data
-                if 'data' in data and isinstance(data['data'], list):
-                    for item in data['data']:
-                        if item.get('contract_address') == config.USDT_CONTRACT_ADDRESS:
-                            balance = float(item.get('balance', 0)) / 1000000
-                            return balance
-                
-                return 0.0
-            else:
-                print(f"Ошибка TronGrid API: {response.status_code}")
-                return 0.0
-                
-        except Exception as e:
-            print(f"Ошибка TronGrid API: {e}")
-            return 0.0
+        return self._parse_trongrid_balance(self.get_account_info(address))
     
     def _get_balance_from_transactions(self, address: str) -> float:
         """Альтернативный метод получения баланса через анализ транзакций"""
-        try:
-            # Получаем все транзакции USDT
-            url = f"{self.api_url}/v1/accounts/{address}/transactions/trc20"
-            params = {
-                'limit': 200,  # Получаем больше транзакций для точного расчета
-                'contract_address': config.USDT_CONTRACT_ADDRESS
-            }
-            
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                transactions = data.get('data', [])
-                
-                balance = 0.0
-                
-                for tx in transactions:
-                    # Проверяем, что это USDT транзакция
-                    if tx.get('token_info', {}).get('contract_address') == config.USDT_CONTRACT_ADDRESS:
-                        value = float(tx.get('value', 0)) / 1000000  # USDT имеет 6 знаков
-                        
-                        # Если это входящая транзакция
-                        if tx.get('to') == address:
-                            balance += value
-                        # Если это исходящая транзакция
-                        elif tx.get('from') == address:
-                            balance -= value
-                
-                return max(0.0, balance)  # Баланс не может быть отрицательным
-            else:
-                print(f"Ошибка получения транзакций для баланса: {response.status_code}")
-                return 0.0
+        # Получаем больше транзакций для точного расчета
+        transactions = self.get_trc20_transactions(address, limit=200)
+        
+        balance = 0.0
+        
+        for tx in transactions:
+            # Проверяем, что это USDT транзакция (TronGrid отдает контракт в token_info.address)
+            token_info = tx.get('token_info', {})
+            if (token_info.get('address') or token_info.get('contract_address')) == config.USDT_CONTRACT_ADDRESS:
+                value = float(tx.get('value', 0)) / 1000000  # USDT имеет 6 знаков
                 
-        except Exception as e:
-            print(f"Ошибка альтернативного получения баланса: {e}")
-            return 0.0
+                # Если это входящая транзакция
+                if tx.get('to') == address:
+                    balance += value
+                # Если это исходящая транзакция
+                elif tx.get('from') == address:
+                    balance -= value
+        
+        return max(0.0, balance)  # Баланс не может быть отрицательным
     
     def get_usdt_balance(self, address: str) -> float:
         """Получить баланс USDT для адреса (алиас для get_balance)"""
         return self.get_balance(address)
     
-    def get_new_transfers(self, address: str) -> List[Dict]:
-        """Получить новые TRC20 переводы для адреса"""
-        try:
-            # Получаем последние транзакции
-            transactions = self.get_trc20_transactions(address, limit=10)
-            new_transfers = []
-            
-            for tx in transactions:
-                # Проверяем, что это входящая транзакция
-                if tx.get('to') == address:
-                    transfer = {
-                        'tx_hash': tx.get('transaction_id', ''),
-                        'amount': float(tx.get('value', 0)) / 1000000,  # USDT имеет 6 знаков
-                        'currency': 'USDT',
-                        'from': tx.get('from', ''),
-                        'to': tx.get('to', ''),
-                        'timestamp': tx.get('block_timestamp', 0)
-                    }
-                    new_transfers.append(transfer)
-            
-            return new_transfers
-            
-        except Exception as e:
-            print(f"Ошибка получения новых переводов: {e}")
-            return []
-
+    def get_new_transfers(self, address: str, min_timestamp: Optional[int] = None,
+                          limit: int = 10, max_timestamp: Optional[int] = None) -> List[Dict]:
+        """
+        Получить новые TRC20 переводы для адреса (с курсора min_timestamp, мс)
+        
+        Запрашиваются только входящие: полная страница значит, что до
+        min_timestamp могут быть еще переводы (следующая - с max_timestamp).
+        """
+        # Получаем последние транзакции
+        transactions = self.get_trc20_transactions(address, limit=limit, min_timestamp=min_timestamp,
+                                                   max_timestamp=max_timestamp, only_to=True)
+        new_transfers = []
+        
+        for tx in transactions:
+            # Проверяем, что это входящая транзакция
+            if tx.get('to') == address:
+                transfer = {
+                    'tx_hash': tx.get('transaction_id', ''),
+                    'amount': float(tx.get('value', 0)) / 1000000,  # USDT имеет 6 знаков
+                    'currency': 'USDT',
+                    'from': tx.get('from', ''),
+                    'to': tx.get('to', ''),
+                    'timestamp': tx.get('block_timestamp', 0)
+                }
+                new_transfers.append(transfer)
+        
+        return new_transfers
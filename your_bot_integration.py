@@ -19,18 +19,21 @@ class YourBotWithPayments:
     Ваш бот с интегрированными платежами через API
     """
     
-    def __init__(self, bot_token: str, payment_api_url: str = "http://localhost:8000"):
+    def __init__(self, bot_token: str, payment_api_url: str = "http://localhost:8000", api_key: str = None):
         self.bot_token = bot_token
         self.payment_api_url = payment_api_url
+        self.api_key = api_key
         self.session = None
+        # Последний полученный seq события - продолжение после переподключения
+        self.last_event_seq = None
     
     async def start(self):
         """Запуск бота"""
         # Создаем HTTP сессию для API запросов
         self.session = aiohttp.ClientSession()
         
-        # Создаем приложение
-        self.application = Application.builder().token(self.bot_token).build()
+        # Создаем приложение; события платежей приходят по WebSocket вместо опроса статусов
+        self.application = Application.builder().token(self.bot_token).post_init(self.on_startup).build()
         
         # Добавляем обработчики команд
         self.application.add_handler(CommandHandler("start", self.start_command))
@@ -54,6 +57,57 @@ class YourBotWithPayments:
             await self.session.close()
         print("🛑 Бот остановлен!")
     
+    async def on_startup(self, application: Application):
+        """Подписка на события платежей после запуска бота"""
+        if self.api_key:
+            application.create_task(self.listen_payment_events())
+    
+    async def listen_payment_events(self):
+        """
+        Одно WebSocket соединение на все платежи вместо опроса статусов
+        
+        При обрыве (в том числе отключении за медленное чтение) соединение
+        восстанавливается с since=последний seq - события не теряются.
+        """
+        ws_url = self.payment_api_url.replace("http", "ws", 1) + "/ws/payments"
+        session = self.session or aiohttp.ClientSession()
+        delay = 1
+        while True:
+            params = {"api_key": self.api_key}
+            if self.last_event_seq is not None:
+                params["since"] = self.last_event_seq
+            try:
+                async with session.ws_connect(ws_url, params=params, heartbeat=30) as ws:
+                    delay = 1
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        event = message.json()
+                        self.last_event_seq = event["seq"]
+                        await self.on_payment_event(event)
+                    if ws.close_code == 1008:
+                        logger.error("WebSocket: неверный API ключ, подписка остановлена")
+                        return
+            except Exception as e:
+                logger.warning(f"WebSocket событий платежей недоступен: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    
+    async def on_payment_event(self, event: dict):
+        """Уведомление пользователя о событии платежа"""
+        data = event["data"]
+        messages = {
+            "payment.confirmed": f"✅ Платеж {data.get('amount')} {data.get('currency')} зачислен!",
+            "payment.expired": f"⏰ Срок оплаты {data.get('amount')} {data.get('currency')} истек",
+            "payment.reversed": f"⚠️ Платеж {data.get('amount')} {data.get('currency')} отменен сетью",
+        }
+        text = messages.get(event["type"])
+        if text and data.get("user_id"):
+            try:
+                await self.application.bot.send_message(chat_id=data["user_id"], text=text)
+            except Exception as e:
+                logger.error(f"Ошибка уведомления пользователя {data['user_id']}: {e}")
+    
     # API методы для работы с платежами
     async def create_payment(self, user_id: int, amount: float, description: str = None):
         """Создание платежа через API"""